@@ -0,0 +1 @@
+__author__ = 'anna'
\ No newline at end of file
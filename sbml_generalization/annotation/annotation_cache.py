@@ -0,0 +1,140 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where the concurrent saves are only merged, not serialized
+    fcntl = None
+
+__author__ = 'anna'
+
+DEFAULT_CACHE_SIZE = 100000
+
+# the cached entries used to be keyed by species names only
+CACHE_FORMAT_VERSION = 2
+
+
+def get_ontology_version(onto_path):
+    """
+    Calculates a version fingerprint of an ontology file, based on its name, size and modification time.
+    :param onto_path: str, path to the ontology file
+    :return: str, ontology version
+    """
+    stat = os.stat(onto_path)
+    return "%s:%d:%d" % (os.path.basename(onto_path), stat.st_size, int(stat.st_mtime))
+
+
+class AnnotationCache(object):
+    """
+    Persistent bounded mapping between species annotation keys (see species_annotator.get_annotation_key)
+    and the ChEBI term ids inferred for them (or None if no term could be inferred),
+    valid for a given ontology version.
+    """
+
+    def __init__(self, path, version, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.version = version
+        self.max_size = max_size
+        self.key2chebi_id = OrderedDict()
+        self.updated = False
+        # the keys put since the last save
+        self.put_keys = set()
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        for key, chebi_id in self._read():
+            self.key2chebi_id[key] = chebi_id
+        self._shrink()
+
+    def _read(self):
+        """
+        Reads the cached entries saved for this ontology version.
+        :return: list of pairs (key, chebi_id), from the least to the most recently used one
+        """
+        if not self.path or not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            logging.error("ignoring the corrupted annotation cache %s" % self.path)
+            return []
+        if data.get('format') != CACHE_FORMAT_VERSION:
+            logging.info("ignoring the annotation cache %s as it was saved in an older format" % self.path)
+            return []
+        if data.get('version') != self.version:
+            logging.info("ignoring the annotation cache %s as it was built for another ontology version" % self.path)
+            return []
+        return data.get('keys', [])
+
+    def save(self):
+        """
+        Saves the cache, merged with the entries saved by other processes sharing it since it was loaded:
+        the entries put since the last save are the most recent ones, followed by the saved ones,
+        and by the other entries of this cache (the least recent ones get dropped if the cache is full).
+        The file is locked while it is being re-read and replaced, so that concurrent saves do not lose entries.
+        """
+        with self.lock:
+            if not self.path or not self.updated:
+                return
+            with open(self.path + '.lock', 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    saved = OrderedDict(self._read())
+                    merged = OrderedDict((key, chebi_id) for (key, chebi_id) in self.key2chebi_id.items()
+                                         if key not in saved and key not in self.put_keys)
+                    merged.update(saved)
+                    for key in self.key2chebi_id:
+                        if key in self.put_keys:
+                            merged.pop(key, None)
+                            merged[key] = self.key2chebi_id[key]
+                    self.key2chebi_id = merged
+                    self._shrink()
+                    # a unique temporary file in the same directory, so that nobody reads a partially written file
+                    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                                    prefix=os.path.basename(self.path), suffix='.tmp')
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump({'format': CACHE_FORMAT_VERSION, 'version': self.version,
+                                   'keys': list(self.key2chebi_id.items())}, f)
+                    os.replace(tmp_path, self.path)
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self.updated = False
+            self.put_keys = set()
+
+    def get(self, key):
+        """
+        Looks for a key in the cache.
+        :param key: str, species annotation key
+        :return: tuple (found, chebi_id): whether the key is cached, ChEBI term id (or None) cached for it
+        """
+        with self.lock:
+            if key not in self.key2chebi_id:
+                return False, None
+            chebi_id = self.key2chebi_id.pop(key)
+            self.key2chebi_id[key] = chebi_id
+            return True, chebi_id
+
+    def put(self, key, chebi_id):
+        with self.lock:
+            self.key2chebi_id.pop(key, None)
+            self.key2chebi_id[key] = chebi_id
+            self.put_keys.add(key)
+            self._shrink()
+            self.updated = True
+
+    def _shrink(self):
+        while len(self.key2chebi_id) > self.max_size:
+            self.key2chebi_id.popitem(last=False)
+
+    def __len__(self):
+        return len(self.key2chebi_id)
+
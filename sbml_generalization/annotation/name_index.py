@@ -0,0 +1,166 @@
+from bisect import bisect_left
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from natsort import natsorted
+
+from sbml_generalization.sbml.sbml_helper import normalize
+
+__author__ = 'anna'
+
+MIN_PREFIX_LEN = 5
+
+
+class NameIndex(object):
+    """
+    Index of ontology term names and synonyms normalized with sbml_helper.normalize:
+    a hash index {normalized_name: term_ids} plus a sorted list of normalized names for prefix matches.
+    Term ids of each name are stored in the order in which the ontology resolves them.
+    If match_prefixes is set, the species whose names have no exact match are annotated with the only term
+    (if there is exactly one) whose name starts with theirs (see species_annotator.infer_chebi_term_by_index).
+    """
+
+    def __init__(self, name2t_ids, version=None, match_prefixes=False):
+        self.name2t_ids = name2t_ids
+        self.version = version
+        self.names = sorted(name2t_ids.keys())
+        self.match_prefixes = match_prefixes
+        self.fingerprint = None
+
+    @staticmethod
+    def from_ontology(onto, version=None):
+        """
+        Builds an index for the given ontology.
+        :param onto: mod_sbml.onto.obo_ontology.Ontology ontology
+        :param version: (optional) str, version of the ontology
+        :return: NameIndex
+        """
+        name2t_ids = {}
+        for term in onto.get_all_terms():
+            for name in term.get_synonyms() | {term.get_name()}:
+                name = normalize(name) if name else None
+                if name:
+                    name2t_ids.setdefault(name, set()).add(term.get_id())
+        return NameIndex({name: natsorted(t_ids, key=lambda t_id: t_id.lower())
+                          for (name, t_ids) in name2t_ids.items()}, version)
+
+    @staticmethod
+    def load(path, version=None):
+        """
+        Loads an index saved with NameIndex.save.
+        :param path: str, path to the index file
+        :param version: (optional) str, expected version of the ontology
+        :return: NameIndex, or None if the file does not exist or was built for another ontology version
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            names = data['names']
+        except (ValueError, KeyError, TypeError):
+            logging.error("ignoring the corrupted name index %s" % path)
+            return None
+        if version and data.get('version') != version:
+            logging.info("ignoring the name index %s as it was built for another ontology version" % path)
+            return None
+        return NameIndex(names, data.get('version'))
+
+    def save(self, path):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path),
+                                        suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': self.version, 'names': self.name2t_ids}, f, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def get_fingerprint(self):
+        """
+        Calculates (once) a fingerprint of the index content, which tells different indices
+        (and the prefix matching setting) apart.
+        :return: str, hexadecimal hash
+        """
+        if self.fingerprint is None:
+            self.fingerprint = hashlib.sha256(json.dumps(self.name2t_ids, sort_keys=True).encode('utf-8')).hexdigest()
+        return self.fingerprint + ':prefixes' if self.match_prefixes else self.fingerprint
+
+    def get_term_ids(self, name):
+        """
+        Finds ids of the terms whose name or synonym matches the given name.
+        :param name: str, name of interest (will be normalized)
+        :return: list of term ids
+        """
+        return self.name2t_ids.get(normalize(name), []) if name else []
+
+    def get_term_ids_by_prefix(self, prefix):
+        """
+        Finds ids of the terms whose normalized name or synonym starts with the given prefix.
+        :param prefix: str, prefix of interest (will be normalized)
+        :return: set of term ids
+        """
+        prefix = normalize(prefix) if prefix else None
+        if not prefix or len(prefix) < MIN_PREFIX_LEN:
+            return set()
+        result = set()
+        i = bisect_left(self.names, prefix)
+        while i < len(self.names) and self.names[i].startswith(prefix):
+            result |= set(self.name2t_ids[self.names[i]])
+            i += 1
+        return result
+
+    def __len__(self):
+        return len(self.name2t_ids)
+
+
+class IndexedOntology(object):
+    """
+    Ontology view whose term lookups by name go through a name index, so that it can be passed
+    to the functions looking terms up with get_term (e.g. mod_sbml's infer_chebi_term).
+    """
+
+    def __init__(self, onto, name_index):
+        self.onto = onto
+        self.name_index = name_index
+
+    def get_term(self, key, check_only_ids=True):
+        """
+        Looks for a term corresponding to the given key (see mod_sbml.onto.obo_ontology.Ontology.get_term):
+        among the term ids and alternative ids, then (unless check_only_ids) among the xrefs,
+        then in the name index.
+        """
+        term = self.onto.get_term(key)
+        if term or check_only_ids or not key:
+            return term
+        xref = key.lower().strip()
+        if xref in self.onto.xref2term_ids:
+            term = next((t for t in (self.onto.get_term(t_id) for t_id
+                                     in natsorted(self.onto.xref2term_ids[xref], key=lambda t_id: t_id.lower())) if t),
+                        None)
+            if term:
+                return term
+        term = next((t for t in (self.onto.get_term(t_id) for t_id in self.name_index.get_term_ids(key)) if t), None)
+        return term if term else self.onto.get_term(key, check_only_ids=False)
+
+
+def get_name_index(onto, path, version=None, match_prefixes=False):
+    """
+    Loads the name index stored alongside the ontology or, if it is missing or outdated, builds and stores it.
+    :param onto: mod_sbml.onto.obo_ontology.Ontology ontology (must not be filtered yet)
+    :param path: str, path to the index file
+    :param version: (optional) str, version of the ontology
+    :param match_prefixes: boolean, whether the index should also be used for name prefix matches
+    (see NameIndex)
+    :return: NameIndex
+    """
+    index = NameIndex.load(path, version)
+    if index is None:
+        logging.info("indexing ontology term names")
+        index = NameIndex.from_ontology(onto, version)
+        try:
+            index.save(path)
+        except (IOError, OSError) as e:
+            logging.error("could not save the name index to %s: %s" % (path, e))
+    index.match_prefixes = match_prefixes
+    return index
@@ -0,0 +1,133 @@
+from itertools import chain
+import json
+import logging
+
+import libsbml
+
+from mod_sbml.annotation.chebi.chebi_annotator import get_chebi_id, infer_chebi_term, annotate_metabolites, \
+    CHEBI_PREFIX
+from mod_sbml.annotation.rdf_annotation_helper import add_annotation, get_is_annotations, get_is_vo_annotations
+from mod_sbml.sbml.sbml_manager import get_formulas
+from sbml_generalization.annotation.name_index import IndexedOntology
+
+__author__ = 'anna'
+
+
+def get_species_names(m, model=None):
+    """
+    Lists the names under which a metabolite can be looked up in ChEBI:
+    its species type's name, its own name and its name without the compartment.
+    :param m: libsbml.Species metabolite of interest
+    :param model: (optional) libsbml.Model model containing the metabolite
+    :return: list of names
+    """
+    names = []
+    s_type = model.getSpeciesType(m.getSpeciesType()) if model and m.getSpeciesType() else None
+    if s_type:
+        names.append(s_type.getName())
+    name = m.getName()
+    names.append(name)
+    if name and model:
+        c = model.getCompartment(m.getCompartment())
+        if c:
+            c_name = c.getName() if c.getName() else c.getId()
+            names.append(name.replace('[%s]' % c_name, '').replace(c_name, '').strip())
+    return [it for it in names if it]
+
+
+def get_annotation_key(m, model=None, name_index=None):
+    """
+    Gets the annotation cache key of a metabolite: all the inputs its ChEBI term inference depends on
+    (its annotations, its species type's annotations and name, its formulas, its name and compartment name),
+    and whether the inference uses a name index (and its prefix matches), so that the cached term is only reused
+    for metabolites that would be inferred the same term.
+    :param m: libsbml.Species metabolite of interest
+    :param model: (optional) libsbml.Model model containing the metabolite
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex index of ChEBI term names
+    :return: str, the key
+    """
+    s_type = model.getSpeciesType(m.getSpeciesType()) if model and m.getSpeciesType() else None
+    c = model.getCompartment(m.getCompartment()) if model else None
+    if name_index is None:
+        lookup = 'ontology'
+    else:
+        lookup = 'index with prefixes' if name_index.match_prefixes else 'index'
+    key = [lookup,
+           sorted(chain(get_is_annotations(m), get_is_vo_annotations(m))),
+           sorted(chain(get_is_annotations(s_type), get_is_vo_annotations(s_type))) if s_type else [],
+           s_type.getName() if s_type else '', sorted(get_formulas(m)), m.getName(),
+           (c.getName() if c.getName() else c.getId()) if c else '']
+    return json.dumps(key)
+
+
+def infer_chebi_term_by_index(m, chebi, name_index, model=None, match_prefixes=False):
+    """
+    Infers a ChEBI term for a metabolite (see mod_sbml's infer_chebi_term),
+    looking its names up in the name index.
+    :param m: libsbml.Species metabolite of interest
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param name_index: sbml_generalization.annotation.name_index.NameIndex index of ChEBI term names
+    :param model: (optional) libsbml.Model model containing the metabolite
+    :param match_prefixes: whether to accept a term whose name starts with the metabolite name
+    if it is the only such term and no exact match was found
+    :return: mod_sbml.onto.term.Term ChEBI term or None if none was found
+    """
+    term = infer_chebi_term(m, IndexedOntology(chebi, name_index), model)
+    if term or not match_prefixes:
+        return term
+    for name in get_species_names(m, model):
+        terms = {t for t in (chebi.get_term(t_id) for t_id in name_index.get_term_ids_by_prefix(name)) if t}
+        if len(terms) == 1:
+            return terms.pop()
+    return None
+
+
+def annotate_species(model, chebi, annotation_cache=None, name_index=None):
+    """
+    Infers ChEBI terms for metabolites that lack them and annotates,
+    reusing the inference results stored in the annotation cache (if given, see get_annotation_key)
+    and looking the names up in the name index (if given).
+    :param model: libsbml.Model model of interest
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex index of ChEBI term names
+    :return: void, input model is modified inplace
+    """
+    if annotation_cache is None and name_index is None:
+        annotate_metabolites(model, chebi)
+        return
+    hits, misses = 0, 0
+    for s in model.getListOfSpecies():
+        if get_chebi_id(s):
+            continue
+        key = get_annotation_key(s, model, name_index) if annotation_cache is not None else None
+        found, chebi_id = annotation_cache.get(key) if key else (False, None)
+        if found:
+            hits += 1
+            term = chebi.get_term(chebi_id) if chebi_id else None
+        else:
+            misses += 1
+            if name_index is not None:
+                term = infer_chebi_term_by_index(s, chebi, name_index, model, name_index.match_prefixes)
+            else:
+                term = infer_chebi_term(s, chebi, model)
+            if key:
+                annotation_cache.put(key, term.get_id() if term else None)
+        if term:
+            add_annotation(s, libsbml.BQB_IS, term.get_id(), CHEBI_PREFIX)
+    if annotation_cache is not None:
+        logging.info("annotation cache: %d hits, %d misses" % (hits, misses))
+        annotation_cache.save()
+
+
+def add_chebi_annotations(model, s_id2chebi_id):
+    """
+    Annotates the metabolites that lack ChEBI terms with the given ones,
+    the same way annotate_species does with the inferred ones (e.g. to replay a cached annotation).
+    :param model: libsbml.Model model of interest
+    :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
+    :return: void, input model is modified inplace
+    """
+    for s in model.getListOfSpecies():
+        if not get_chebi_id(s) and s.getId() in s_id2chebi_id:
+            add_annotation(s, libsbml.BQB_IS, s_id2chebi_id[s.getId()], CHEBI_PREFIX)
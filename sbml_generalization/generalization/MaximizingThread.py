@@ -2,7 +2,9 @@ from collections import defaultdict
 from itertools import chain
 import threading
 
+from sbml_generalization.generalization.metrics import METRICS
 from sbml_generalization.generalization.vertical_key import is_reactant
+from sbml_generalization.generalization.progress import PHASE_METABOLITE_DIVERSITY
 
 __author__ = 'anna'
 
@@ -25,7 +27,7 @@ def merge_based_on_neighbours(lst):
 
 class MaximizingThread(threading.Thread):
     def __init__(self, model, term_ids, species_id2term_id, clu, term_id2clu, s_id2clu,
-                 ubiquitous_chebi_ids, r_id2clu, r_ids_to_ignore=None):
+                 ubiquitous_chebi_ids, r_id2clu, r_ids_to_ignore=None, monitor=None, budget=None, where=None):
         threading.Thread.__init__(self)
         self.model = model
         self.term_ids = term_ids
@@ -36,12 +38,37 @@ class MaximizingThread(threading.Thread):
         self.ubiquitous_chebi_ids = ubiquitous_chebi_ids
         self.r_id2clu = r_id2clu
         self.r_ids_to_ignore = r_ids_to_ignore
+        self.monitor = monitor
+        self.budget = budget
+        self.where = where
+        # the metrics registry of the generalization the thread works for
+        self.metrics = monitor.metrics if monitor else METRICS.get_registry()
+
+    def is_cancelled(self):
+        return self.monitor is not None and self.monitor.is_cancelled()
+
+    def is_budget_exhausted(self):
+        # an unfinished cluster is left as it is
+        if self.budget and self.budget.is_exhausted():
+            self.budget.truncate(PHASE_METABOLITE_DIVERSITY, '%s, cluster %s' % (self.where, self.clu)
+                                 if self.where else 'cluster %s' % (self.clu, ))
+            return True
+        return False
 
     def run(self):
+        with METRICS.bind(self.metrics):
+            self.split_cluster()
+
+    def split_cluster(self):
+        if self.is_cancelled():
+            return
         neighbours2term_ids = defaultdict(set)
         neighbourless_terms = set()
         t_id2rs = defaultdict(list)
         for r in (r for r in self.model.getListOfReactions() if r.getNumReactants() + r.getNumProducts() > 2):
+            # the caller (model_generalizer.maximize) raises GeneralizationCancelled once the threads are joined
+            if self.is_cancelled() or self.is_budget_exhausted():
+                return
             if self.r_ids_to_ignore and r.getId() in self.r_ids_to_ignore:
                 continue
             for s_id in chain((species_ref.getSpecies() for species_ref in r.getListOfReactants()),
@@ -51,6 +78,8 @@ class MaximizingThread(threading.Thread):
                 else:
                     t_id2rs[s_id].append(r)
         for t_id in self.term_ids:
+            if self.is_cancelled() or self.is_budget_exhausted():
+                return
             neighbours = {
                 ("in"
                  if is_reactant(self.model, t_id, r, self.s_id2clu, self.species_id2term_id, self.ubiquitous_chebi_ids)
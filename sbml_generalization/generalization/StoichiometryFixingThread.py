@@ -1,16 +1,23 @@
 from collections import defaultdict, Counter
 from functools import reduce
 from itertools import chain
+import logging
 import threading
 
-from sbml_generalization.generalization.vertical_key import get_vk2r_ids, vertical_key2simplified_vertical_key, get_vertical_key, get_r_compartments
+from sbml_generalization.generalization.progress import PHASE_STOICHIOMETRY
+from sbml_generalization.generalization.metrics import METRICS, SPECIES_LOOKUPS, GREEDY_ITERATIONS, PSI_SIZE, \
+    PRUNED_PSI_SIZE, CONFLICTS
+from sbml_generalization.generalization.vertical_key import get_vertical_key
 from mod_sbml.utils.misc import invert_map
-from mod_sbml.sbml.sbml_manager import get_metabolites
+from mod_sbml.sbml.sbml_manager import get_reactants, get_products
 
 __author__ = 'anna'
 
 st_fix_lock = threading.RLock()
 
+# candidate sets with more conflicts than that are not considered
+MAX_CONFLICT_NUM = 40
+
 
 def compute_s_id2clu(unmapped_s_ids, model, species_id2term_id, term_id2clu):
     """
@@ -22,6 +29,7 @@ def compute_s_id2clu(unmapped_s_ids, model, species_id2term_id, term_id2clu):
     :return: dict {metabolite_id: (compartment_id, cluster)}
     """
     s_id2clu = {}
+    METRICS.inc(SPECIES_LOOKUPS, len(species_id2term_id))
     for s_id, t_id in species_id2term_id.items():
         if t_id in term_id2clu:
             s_id2clu[s_id] = (model.getSpecies(s_id).getCompartment(), term_id2clu[t_id])
@@ -29,6 +37,7 @@ def compute_s_id2clu(unmapped_s_ids, model, species_id2term_id, term_id2clu):
             s_id2clu[s_id] = (model.getSpecies(s_id).getCompartment(), (t_id, ))
     for s_id in unmapped_s_ids:
         if s_id in term_id2clu:
+            METRICS.inc(SPECIES_LOOKUPS)
             s_id2clu[s_id] = (model.getSpecies(s_id).getCompartment(), term_id2clu[s_id])
     return s_id2clu
 
@@ -52,7 +61,8 @@ def get_most_problematic_term(t_set, conflicts):
         common = t_set & c_ts
         if len(common) > 1:
             result.update({t: 1 for t in common})
-    return max(result.keys(), key=lambda t: result[t])
+    # the ties are broken by the term ids, not by the (hash-dependent) order of the sets
+    return max(result.keys(), key=lambda t: (result[t], t))
 
 
 def get_conflict_num(t_set, conflicts):
@@ -64,194 +74,283 @@ def get_conflict_num(t_set, conflicts):
     return res
 
 
-def suggest_clusters(model, unmapped_s_ids, term_id2clu, s_id2term_id, ubiquitous_chebi_ids, r_ids_to_ignore=None):
-    # TODO: double check it
-    return
-    if not unmapped_s_ids:
-        return
-    s_id2clu = compute_s_id2clu(set(), model, s_id2term_id, term_id2clu)
-    term_id2s_ids = invert_map(s_id2term_id)
-    vk2r_ids = get_vk2r_ids(model, s_id2clu, s_id2term_id, ubiquitous_chebi_ids, r_ids_to_ignore=r_ids_to_ignore)
-    vk2r_ids = {vk: r_ids for (vk, r_ids) in vk2r_ids.items() if len(r_ids) > 1}
-    processed_r_ids = reduce(lambda s1, s2: s1 | s2, vk2r_ids.values(), set())
-
-    s_vk2vk = defaultdict(set)
-    for vk in vk2r_ids.keys():
-        s_vk2vk[vertical_key2simplified_vertical_key(vk)].add(vk)
-
-    s_id2r_ids = defaultdict(list)
-    for r in (r for r in model.getListOfReactions() if r.getNumReactants() + r.getNumProducts() > 2):
-        if r_ids_to_ignore and r.getId() in r_ids_to_ignore:
-            continue
-        r_id = r.getId()
-        for s_id in chain((species_ref.getSpecies() for species_ref in r.getListOfReactants()),
-                          (species_ref.getSpecies() for species_ref in r.getListOfProducts())):
-            s_id2r_ids[s_id].append(r_id)
+def colour_conflict_graph(t_ids, conflicts):
+    """
+    Splits terms into groups that contain at most one term of each conflict,
+    by greedily colouring the graph whose edges connect the terms participating in the same conflict
+    (the terms with the most neighbours are coloured first, each with the first colour unused by its neighbours).
+    :param t_ids: collection of term ids
+    :param conflicts: list of sets of term ids that cannot be grouped together
+    :return: list of sets of term ids
+    """
+    t_id2neighbours = {t_id: set() for t_id in t_ids}
+    for c_ts in conflicts:
+        c_ts = [t_id for t_id in c_ts if t_id in t_id2neighbours]
+        for t_id in c_ts:
+            t_id2neighbours[t_id].update(c_ts)
+    for t_id, neighbours in t_id2neighbours.items():
+        neighbours.discard(t_id)
+    t_id2colour = {}
+    groups = []
+    for t_id in sorted(t_id2neighbours.keys(), key=lambda t: (-len(t_id2neighbours[t]), t)):
+        used = {t_id2colour[n] for n in t_id2neighbours[t_id] if n in t_id2colour}
+        colour = next((c for c in range(len(groups)) if c not in used), len(groups))
+        if colour == len(groups):
+            groups.append(set())
+        groups[colour].add(t_id)
+        t_id2colour[t_id] = colour
+    return groups
+
+
+class TermReactionIndex(object):
+    """
+    Indexes the reactions of a model by the terms (or unmapped metabolite ids) participating in them,
+    so that the cluster inference only looks at the reactions concerned.
+    """
 
-    for r in model.getListOfReactions():
-        if r.getId() in processed_r_ids or not unmapped_s_ids & get_metabolites(r):
-            continue
-        if r_ids_to_ignore and r.getId() in r_ids_to_ignore:
-            continue
-        ub_rs, ub_ps, rs, ps = get_vertical_key(model, r, s_id2clu, s_id2term_id, ubiquitous_chebi_ids)
-        vk = ub_rs, ub_ps, rs, ps
-        rs, ps = set(rs), set(ps)
-        partial_rs, partial_ps = {(s_id, c_id) for (s_id, c_id) in rs if s_id not in unmapped_s_ids}, \
-                                 {(s_id, c_id) for (s_id, c_id) in ps if s_id not in unmapped_s_ids}
-        if vk in vk2r_ids or len(ub_rs) + len(ub_ps) + len(partial_rs) + len(partial_ps) < 2:
-            continue
-        s_vk = vertical_key2simplified_vertical_key(vk)
-        if s_vk in s_vk2vk:
-            ub_rs, ub_ps = tuple(sorted(ub_rs)), tuple(sorted(ub_ps))
-            for (vk_ub_rs, vk_ub_ps, vk_rs, vk_ps) in s_vk2vk[s_vk]:
-                vk_rs, vk_ps = {(s_id if s_id not in s_id2clu else s_id2clu[s_id], c_id) for (s_id, c_id) in vk_rs}, \
-                               {(s_id if s_id not in s_id2clu else s_id2clu[s_id], c_id) for (s_id, c_id) in vk_ps}
-                proposal = {}
-                if vk_ub_rs == ub_ps and vk_ub_ps == ub_rs and not partial_rs - vk_ps and not partial_ps - vk_rs:
-                    vk_ub_rs, vk_ub_ps, partial_rs, partial_ps = vk_ub_ps, vk_ub_rs, partial_ps, partial_rs
-                if vk_ub_rs == ub_rs and vk_ub_ps == ub_ps and not partial_rs - vk_rs and not partial_ps - vk_ps:
-                    r_s_ids = rs - vk_rs
-                    p_s_ids = ps - vk_ps
-                    if 0 < len(r_s_ids) <= 1 and 0 < len(p_s_ids) <= 1 and r_s_ids or p_s_ids:
-                        if r_s_ids and vk_rs - rs:
-                            s_id, c_id = r_s_ids.pop()
-                            clu, c_id = (vk_rs - rs).pop()
-                            # if it is a species id instead of a cluster, continue
-                            if not isinstance(clu, tuple):
-                                continue
-                            # if it is not a species id but a cluster, continue
-                            if not isinstance(s_id, str):
-                                continue
-                            candidate_sps = {model.getSpecies(sp_id) for sp_id in
-                                             (term_id2s_ids[s_id2term_id[s_id]] if s_id in s_id2term_id else [s_id])}
-                            comp, term = clu
-                            for s in candidate_sps:
-                                proposal[s.getId()] = term
-                        if p_s_ids and vk_ps - ps:
-                            s_id, c_id = p_s_ids.pop()
-                            clu, c_id = (vk_ps - ps).pop()
-                            # if it is a species id instead of a cluster, continue
-                            if not isinstance(clu, tuple):
-                                continue
-                            # if it is not a species id but a cluster, continue
-                            if not isinstance(s_id, str):
-                                continue
-                            candidate_sps = {model.getSpecies(it) for it in
-                                             (term_id2s_ids[s_id2term_id[s_id]] if s_id in s_id2term_id else {s_id})}
-                            comp, term = clu
-                            for s in candidate_sps:
-                                proposal[s.getId()] = term
-                if proposal:
-                    for s_id, clu in proposal.items():
-                        term_id2clu[s_id] = (clu, ) if not (isinstance(clu, tuple)) else clu
-                        unmapped_s_ids -= {s_id}
-
-
-def infer_clusters(model, unmapped_s_ids, s_id2clu, s_id2term_id, ubiquitous_chebi_ids, r_ids_to_ignore=None):
-    # TODO: double check it
-    return
-    if not unmapped_s_ids:
-        return
-    term_id2s_ids = invert_map(s_id2term_id)
-    clu2s_ids = invert_map(s_id2clu)
-    vk2r_ids = get_vk2r_ids(model, s_id2clu, s_id2term_id, ubiquitous_chebi_ids, r_ids_to_ignore=r_ids_to_ignore)
-    vk2r_ids = {vk: r_ids for (vk, r_ids) in vk2r_ids.items() if len(r_ids) > 1}
-
-    simplified_vk2vk_set = defaultdict(set)
-    for vk in vk2r_ids.keys():
-        simplified_vk2vk_set[vertical_key2simplified_vertical_key(vk)].add(vk)
-
-    s_id2r_ids = defaultdict(list)
-    for r in (r for r in model.getListOfReactions() if r.getNumReactants() + r.getNumProducts() > 2):
-        if r_ids_to_ignore and r.getId() in r_ids_to_ignore:
-            continue
-        r_id = r.getId()
-        for s_id in chain((species_ref.getSpecies() for species_ref in r.getListOfReactants()),
-                          (species_ref.getSpecies() for species_ref in r.getListOfProducts())):
-            s_id2r_ids[s_id].append(r_id)
-
-    def in_species_conflict(term, candidate_sps, proposal_s_id2clu):
-        proposal_clu2s_ids = invert_map(proposal_s_id2clu)
-        for s in candidate_sps:
-            s_clu = s.getCompartment(), term
-            rs = {r_id for r_id in s_id2r_ids[s.getId()]}
-            clu_s_ids = clu2s_ids[s_clu] | proposal_clu2s_ids[s_clu]
-            for clu_s_id in clu_s_ids:
-                if {r_id for r_id in s_id2r_ids[clu_s_id]} & rs:
-                    return True
-        return False
+    def __init__(self, model, s_id2term_id, r_ids_to_ignore=None):
+        """
+        :param model: libsbml.Model model of interest
+        :param s_id2term_id: dict {metabolite_id: ChEBI_term_id}
+        :param r_ids_to_ignore: (optional) ids of reactions whose stoichiometry preserving constraint can be ignored
+        """
+        self.model = model
+        self.r_id2r = {}
+        self.t_id2r_ids = defaultdict(set)
+        self.t_id2s_ids = defaultdict(set)
+        for s in model.getListOfSpecies():
+            s_id = s.getId()
+            self.t_id2s_ids[s_id2term_id[s_id] if s_id in s_id2term_id else s_id].add(s_id)
+        for r in model.getListOfReactions():
+            r_id = r.getId()
+            if r_ids_to_ignore and r_id in r_ids_to_ignore:
+                continue
+            self.r_id2r[r_id] = r
+            for s_id in chain(get_reactants(r), get_products(r)):
+                self.t_id2r_ids[s_id2term_id[s_id] if s_id in s_id2term_id else s_id].add(r_id)
+
+    def get_r_ids(self, t_ids):
+        """
+        :param t_ids: collection of term ids (or unmapped metabolite ids)
+        :return: sorted list of ids of the reactions the given terms participate in
+        """
+        return sorted(set(chain(*(self.t_id2r_ids[t_id] for t_id in t_ids if t_id in self.t_id2r_ids))))
+
+    def get_compartment(self, s_id):
+        """
+        Looks a metabolite up in the model.
+        :param s_id: metabolite id
+        :return: id of the metabolite's compartment
+        """
+        METRICS.inc(SPECIES_LOOKUPS)
+        return self.model.getSpecies(s_id).getCompartment()
+
+
+def get_key_holes(vk, clus):
+    """
+    Lists the ways to obtain a (partial) reaction key from a given one by removing at most one cluster
+    from the specific reactant classes and at most one from the specific product classes.
+    :param vk: tuple (ubiquitous_reactants, ubiquitous_products,
+    specific_reactant_classes, specific_product_classes) -- reaction key
+    :param clus: collection of clusters that can be removed
+    :return: iterator of tuples (partial_key, (removed_reactant_class, removed_product_class)),
+    where the removed classes are tuples (cluster, compartment_id) or None
+    """
+    u_rs, u_ps, rs, ps = vk
+    r_options = [(rs, None)] + [(rs[:i] + rs[i + 1:], rs[i]) for i in range(len(rs)) if rs[i][0] in clus]
+    p_options = [(ps, None)] + [(ps[:i] + ps[i + 1:], ps[i]) for i in range(len(ps)) if ps[i][0] in clus]
+    for r_rest, r_hole in r_options:
+        for p_rest, p_hole in p_options:
+            if r_hole or p_hole:
+                yield (u_rs, u_ps, r_rest, p_rest, r_hole is not None, p_hole is not None), (r_hole, p_hole)
 
-    processed_r_ids = reduce(lambda s1, s2: s1 | s2, vk2r_ids.values(), set())
 
-    for r in model.getListOfReactions():
-        if r.getId() in processed_r_ids or not unmapped_s_ids & get_metabolites(r):
-            continue
-        if r_ids_to_ignore and r.getId() in r_ids_to_ignore:
-            continue
-        ub_rs, ub_ps, rs, ps = get_vertical_key(model, r, s_id2clu, s_id2term_id, ubiquitous_chebi_ids)
-        vk = ub_rs, ub_ps, rs, ps
-        rs, ps = set(rs), set(ps)
-        partial_rs, partial_ps = {(s_id, c_id) for (s_id, c_id) in rs if s_id not in unmapped_s_ids}, \
-                                 {(s_id, c_id) for (s_id, c_id) in ps if s_id not in unmapped_s_ids}
-        if len(ub_rs) + len(ub_ps) + len(partial_rs) + len(partial_ps) < 2:
+def infer_term_clusters(model, unmapped_t_ids, clu2t_ids, s_id2clu, s_id2term_id, ubiquitous_chebi_ids,
+                        reaction_index):
+    """
+    Puts unmapped terms (or metabolite ids) into existing clusters, when this makes a reaction they participate in
+    equivalent to (at least two) other reactions, i.e. when an unmapped term plays the role of the cluster's terms.
+    The terms are not added to clusters containing the terms they react with (stoichiometry preserving restriction).
+    :param model: libsbml.Model model of interest
+    :param unmapped_t_ids: collection of ids of terms (or metabolites) that do not belong to any cluster
+    :param clu2t_ids: dict {cluster: set of term ids}, the clusters the terms can be put into, is updated inplace
+    :param s_id2clu: dict {metabolite_id: (compartment_id, cluster)}, is updated inplace
+    :param s_id2term_id: dict {metabolite_id: ChEBI_term_id}
+    :param ubiquitous_chebi_ids: set of ubiquitous ChEBI_ids
+    :param reaction_index: TermReactionIndex
+    :return: dict {term_id: cluster} for the terms that were put into clusters
+    """
+    t_id2r_ids, r_id2r = reaction_index.t_id2r_ids, reaction_index.r_id2r
+    unmapped_t_ids = {t_id for t_id in unmapped_t_ids if t_id in t_id2r_ids}
+    if not unmapped_t_ids or not clu2t_ids:
+        return {}
+    get_vk = lambda r_id: get_vertical_key(model, r_id2r[r_id], s_id2clu, s_id2term_id, ubiquitous_chebi_ids)
+
+    # the keys of the reactions of the clusters' terms, with a hole in place of a cluster
+    vk2r_ids = defaultdict(set)
+    for r_id in reaction_index.get_r_ids(chain(*clu2t_ids.values())):
+        vk2r_ids[get_vk(r_id)].add(r_id)
+    hole2classes = defaultdict(list)
+    for vk, r_ids in vk2r_ids.items():
+        if len(r_ids) > 1:
+            for hole, classes in get_key_holes(vk, clu2t_ids):
+                hole2classes[hole].append(classes)
+    if not hole2classes:
+        return {}
+
+    candidate_r_ids = reaction_index.get_r_ids(unmapped_t_ids)
+    for r_id in candidate_r_ids:
+        vk2r_ids[get_vk(r_id)].add(r_id)
+    grouped_r_ids = set(chain(*(r_ids for r_ids in vk2r_ids.values() if len(r_ids) > 1)))
+
+    clu2r_ids = {}
+
+    def in_species_conflict(t_id, clu):
+        if clu not in clu2r_ids:
+            clu2r_ids[clu] = set(chain(*(t_id2r_ids[it] for it in clu2t_ids[clu] if it in t_id2r_ids)))
+        return not clu2r_ids[clu].isdisjoint(t_id2r_ids[t_id])
+
+    def split(classes):
+        unmapped = [(t_ids[0], c_id) for (t_ids, c_id) in classes if len(t_ids) == 1 and t_ids[0] in unmapped_t_ids]
+        if len(unmapped) != 1:
+            return classes, None, len(unmapped)
+        t_id, c_id = unmapped[0]
+        rest = list(classes)
+        rest.remove(((t_id, ), c_id))
+        return tuple(rest), unmapped[0], 1
+
+    def match(unmapped_holes):
+        t_id2clu = {}
+        for unmapped, hole in unmapped_holes:
+            if not unmapped:
+                continue
+            (t_id, c_id), (clu, hole_c_id) = unmapped, hole
+            # the unknown needs to be in the same compartment as the cluster it replaces
+            if c_id != hole_c_id or t_id2clu.setdefault(t_id, clu) != clu:
+                return None
+        return t_id2clu
+
+    def update_s_id2clu(t_ids, t_id2clu):
+        for t_id in t_ids:
+            for s_id in reaction_index.t_id2s_ids[t_id]:
+                if t_id in t_id2clu:
+                    s_id2clu[s_id] = reaction_index.get_compartment(s_id), t_id2clu[t_id]
+                else:
+                    s_id2clu.pop(s_id, None)
+
+    result = {}
+    for r_id in candidate_r_ids:
+        if r_id in grouped_r_ids:
             continue
-        simplified_vk = vertical_key2simplified_vertical_key(vk)
-        if simplified_vk in simplified_vk2vk_set:
-            ub_rs, ub_ps = tuple(sorted(ub_rs)), tuple(sorted(ub_ps))
-            for (vk_ub_rs, vk_ub_ps, vk_rs, vk_ps) in simplified_vk2vk_set[simplified_vk]:
-                vk_rs, vk_ps = {(s_id if s_id not in s_id2clu else s_id2clu[s_id], c_id) for (s_id, c_id) in vk_rs}, \
-                               {(s_id if s_id not in s_id2clu else s_id2clu[s_id], c_id) for (s_id, c_id) in vk_ps}
-                proposal = {}
-                if vk_ub_rs == ub_ps and vk_ub_ps == ub_rs and not partial_rs - vk_ps and not partial_ps - vk_rs:
-                    vk_ub_rs, vk_ub_ps, partial_rs, partial_ps = vk_ub_ps, vk_ub_rs, partial_ps, partial_rs
-                if vk_ub_rs == ub_rs and vk_ub_ps == ub_ps and not partial_rs - vk_rs and not partial_ps - vk_ps:
-                    r_s_ids = rs - vk_rs
-                    p_s_ids = ps - vk_ps
-                    if 0 < len(r_s_ids) <= 1 and 0 < len(p_s_ids) <= 1 and r_s_ids or p_s_ids:
-                        if r_s_ids and vk_rs - rs:
-                            s_id, c_id = r_s_ids.pop()
-                            # if it is not a species id but a cluster, continue
-                            if not isinstance(s_id, str):
-                                continue
-                            clu, c_id = (vk_rs - rs).pop()
-                            # if it is a species id instead of a cluster, continue
-                            if not isinstance(clu, tuple):
-                                continue
-                            candidate_sps = {model.getSpecies(it) for it in
-                                             (term_id2s_ids[s_id2term_id[s_id]] if s_id in s_id2term_id else {s_id})}
-                            comp, term = clu
-                            if not in_species_conflict(term, candidate_sps, proposal):
-                                for s in candidate_sps:
-                                    proposal[s.getId()] = s.getCompartment(), term
-                            else:
-                                continue
-                        if p_s_ids and vk_ps - ps:
-                            s_id, c_id = p_s_ids.pop()
-                            # if it is not a species id but a cluster, continue
-                            if not isinstance(s_id, str):
-                                continue
-                            clu, c_id = (vk_ps - ps).pop()
-                            # if it is a species id instead of a cluster, continue
-                            if not isinstance(clu, tuple):
-                                continue
-                            candidate_sps = {model.getSpecies(it) for it in
-                                             (term_id2s_ids[s_id2term_id[s_id]] if s_id in s_id2term_id else {s_id})}
-                            comp, term = clu
-                            if not in_species_conflict(term, candidate_sps, proposal):
-                                for s in candidate_sps:
-                                    proposal[s.getId()] = s.getCompartment(), term
-                            else:
-                                continue
-                if proposal:
-                    s_id2clu.update(proposal)
-                    for s_id, clu in proposal.items():
-                        clu2s_ids[clu].add(s_id)
-                    unmapped_s_ids -= set(proposal.keys())
+        vk = get_vk(r_id)
+        ub_rs, ub_ps, rs, ps = vk
+        orientations = [vk, (ub_ps, ub_rs, ps, rs)] if r_id2r[r_id].getReversible() else [vk]
+        for (o_ub_rs, o_ub_ps, o_rs, o_ps) in orientations:
+            r_rest, r_unmapped, r_n = split(o_rs)
+            p_rest, p_unmapped, p_n = split(o_ps)
+            # at most one unknown per side, and enough known participants to trust the similarity
+            if r_n > 1 or p_n > 1 or not r_unmapped and not p_unmapped \
+                    or len(o_ub_rs) + len(o_ub_ps) + len(r_rest) + len(p_rest) < 2:
+                continue
+            proposal = None
+            for r_hole, p_hole in hole2classes.get((o_ub_rs, o_ub_ps, r_rest, p_rest,
+                                                    r_unmapped is not None, p_unmapped is not None), []):
+                t_id2clu = match(((r_unmapped, r_hole), (p_unmapped, p_hole)))
+                if not t_id2clu:
+                    continue
+                # two different terms of one reaction cannot go to the same cluster
+                if len(set(t_id2clu.values())) < len(t_id2clu) \
+                        or next((t_id for (t_id, clu) in t_id2clu.items() if in_species_conflict(t_id, clu)), None):
+                    continue
+                # make sure that the reaction does join the equivalent ones (e.g. is oriented the same way)
+                update_s_id2clu(t_id2clu.keys(), t_id2clu)
+                if len(vk2r_ids.get(get_vk(r_id), ())) > 1:
+                    proposal = t_id2clu
+                    break
+                update_s_id2clu(t_id2clu.keys(), {})
+            if proposal:
+                for t_id, clu in proposal.items():
+                    clu2t_ids[clu].add(t_id)
+                    if clu in clu2r_ids:
+                        clu2r_ids[clu] |= t_id2r_ids[t_id]
+                    unmapped_t_ids.discard(t_id)
+                result.update(proposal)
+                break
+    return result
+
+
+def get_clusters(s_id2clu, s_id2term_id, clus=None):
+    """
+    Finds the clusters (of at least one term that is not the cluster itself) of a metabolite clustering.
+    :param s_id2clu: dict {metabolite_id: (compartment_id, cluster)}
+    :param s_id2term_id: dict {metabolite_id: ChEBI_term_id}
+    :param clus: (optional) collection of clusters of interest (if None, all the clusters are considered)
+    :return: dict {cluster: set of term ids}
+    """
+    clu2t_ids = defaultdict(set)
+    for s_id, (_, clu) in s_id2clu.items():
+        t_id = s_id2term_id[s_id] if s_id in s_id2term_id else s_id
+        if (clus is None or clu in clus) and clu != (t_id, ):
+            clu2t_ids[clu].add(t_id)
+    return clu2t_ids
+
+
+def suggest_clusters(model, unmapped_s_ids, term_id2clu, s_id2term_id, ubiquitous_chebi_ids, r_ids_to_ignore=None,
+                     reaction_index=None):
+    """
+    Puts the metabolites for which no ChEBI term was found into the clusters of the terms
+    they are interchangeable with in the model's reactions (see infer_term_clusters).
+    :param model: libsbml.Model model of interest
+    :param unmapped_s_ids: set of ids of metabolites for which no ChEBI term was found
+    :param term_id2clu: dict {term_id: cluster}, is updated inplace
+    :param s_id2term_id: dict {metabolite_id: ChEBI_term_id}
+    :param ubiquitous_chebi_ids: set of ubiquitous ChEBI_ids
+    :param r_ids_to_ignore: (optional) ids of reactions whose stoichiometry preserving constraint can be ignored
+    :param reaction_index: (optional) TermReactionIndex (will be created if not given)
+    :return: dict {metabolite_id: cluster} for the metabolites that were put into clusters
+    """
+    unmapped_s_ids = {s_id for s_id in unmapped_s_ids if s_id not in term_id2clu}
+    if not unmapped_s_ids or not term_id2clu:
+        return {}
+    if not reaction_index:
+        reaction_index = TermReactionIndex(model, s_id2term_id, r_ids_to_ignore)
+    s_id2clu = compute_s_id2clu(set(), model, s_id2term_id, term_id2clu)
+    clu2t_ids = {clu: t_ids for (clu, t_ids) in invert_map(term_id2clu).items()
+                 if len(t_ids) > 1 or clu != (next(iter(t_ids)), )}
+    proposal = infer_term_clusters(model, unmapped_s_ids, clu2t_ids, s_id2clu, s_id2term_id, ubiquitous_chebi_ids,
+                                   reaction_index)
+    term_id2clu.update(proposal)
+    if proposal:
+        logging.info("  put %d unmapped metabolite(s) into clusters" % len(proposal))
+    return proposal
+
+
+def infer_clusters(model, unmapped_s_ids, s_id2clu, s_id2term_id, ubiquitous_chebi_ids, r_ids_to_ignore=None,
+                   reaction_index=None, clus=None):
+    """
+    Puts the unmapped terms (or metabolite ids) into the clusters of the terms
+    they are interchangeable with in the model's reactions (see infer_term_clusters).
+    :param model: libsbml.Model model of interest
+    :param unmapped_s_ids: set of ids of terms (or metabolites) that do not belong to any cluster
+    :param s_id2clu: dict {metabolite_id: (compartment_id, cluster)}, is updated inplace
+    :param s_id2term_id: dict {metabolite_id: ChEBI_term_id}
+    :param ubiquitous_chebi_ids: set of ubiquitous ChEBI_ids
+    :param r_ids_to_ignore: (optional) ids of reactions whose stoichiometry preserving constraint can be ignored
+    :param reaction_index: (optional) TermReactionIndex (will be created if not given)
+    :param clus: (optional) collection of clusters the terms can be put into (by default any cluster)
+    :return: dict {term_id: cluster} for the terms that were put into clusters
+    """
+    if not unmapped_s_ids:
+        return {}
+    if not reaction_index:
+        reaction_index = TermReactionIndex(model, s_id2term_id, r_ids_to_ignore)
+    return infer_term_clusters(model, unmapped_s_ids, get_clusters(s_id2clu, s_id2term_id, clus), s_id2clu,
+                               s_id2term_id, ubiquitous_chebi_ids, reaction_index)
 
 
 class StoichiometryFixingThread(threading.Thread):
     def __init__(self, model, s_id2term_id, ub_chebi_ids, unmapped_s_ids, term_ids, conflicts, onto, clu, term_id2clu,
-                 r_ids_to_ignore=None):
+                 r_ids_to_ignore=None, monitor=None, budget=None, max_exact_cluster_size=None):
         threading.Thread.__init__(self)
         self.ub_chebi_ids = ub_chebi_ids
         self.s_id2term_id = s_id2term_id
@@ -263,6 +362,25 @@ class StoichiometryFixingThread(threading.Thread):
         self.term_id2clu = term_id2clu
         self.conflicts = conflicts
         self.r_ids_to_ignore = r_ids_to_ignore
+        self.monitor = monitor
+        self.budget = budget
+        self.max_exact_cluster_size = max_exact_cluster_size
+        # the metrics registry of the generalization the thread works for
+        self.metrics = monitor.metrics if monitor else METRICS.get_registry()
+        # the clusters the terms were split into, the unmapped metabolites are put into them once all the threads
+        # are over (see model_generalizer.fix_stoichiometry)
+        self.new_clus = set()
+        self.t_id2ancestor_ids = {}
+        self.t_id2levels = {}
+
+    def is_cancelled(self):
+        return self.monitor is not None and self.monitor.is_cancelled()
+
+    def is_budget_exhausted(self, step):
+        if self.budget and self.budget.is_exhausted():
+            self.budget.truncate(PHASE_STOICHIOMETRY, 'cluster %s, %s' % (self.clu, step))
+            return True
+        return False
 
     def get_common_roots(self, relationships=None):
         # the least common ancestors, or roots if there are none
@@ -276,64 +394,130 @@ class StoichiometryFixingThread(threading.Thread):
                        set())
         return common_ancestor_terms
 
-    def get_covered_term_ids(self, term, term_ids):
-        return term_ids & {t.get_id() for t in self.onto.get_sub_tree(term)}
+    def get_ancestor_ids(self, term):
+        t_id = term.get_id()
+        if t_id not in self.t_id2ancestor_ids:
+            self.t_id2ancestor_ids[t_id] = \
+                {t.get_id() for t in self.onto.get_generalized_ancestors(term, False, set()) if t}
+        return self.t_id2ancestor_ids[t_id]
+
+    def get_levels(self, t):
+        # memoized version of self.onto.get_level
+        t_id = t.get_id()
+        if t_id not in self.t_id2levels:
+            parents = [p for p in self.onto.get_ancestors(t) if p]
+            self.t_id2levels[t_id] = {1 + level for p in parents for level in self.get_levels(p)} if parents else {0}
+        return self.t_id2levels[t_id]
 
     def get_level(self, t):
-        level = self.onto.get_level(t)
+        level = self.get_levels(t)
         return sum(level) / len(level)
 
+    def get_ancestor_id2covered_term_ids(self):
+        """
+        Indexes the cluster terms by the terms that cover them (i.e. their generalized ancestors and equivalents),
+        in one bottom-up pass.
+        :return: dict {ancestor_term_id: set of covered cluster term ids}
+        """
+        a_id2covered_t_ids = defaultdict(set)
+        for t_id in self.term_ids:
+            term = self.onto.get_term(t_id)
+            # sub-trees consist of primary term ids, so a term known by its alternative id is never covered
+            if not term or term.get_id() != t_id:
+                continue
+            a_id2covered_t_ids[t_id].add(t_id)
+            for a_id in chain(self.get_ancestor_ids(term), (t.get_id() for t in self.onto.get_equivalents(term))):
+                a_id2covered_t_ids[a_id].add(t_id)
+        return a_id2covered_t_ids
+
     def get_psi_set(self, conflicts):
         common_ancestor_terms = self.get_common_roots()
+        a_id2covered_t_ids = self.get_ancestor_id2covered_term_ids()
+
+        t_id2conflict_num = Counter(chain(*conflicts))
+        set2score = {}
+
+        def process(covered_term_ids, score):
+            if not covered_term_ids:
+                return
+            # the number of conflicts of a set is a half of the sum of its terms' conflict numbers
+            if len(covered_term_ids) > 1 \
+                    and sum(t_id2conflict_num[t_id] for t_id in covered_term_ids) / 2 > MAX_CONFLICT_NUM:
+                return
+            covered_term_ids_tuple = tuple(sorted(covered_term_ids))
+            # of the equal sets keep the first processed one
+            if covered_term_ids_tuple not in set2score:
+                set2score[covered_term_ids_tuple] = score
 
-        psi, basics, set2score = set(), [], {}
-
-        def process(covered_term_ids, score, basics):
-            covered_term_ids_tuple = tuple(covered_term_ids)
-            if covered_term_ids_tuple in psi:
-                return False
-            if get_conflict_num(covered_term_ids, conflicts) > 40:
-                return True
-            basics.append(covered_term_ids)
-            psi.add(covered_term_ids_tuple)
-            set2score[covered_term_ids_tuple] = score
-            return True
-
-        # sets defined by the least common ancestors
         for t_id in self.term_ids:
             term = self.onto.get_term(t_id)
             ancestor_level = self.get_level(term) if term else 0
-            process({t_id}, (3, ancestor_level), basics)
+            process({t_id}, (3, ancestor_level))
 
         processed = set(self.term_ids)
 
+        # sets defined by the least common ancestors and their descendants
         for common_ancestor in common_ancestor_terms:
+            if self.is_cancelled() or self.is_budget_exhausted('candidate sets'):
+                break
             if common_ancestor.get_id() in processed:
                 continue
             processed.add(common_ancestor.get_id())
-
-            common_ancestor_covered_term_ids = self.get_covered_term_ids(common_ancestor, self.term_ids)
-            ancestor_level = self.get_level(common_ancestor)
-            process(common_ancestor_covered_term_ids, (3, ancestor_level), basics)
+            process(a_id2covered_t_ids.get(common_ancestor.get_id(), None), (3, self.get_level(common_ancestor)))
             for t in self.onto.get_generalized_descendants(common_ancestor, False, set()):
                 if t.get_id() in processed:
                     continue
                 processed.add(t.get_id())
-                t_covered_term_ids = self.get_covered_term_ids(t, common_ancestor_covered_term_ids)
-                if not t_covered_term_ids:
-                    continue
-                t_level = self.get_level(t)
-                process(t_covered_term_ids, (3, t_level), basics)
-        result = psi
-        return result, set2score
+                # the descendants that cover none of the cluster terms are not indexed
+                if t.get_id() in a_id2covered_t_ids:
+                    process(a_id2covered_t_ids[t.get_id()], (3, self.get_level(t)))
+        return self.prune_dominated_sets(set2score, conflicts), set2score
+
+    @staticmethod
+    def prune_dominated_sets(set2score, conflicts):
+        """
+        Removes the candidate sets that the greedy covering would never choose:
+        those with conflicting terms, and those contained in a conflict-free candidate set
+        that is scored at least as high (the single-term sets are kept, as they are chosen explicitly).
+        :param set2score: dict {candidate_term_id_tuple: score}
+        :param conflicts: list of sets of conflicting term ids
+        :return: set of the remaining candidate term id tuples
+        """
+        good_sets = {s for s in set2score if len(s) > 1 and good(set(s), conflicts)}
+        t_id2good_sets = defaultdict(list)
+        for s in good_sets:
+            for t_id in s:
+                t_id2good_sets[t_id].append(s)
+        psi = set(set2score.keys())
+        for s, score in set2score.items():
+            if len(s) <= 1:
+                continue
+            if s not in good_sets:
+                psi.discard(s)
+                continue
+            candidates = min((t_id2good_sets[t_id] for t_id in s), key=len)
+            if any(len(other) > len(s) and set2score[other] >= score and set(s) <= set(other)
+                   for other in candidates):
+                psi.discard(s)
+        METRICS.observe(PRUNED_PSI_SIZE, len(set2score) - len(psi))
+        return psi
 
     def greedy(self, psi, set2score, conflicts):
         terms = set(self.term_ids)
         while terms and psi:
+            METRICS.inc(GREEDY_ITERATIONS)
             if good(set(terms), conflicts):
                 yield terms
                 break
-            s = max((term_set for term_set in psi if good(set(term_set), conflicts)), key=lambda candidate_terms: (len(set(candidate_terms) & terms), set2score[candidate_terms]))
+            # out of budget: the remaining terms stay ungrouped
+            if self.is_budget_exhausted('greedy covering'):
+                for t in terms:
+                    yield {t}
+                break
+            # the ties are broken by the terms themselves, not by the hash-dependent order of psi
+            s = max((term_set for term_set in psi if good(set(term_set), conflicts)),
+                    key=lambda candidate_terms: (len(set(candidate_terms) & terms), set2score[candidate_terms],
+                                                 tuple(sorted(candidate_terms))))
             result = set(s)
             if len(result & terms) == 1:
                 problematic_term = get_most_problematic_term(set(terms), conflicts)
@@ -345,23 +529,34 @@ class StoichiometryFixingThread(threading.Thread):
             psi.remove(s)
 
     def run(self):
+        with METRICS.bind(self.metrics):
+            self.split_cluster()
+
+    def split_cluster(self):
         conflicts = self.conflicts
         if not conflicts:
             return
-        psi, set2score = self.get_psi_set(conflicts)
+        METRICS.observe(CONFLICTS, len(conflicts))
+        # the candidate sets of the biggest clusters are too many to search through
+        if self.max_exact_cluster_size is not None and len(self.term_ids) > self.max_exact_cluster_size:
+            logging.info("  cluster %s of %d terms (%d conflicts) is too big, splitting it approximately"
+                         % (self.clu, len(self.term_ids), len(conflicts)))
+            if self.budget:
+                self.budget.approximate(self.clu)
+            groups = colour_conflict_graph(self.term_ids, conflicts)
+        else:
+            psi, set2score = self.get_psi_set(conflicts)
+            METRICS.observe(PSI_SIZE, len(psi))
+            groups = self.greedy(psi, set2score, conflicts)
         i = 0
-        for ts in self.greedy(psi, set2score, conflicts):
+        new_clus = set()
+        for ts in groups:
+            if self.is_cancelled():
+                return
             i += 1
             n_clu = self.clu + (i,)
+            new_clus.add(n_clu)
             with st_fix_lock:
                 for t in ts:
                     self.term_id2clu[t] = n_clu
-        s_id2clu = compute_s_id2clu(set(), self.model, self.s_id2term_id, self.term_id2clu)
-        infer_clusters(self.model, self.unmapped_s_ids, s_id2clu, self.s_id2term_id, self.ub_chebi_ids,
-                       r_ids_to_ignore=self.r_ids_to_ignore)
-        for s_id in self.unmapped_s_ids:
-            with st_fix_lock:
-                if s_id in s_id2clu:
-                    self.term_id2clu[s_id] = s_id2clu[s_id][1]
-                elif s_id in self.term_id2clu:
-                    del self.term_id2clu[s_id]
\ No newline at end of file
+        self.new_clus = new_clus
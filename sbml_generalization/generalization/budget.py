@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+
+__author__ = 'anna'
+
+
+class Budget(object):
+    """
+    Wall-clock and/or iteration budget for the clustering loops.
+    Once it is exhausted, the clustering stops refining the metabolite groups
+    and returns the best stoichiometry-preserving clustering found so far.
+    The phases that were cut short are listed in truncated_phases,
+    and where exactly they were cut (e.g. which pass and iteration, or which cluster) in truncations.
+
+    The clusters that were split (to preserve the reaction stoichiometry) with a cheap approximation
+    instead of the exact greedy search, because of their size (see model_generalizer.fix_stoichiometry),
+    are listed in approximated_clusters.
+    """
+
+    def __init__(self, seconds=None, max_iterations=None):
+        """
+        :param seconds: (optional) float, maximal wall-clock time (in seconds) for the clustering
+        :param max_iterations: (optional) int, maximal number of iterations of each metabolite diversity loop
+        """
+        self.seconds = seconds
+        self.max_iterations = max_iterations
+        self.start = None
+        self.truncated_phases = []
+        self.truncations = []
+        self.approximated_clusters = []
+        self.lock = threading.RLock()
+
+    def start_timer(self):
+        if self.start is None:
+            self.start = time.time()
+
+    def is_exhausted(self, iteration=None):
+        """
+        Checks whether the budget is exhausted.
+        :param iteration: (optional) int, number of the loop iteration that is about to start
+        :return: boolean
+        """
+        if self.seconds is not None and self.start is not None and time.time() - self.start > self.seconds:
+            return True
+        return iteration is not None and self.max_iterations is not None and iteration > self.max_iterations
+
+    def truncate(self, phase, where=None):
+        """
+        Marks a phase as truncated because the budget was exhausted.
+        :param phase: str, phase name
+        :param where: (optional) str, which part of the phase was cut short,
+        e.g. 'pass 2, iteration 3' or 'cluster ('chebi:33709',)'
+        :return: void
+        """
+        with self.lock:
+            if phase not in self.truncated_phases:
+                self.truncated_phases.append(phase)
+            truncation = {'phase': phase, 'where': where}
+            if truncation not in self.truncations:
+                logging.info("  budget exhausted, truncating %s%s" % (phase, ' (%s)' % where if where else ''))
+                self.truncations.append(truncation)
+
+    def is_truncated(self):
+        return len(self.truncated_phases) > 0
+
+    def approximate(self, clu):
+        """
+        Marks a cluster as split approximately because of its size.
+        :param clu: cluster
+        :return: void
+        """
+        with self.lock:
+            self.approximated_clusters.append(clu)
@@ -0,0 +1,87 @@
+from collections import defaultdict
+from itertools import chain
+
+from sbml_generalization.generalization.vertical_key import get_vertical_key, vertical_key2simplified_vertical_key
+
+__author__ = 'anna'
+
+
+class UnionFind(object):
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        self.parent.setdefault(x, x)
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self.parent[y] = x
+
+
+def get_components(model, s_id2term_id, t_ids, ubiquitous_chebi_ids, r_ids_to_ignore=None):
+    """
+    Partitions the terms (and the reactions) of the model into independent components:
+    two terms are in the same component if they participate in the same reaction (ubiquitous metabolites and
+    the reactions to be ignored are not taken into account), or if they participate in reactions
+    that might be generalized together, i.e. that have the same simplified vertical key.
+    :param model: libsbml.Model model of interest
+    :param s_id2term_id: dict {metabolite_id: ChEBI_term_id}
+    :param t_ids: collection of term ids to be partitioned (unmapped metabolites are represented by their ids)
+    :param ubiquitous_chebi_ids: set of ubiquitous ChEBI ids
+    :param r_ids_to_ignore: (optional) ids of reactions whose stoichiometry preserving constraint can be ignored
+    :return: list of tuples (term_ids, reaction_ids), sorted by decreasing size
+    """
+    uf = UnionFind()
+    for t_id in t_ids:
+        uf.find(t_id)
+    r_id2t_id = {}
+    s_vk2t_id = {}
+    for r in model.getListOfReactions():
+        if r_ids_to_ignore and r.getId() in r_ids_to_ignore:
+            continue
+        specific_t_ids = [s_id2term_id[s_id] if s_id in s_id2term_id else s_id
+                          for s_id in chain((species_ref.getSpecies() for species_ref in r.getListOfReactants()),
+                                            (species_ref.getSpecies() for species_ref in r.getListOfProducts()))
+                          if not ubiquitous_chebi_ids or s_id not in s_id2term_id
+                          or s_id2term_id[s_id] not in ubiquitous_chebi_ids]
+        if not specific_t_ids:
+            continue
+        first = specific_t_ids[0]
+        for t_id in specific_t_ids[1:]:
+            uf.union(first, t_id)
+        r_id2t_id[r.getId()] = first
+        s_vk = vertical_key2simplified_vertical_key(get_vertical_key(model, r, {}, s_id2term_id, ubiquitous_chebi_ids))
+        if s_vk in s_vk2t_id:
+            uf.union(s_vk2t_id[s_vk], first)
+        else:
+            s_vk2t_id[s_vk] = first
+
+    root2t_ids, root2r_ids = defaultdict(set), defaultdict(set)
+    for t_id in uf.parent.keys():
+        root2t_ids[uf.find(t_id)].add(t_id)
+    for r_id, t_id in r_id2t_id.items():
+        root2r_ids[uf.find(t_id)].add(r_id)
+    return sorted(((root2t_ids[root], root2r_ids[root]) for root in root2t_ids.keys()),
+                  key=lambda t_ids_r_ids: -len(t_ids_r_ids[0]) - len(t_ids_r_ids[1]))
+
+
+def group_components(components, n):
+    """
+    Distributes the components into (at most) n groups of similar size.
+    :param components: list of tuples (term_ids, reaction_ids), sorted by decreasing size
+    :param n: int, maximal number of groups
+    :return: list of tuples (term_ids, reaction_ids), one per non-empty group
+    """
+    groups = [(set(), set()) for _ in range(max(1, min(n, len(components))))]
+    for t_ids, r_ids in components:
+        g_t_ids, g_r_ids = min(groups, key=lambda g: len(g[0]) + len(g[1]))
+        g_t_ids |= t_ids
+        g_r_ids |= r_ids
+    return [g for g in groups if g[0]]
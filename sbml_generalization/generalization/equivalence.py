@@ -0,0 +1,609 @@
+from collections import Counter, defaultdict
+import importlib
+from itertools import chain
+import inspect
+import logging
+import random
+import sys
+import threading
+import time
+
+import libsbml
+
+from mod_sbml.annotation.chebi.chebi_annotator import CHEBI_PREFIX, EQUIVALENT_RELATIONSHIPS
+from mod_sbml.annotation.rdf_annotation_helper import add_annotation
+from mod_sbml.onto.obo_ontology import Ontology
+from mod_sbml.utils.misc import invert_map
+from sbml_generalization.generalization import model_generalizer, vertical_key, MaximizingThread
+from sbml_generalization.generalization.StoichiometryFixingThread import StoichiometryFixingThread, \
+    compute_s_id2clu, good, get_most_problematic_term, get_conflict_num, st_fix_lock, suggest_clusters
+from sbml_generalization.generalization.vertical_key import is_reactant
+from sbml_generalization.generalization.sbml_generalizer import preprocess_document, generalize_preprocessed_model, \
+    filter_chebi, get_ub_elements, get_ubiquitous_threshold
+
+__author__ = 'anna'
+
+# ATP, ADP, water
+SYNTHETIC_UB_CHEBI_IDS = ('chebi:15422', 'chebi:16761', 'chebi:15377')
+
+# how many diverging elements are listed in a comparison report
+MAX_REPORTED_DIVERGENCES = 10
+
+COMPONENT_GREEDY = 'greedy'
+COMPONENT_MERGE_NEIGHBOURS = 'merge_based_on_neighbours'
+COMPONENT_VERTICAL_KEY = 'vertical_key'
+COMPONENT_ONTOLOGY = 'ontology'
+COMPONENTS = (COMPONENT_GREEDY, COMPONENT_MERGE_NEIGHBOURS, COMPONENT_VERTICAL_KEY, COMPONENT_ONTOLOGY)
+
+# the ontology queries of the clustering
+ONTOLOGY_QUERIES = ('common_points', 'get_generalized_ancestors', 'get_generalized_ancestors_of_level',
+                    'get_generalized_descendants', 'get_sub_tree', 'get_equivalents', 'get_ancestors',
+                    'get_descendants', 'get_level')
+
+
+def reference_merge_based_on_neighbours(lst):
+    # frozen copy of MaximizingThread.merge_based_on_neighbours
+    new_lst = []
+    for neighbours, terms in lst:
+        neighbours = set(neighbours)
+        to_remove = []
+        for (new_neighbours, new_terms) in new_lst:
+            if neighbours & new_neighbours:
+                neighbours |= new_neighbours
+                terms |= new_terms
+                to_remove.append((new_neighbours, new_terms))
+        new_lst = [it for it in new_lst if not it in to_remove] + [(neighbours, terms)]
+    return new_lst
+
+
+class ReferenceMaximizingThread(MaximizingThread.MaximizingThread):
+    """
+    Frozen copy of the original cluster splitting (MaximizingThread.split_cluster),
+    without cancellation and budget checks (and metrics).
+    """
+
+    def run(self):
+        neighbours2term_ids = defaultdict(set)
+        neighbourless_terms = set()
+        t_id2rs = defaultdict(list)
+        for r in (r for r in self.model.getListOfReactions() if r.getNumReactants() + r.getNumProducts() > 2):
+            if self.r_ids_to_ignore and r.getId() in self.r_ids_to_ignore:
+                continue
+            for s_id in chain((species_ref.getSpecies() for species_ref in r.getListOfReactants()),
+                              (species_ref.getSpecies() for species_ref in r.getListOfProducts())):
+                if s_id in self.species_id2term_id:
+                    t_id2rs[self.species_id2term_id[s_id]].append(r)
+                else:
+                    t_id2rs[s_id].append(r)
+        for t_id in self.term_ids:
+            neighbours = {
+                ("in"
+                 if is_reactant(self.model, t_id, r, self.s_id2clu, self.species_id2term_id, self.ubiquitous_chebi_ids)
+                 else "out",
+                 self.r_id2clu[r.getId()]) for r in t_id2rs[t_id]}
+            if neighbours:
+                key = tuple(sorted(neighbours))
+                neighbours2term_ids[key].add(t_id)
+            else:
+                neighbourless_terms.add(t_id)
+        new_lst = reference_merge_based_on_neighbours(neighbours2term_ids.items())
+        i = 0
+        if len(new_lst) > 1:
+            for neighbours, term_ids in new_lst:
+                n_clu = self.clu + (i,)
+                i += 1
+                with MaximizingThread.max_lock:
+                    for t in term_ids:
+                        self.term_id2clu[t] = n_clu
+        with MaximizingThread.max_lock:
+            for t in neighbourless_terms:
+                self.term_id2clu[t] = self.clu + (i,)
+                i += 1
+
+
+class ReferenceStoichiometryFixingThread(StoichiometryFixingThread):
+    """
+    Frozen copy of the original candidate (psi) set construction and greedy covering of StoichiometryFixingThread:
+    the covered terms are found in the sub-trees, the levels and conflict numbers are recalculated for each set,
+    nothing is pruned, and the biggest clusters are never approximated.
+    """
+
+    def get_covered_term_ids(self, term, term_ids):
+        return term_ids & {t.get_id() for t in self.onto.get_sub_tree(term)}
+
+    def get_level(self, t):
+        level = self.onto.get_level(t)
+        return sum(level) / len(level)
+
+    def get_psi_set(self, conflicts):
+        common_ancestor_terms = self.get_common_roots()
+
+        psi, basics, set2score = set(), [], {}
+
+        def process(covered_term_ids, score, basics):
+            covered_term_ids_tuple = tuple(covered_term_ids)
+            if covered_term_ids_tuple in psi:
+                return False
+            if get_conflict_num(covered_term_ids, conflicts) > 40:
+                return True
+            basics.append(covered_term_ids)
+            psi.add(covered_term_ids_tuple)
+            set2score[covered_term_ids_tuple] = score
+            return True
+
+        # sets defined by the least common ancestors
+        for t_id in self.term_ids:
+            term = self.onto.get_term(t_id)
+            ancestor_level = self.get_level(term) if term else 0
+            process({t_id}, (3, ancestor_level), basics)
+
+        processed = set(self.term_ids)
+
+        for common_ancestor in common_ancestor_terms:
+            if common_ancestor.get_id() in processed:
+                continue
+            processed.add(common_ancestor.get_id())
+
+            common_ancestor_covered_term_ids = self.get_covered_term_ids(common_ancestor, self.term_ids)
+            ancestor_level = self.get_level(common_ancestor)
+            process(common_ancestor_covered_term_ids, (3, ancestor_level), basics)
+            for t in self.onto.get_generalized_descendants(common_ancestor, False, set()):
+                if t.get_id() in processed:
+                    continue
+                processed.add(t.get_id())
+                t_covered_term_ids = self.get_covered_term_ids(t, common_ancestor_covered_term_ids)
+                if not t_covered_term_ids:
+                    continue
+                t_level = self.get_level(t)
+                process(t_covered_term_ids, (3, t_level), basics)
+        result = psi
+        return result, set2score
+
+    def greedy(self, psi, set2score, conflicts):
+        terms = set(self.term_ids)
+        while terms and psi:
+            if good(set(terms), conflicts):
+                yield terms
+                break
+            # (with the same tie-break as StoichiometryFixingThread, not the hash-dependent order of psi)
+            s = max((term_set for term_set in psi if good(set(term_set), conflicts)),
+                    key=lambda candidate_terms: (len(set(candidate_terms) & terms), set2score[candidate_terms],
+                                                 tuple(sorted(candidate_terms))))
+            result = set(s)
+            if len(result & terms) == 1:
+                problematic_term = get_most_problematic_term(set(terms), conflicts)
+                if problematic_term:
+                    s = (problematic_term,)
+                    result = {problematic_term}
+            yield result & terms
+            terms -= result
+            psi.remove(s)
+
+    def run(self):
+        conflicts = self.conflicts
+        if not conflicts:
+            return
+        psi, set2score = self.get_psi_set(conflicts)
+        i = 0
+        for ts in self.greedy(psi, set2score, conflicts):
+            i += 1
+            n_clu = self.clu + (i,)
+            self.new_clus.add(n_clu)
+            with st_fix_lock:
+                for t in ts:
+                    self.term_id2clu[t] = n_clu
+
+
+def reference_maximize(unmapped_s_ids, model, term_id2clu, species_id2term_id, ub_chebi_ids, r_ids_to_ignore=None):
+    # frozen copy of the original model_generalizer.maximize, which splits all the clusters
+    clu2term_ids = invert_map(term_id2clu)
+    s_id2clu = compute_s_id2clu(unmapped_s_ids, model, species_id2term_id, term_id2clu)
+
+    r_id2clu = model_generalizer.generalize_reactions(model, s_id2clu, species_id2term_id, ub_chebi_ids,
+                                                      r_ids_to_ignore=r_ids_to_ignore)
+
+    thrds = []
+    for (clu, term_ids) in clu2term_ids.items():
+        if len(term_ids) <= 1:
+            continue
+
+        thread = ReferenceMaximizingThread(model, term_ids, species_id2term_id, clu, term_id2clu,
+                                           s_id2clu, ub_chebi_ids, r_id2clu, r_ids_to_ignore=r_ids_to_ignore)
+        thrds.append(thread)
+        thread.start()  # This actually causes the thread to run
+    for th in thrds:
+        th.join()  # This waits until the thread has completed
+    return term_id2clu
+
+
+def reference_update_onto(onto, term_id2clu):
+    # frozen copy of the original model_generalizer.update_onto, which keeps no caches
+    ancestors = []
+    clu2t_ids = invert_map(term_id2clu)
+    for clu, t_ids in clu2t_ids.items():
+        if len(t_ids) <= 1:
+            continue
+        terms = {onto.get_term(t_id) for t_id in t_ids if onto.get_term(t_id)}
+        if terms:
+            ancestors.extend(set(onto.common_points(terms, relationships=EQUIVALENT_RELATIONSHIPS)))
+    removed_something = False
+    count = Counter(ancestors)
+    for t in (t for t in count.keys() if count[t] > 1):
+        # if this term has been already removed as an ancestor/equivalent of another term
+        if not onto.get_term(t.get_id()):
+            continue
+        for it in onto.get_generalized_ancestors(t, relationships=EQUIVALENT_RELATIONSHIPS):
+            onto.remove_term(it, True)
+        for it in onto.get_equivalents(t, relationships=EQUIVALENT_RELATIONSHIPS):
+            onto.remove_term(it, True)
+        onto.remove_term(t, True)
+        removed_something = True
+    return removed_something
+
+
+def reference_cover_with_onto_terms(model, onto, species_id2chebi_id, term_id2clu, ubiquitous_chebi_ids,
+                                    r_ids_to_ignore=None):
+    # frozen copy of the original model_generalizer.cover_with_onto_terms, which covers all the clusters again
+    onto_updated = reference_update_onto(onto, term_id2clu)
+    if onto_updated:
+        for clu, t_ids in invert_map(term_id2clu).items():
+            if len(t_ids) == 1:
+                del term_id2clu[t_ids.pop()]
+            else:
+                new_t_id2clu = model_generalizer.cover_t_ids(model, species_id2chebi_id, ubiquitous_chebi_ids, t_ids,
+                                                             onto, clu, r_ids_to_ignore=r_ids_to_ignore)
+                for t_id in t_ids:
+                    if t_id in new_t_id2clu:
+                        term_id2clu[t_id] = new_t_id2clu[t_id]
+                    else:
+                        del term_id2clu[t_id]
+    return onto_updated
+
+
+def reference_maximization_step(model, onto, species_id2chebi_id, term_id2clu, ub_term_ids, unmapped_s_ids,
+                                r_ids_to_ignore=None):
+    # frozen copy of the original model_generalizer.maximization_step,
+    # which maximizes all the clusters at each iteration, until the ontology stops changing
+    onto_updated = True
+    while onto_updated:
+        term_id2clu = reference_maximize(unmapped_s_ids, model, term_id2clu, species_id2chebi_id, ub_term_ids,
+                                         r_ids_to_ignore=r_ids_to_ignore)
+        onto_updated = reference_cover_with_onto_terms(model, onto, species_id2chebi_id, term_id2clu, ub_term_ids,
+                                                       r_ids_to_ignore=r_ids_to_ignore)
+
+
+def reference_find_term_clustering(model, chebi, species_id2chebi_id, unmapped_s_ids, ubiquitous_chebi_ids,
+                                   r_ids_to_ignore=None):
+    """
+    The original term clustering (see model_generalizer.find_term_clustering), with the frozen copies
+    of the original maximization and candidate set code
+    (see reference_maximization_step and ReferenceStoichiometryFixingThread).
+    """
+    if not ubiquitous_chebi_ids:
+        ubiquitous_chebi_ids = set()
+    chebi_ids = set(species_id2chebi_id.values()) - ubiquitous_chebi_ids
+    term_id2clu = model_generalizer.cover_t_ids(model, species_id2chebi_id, ubiquitous_chebi_ids, chebi_ids, chebi,
+                                                r_ids_to_ignore=r_ids_to_ignore)
+    chebi.trim({it[0] for it in term_id2clu.values()}, relationships=EQUIVALENT_RELATIONSHIPS)
+    suggest_clusters(model, unmapped_s_ids, term_id2clu, species_id2chebi_id, ubiquitous_chebi_ids,
+                     r_ids_to_ignore=r_ids_to_ignore)
+    reference_maximization_step(model, chebi, species_id2chebi_id, term_id2clu, ubiquitous_chebi_ids, unmapped_s_ids,
+                                r_ids_to_ignore=r_ids_to_ignore)
+    model_generalizer.fix_stoichiometry(model, term_id2clu, species_id2chebi_id, ubiquitous_chebi_ids, chebi,
+                                        r_ids_to_ignore=r_ids_to_ignore,
+                                        fixing_thread_class=ReferenceStoichiometryFixingThread)
+    reference_maximization_step(model, chebi, species_id2chebi_id, term_id2clu, ubiquitous_chebi_ids, unmapped_s_ids,
+                                r_ids_to_ignore=r_ids_to_ignore)
+    return term_id2clu
+
+
+def reference_engine(model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids=None):
+    """
+    The original (sequential, pure Python) clustering: the current clustering pipeline,
+    with the original term clustering (see reference_find_term_clustering).
+    An engine takes a preprocessed model (see sbml_generalizer.preprocess_document), leaves it and ChEBI intact,
+    and returns its clustering.
+    :param model: libsbml.Model preprocessed model
+    :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
+    :param r_ids_to_ignore: ids of reactions whose stoichiometry preserving constraint can be ignored (or None)
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param ub_chebi_ids: (optional) ids of ubiquitous ChEBI terms (will be inferred if set to None)
+    :return: tuple (r_id2clu, clu2s_ids, ub_s_ids), see sbml_generalizer.generalize_preprocessed_model
+    """
+    ub_chebi_ids, ub_s_ids = get_ub_elements(model, chebi, s_id2chebi_id, ub_chebi_ids, None)
+    onto = filter_chebi(chebi, s_id2chebi_id, copy_chebi=True)
+    unmapped_s_ids = {s.getId() for s in model.getListOfSpecies() if s.getId() not in s_id2chebi_id}
+    term_id2clu = reference_find_term_clustering(model, onto, s_id2chebi_id, unmapped_s_ids, ub_chebi_ids,
+                                                 r_ids_to_ignore=r_ids_to_ignore)
+    s_id2clu, ub_s_ids = model_generalizer.get_species_clustering(model, s_id2chebi_id, unmapped_s_ids, term_id2clu,
+                                                                  onto, ub_s_ids, get_ubiquitous_threshold(model))
+    r_id2clu = model_generalizer.generalize_reactions(model, s_id2clu, s_id2chebi_id, ub_chebi_ids,
+                                                      r_ids_to_ignore=r_ids_to_ignore)
+    clu2s_ids = {(c_id, term): s_ids for ((c_id, (term, )), s_ids) in invert_map(s_id2clu).items()}
+    return r_id2clu, clu2s_ids, ub_s_ids
+
+
+def sequential_engine(model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids=None):
+    """
+    The current sequential clustering (see reference_engine).
+    """
+    r_id2clu, clu2s_ids, ub_s_ids, _ = \
+        generalize_preprocessed_model(model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids=ub_chebi_ids,
+                                      copy_chebi=True)
+    return r_id2clu, clu2s_ids, ub_s_ids
+
+
+def partitioned_engine(model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids=None):
+    """
+    The clustering of the model's independent components in parallel processes (see reference_engine).
+    """
+    r_id2clu, clu2s_ids, ub_s_ids, _ = \
+        generalize_preprocessed_model(model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids=ub_chebi_ids,
+                                      copy_chebi=True, partitioned=True)
+    return r_id2clu, clu2s_ids, ub_s_ids
+
+
+ENGINES = {'reference': reference_engine, 'sequential': sequential_engine, 'partitioned': partitioned_engine}
+
+
+def get_engine(name):
+    """
+    Finds an engine by its name: either one of ENGINES, or a function given as 'package.module:function'
+    (with the signature of reference_engine).
+    :param name: str, engine name
+    :return: engine function
+    """
+    if name in ENGINES:
+        return ENGINES[name]
+    if ':' not in name:
+        raise ValueError("unknown engine %s, should be one of %s or package.module:function"
+                         % (name, ', '.join(sorted(ENGINES.keys()))))
+    module, function = name.split(':', 1)
+    return getattr(importlib.import_module(module), function)
+
+
+def get_partition(element2clu):
+    """
+    Converts a clustering into a partition that does not depend on the cluster labels.
+    :param element2clu: dict {element_id: cluster}
+    :return: set of frozensets of element ids (the clusters)
+    """
+    clu2elements = defaultdict(set)
+    for element, clu in element2clu.items():
+        clu2elements[clu].add(element)
+    return {frozenset(elements) for elements in clu2elements.values()}
+
+
+def compare_partitions(partition, other_partition):
+    """
+    Compares two partitions (see get_partition).
+    :return: tuple (equal, only, other_only, diverging): boolean, whether they are equal;
+    lists of the clusters (sorted lists of element ids) that are only found in the first (in the second) partition;
+    sorted list of the element ids whose clusters differ
+    """
+    only = sorted(sorted(it) for it in partition - other_partition)
+    other_only = sorted(sorted(it) for it in other_partition - partition)
+    diverging = sorted({e for it in only for e in it} | {e for it in other_only for e in it})
+    return not diverging, only, other_only, diverging
+
+
+def get_clustering(r_id2clu, clu2s_ids):
+    """
+    :return: tuple (r_partition, s_partition), see get_partition
+    """
+    s_id2clu = {s_id: clu for (clu, s_ids) in clu2s_ids.items() for s_id in s_ids}
+    return get_partition(r_id2clu), get_partition(s_id2clu)
+
+
+class ComponentTimer(object):
+    """
+    Measures the time spent in the clustering internals: the greedy set covers, merge_based_on_neighbours,
+    the vertical key calculations and the ontology queries, by wrapping them (wherever sbml_generalization
+    refers to them) while it is used as a context manager.
+    The nested calls of the same component are measured once, the time of the calls made by concurrent threads
+    is summed up, and the calls made in other processes (e.g. by the partitioned clustering's workers)
+    are not measured.
+    """
+
+    def __init__(self):
+        self.component2time = {component: 0. for component in COMPONENTS}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.patches = []
+
+    def measure(self, component, function, *args, **kwargs):
+        if getattr(self.local, component, False):
+            return function(*args, **kwargs)
+        setattr(self.local, component, True)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            setattr(self.local, component, False)
+            with self.lock:
+                self.component2time[component] += duration
+
+    def wrap(self, component, function):
+        if inspect.isgeneratorfunction(function):
+            # the work is done while the items are generated (e.g. by the greedy set covers)
+            def generator_wrapper(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                while True:
+                    try:
+                        item = self.measure(component, next, generator)
+                    except StopIteration:
+                        return
+                    yield item
+            return generator_wrapper
+
+        def wrapper(*args, **kwargs):
+            return self.measure(component, function, *args, **kwargs)
+        return wrapper
+
+    def patch(self, owner, name, component):
+        original = getattr(owner, name)
+        self.patches.append((owner, name, original))
+        setattr(owner, name, self.wrap(component, original))
+
+    def patch_everywhere(self, function, component):
+        # the functions are imported by name into several modules
+        for module in list(sys.modules.values()):
+            if module and module.__name__.startswith('sbml_generalization.'):
+                for name, value in list(vars(module).items()):
+                    if value is function:
+                        self.patch(module, name, component)
+
+    def __enter__(self):
+        self.patch_everywhere(model_generalizer.greedy, COMPONENT_GREEDY)
+        self.patch(StoichiometryFixingThread, 'greedy', COMPONENT_GREEDY)
+        self.patch(ReferenceStoichiometryFixingThread, 'greedy', COMPONENT_GREEDY)
+        self.patch_everywhere(MaximizingThread.merge_based_on_neighbours, COMPONENT_MERGE_NEIGHBOURS)
+        self.patch_everywhere(reference_merge_based_on_neighbours, COMPONENT_MERGE_NEIGHBOURS)
+        self.patch_everywhere(vertical_key.get_vertical_key, COMPONENT_VERTICAL_KEY)
+        for name in ONTOLOGY_QUERIES:
+            self.patch(Ontology, name, COMPONENT_ONTOLOGY)
+        return self
+
+    def __exit__(self, *args):
+        for owner, name, original in reversed(self.patches):
+            setattr(owner, name, original)
+        self.patches = []
+
+
+def run_engine(engine, model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids=None, repeats=1):
+    """
+    Runs an engine several times.
+    :return: tuple (r_partition, s_partition, ub_s_ids, time, stable, component2time): the clustering
+    of the first run (see get_clustering), the minimal running time (in seconds), whether all the runs agreed,
+    and dict {component: time (in seconds)} of the fastest run (see ComponentTimer)
+    """
+    result, best_time, stable, best_component2time = None, None, True, None
+    for _ in range(max(repeats, 1)):
+        start = time.time()
+        with ComponentTimer() as timer:
+            r_id2clu, clu2s_ids, ub_s_ids = engine(model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids)
+        duration = time.time() - start
+        if best_time is None or duration < best_time:
+            best_time, best_component2time = duration, timer.component2time
+        clustering = get_clustering(r_id2clu, clu2s_ids) + (frozenset(ub_s_ids), )
+        if result is None:
+            result = clustering
+        elif result != clustering:
+            stable = False
+    r_partition, s_partition, ub_s_ids = result
+    return r_partition, s_partition, ub_s_ids, best_time, stable, best_component2time
+
+
+def compare_engines(model_name, input_doc, chebi, engines, ub_chebi_ids=None, ignore_biomass=True, repeats=1):
+    """
+    Runs the engines side by side on a model and compares their clusterings to the first engine's one
+    (modulo cluster relabelling).
+    :param model_name: str, model name for the report
+    :param input_doc: libsbml.SBMLDocument input model (is left intact)
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology (is left intact)
+    :param engines: list of tuples (engine_name, engine), the first one being the reference
+    :param ub_chebi_ids: (optional) ids of ubiquitous ChEBI terms (will be inferred if set to None)
+    :param ignore_biomass: boolean, whether to ignore the biomass reaction (and its stoichiometry preserving constraint)
+    :param repeats: int, number of runs of each engine (the fastest one is reported)
+    :return: list of dicts, one per engine, with the keys: 'model', 'engine', 'time' (in seconds),
+    'speed_up' (the reference time divided by the engine's one), 'stable' (whether the repeated runs agreed),
+    'equal' (whether the reaction and species clusterings and the ubiquitous species are the same as the reference's),
+    'diverging_reactions', 'diverging_species' (numbers of elements whose clusters differ from the reference's),
+    'examples' (some of those elements), 'component_times' (dict {component: time (in seconds)},
+    see ComponentTimer)
+    """
+    _, model, s_id2chebi_id, r_ids_to_ignore = preprocess_document(input_doc.clone(), chebi, ignore_biomass)
+    results = []
+    ref_r_partition, ref_s_partition, ref_ub_s_ids, ref_time = None, None, None, None
+    for name, engine in engines:
+        logging.info("running the %s engine on %s" % (name, model_name))
+        r_partition, s_partition, ub_s_ids, duration, stable, component2time = \
+            run_engine(engine, model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids, repeats)
+        if ref_time is None:
+            ref_r_partition, ref_s_partition, ref_ub_s_ids, ref_time = r_partition, s_partition, ub_s_ids, duration
+        r_equal, _, _, r_diverging = compare_partitions(ref_r_partition, r_partition)
+        s_equal, _, _, s_diverging = compare_partitions(ref_s_partition, s_partition)
+        ub_diverging = sorted(ref_ub_s_ids ^ ub_s_ids)
+        result = {'model': model_name, 'engine': name, 'time': duration,
+                  'speed_up': ref_time / duration if duration else float('inf'), 'stable': stable,
+                  'equal': r_equal and s_equal and not ub_diverging,
+                  'diverging_reactions': len(r_diverging), 'diverging_species': len(set(s_diverging) | set(ub_diverging)),
+                  'examples': (r_diverging + s_diverging + ub_diverging)[:MAX_REPORTED_DIVERGENCES],
+                  'component_times': component2time}
+        if not result['equal']:
+            logging.warning("the %s engine diverges from the %s one on %s: %d reactions, %d species, e.g. %s"
+                            % (name, engines[0][0], model_name, result['diverging_reactions'],
+                               result['diverging_species'], ', '.join(result['examples'])))
+        results.append(result)
+    return results
+
+
+def create_synthetic_model(chebi, families=10, family_size=5, seed=0):
+    """
+    Creates a model whose metabolites are annotated with ChEBI terms that can be generalized:
+    a family is formed by children of the same ChEBI term, and the i-th members of consecutive families
+    are converted into each other (using ubiquitous ATP, ADP and water), in the cytosol and in the mitochondrion.
+    Some reactions also combine two members of a family, so that the stoichiometry has to be fixed.
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param families: int, number of metabolite families
+    :param family_size: int, number of metabolites in each family
+    :param seed: int, random seed (the same parameters produce the same model)
+    :return: libsbml.SBMLDocument
+    """
+    rnd = random.Random(seed)
+    t_ids = sorted(chebi.get_all_term_ids())
+    used = set(SYNTHETIC_UB_CHEBI_IDS)
+    t_id_families = []
+    # only the children of the terms sampled until the families are found are looked at
+    for t_id in rnd.sample(t_ids, len(t_ids)):
+        if len(t_id_families) >= families:
+            break
+        children = chebi.get_descendants(t_id)
+        if len(children) < family_size:
+            continue
+        children = sorted(c_id for c_id in children if c_id not in used and chebi.get_term(c_id)
+                          and not chebi.get_descendants(c_id) and chebi.get_term(c_id).get_name())
+        if len(children) < family_size:
+            continue
+        family = rnd.sample(children, family_size)
+        used |= set(family)
+        t_id_families.append(family)
+
+    doc = libsbml.SBMLDocument(2, 4)
+    model = doc.createModel()
+    model.setId('synthetic_%d_%d_%d' % (families, family_size, seed))
+    for c_id, name in (('c', 'cytosol'), ('m', 'mitochondrion')):
+        compartment = model.createCompartment()
+        compartment.setId(c_id)
+        compartment.setName(name)
+
+    t_c_id2s_id = {}
+
+    def get_species(t_id, c_id):
+        if (t_id, c_id) not in t_c_id2s_id:
+            s = model.createSpecies()
+            s.setId('s_%d' % len(t_c_id2s_id))
+            s.setName(chebi.get_term(t_id).get_name() if chebi.get_term(t_id) else t_id)
+            s.setCompartment(c_id)
+            add_annotation(s, libsbml.BQB_IS, t_id, CHEBI_PREFIX)
+            t_c_id2s_id[(t_id, c_id)] = s.getId()
+        return t_c_id2s_id[(t_id, c_id)]
+
+    def add_reaction(rs, ps, reversible):
+        r = model.createReaction()
+        r.setId('r_%d' % model.getNumReactions())
+        r.setReversible(reversible)
+        for t_id, c_id in rs:
+            r.createReactant().setSpecies(get_species(t_id, c_id))
+        for t_id, c_id in ps:
+            r.createProduct().setSpecies(get_species(t_id, c_id))
+
+    atp, adp, water = SYNTHETIC_UB_CHEBI_IDS
+    for family, next_family in zip(t_id_families, t_id_families[1:]):
+        reversible = rnd.random() < 0.5
+        for c_id in ('c', 'm'):
+            for t_id, next_t_id in zip(family, next_family):
+                add_reaction([(t_id, c_id), (atp, c_id)], [(next_t_id, c_id), (adp, c_id)], reversible)
+            add_reaction([(family[0], c_id), (family[1], c_id)], [(next_family[0], c_id), (water, c_id)], False)
+    return doc
@@ -0,0 +1,176 @@
+from copy import deepcopy
+import logging
+import os
+
+from mod_sbml.sbml.sbml_manager import get_reactants, get_products
+from mod_sbml.utils.misc import invert_map
+from sbml_generalization.generalization.model_generalizer import generalize_species, generalize_reactions, \
+    find_term_clustering
+from sbml_generalization.generalization.sbml_generalizer import preprocess_model, filter_chebi, get_ub_elements, \
+    get_ubiquitous_threshold
+from sbml_generalization.sbml.model_cache import get_sbml_model
+from sbml_generalization.sbml.sbml_helper import save_as_comp_generalized_sbml, remove_elements, \
+    remove_unused_elements, get_sbml_prefix
+
+__author__ = 'anna'
+
+
+def get_reaction_signature(model, r, s_id2chebi_id):
+    """
+    Describes a reaction by its participants, so that the same reactions can be recognised in different models.
+    :param model: libsbml.Model model of interest
+    :param r: libsbml.Reaction reaction of interest
+    :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
+    :return: tuple (reversible, reactants, products), where reactants and products are frozensets of tuples
+    (species_id, ChEBI_term_id, compartment_id)
+    """
+    describe = lambda s_ids: frozenset((s_id, s_id2chebi_id.get(s_id, None), model.getSpecies(s_id).getCompartment())
+                                       for s_id in s_ids)
+    return r.getReversible(), describe(get_reactants(r)), describe(get_products(r))
+
+
+def get_core_reaction_ids(models, s_id2chebi_ids, r_ids_to_ignore_list):
+    """
+    Finds the reactions shared by all the models (same ids and participants),
+    excluding those whose stoichiometry preserving constraint can be ignored in any of them.
+    :param models: list of libsbml.Model (or sbml_generalization.sbml.model_cache.CachedModel) preprocessed models
+    :param s_id2chebi_ids: list of dicts {species_id: ChEBI_term_id}, one per model
+    :param r_ids_to_ignore_list: list of collections of reaction ids to be ignored (or None), one per model
+    :return: set of reaction ids
+    """
+    core = None
+    for model, s_id2chebi_id, r_ids_to_ignore in zip(models, s_id2chebi_ids, r_ids_to_ignore_list):
+        r_id2signature = {r.getId(): get_reaction_signature(model, r, s_id2chebi_id)
+                          for r in model.getListOfReactions() if not r_ids_to_ignore or r.getId() not in r_ids_to_ignore}
+        core = r_id2signature if core is None \
+            else {r_id: sign for (r_id, sign) in core.items() if r_id2signature.get(r_id, None) == sign}
+    return set(core.keys()) if core else set()
+
+
+def get_core_model(model, core_r_ids):
+    """
+    Creates a model containing only the given (core) reactions of the given model and their species.
+    :param model: libsbml.Model (or sbml_generalization.sbml.model_cache.CachedModel) preprocessed model
+    :param core_r_ids: set of reaction ids to be kept
+    :return: tuple (doc, model): libsbml.SBMLDocument (to be kept while the model is used), libsbml.Model core model
+    """
+    doc, sbml_model = get_sbml_model(model)
+    core_doc = (doc if doc else sbml_model.getSBMLDocument()).clone()
+    core_model = core_doc.getModel()
+    remove_elements(core_model.getListOfReactions(), lambda r: r.getId() in core_r_ids)
+    remove_unused_elements(core_model)
+    return core_doc, core_model
+
+
+def save_correspondence(out_tsv, model_names, models, results):
+    """
+    Saves the cross-model group correspondence table: for each species and reaction of any model,
+    the id of the generalized element it corresponds to in each of the models
+    (its own id if it was not generalized, or nothing if the model does not contain it),
+    followed by the generalized element's ChEBI term (for species) or name (for reactions),
+    as the generalized element ids are generated independently for each model.
+    :param out_tsv: str, path to the output tab-separated file
+    :param model_names: list of model names
+    :param models: list of libsbml.Model (or sbml_generalization.sbml.model_cache.CachedModel) models
+    :param results: list of tuples (r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids) as returned by generalize_models
+    :return: void
+    """
+    with open(out_tsv, 'w') as f:
+        f.write('type\tid\t%s\n' % '\t'.join('%s\t%s term' % (name, name) for name in model_names))
+        for el_type, get_elements, mapping_index in (('species', lambda m: m.getListOfSpecies(), 1),
+                                                     ('reaction', lambda m: m.getListOfReactions(), 0)):
+            e_ids, model_e_ids = [], []
+            for model in models:
+                m_e_ids = {e.getId() for e in get_elements(model)}
+                e_ids.extend(sorted(m_e_ids - set(e_ids)))
+                model_e_ids.append(m_e_ids)
+            for e_id in e_ids:
+                cells = []
+                for result, m_e_ids in zip(results, model_e_ids):
+                    e_id2g = result[mapping_index]
+                    if e_id not in m_e_ids:
+                        cells.extend(('', ''))
+                    elif e_id not in e_id2g:
+                        cells.extend((e_id, ''))
+                    else:
+                        g_id, g = e_id2g[e_id]
+                        cells.extend((g_id, g if isinstance(g, str) else g.get_id()))
+                f.write('%s\t%s\t%s\n' % (el_type, e_id, '\t'.join(cells)))
+    logging.info("saved the group correspondence to %s" % out_tsv)
+
+
+def generalize_models(in_sbml_list, chebi, groups_sbml_list, out_sbml_list, correspondence_tsv=None,
+                      ub_chebi_ids=None, ignore_biomass=True, annotation_cache=None, name_index=None,
+                      copy_chebi=False, model_cache=None, groups_sidecar=False):
+    """
+    Generalizes a family of related models (e.g. strain-specific models sharing most of their reactions).
+    The ontology filtering and the ubiquitous metabolite inference are performed once for all the models,
+    and so is the clustering of the core model formed by the reactions shared by all the models.
+    Each model's clustering then starts from the core one, and only refines the clusters
+    involved in the model-specific reactions (see model_generalizer.find_term_clustering_from_core).
+    :param in_sbml_list: list of paths to the input SBML files
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param groups_sbml_list: list of paths to the output SBML files (with groups extension), one per model
+    :param out_sbml_list: list of paths to the output SBML files (generalized), one per model
+    :param correspondence_tsv: (optional) str, path to the output cross-model group correspondence table
+    (see save_correspondence)
+    :param ub_chebi_ids: optional, ids of ubiquitous ChEBI terms (will be inferred if set to None)
+    :param ignore_biomass: boolean, whether to ignore the biomass reaction (and its stoichiometry preserving constraint)
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    to reuse ChEBI terms previously inferred from species names
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    to look species names up among ChEBI term names
+    :param copy_chebi: boolean, whether to work on a filtered copy of ChEBI and leave the input ontology intact
+    (otherwise it gets filtered inplace)
+    :param model_cache: (optional) sbml_generalization.sbml.model_cache.ModelCache
+    to reuse models preprocessed during previous runs
+    :param groups_sidecar: boolean, whether to also save the groups into compact sidecar files next to the groups models
+    (see sbml_generalization.sbml.group_serializer)
+    :return: list of tuples (r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids), one per model, as for
+    sbml_generalizer.generalize_model
+    """
+    if not in_sbml_list:
+        return []
+    docs, models, s_id2chebi_ids, r_ids_to_ignore_list = \
+        zip(*(preprocess_model(in_sbml, chebi, ignore_biomass, annotation_cache, name_index, model_cache)
+              for in_sbml in in_sbml_list))
+    # the species of all the models (told apart by the model index)
+    all_s_id2chebi_id = {(i, s_id): chebi_id for (i, s_id2chebi_id) in enumerate(s_id2chebi_ids)
+                         for (s_id, chebi_id) in s_id2chebi_id.items()}
+    # the ubiquitous terms are shared by all the models, so they are inferred from all of them, not a particular one
+    ub_chebi_ids, _ = get_ub_elements(None, chebi, all_s_id2chebi_id, ub_chebi_ids, None)
+    onto = filter_chebi(chebi, all_s_id2chebi_id, copy_chebi)
+
+    core = None
+    core_r_ids = get_core_reaction_ids(models, s_id2chebi_ids, r_ids_to_ignore_list) if len(models) > 1 else set()
+    if core_r_ids:
+        logging.info("clustering the core: %d reactions shared by all the models" % len(core_r_ids))
+        core_doc, core_model = get_core_model(models[0], core_r_ids)
+        core_s_id2chebi_id = {s_id: chebi_id for (s_id, chebi_id) in s_id2chebi_ids[0].items()
+                              if core_model.getSpecies(s_id)}
+        core_unmapped_s_ids = {s.getId() for s in core_model.getListOfSpecies() if s.getId() not in core_s_id2chebi_id}
+        core_term_id2clu = find_term_clustering(core_model, onto, core_s_id2chebi_id, core_unmapped_s_ids,
+                                                ub_chebi_ids)
+        core = core_term_id2clu, (set(core_s_id2chebi_id.values()) - ub_chebi_ids) | core_unmapped_s_ids, core_r_ids
+
+    results = []
+    for in_sbml, model, s_id2chebi_id, r_ids_to_ignore, groups_sbml, out_sbml \
+            in zip(in_sbml_list, models, s_id2chebi_ids, r_ids_to_ignore_list, groups_sbml_list, out_sbml_list):
+        logging.info("generalizing %s" % in_sbml)
+        # the clustering modifies the ontology, so each model starts from its own copy of the core one
+        model_onto = deepcopy(onto)
+        ub_s_ids = {s_id for (s_id, chebi_id) in s_id2chebi_id.items() if chebi_id in ub_chebi_ids}
+        s_id2clu, ub_s_ids = generalize_species(model, s_id2chebi_id, ub_s_ids, model_onto, ub_chebi_ids,
+                                                get_ubiquitous_threshold(model), r_ids_to_ignore=r_ids_to_ignore,
+                                                core=core)
+        r_id2clu = generalize_reactions(model, s_id2clu, s_id2chebi_id, ub_chebi_ids, r_ids_to_ignore=r_ids_to_ignore)
+        clu2s_ids = {(c_id, term): s_ids for ((c_id, (term, )), s_ids) in invert_map(s_id2clu).items()}
+        sbml_doc, sbml_model = get_sbml_model(model)
+        r_id2g_eq, s_id2gr_id = save_as_comp_generalized_sbml(sbml_model, out_sbml, groups_sbml, r_id2clu, clu2s_ids,
+                                                              ub_s_ids, model_onto, groups_sidecar=groups_sidecar)
+        results.append((r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids))
+
+    if correspondence_tsv:
+        model_names = [get_sbml_prefix(os.path.basename(in_sbml))[0] for in_sbml in in_sbml_list]
+        save_correspondence(correspondence_tsv, model_names, models, results)
+    return results
@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+import json
+import threading
+
+__author__ = 'anna'
+
+VERTICAL_KEY_CALLS = 'mod_gen_vertical_key_calls_total'
+SPECIES_LOOKUPS = 'mod_gen_species_lookups_total'
+GREEDY_ITERATIONS = 'mod_gen_greedy_iterations_total'
+MAXIMIZATION_ITERATIONS = 'mod_gen_maximization_iterations_total'
+ONTO_TERMS_REMOVED = 'mod_gen_onto_terms_removed_total'
+PSI_SIZE = 'mod_gen_psi_size'
+PRUNED_PSI_SIZE = 'mod_gen_pruned_psi_size'
+CONFLICTS = 'mod_gen_conflicts'
+
+METRIC_DESCRIPTIONS = {
+    VERTICAL_KEY_CALLS: 'Number of reaction vertical key calculations.',
+    SPECIES_LOOKUPS: 'Number of species looked up in the model.',
+    GREEDY_ITERATIONS: 'Number of iterations of the greedy stoichiometry fixing set cover.',
+    MAXIMIZATION_ITERATIONS: 'Number of iterations of the metabolite diversity loops.',
+    ONTO_TERMS_REMOVED: 'Number of ontology terms removed as ancestors shared by several clusters.',
+    PSI_SIZE: 'Number of candidate term sets considered when fixing the stoichiometry of a cluster.',
+    PRUNED_PSI_SIZE: 'Number of candidate term sets of a cluster that the greedy set cover would never choose.',
+    CONFLICTS: 'Number of stoichiometry conflicts of a cluster.',
+}
+
+
+class MetricsRegistry(object):
+    """
+    Collects counters and per-cluster observations (summarized by their count, sum and maximum)
+    on the hot paths of the generalization. It is disabled by default, in which case recording costs
+    a single attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.summaries = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.summaries = {}
+
+    def inc(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            count, total, maximum = self.summaries.get(name, (0, 0, value))
+            self.summaries[name] = count + 1, total + value, max(maximum, value)
+
+    def get_snapshot(self):
+        """
+        :return: dict {'counters': {name: value}, 'summaries': {name: {'count': count, 'sum': sum, 'max': max}}}
+        """
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'summaries': {name: {'count': count, 'sum': total, 'max': maximum}
+                                  for (name, (count, total, maximum)) in self.summaries.items()}}
+
+    def merge(self, snapshot):
+        """
+        Adds the metrics collected elsewhere (e.g. in a worker process) to this registry.
+        :param snapshot: dict as returned by get_snapshot
+        """
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, summary in snapshot['summaries'].items():
+                count, total, maximum = self.summaries.get(name, (0, 0, summary['max']))
+                self.summaries[name] = \
+                    count + summary['count'], total + summary['sum'], max(maximum, summary['max'])
+
+    def to_prometheus(self):
+        """
+        :return: str, the metrics in Prometheus text exposition format
+        """
+        snapshot = self.get_snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            if name in METRIC_DESCRIPTIONS:
+                lines.append('# HELP %s %s' % (name, METRIC_DESCRIPTIONS[name]))
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %s' % (name, value))
+        for name, summary in sorted(snapshot['summaries'].items()):
+            if name in METRIC_DESCRIPTIONS:
+                lines.append('# HELP %s %s' % (name, METRIC_DESCRIPTIONS[name]))
+            lines.append('# TYPE %s summary' % name)
+            lines.append('%s_sum %s' % (name, summary['sum']))
+            lines.append('%s_count %s' % (name, summary['count']))
+            lines.append('# TYPE %s_max gauge' % name)
+            lines.append('%s_max %s' % (name, summary['max']))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        """
+        Saves the metrics: as JSON if the path ends with .json, in Prometheus text format otherwise.
+        :param path: str, path to the output file
+        """
+        with open(path, 'w') as f:
+            if path.lower().endswith('.json'):
+                json.dump(self.get_snapshot(), f, indent=2, sort_keys=True)
+            else:
+                f.write(self.to_prometheus())
+
+
+class CurrentMetrics(object):
+    """
+    Records the metrics to the registry of the job the current thread works for (see bind),
+    so that the jobs run concurrently (e.g. by the server) do not add to each other's metrics.
+    The threads that are not bound to a registry record nothing.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def get_registry(self):
+        """
+        :return: MetricsRegistry the current thread records to, or None
+        """
+        return getattr(self.local, 'registry', None)
+
+    @contextmanager
+    def bind(self, registry):
+        """
+        Makes the current thread record the metrics to the given registry until the end of the with block.
+        :param registry: MetricsRegistry or None (for recording nothing)
+        """
+        previous = self.get_registry()
+        self.local.registry = registry
+        try:
+            yield registry
+        finally:
+            self.local.registry = previous
+
+    def inc(self, name, value=1):
+        registry = getattr(self.local, 'registry', None)
+        if registry is not None:
+            registry.inc(name, value)
+
+    def observe(self, name, value):
+        registry = getattr(self.local, 'registry', None)
+        if registry is not None:
+            registry.observe(name, value)
+
+
+# what the generalization reports to: the registry of the current job (see progress.ProgressMonitor)
+METRICS = CurrentMetrics()
@@ -1,16 +1,24 @@
-from collections import Counter
+from collections import Counter, defaultdict
 from itertools import chain
 import logging
+import multiprocessing
+import multiprocessing.connection
 from mod_sbml.annotation.chebi.chebi_annotator import EQUIVALENT_RELATIONSHIPS
 
+from sbml_generalization.generalization.components import get_components, group_components
+from sbml_generalization.generalization.workers import can_fork, fork_pool
 from sbml_generalization.generalization.MaximizingThread import MaximizingThread
 from sbml_generalization.generalization.StoichiometryFixingThread import StoichiometryFixingThread, compute_s_id2clu, \
-    infer_clusters, suggest_clusters
+    infer_clusters, suggest_clusters, TermReactionIndex
 from sbml_generalization.generalization.vertical_key import get_vk2r_ids
+from sbml_generalization.generalization.progress import ProgressMonitor, PHASE_AGGRESSIVE_GROUPING, \
+    PHASE_METABOLITE_DIVERSITY, PHASE_STOICHIOMETRY
+from sbml_generalization.generalization.metrics import METRICS, MetricsRegistry, MAXIMIZATION_ITERATIONS, \
+    ONTO_TERMS_REMOVED, SPECIES_LOOKUPS
 from mod_sbml.utils.misc import invert_map
+from mod_sbml.sbml.sbml_manager import get_reactants, get_products
 from mod_sbml.onto.term import Term
-from mod_sbml.sbml.ubiquitous_manager import UBIQUITOUS_THRESHOLD, get_frequent_term_ids, \
-    select_metabolite_ids_by_term_ids
+from mod_sbml.sbml.ubiquitous_manager import UBIQUITOUS_THRESHOLD
 
 __author__ = 'anna'
 
@@ -25,7 +33,27 @@ def generalize_reactions(model, s_id2clu, s_id2term_id, ubiquitous_chebi_ids, r_
     return r_id2clu
 
 
-def maximize(unmapped_s_ids, model, term_id2clu, species_id2term_id, ub_chebi_ids, r_ids_to_ignore=None):
+def get_maximization_step_name(maximization_pass, iteration):
+    """
+    :return: str, e.g. 'pass 2, iteration 3', to report where the metabolite diversity phase was truncated
+    """
+    return ', '.join('%s %s' % (name, value) for (name, value)
+                     in (('pass', maximization_pass), ('iteration', iteration)) if value is not None)
+
+
+def maximize(unmapped_s_ids, model, term_id2clu, species_id2term_id, ub_chebi_ids, r_ids_to_ignore=None,
+             monitor=None, iteration=None, clus=None, budget=None, maximization_pass=None):
+    """
+    Splits the clusters whose terms participate in differently generalized reactions.
+    :param clus: (optional) collection of clusters to be processed (if None, all the clusters are processed)
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time budget:
+    once it is exhausted, the clusters that are not split yet are left as they are
+    :param maximization_pass: (optional) int, number of the metabolite diversity pass (to report truncations)
+    :return: updated (inplace) dict term_id2clu {term_id: cluster}
+    """
+    if not monitor:
+        monitor = ProgressMonitor()
+    step = get_maximization_step_name(maximization_pass, iteration)
     clu2term_ids = invert_map(term_id2clu)
     s_id2clu = compute_s_id2clu(unmapped_s_ids, model, species_id2term_id, term_id2clu)
 
@@ -33,19 +61,27 @@ def maximize(unmapped_s_ids, model, term_id2clu, species_id2term_id, ub_chebi_id
 
     thrds = []
     for (clu, term_ids) in clu2term_ids.items():
-        if len(term_ids) <= 1:
+        if len(term_ids) <= 1 or clus is not None and clu not in clus:
             continue
+        if budget and budget.is_exhausted():
+            budget.truncate(PHASE_METABOLITE_DIVERSITY, '%s, before cluster %s' % (step, clu) if step
+                            else 'before cluster %s' % (clu, ))
+            break
 
         thread = MaximizingThread(model, term_ids, species_id2term_id, clu, term_id2clu,
-                                  s_id2clu, ub_chebi_ids, r_id2clu, r_ids_to_ignore=r_ids_to_ignore)
+                                  s_id2clu, ub_chebi_ids, r_id2clu, r_ids_to_ignore=r_ids_to_ignore, monitor=monitor,
+                                  budget=budget, where=step)
         thrds.append(thread)
         thread.start()  # This actually causes the thread to run
-    for th in thrds:
+    for i, th in enumerate(thrds):
         th.join()  # This waits until the thread has completed
+        monitor.report(PHASE_METABOLITE_DIVERSITY, iteration, i + 1, len(thrds))
+    monitor.check_cancelled()
     return term_id2clu
 
 
-def cover_t_ids(model, species_id2term_id, ubiquitous_t_ids, t_ids, onto, clu=None, r_ids_to_ignore=None):
+def cover_t_ids(model, species_id2term_id, ubiquitous_t_ids, t_ids, onto, clu=None, r_ids_to_ignore=None,
+                reaction_index=None, budget=None, phase=PHASE_AGGRESSIVE_GROUPING):
     """
     Find ancestor terms that cover (generalize) given terms.
     :param model: libsbml.Model model of interest
@@ -55,9 +91,21 @@ def cover_t_ids(model, species_id2term_id, ubiquitous_t_ids, t_ids, onto, clu=No
     :param onto: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
     :param clu: current cluster to which the terms belong
     :param r_ids_to_ignore: collection of reaction ids to ignore (don't fix their Stoichiometry preserving constraints)
+    :param reaction_index: (optional) sbml_generalization.generalization.StoichiometryFixingThread.TermReactionIndex
+    to find the clusters of the terms that are not in the ontology (will be created if needed and not given)
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time budget:
+    once it is exhausted, the terms that are not covered yet are left ungrouped
+    :param phase: str, the phase the covering is part of (to report truncations)
     :return: dictionary {term_id: cluster}
     """
     term_id2clu = {}
+
+    def is_budget_exhausted():
+        if budget and budget.is_exhausted():
+            budget.truncate(phase, 'covering cluster %s' % (clu, ) if clu else 'covering the terms')
+            return True
+        return False
+
     real_terms = {onto.get_term(t_id) for t_id in t_ids if onto.get_term(t_id)}
 
     # If there is no term for t_id in the ontology, we assume it is a metabolite id instead
@@ -71,46 +119,124 @@ def cover_t_ids(model, species_id2term_id, ubiquitous_t_ids, t_ids, onto, clu=No
 
     roots = set()
     for term in real_terms:
+        if is_budget_exhausted():
+            return term_id2clu
         roots |= onto.get_generalized_ancestors_of_level(term, set(), None, 4)
     terms2root = {tuple(sorted(t.get_id() for t in onto.get_sub_tree(root))): root.get_id() for root in roots}
     for t_set, root_id in greedy({t.get_id() for t in real_terms}, terms2root, {it: 1 for it in terms2root}):
+        if is_budget_exhausted():
+            break
         new_clu = clu + (root_id, ) if clu else (root_id, )
         term_id2clu.update({t_id: new_clu for t_id in t_set})
 
-    s_id2clu = compute_s_id2clu(set(), model, species_id2term_id, term_id2clu)
-    infer_clusters(model, unmapped_s_ids, s_id2clu, species_id2term_id, ubiquitous_t_ids,
-                   r_ids_to_ignore=r_ids_to_ignore)
-    # for s_id in unmapped_s_ids:
-    #     if s_id in s_id2clu:
-    #         term_id2clu[s_id] = (s_id2clu[s_id][1], )
+    if unmapped_s_ids and term_id2clu:
+        if not reaction_index:
+            reaction_index = TermReactionIndex(model, species_id2term_id, r_ids_to_ignore)
+        # the metabolites of the other terms are keyed by their terms anyway
+        s_id2clu = {s_id: (reaction_index.get_compartment(s_id), t_clu)
+                    for (t_id, t_clu) in term_id2clu.items() for s_id in reaction_index.t_id2s_ids[t_id]}
+        term_id2clu.update(infer_clusters(model, unmapped_s_ids, s_id2clu, species_id2term_id, ubiquitous_t_ids,
+                                          reaction_index=reaction_index))
     return term_id2clu
 
 
-def update_onto(onto, term_id2clu):
+def get_ancestor_ids(onto, t_id):
+    """
+    :param onto: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param t_id: term id
+    :return: set of ids of the generalized ancestors and equivalents of the term (empty if it is not in the ontology)
+    """
+    term = onto.get_term(t_id)
+    if not term:
+        return set()
+    return {it.get_id() for it in onto.get_generalized_ancestors(term, direct=False, checked=set(),
+                                                                 relationships=EQUIVALENT_RELATIONSHIPS) if it} \
+        | {it.get_id() for it in onto.get_equivalents(term, relationships=EQUIVALENT_RELATIONSHIPS) if it}
+
+
+def update_onto(onto, term_id2clu, t_ids2common_ancestors=None, synchronizer=None):
+    """
+    Removes from the ontology the common ancestors that are shared by several clusters (and their ancestors).
+    :param onto: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param term_id2clu: dict {term_id: cluster}
+    :param t_ids2common_ancestors: (optional) dict {frozenset of term ids: set of their lowest common ancestors},
+    caches the common ancestors of the clusters between the calls, is updated inplace
+    :param synchronizer: (optional) ComponentGroupSynchronizer, if the term clustering covers only a group
+    of the model components, counts the clusters of the other groups as well
+    :return: tuple (removed_something, affected_clus): boolean, whether any term was removed from the ontology;
+    set of the clusters that lost their common ancestors (or never had any) and therefore need to be covered again.
+    """
+    if t_ids2common_ancestors is None:
+        t_ids2common_ancestors = {}
     ancestors = []
+    clu2ancestors = {}
     clu2t_ids = invert_map(term_id2clu)
     for clu, t_ids in clu2t_ids.items():
         if len(t_ids) <= 1:
             continue
-        terms = {onto.get_term(t_id) for t_id in t_ids if onto.get_term(t_id)}
-        if terms:
-            ancestors.extend(set(onto.common_points(terms, relationships=EQUIVALENT_RELATIONSHIPS)))
-    removed_something = False
+        key = frozenset(t_ids)
+        if key not in t_ids2common_ancestors:
+            terms = {onto.get_term(t_id) for t_id in t_ids if onto.get_term(t_id)}
+            t_ids2common_ancestors[key] = \
+                set(onto.common_points(terms, relationships=EQUIVALENT_RELATIONSHIPS)) if terms else set()
+        clu2ancestors[clu] = t_ids2common_ancestors[key]
+        ancestors.extend(clu2ancestors[clu])
     count = Counter(ancestors)
-    for t in (t for t in count.keys() if count[t] > 1):
+    if synchronizer:
+        shared_ancestors = [onto.get_term(t_id) for t_id in synchronizer.get_shared_ancestor_ids(
+            Counter({t.get_id(): n for (t, n) in count.items()}))]
+    else:
+        shared_ancestors = [t for t in count.keys() if count[t] > 1]
+    if not shared_ancestors:
+        return False, set()
+    # the generalized ancestors (and equivalents) of the clustered terms, as they were before the removal
+    t_id2ancestor_ids = {}
+    for t_id in chain(*(clu2t_ids[clu] for clu in clu2ancestors.keys())):
+        if t_id not in t_id2ancestor_ids and onto.get_term(t_id):
+            t_id2ancestor_ids[t_id] = get_ancestor_ids(onto, t_id)
+    removed_t_ids = set()
+    for t in shared_ancestors:
         # if this term has been already removed as an ancestor/equivalent of another term
         if not onto.get_term(t.get_id()):
             continue
         for it in onto.get_generalized_ancestors(t, relationships=EQUIVALENT_RELATIONSHIPS):
             onto.remove_term(it, True)
+            removed_t_ids.add(it.get_id())
         for it in onto.get_equivalents(t, relationships=EQUIVALENT_RELATIONSHIPS):
             onto.remove_term(it, True)
+            removed_t_ids.add(it.get_id())
         onto.remove_term(t, True)
-        removed_something = True
-    return removed_something
-
-
-def fix_stoichiometry(model, term_id2clu, species_id2term_id, ub_chebi_ids, onto, r_ids_to_ignore=None):
+        removed_t_ids.add(t.get_id())
+    METRICS.inc(ONTO_TERMS_REMOVED, len(removed_t_ids))
+    if not removed_t_ids:
+        return False, set()
+    # A cluster keeps its (lowest) common ancestors unless any of its terms, their ancestors or equivalents
+    # (e.g. an equivalent of a removed term) was removed.
+    affected_clus = set()
+    for clu, clu_ancestors in clu2ancestors.items():
+        if not clu_ancestors or next((t_id for t_id in clu2t_ids[clu]
+                                      if t_id in removed_t_ids
+                                      or t_id2ancestor_ids.get(t_id, set()) & removed_t_ids), None):
+            affected_clus.add(clu)
+            t_ids2common_ancestors.pop(frozenset(clu2t_ids[clu]), None)
+    return True, affected_clus
+
+
+def fix_stoichiometry(model, term_id2clu, species_id2term_id, ub_chebi_ids, onto, r_ids_to_ignore=None, monitor=None,
+                      budget=None, max_exact_cluster_size=None, fixing_thread_class=StoichiometryFixingThread):
+    """
+    Splits the clusters whose terms participate in the same reactions, so that the reaction stoichiometry is preserved.
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time budget,
+    where the approximated clusters are listed
+    :param max_exact_cluster_size: (optional) int, maximal number of terms of a cluster that is split
+    with the exact greedy search, the bigger ones are split approximately
+    (see StoichiometryFixingThread.colour_conflict_graph)
+    :param fixing_thread_class: (optional) StoichiometryFixingThread (sub)class that splits each cluster
+    (e.g. the reference one of sbml_generalization.generalization.equivalence)
+    :return: void, term_id2clu is updated inplace
+    """
+    if not monitor:
+        monitor = ProgressMonitor()
     clu2term_ids = invert_map(term_id2clu)
     thrds = []
     conflicts = []
@@ -129,12 +255,32 @@ def fix_stoichiometry(model, term_id2clu, species_id2term_id, ub_chebi_ids, onto
         real_term_ids = {t_id for t_id in term_ids if onto.get_term(t_id)}
         unmapped_s_ids = {s_id for s_id in term_ids if not onto.get_term(s_id)}
         if clu_conflicts:
-            thread = StoichiometryFixingThread(model, species_id2term_id, ub_chebi_ids, unmapped_s_ids, real_term_ids,
-                                               clu_conflicts, onto, clu, term_id2clu, r_ids_to_ignore=r_ids_to_ignore)
+            thread = fixing_thread_class(model, species_id2term_id, ub_chebi_ids, unmapped_s_ids, real_term_ids,
+                                         clu_conflicts, onto, clu, term_id2clu, r_ids_to_ignore=r_ids_to_ignore,
+                                         monitor=monitor, budget=budget, max_exact_cluster_size=max_exact_cluster_size)
             thrds.append(thread)
             thread.start()  # This actually causes the thread to run
-    for th in thrds:
+    for i, th in enumerate(thrds):
         th.join()  # This waits until the thread has completed
+        monitor.report(PHASE_STOICHIOMETRY, None, i + 1, len(thrds))
+    monitor.check_cancelled()
+
+    # The unmapped metabolites go to the new clusters whose terms they can replace, or are ungrouped.
+    # This is only done once all the clusters are split, and in the order of the threads,
+    # so that the reaction keys (and hence the result) do not depend on the thread scheduling.
+    thrds = [th for th in thrds if th.unmapped_s_ids]
+    if not thrds:
+        return
+    for th in thrds:
+        for s_id in th.unmapped_s_ids:
+            term_id2clu.pop(s_id, None)
+    reaction_index = TermReactionIndex(model, species_id2term_id, r_ids_to_ignore)
+    s_id2clu = compute_s_id2clu(set(), model, species_id2term_id, term_id2clu)
+    for th in thrds:
+        # s_id2clu is updated inplace with the metabolites put into clusters
+        term_id2clu.update(infer_clusters(model, th.unmapped_s_ids, s_id2clu, species_id2term_id, ub_chebi_ids,
+                                          r_ids_to_ignore=r_ids_to_ignore, reaction_index=reaction_index,
+                                          clus=th.new_clus))
 
 
 def greedy(yet_to_be_covered, set2label, set2score):
@@ -191,34 +337,150 @@ def filter_clu_to_terms(term2clu):
             del term2clu[terms.pop()]
 
 
-def cover_with_onto_terms(model, onto, species_id2chebi_id, term_id2clu, ubiquitous_chebi_ids, r_ids_to_ignore=None):
-    onto_updated = update_onto(onto, term_id2clu)
+def cover_clusters(model, onto, species_id2chebi_id, term_id2clu, clus, ubiquitous_chebi_ids, r_ids_to_ignore=None,
+                   monitor=None, reaction_index=None, budget=None, step=None):
+    """
+    Covers the terms of the given clusters with the ontology terms again
+    (e.g. once the clusters lost their common ancestors), and removes the singleton clusters.
+    :param clus: collection of clusters to be covered again
+    :return: void, term_id2clu is updated inplace
+    """
+    uncovered_clu_num = 0
+    for clu, t_ids in invert_map(term_id2clu).items():
+        if monitor:
+            monitor.check_cancelled()
+        if len(t_ids) == 1:
+            del term_id2clu[t_ids.pop()]
+        # the clusters that kept their common ancestors would be covered by them again, as a whole
+        elif clu in clus:
+            # out of budget: the cluster stays as it is
+            if budget and budget.is_exhausted():
+                uncovered_clu_num += 1
+                continue
+            new_t_id2clu = cover_t_ids(model, species_id2chebi_id, ubiquitous_chebi_ids, t_ids, onto, clu,
+                                       r_ids_to_ignore=r_ids_to_ignore, reaction_index=reaction_index,
+                                       budget=budget, phase=PHASE_METABOLITE_DIVERSITY)
+            for t_id in t_ids:
+                if t_id in new_t_id2clu:
+                    term_id2clu[t_id] = new_t_id2clu[t_id]
+                else:
+                    del term_id2clu[t_id]
+    if uncovered_clu_num:
+        budget.truncate(PHASE_METABOLITE_DIVERSITY, '%s, %d clusters left uncovered'
+                        % (step, uncovered_clu_num) if step else '%d clusters left uncovered' % uncovered_clu_num)
+
+
+def cover_with_onto_terms(model, onto, species_id2chebi_id, term_id2clu, ubiquitous_chebi_ids, r_ids_to_ignore=None,
+                          monitor=None, t_ids2common_ancestors=None, reaction_index=None, budget=None, step=None,
+                          synchronizer=None):
+    onto_updated, affected_clus = update_onto(onto, term_id2clu, t_ids2common_ancestors, synchronizer=synchronizer)
     if onto_updated:
-        for clu, t_ids in invert_map(term_id2clu).items():
-            if len(t_ids) == 1:
-                del term_id2clu[t_ids.pop()]
-            else:
-                new_t_id2clu = cover_t_ids(model, species_id2chebi_id, ubiquitous_chebi_ids, t_ids, onto, clu,
-                                           r_ids_to_ignore=r_ids_to_ignore)
-                for t_id in t_ids:
-                    if t_id in new_t_id2clu:
-                        term_id2clu[t_id] = new_t_id2clu[t_id]
-                    else:
-                        del term_id2clu[t_id]
+        cover_clusters(model, onto, species_id2chebi_id, term_id2clu, affected_clus, ubiquitous_chebi_ids,
+                       r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, reaction_index=reaction_index,
+                       budget=budget, step=step)
     return onto_updated
 
 
-def maximization_step(model, onto, species_id2chebi_id, term_id2clu, ub_term_ids, unmapped_s_ids, r_ids_to_ignore=None):
-    onto_updated = True
-    while onto_updated:
+def get_partition(term_id2clu):
+    """
+    Represents a term clustering independently of the cluster labels.
+    :param term_id2clu: dict {term_id: cluster}
+    :return: set of frozensets of term ids
+    """
+    return {frozenset(t_ids) for t_ids in invert_map(term_id2clu).values()}
+
+
+def get_t_id2neighbour_t_ids(model, species_id2term_id):
+    """
+    Finds for each term (or unmapped metabolite id) the terms (unmapped metabolite ids)
+    that participate in the same reactions.
+    :param model: libsbml.Model model of interest
+    :param species_id2term_id: dict {metabolite_id: ChEBI_term_id}
+    :return: dict {term_id: set of neighbour term ids}
+    """
+    t_id2neighbour_t_ids = defaultdict(set)
+    for r in model.getListOfReactions():
+        t_ids = {species_id2term_id[s_id] if s_id in species_id2term_id else s_id
+                 for s_id in chain((species_ref.getSpecies() for species_ref in r.getListOfReactants()),
+                                   (species_ref.getSpecies() for species_ref in r.getListOfProducts()))}
+        for t_id in t_ids:
+            t_id2neighbour_t_ids[t_id] |= t_ids
+    return t_id2neighbour_t_ids
+
+
+def get_dirty_clusters(term_id2clu, old_term_id2clu, t_id2neighbour_t_ids):
+    """
+    Finds the clusters that need to be maximized again: those whose terms have changed their clusters
+    since the old clustering, and those that share reactions with them (as their reactions might be generalized
+    differently now).
+    :param term_id2clu: dict {term_id: cluster}
+    :param old_term_id2clu: dict {term_id: cluster}, the clustering before the changes
+    :param t_id2neighbour_t_ids: dict {term_id: set of term ids participating in the same reactions}
+    :return: set of clusters
+    """
+    changed_t_ids = {t_id for t_id in chain(term_id2clu.keys(), old_term_id2clu.keys())
+                     if term_id2clu.get(t_id, None) != old_term_id2clu.get(t_id, None)}
+    if not changed_t_ids:
+        return set()
+    dirty_t_ids = set(changed_t_ids)
+    for t_id in changed_t_ids:
+        if t_id in t_id2neighbour_t_ids:
+            dirty_t_ids |= t_id2neighbour_t_ids[t_id]
+    return {clu for (clu, t_ids) in invert_map(term_id2clu).items() if t_ids & dirty_t_ids}
+
+
+def maximization_step(model, onto, species_id2chebi_id, term_id2clu, ub_term_ids, unmapped_s_ids, r_ids_to_ignore=None,
+                      monitor=None, budget=None, clus=None, maximization_pass=None, synchronizer=None):
+    """
+    Splits the clusters until they satisfy metabolite diversity,
+    i.e. until an iteration neither updates the ontology nor changes the clustering.
+    :param clus: (optional) collection of clusters to be maximized during the first iteration
+    (if None, all the clusters are maximized)
+    :param maximization_pass: (optional) int, number of this metabolite diversity pass (to report truncations)
+    :param synchronizer: (optional) ComponentGroupSynchronizer, if the term clustering covers only a group
+    of the model components, makes the groups iterate together, as the model would as a whole
+    :return: void, term_id2clu is updated inplace
+    """
+    if not monitor:
+        monitor = ProgressMonitor()
+    t_id2neighbour_t_ids = get_t_id2neighbour_t_ids(model, species_id2chebi_id)
+    reaction_index = TermReactionIndex(model, species_id2chebi_id, r_ids_to_ignore)
+    t_ids2common_ancestors = {}
+    # None stands for all the clusters
+    dirty_clus = clus
+    onto_updated, clustering_changed = True, True
+    iteration = 0
+    while onto_updated or clustering_changed:
+        iteration += 1
+        monitor.check_cancelled()
+        exhausted = budget is not None and budget.is_exhausted(iteration)
+        if synchronizer:
+            exhausted = synchronizer.any(exhausted)
+        if exhausted:
+            budget.truncate(PHASE_METABOLITE_DIVERSITY, get_maximization_step_name(maximization_pass, iteration))
+            break
+        METRICS.inc(MAXIMIZATION_ITERATIONS)
         logging.info("  satisfying metabolite diversity...")
+        old_term_id2clu = dict(term_id2clu)
         term_id2clu = maximize(unmapped_s_ids, model, term_id2clu, species_id2chebi_id, ub_term_ids,
-                               r_ids_to_ignore=r_ids_to_ignore)
+                               r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, iteration=iteration, clus=dirty_clus,
+                               budget=budget, maximization_pass=maximization_pass)
         onto_updated = cover_with_onto_terms(model, onto, species_id2chebi_id, term_id2clu, ub_term_ids,
-                                             r_ids_to_ignore=r_ids_to_ignore)
-
-
-def find_term_clustering(model, chebi, species_id2chebi_id, unmapped_s_ids, ubiquitous_chebi_ids, r_ids_to_ignore=None):
+                                             r_ids_to_ignore=r_ids_to_ignore, monitor=monitor,
+                                             t_ids2common_ancestors=t_ids2common_ancestors,
+                                             reaction_index=reaction_index, budget=budget,
+                                             step=get_maximization_step_name(maximization_pass, iteration),
+                                             synchronizer=synchronizer)
+        clustering_changed = term_id2clu != old_term_id2clu
+        if synchronizer:
+            clustering_changed = synchronizer.any(clustering_changed)
+        dirty_clus = get_dirty_clusters(term_id2clu, old_term_id2clu, t_id2neighbour_t_ids)
+        if not onto_updated and not clustering_changed:
+            logging.info("  reached a fixed point after %d iteration(s)" % iteration)
+
+
+def find_term_clustering(model, chebi, species_id2chebi_id, unmapped_s_ids, ubiquitous_chebi_ids, r_ids_to_ignore=None,
+                         monitor=None, budget=None, max_exact_cluster_size=None):
     """
     Calculates a ChEBI term id clustering for the given model.
     :param model: libsbml.Model model of interest
@@ -227,42 +489,405 @@ def find_term_clustering(model, chebi, species_id2chebi_id, unmapped_s_ids, ubiq
     :param unmapped_s_ids: set of ids of metabolite for which no ChEBI term was found
     :param ubiquitous_chebi_ids: set of ubiquitous ChEBI ids
     :param r_ids_to_ignore: (optional) ids of reactions whose stoichiometry preserving constraint can be ignores
+    :param monitor: (optional) sbml_generalization.generalization.progress.ProgressMonitor
+    to report progress to and check for cancellation
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time/iteration budget:
+    once it is exhausted, the best clustering found so far that preserves stoichiometry is returned,
+    and the truncated phases are listed in budget.truncated_phases
+    :param max_exact_cluster_size: (optional) int, see fix_stoichiometry
     :return: dict {ChEBI_term_id: cluster}
     """
+    if not monitor:
+        monitor = ProgressMonitor()
+    if budget:
+        budget.start_timer()
     if not ubiquitous_chebi_ids:
         ubiquitous_chebi_ids = set()
     chebi_ids = set(species_id2chebi_id.values()) - ubiquitous_chebi_ids
 
     logging.info("  aggressive metabolite grouping...")
+    monitor.report(PHASE_AGGRESSIVE_GROUPING)
     term_id2clu = cover_t_ids(model, species_id2chebi_id, ubiquitous_chebi_ids, chebi_ids, chebi,
-                              r_ids_to_ignore=r_ids_to_ignore)
+                              r_ids_to_ignore=r_ids_to_ignore, budget=budget)
     chebi.trim({it[0] for it in term_id2clu.values()}, relationships=EQUIVALENT_RELATIONSHIPS)
     suggest_clusters(model, unmapped_s_ids, term_id2clu, species_id2chebi_id, ubiquitous_chebi_ids,
                      r_ids_to_ignore=r_ids_to_ignore)
     # filter_clu_to_terms(term_id2clu)
     # _log_clusters(term_id2clu, onto, model)
 
+    refine_term_clustering(model, chebi, species_id2chebi_id, term_id2clu, unmapped_s_ids, ubiquitous_chebi_ids,
+                           r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget,
+                           max_exact_cluster_size=max_exact_cluster_size)
+    return term_id2clu
+
+
+def refine_term_clustering(model, chebi, species_id2chebi_id, term_id2clu, unmapped_s_ids, ubiquitous_chebi_ids,
+                           r_ids_to_ignore=None, monitor=None, budget=None, clus=None, max_exact_cluster_size=None,
+                           synchronizer=None):
+    """
+    Splits the clusters of the aggressive term grouping, so that they satisfy metabolite diversity
+    and preserve reaction stoichiometry.
+    :param model: libsbml.Model model of interest
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param species_id2chebi_id: dict {metabolite_id: ChEBI_term_id}
+    :param term_id2clu: dict {ChEBI_term_id: cluster}, the aggressive term grouping
+    :param unmapped_s_ids: set of ids of metabolite for which no ChEBI term was found
+    :param ubiquitous_chebi_ids: set of ubiquitous ChEBI ids
+    :param r_ids_to_ignore: (optional) ids of reactions whose stoichiometry preserving constraint can be ignores
+    :param monitor: (optional) sbml_generalization.generalization.progress.ProgressMonitor
+    to report progress to and check for cancellation
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time/iteration budget
+    :param clus: (optional) collection of clusters that might not satisfy metabolite diversity
+    (if None, all the clusters are checked), the other ones are only checked again if their neighbours change
+    :param max_exact_cluster_size: (optional) int, see fix_stoichiometry
+    :param synchronizer: (optional) ComponentGroupSynchronizer, see maximization_step
+    :return: void, term_id2clu is updated inplace
+    """
     maximization_step(model, chebi, species_id2chebi_id, term_id2clu, ubiquitous_chebi_ids, unmapped_s_ids,
-                      r_ids_to_ignore=r_ids_to_ignore)
+                      r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget, clus=clus, maximization_pass=1,
+                      synchronizer=synchronizer)
     # filter_clu_to_terms(term_id2clu)
     # _log_clusters(term_id2clu, onto, model)
 
     logging.info("  preserving stoichiometry...")
+    old_term_id2clu = dict(term_id2clu) if clus is not None else None
     fix_stoichiometry(model, term_id2clu, species_id2chebi_id, ubiquitous_chebi_ids, chebi,
-                      r_ids_to_ignore=r_ids_to_ignore)
+                      r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget,
+                      max_exact_cluster_size=max_exact_cluster_size)
     # filter_clu_to_terms(term_id2clu)
     # _log_clusters(term_id2clu, onto, model)
 
+    if clus is not None:
+        clus = get_dirty_clusters(term_id2clu, old_term_id2clu, get_t_id2neighbour_t_ids(model, species_id2chebi_id))
     maximization_step(model, chebi, species_id2chebi_id, term_id2clu, ubiquitous_chebi_ids, unmapped_s_ids,
-                      r_ids_to_ignore=r_ids_to_ignore)
+                      r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget, clus=clus, maximization_pass=2,
+                      synchronizer=synchronizer)
     # filter_clu_to_terms(term_id2clu)
     # _log_clusters(term_id2clu, onto, model)
 
+
+# how often (in seconds) the parent process checks for cancellation while the components are being clustered
+CANCELLATION_CHECK_INTERVAL = 0.5
+
+# the model, ontology and aggressive term grouping, shared with the (forked) component clustering processes
+_component_context = None
+
+SYNC_ANY = 'any'
+SYNC_SHARED_ANCESTORS = 'shared_ancestors'
+
+
+class ComponentGroupSynchronizer(object):
+    """
+    Lets a group of components, clustered in a worker process, take the decisions the clustering of the model
+    as a whole would take: the ancestors shared by clusters of any groups are removed from the ontology,
+    and the groups iterate until none of them changes. Each call blocks until all the groups have made it,
+    and the parent process (see serve_component_groups) has combined their answers.
+    """
+
+    def __init__(self, connection):
+        """
+        :param connection: multiprocessing.connection.Connection to the parent process
+        """
+        self.connection = connection
+
+    def _exchange(self, kind, value):
+        self.connection.send((kind, value))
+        return self.connection.recv()
+
+    def any(self, value):
+        """
+        :param value: boolean, this group's value
+        :return: boolean, whether the value is True for any group
+        """
+        return self._exchange(SYNC_ANY, value)
+
+    def get_shared_ancestor_ids(self, ancestor_id_count):
+        """
+        :param ancestor_id_count: Counter {term_id: number of this group's clusters it is a common ancestor of}
+        :return: sorted list of ids of the terms that are common ancestors of several clusters of all the groups
+        """
+        return self._exchange(SYNC_SHARED_ANCESTORS, ancestor_id_count)
+
+
+def serve_component_groups(connections, result, monitor):
+    """
+    Combines the answers of the groups of components (see ComponentGroupSynchronizer)
+    until their clustering is over, checking for cancellation in the meantime.
+    :param connections: list of multiprocessing.connection.Connection to the worker processes, one per group
+    :param result: multiprocessing.pool.AsyncResult of the groups' clustering
+    :param monitor: sbml_generalization.generalization.progress.ProgressMonitor
+    :return: void
+    """
+    connection2request = {}
+    # once any group fails, the result is ready too, and the others (that might be waiting for it) are terminated
+    while not result.ready():
+        for connection in multiprocessing.connection.wait([it for it in connections if it not in connection2request],
+                                                          CANCELLATION_CHECK_INTERVAL):
+            connection2request[connection] = connection.recv()
+        if len(connection2request) == len(connections):
+            kinds = {kind for (kind, _) in connection2request.values()}
+            if len(kinds) != 1:
+                raise ValueError('the groups of components got out of step: %s' % ', '.join(sorted(kinds)))
+            values = [value for (_, value) in connection2request.values()]
+            if SYNC_SHARED_ANCESTORS in kinds:
+                count = sum(values, Counter())
+                reply = sorted(t_id for (t_id, n) in count.items() if n > 1)
+            else:
+                reply = any(values)
+            for connection in connections:
+                connection.send(reply)
+            connection2request = {}
+        monitor.check_cancelled()
+
+
+def _refine_component_term_clustering(i):
+    model, chebi, species_id2chebi_id, term_id2clu, unmapped_s_ids, ubiquitous_chebi_ids, r_ids_to_ignore, \
+        groups, connections, budget, max_exact_cluster_size, collect_metrics = _component_context
+    t_ids, r_ids = groups[i]
+    # the worker process inherited the parent's budget records, only its own ones (and its metrics) are sent back
+    metrics = MetricsRegistry()
+    if collect_metrics:
+        metrics.enable()
+    if budget:
+        budget.truncated_phases, budget.truncations, budget.approximated_clusters = [], [], []
+    onto_t_ids = chebi.get_all_term_ids()
+    component_term_id2clu = {t_id: clu for (t_id, clu) in term_id2clu.items() if t_id in t_ids}
+    # the reactions of the other components are ignored
+    component_r_ids_to_ignore = {r.getId() for r in model.getListOfReactions() if r.getId() not in r_ids}
+    monitor = ProgressMonitor(metrics=metrics)
+    with monitor.recording_metrics():
+        refine_term_clustering(model, chebi, species_id2chebi_id, component_term_id2clu, unmapped_s_ids & t_ids,
+                               ubiquitous_chebi_ids, r_ids_to_ignore=component_r_ids_to_ignore, monitor=monitor,
+                               budget=budget, max_exact_cluster_size=max_exact_cluster_size,
+                               synchronizer=ComponentGroupSynchronizer(connections[i]))
+    # the terms this component removed from its copy of the ontology, to be removed from the parent's one as well
+    removed_t_ids = onto_t_ids - chebi.get_all_term_ids()
+    truncations = budget.truncations if budget else []
+    approximated_clusters = budget.approximated_clusters if budget else []
+    return component_term_id2clu, removed_t_ids, truncations, approximated_clusters, metrics.get_snapshot()
+
+
+def find_term_clustering_by_components(model, chebi, species_id2chebi_id, unmapped_s_ids, ubiquitous_chebi_ids,
+                                       r_ids_to_ignore=None, monitor=None, budget=None, processes=None,
+                                       max_exact_cluster_size=None):
+    """
+    Calculates a ChEBI term id clustering for the given model, like find_term_clustering does,
+    but partitions the model into independent components (see
+    sbml_generalization.generalization.components.get_components), and refines the aggressive term grouping
+    for groups of components in parallel processes. The groups iterate together and remove the same ancestors
+    from their copies of the ontology (those shared by clusters of any groups), as the model would as a whole.
+    The resulting cluster maps are then combined (keeping their labels),
+    the terms removed from the ontology by the groups are removed from the shared one,
+    and the clusters split between several groups or affected by the other groups' removals are maximized again.
+    The budget records (truncations and approximated clusters) of the groups are added to the budget,
+    and their metrics to the monitor's registry;
+    the worker processes are terminated once the generalization is cancelled.
+    :param model: libsbml.Model model of interest
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param species_id2chebi_id: dict {metabolite_id: ChEBI_term_id}
+    :param unmapped_s_ids: set of ids of metabolite for which no ChEBI term was found
+    :param ubiquitous_chebi_ids: set of ubiquitous ChEBI ids
+    :param r_ids_to_ignore: (optional) ids of reactions whose stoichiometry preserving constraint can be ignores
+    :param monitor: (optional) sbml_generalization.generalization.progress.ProgressMonitor
+    to report progress to and check for cancellation
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time/iteration budget
+    :param processes: (optional) int, maximal number of worker processes (by default the number of CPUs)
+    :param max_exact_cluster_size: (optional) int, see fix_stoichiometry
+    :return: dict {ChEBI_term_id: cluster}
+    """
+    global _component_context
+
+    if not monitor:
+        monitor = ProgressMonitor()
+    if budget:
+        budget.start_timer()
+    if not ubiquitous_chebi_ids:
+        ubiquitous_chebi_ids = set()
+    chebi_ids = set(species_id2chebi_id.values()) - ubiquitous_chebi_ids
+
+    logging.info("  aggressive metabolite grouping...")
+    monitor.report(PHASE_AGGRESSIVE_GROUPING)
+    term_id2clu = cover_t_ids(model, species_id2chebi_id, ubiquitous_chebi_ids, chebi_ids, chebi,
+                              r_ids_to_ignore=r_ids_to_ignore, budget=budget)
+    chebi.trim({it[0] for it in term_id2clu.values()}, relationships=EQUIVALENT_RELATIONSHIPS)
+    suggest_clusters(model, unmapped_s_ids, term_id2clu, species_id2chebi_id, ubiquitous_chebi_ids,
+                     r_ids_to_ignore=r_ids_to_ignore)
+
+    processes = processes or multiprocessing.cpu_count()
+    components = get_components(model, species_id2chebi_id, chebi_ids | unmapped_s_ids, ubiquitous_chebi_ids,
+                                r_ids_to_ignore)
+    groups = group_components(components, processes)
+    logging.info("  partitioned the model into %d components, processed in %d groups"
+                 % (len(components), len(groups)))
+    if len(groups) <= 1 or not can_fork():
+        refine_term_clustering(model, chebi, species_id2chebi_id, term_id2clu, unmapped_s_ids, ubiquitous_chebi_ids,
+                               r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget,
+                               max_exact_cluster_size=max_exact_cluster_size)
+        return term_id2clu
+
+    monitor.report(PHASE_METABOLITE_DIVERSITY)
+    # the groups iterate together (see ComponentGroupSynchronizer), one connection pair per group
+    pipes = [multiprocessing.Pipe() for _ in groups]
+    _component_context = model, chebi, species_id2chebi_id, term_id2clu, set(unmapped_s_ids), ubiquitous_chebi_ids, \
+        r_ids_to_ignore, groups, [it[1] for it in pipes], budget, max_exact_cluster_size, \
+        monitor.metrics is not None and monitor.metrics.enabled
+    try:
+        # each group modifies its own copy of the ontology, hence a newly forked worker per group,
+        # all of them running at the same time
+        with fork_pool(len(groups), maxtasksperchild=1) as pool:
+            result = pool.map_async(_refine_component_term_clustering, range(len(groups)), chunksize=1)
+            # the workers cannot see the cancellation token, so the pool is terminated on cancellation
+            serve_component_groups([it[0] for it in pipes], result, monitor)
+            results = result.get()
+    finally:
+        _component_context = None
+        for connection in chain(*pipes):
+            connection.close()
+
+    # the same cluster might have been split between several groups of components,
+    # the clusters they labelled the same way are maximized (i.e. split) again as they would be as a whole
+    term_id2clu, clu2i, clus = {}, {}, set()
+    for i, (component_term_id2clu, _, truncations, approximated_clusters, metrics_snapshot) in enumerate(results):
+        if monitor.metrics is not None:
+            monitor.metrics.merge(metrics_snapshot)
+        for t_id, clu in component_term_id2clu.items():
+            if clu2i.setdefault(clu, i) != i:
+                clus.add(clu)
+            term_id2clu[t_id] = clu
+        if budget:
+            for truncation in truncations:
+                budget.truncate(truncation['phase'], truncation['where'])
+            for clu in approximated_clusters:
+                with budget.lock:
+                    budget.approximated_clusters.append(clu)
+
+    # The ontology state is shared by all the components, as it would be if the model was clustered as a whole
+    # (the groups remove the same terms, but in case one of them did not):
+    # the clusters that lose their common ancestors with the terms removed by the other groups
+    # are covered with the ontology terms (and maximized) again
+    removed_t_ids = set(chain(*(it[1] for it in results)))
+    for component_term_id2clu, component_removed_t_ids, _, _, _ in results:
+        other_removed_t_ids = removed_t_ids - component_removed_t_ids
+        if not other_removed_t_ids:
+            continue
+        for clu, t_ids in invert_map(component_term_id2clu).items():
+            if next((t_id for t_id in t_ids if t_id in other_removed_t_ids
+                     or get_ancestor_ids(chebi, t_id) & other_removed_t_ids), None):
+                clus.add(clu)
+    for t_id in removed_t_ids:
+        if chebi.get_term(t_id):
+            chebi.remove_term(chebi.get_term(t_id), True)
+
+    logging.info("  reconciling the components...")
+    if clus:
+        old_term_id2clu = dict(term_id2clu)
+        cover_clusters(model, chebi, species_id2chebi_id, term_id2clu, clus, ubiquitous_chebi_ids,
+                       r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget)
+        clus = get_dirty_clusters(term_id2clu, old_term_id2clu, get_t_id2neighbour_t_ids(model, species_id2chebi_id))
+    # Reactions of different components never get generalized together, so the other clusters are already maximal
+    # and preserve stoichiometry inside their components
+    refine_term_clustering(model, chebi, species_id2chebi_id, term_id2clu, unmapped_s_ids, ubiquitous_chebi_ids,
+                           r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget, clus=clus,
+                           max_exact_cluster_size=max_exact_cluster_size)
     return term_id2clu
 
 
+def find_term_clustering_from_core(model, chebi, species_id2chebi_id, unmapped_s_ids, ubiquitous_chebi_ids,
+                                   core_term_id2clu, core_t_ids, core_r_ids, r_ids_to_ignore=None, monitor=None,
+                                   budget=None, max_exact_cluster_size=None):
+    """
+    Calculates a ChEBI term id clustering for the given model, like find_term_clustering does,
+    starting from the clustering of a core model (i.e. a part of this model shared with other models):
+    only the model-specific terms are grouped aggressively, and only the clusters
+    that participate in the model-specific reactions are refined
+    (the core clusters can only be split further, not merged).
+    :param model: libsbml.Model model of interest
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology, as left by the core clustering
+    :param species_id2chebi_id: dict {metabolite_id: ChEBI_term_id}
+    :param unmapped_s_ids: set of ids of metabolite for which no ChEBI term was found
+    :param ubiquitous_chebi_ids: set of ubiquitous ChEBI ids
+    :param core_term_id2clu: dict {ChEBI_term_id: cluster}, the core model clustering
+    :param core_t_ids: set of ids of the core model terms (and unmapped metabolites)
+    :param core_r_ids: set of ids of the core model reactions
+    :param r_ids_to_ignore: (optional) ids of reactions whose stoichiometry preserving constraint can be ignores
+    :param monitor: (optional) sbml_generalization.generalization.progress.ProgressMonitor
+    to report progress to and check for cancellation
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time/iteration budget
+    :param max_exact_cluster_size: (optional) int, see fix_stoichiometry
+    :return: dict {ChEBI_term_id: cluster}
+    """
+    if not monitor:
+        monitor = ProgressMonitor()
+    if budget:
+        budget.start_timer()
+    if not ubiquitous_chebi_ids:
+        ubiquitous_chebi_ids = set()
+    specific_chebi_ids = set(species_id2chebi_id.values()) - ubiquitous_chebi_ids - core_t_ids
+    specific_s_ids = set(unmapped_s_ids) - core_t_ids
+
+    logging.info("  aggressive grouping of the model-specific metabolites...")
+    monitor.report(PHASE_AGGRESSIVE_GROUPING)
+    term_id2clu = dict(core_term_id2clu)
+    if specific_chebi_ids:
+        specific_term_id2clu = cover_t_ids(model, species_id2chebi_id, ubiquitous_chebi_ids, specific_chebi_ids, chebi,
+                                           r_ids_to_ignore=r_ids_to_ignore, budget=budget)
+        # the core clusters are roots as well: their (lowest) common ancestors must not be trimmed,
+        # otherwise they would not be covered as they are in the core clustering
+        root_ids = {it[0] for it in chain(core_term_id2clu.values(), specific_term_id2clu.values())
+                    if chebi.get_term(it[0])}
+        for t_ids in invert_map(core_term_id2clu).values():
+            terms = {chebi.get_term(t_id) for t_id in t_ids if chebi.get_term(t_id)}
+            if terms:
+                root_ids |= {t.get_id() for t in chebi.common_points(terms, relationships=EQUIVALENT_RELATIONSHIPS)}
+        chebi.trim(root_ids, relationships=EQUIVALENT_RELATIONSHIPS)
+        term_id2clu.update(specific_term_id2clu)
+    suggest_clusters(model, specific_s_ids, term_id2clu, species_id2chebi_id, ubiquitous_chebi_ids,
+                     r_ids_to_ignore=r_ids_to_ignore)
+
+    # the clusters of the model-specific terms and of the terms participating in the model-specific reactions
+    specific_t_ids = specific_chebi_ids | specific_s_ids
+    for r in model.getListOfReactions():
+        if r.getId() not in core_r_ids:
+            specific_t_ids |= {species_id2chebi_id[s_id] if s_id in species_id2chebi_id else s_id
+                               for s_id in chain(get_reactants(r), get_products(r))}
+    clus = {term_id2clu[t_id] for t_id in specific_t_ids if t_id in term_id2clu}
+    logging.info("  refining %d of %d clusters..." % (len(clus), len(set(term_id2clu.values()))))
+    refine_term_clustering(model, chebi, species_id2chebi_id, term_id2clu, unmapped_s_ids, ubiquitous_chebi_ids,
+                           r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget, clus=clus,
+                           max_exact_cluster_size=max_exact_cluster_size)
+    return term_id2clu
+
+
+def get_species_degree_histogram(model, s_id2chebi_id):
+    """
+    Counts in how many reactions the species annotated with each ChEBI term participate
+    (the same way as mod_sbml.sbml.ubiquitous_manager.get_frequent_term_ids does).
+    :param model: libsbml.Model model of interest
+    :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
+    :return: collections.Counter {(ChEBI_term_id, compartment_id): number of reaction participations}
+    """
+    key2vote = Counter()
+    for reaction in model.getListOfReactions():
+        for s_id in chain(get_reactants(reaction), get_products(reaction)):
+            if s_id in s_id2chebi_id:
+                METRICS.inc(SPECIES_LOOKUPS)
+                key2vote[(s_id2chebi_id[s_id], model.getSpecies(s_id).getCompartment())] += 1
+    return key2vote
+
+
+def get_frequent_term_ids_by_histogram(key2vote, threshold):
+    """
+    Selects the ChEBI terms whose species participate in more than threshold reactions (in some compartment).
+    :param key2vote: dict {(ChEBI_term_id, compartment_id): number of reaction participations}
+    :param threshold: threshold for a metabolite to be considered as frequently participating in reactions
+    :return: set of ChEBI term ids
+    """
+    return {chebi_id for ((chebi_id, _), vote) in key2vote.items() if vote > threshold}
+
+
 def generalize_species(model, s_id2chebi_id, ub_s_ids, chebi, ub_chebi_ids, threshold=UBIQUITOUS_THRESHOLD,
-                       r_ids_to_ignore=None):
+                       r_ids_to_ignore=None, monitor=None, budget=None, partitioned=False, processes=None, core=None,
+                       max_exact_cluster_size=None, degree_histogram=None):
     """
     Groups metabolites of the model into clusters.
     :param model: libsbml.Model model of interest
@@ -273,11 +898,59 @@ def generalize_species(model, s_id2chebi_id, ub_s_ids, chebi, ub_chebi_ids, thre
     :param threshold: threshold for a metabolite to be considered as frequently participating in reactions
     and therefore ubiquitous
     :param r_ids_to_ignore: (optional) ids of reactions whose stoichiometry preserving constraint can be ignores
+    :param monitor: (optional) sbml_generalization.generalization.progress.ProgressMonitor
+    to report progress to and check for cancellation
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time/iteration budget for the clustering
+    :param partitioned: boolean, whether to partition the model into independent components
+    and cluster them in parallel processes
+    :param processes: (optional) int, maximal number of worker processes for the partitioned clustering
+    (by default the number of CPUs)
+    :param core: (optional) tuple (core_term_id2clu, core_t_ids, core_r_ids), the clustering of a core model
+    shared with other models, its terms and reactions (see find_term_clustering_from_core)
+    :param max_exact_cluster_size: (optional) int, maximal number of terms of a cluster that is split
+    with the exact greedy search to preserve the reaction stoichiometry, the bigger ones are split approximately
+    (see fix_stoichiometry)
+    :param degree_histogram: (optional) the model's species degree histogram (see get_species_degree_histogram),
+    if it was already calculated (e.g. once for all the settings of a sweep)
     :return:
     """
     unmapped_s_ids = {s.getId() for s in model.getListOfSpecies() if s.getId() not in s_id2chebi_id}
-    term_id2clu = find_term_clustering(model, chebi, s_id2chebi_id, unmapped_s_ids, ub_chebi_ids,
-                                       r_ids_to_ignore=r_ids_to_ignore)
+    if core:
+        core_term_id2clu, core_t_ids, core_r_ids = core
+        term_id2clu = find_term_clustering_from_core(model, chebi, s_id2chebi_id, unmapped_s_ids, ub_chebi_ids,
+                                                     core_term_id2clu, core_t_ids, core_r_ids,
+                                                     r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget,
+                                                     max_exact_cluster_size=max_exact_cluster_size)
+    elif partitioned:
+        term_id2clu = find_term_clustering_by_components(model, chebi, s_id2chebi_id, unmapped_s_ids, ub_chebi_ids,
+                                                         r_ids_to_ignore=r_ids_to_ignore, monitor=monitor,
+                                                         budget=budget, processes=processes,
+                                                         max_exact_cluster_size=max_exact_cluster_size)
+    else:
+        term_id2clu = find_term_clustering(model, chebi, s_id2chebi_id, unmapped_s_ids, ub_chebi_ids,
+                                           r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget,
+                                           max_exact_cluster_size=max_exact_cluster_size)
+    return get_species_clustering(model, s_id2chebi_id, unmapped_s_ids, term_id2clu, chebi, ub_s_ids, threshold,
+                                  degree_histogram)
+
+
+def get_species_clustering(model, s_id2chebi_id, unmapped_s_ids, term_id2clu, chebi, ub_s_ids,
+                           threshold=UBIQUITOUS_THRESHOLD, degree_histogram=None):
+    """
+    Groups metabolites of the model into clusters of their terms, and infers the ubiquitous metabolites
+    (if they are not given) among the frequent ones that stay ungrouped.
+    :param model: libsbml.Model model of interest
+    :param s_id2chebi_id: dict {metabolite_id: ChEBI_term_id}
+    :param unmapped_s_ids: set of ids of metabolite for which no ChEBI term was found
+    :param term_id2clu: dict {ChEBI_term_id: cluster}, the term clustering (see find_term_clustering)
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param ub_s_ids: collection of ubiquitous metabolite ids
+    :param threshold: threshold for a metabolite to be considered as frequently participating in reactions
+    and therefore ubiquitous
+    :param degree_histogram: (optional) the model's species degree histogram (see get_species_degree_histogram),
+    calculated if needed and not given
+    :return: tuple (s_id2clu, ub_s_ids): dict {metabolite_id: cluster}, collection of ubiquitous metabolite ids
+    """
     if term_id2clu:
         term_id2clu = select_representative_terms(term_id2clu, chebi)
         s_id2clu = compute_s_id2clu(unmapped_s_ids, model, s_id2chebi_id, term_id2clu)
@@ -288,8 +961,11 @@ def generalize_species(model, s_id2chebi_id, ub_s_ids, chebi, ub_chebi_ids, thre
     else:
         s_id2clu = {}
     if not ub_s_ids:
-        frequent_ch_ids = get_frequent_term_ids(model, threshold)
-        ub_s_ids = select_metabolite_ids_by_term_ids(model, frequent_ch_ids) - set(s_id2clu.keys())
+        if degree_histogram is None:
+            degree_histogram = get_species_degree_histogram(model, s_id2chebi_id)
+        frequent_ch_ids = get_frequent_term_ids_by_histogram(degree_histogram, threshold)
+        ub_s_ids = {s_id for (s_id, chebi_id) in s_id2chebi_id.items() if chebi_id in frequent_ch_ids} \
+            - set(s_id2clu.keys())
     # unmapped_s_ids = {s_id for s_id in unmapped_s_ids if s_id not in s_id2clu}
     # infer_clusters(model, unmapped_s_ids, s_id2clu, species_id2chebi_id, ub_chebi_ids)
     return s_id2clu, ub_s_ids
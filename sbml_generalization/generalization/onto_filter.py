@@ -0,0 +1,62 @@
+from mod_sbml.onto.obo_ontology import Ontology
+from mod_sbml.onto.term import Term
+
+__author__ = 'anna'
+
+
+def get_terms_to_keep(onto, terms_collection, relationships=None, min_deepness=None):
+    """
+    Finds the terms that mod_sbml.onto.filter_ontology would keep: the terms in the given collection,
+    and their/their generalized (via specified relationships) ancestors' (up to the min_deepness level of ancestry)
+    generalized descendants.
+    :param onto: mod_sbml.onto.obo_ontology.Ontology ontology
+    :param terms_collection: collection of terms to be kept
+    :param relationships: collection of relationships to be kept (or None to keep all of them)
+    :param min_deepness: int, generalized (via specified relationships) ancestors' up to the min_deepness
+    level of ancestry will be considered (or None to get ancestors up to root)
+    :return: set of terms to be kept
+    """
+    terms_to_keep = set()
+    for term in terms_collection:
+        if term in terms_to_keep:
+            continue
+        terms_to_keep |= onto.get_sub_tree(term, relationships=relationships)
+        for ancestor in onto.get_generalized_ancestors(term, direct=False, checked=set(), relationships=relationships,
+                                                       depth=min_deepness):
+            terms_to_keep |= onto.get_sub_tree(ancestor, relationships=relationships)
+    return terms_to_keep
+
+
+def copy_filtered_ontology(onto, terms_collection, relationships=None, min_deepness=None):
+    """
+    Creates a filtered copy of a given ontology, equivalent to the result of mod_sbml.onto.filter_ontology,
+    but leaves the input ontology intact. As only the kept terms are copied,
+    it is also much faster than removing the others from a big ontology.
+    :param onto: mod_sbml.onto.obo_ontology.Ontology ontology
+    :param terms_collection: collection of terms to be kept
+    :param relationships: collection of relationships to be kept (or None to keep all of them)
+    :param min_deepness: int, generalized (via specified relationships) ancestors' up to the min_deepness
+    level of ancestry will be considered (or None to get ancestors up to root)
+    :return: mod_sbml.onto.obo_ontology.Ontology the filtered copy
+    """
+    terms_to_keep = get_terms_to_keep(onto, terms_collection, relationships, min_deepness)
+    removed_ids = onto.get_all_term_ids() - {t.get_id() for t in terms_to_keep}
+    kept_ids = set()
+    for term in terms_to_keep:
+        kept_ids |= term.get_all_ids()
+
+    copy = Ontology()
+    for term in terms_to_keep:
+        new_term = Term(onto=copy, t_id=term.get_id(), name=term.get_name(),
+                        parent_ids=(p_id for p_id in term.get_parent_ids() if p_id in kept_ids))
+        new_term.altIds = set(term.altIds)
+        new_term.synonyms = term.get_synonyms()
+        for db in term.get_dbs():
+            new_term.xrefs[db] = term.get_xrefs(db)
+        copy.add_term(new_term)
+
+    for rel_set in onto.rel_map.values():
+        for (subj, rel, obj) in rel_set:
+            if (relationships is None or rel in relationships) and subj not in removed_ids and obj not in removed_ids:
+                copy.add_relationship(subj, rel, obj)
+    return copy
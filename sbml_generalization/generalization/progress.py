@@ -0,0 +1,112 @@
+import logging
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from sbml_generalization.generalization.metrics import METRICS
+
+__author__ = 'anna'
+
+PHASE_PREPROCESSING = 'preprocessing'
+PHASE_AGGRESSIVE_GROUPING = 'aggressive metabolite grouping'
+PHASE_METABOLITE_DIVERSITY = 'satisfying metabolite diversity'
+PHASE_STOICHIOMETRY = 'preserving stoichiometry'
+PHASE_REACTION_GROUPING = 'reaction grouping'
+PHASE_SERIALIZATION = 'serialization'
+PHASE_DONE = 'done'
+
+
+def get_peak_memory():
+    """
+    Gets the peak resident set size of the current process.
+    :return: float, peak memory usage in MB, or None if it cannot be measured on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+
+def log_peak_memory(phase):
+    """
+    Logs the peak memory usage of the current process (if it can be measured on this platform).
+    :param phase: str, the phase that has just been completed
+    """
+    peak = get_peak_memory()
+    if peak is not None:
+        logging.info("peak memory usage after %s: %.1f MB" % (phase, peak))
+
+
+class GeneralizationCancelled(Exception):
+    def __init__(self):
+        Exception.__init__(self, "generalization was cancelled")
+        self.msg = "generalization was cancelled"
+
+
+class CancellationToken(object):
+    """
+    Allows to cancel a running generalization from another thread.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+
+class ProgressMonitor(object):
+    """
+    Reports generalization progress events to a callback and checks whether the generalization was cancelled.
+    Each event is a dict {'phase': phase, 'iteration': iteration, 'done': processed_cluster_number,
+    'total': total_cluster_number, 'elapsed': seconds_since_start, 'peak_memory': peak_memory_usage_in_MB}.
+    It also carries the metrics registry of the generalization (see metrics.METRICS),
+    which the threads working for it record to.
+    """
+
+    def __init__(self, callback=None, cancellation_token=None, metrics=None):
+        """
+        :param callback: (optional) function that takes an event dict as its only argument
+        :param cancellation_token: (optional) CancellationToken
+        :param metrics: (optional) sbml_generalization.generalization.metrics.MetricsRegistry
+        of this generalization (by default the one the current thread records to, if any)
+        """
+        self.callback = callback
+        self.cancellation_token = cancellation_token
+        self.metrics = metrics if metrics is not None else METRICS.get_registry()
+        self.start = time.time()
+        self.lock = threading.RLock()
+
+    def report(self, phase, iteration=None, done=None, total=None):
+        if not self.callback:
+            return
+        with self.lock:
+            self.callback({'phase': phase, 'iteration': iteration, 'done': done, 'total': total,
+                           'elapsed': time.time() - self.start, 'peak_memory': get_peak_memory()})
+
+    def is_cancelled(self):
+        return self.cancellation_token is not None and self.cancellation_token.is_cancelled()
+
+    def check_cancelled(self):
+        """
+        Raises GeneralizationCancelled if the generalization was cancelled.
+        """
+        if self.is_cancelled():
+            raise GeneralizationCancelled()
+
+    def recording_metrics(self):
+        """
+        Makes the current thread record the metrics to this generalization's registry
+        until the end of the with block.
+        """
+        return METRICS.bind(self.metrics)
@@ -2,16 +2,21 @@ import logging
 
 import libsbml
 
-from mod_sbml.sbml.ubiquitous_manager import UBIQUITOUS_THRESHOLD, select_metabolite_ids_by_term_ids, \
-    get_ubiquitous_chebi_ids
+from mod_sbml.sbml.ubiquitous_manager import UBIQUITOUS_THRESHOLD, get_ubiquitous_chebi_ids
 from mod_sbml.onto import filter_ontology
 from mod_sbml.sbml.compartment.compartment_manager import separate_boundary_metabolites
 from mod_sbml.sbml.submodel_manager import get_biomass_r_ids
 from sbml_generalization.sbml.sbml_helper import save_as_comp_generalized_sbml, remove_is_a_reactions, \
-    remove_unused_elements
+    remove_unused_elements, read_sbml, get_sbml_document, get_comp_generalized_documents
+from sbml_generalization.sbml.model_cache import get_sbml_model
 from sbml_generalization.generalization.model_generalizer import generalize_species, generalize_reactions
+from sbml_generalization.generalization.onto_filter import copy_filtered_ontology
+from sbml_generalization.generalization.shared_ontology import SharedOntology
+from sbml_generalization.generalization.progress import ProgressMonitor, PHASE_PREPROCESSING, \
+    PHASE_REACTION_GROUPING, PHASE_SERIALIZATION, PHASE_DONE, log_peak_memory
 from mod_sbml.annotation.chebi.chebi_annotator import add_equivalent_chebi_ids, \
-    EQUIVALENT_RELATIONSHIPS, annotate_metabolites, get_species_id2chebi_id
+    EQUIVALENT_RELATIONSHIPS, get_species_id2chebi_id
+from sbml_generalization.annotation.species_annotator import annotate_species, add_chebi_annotations
 from mod_sbml.utils.misc import invert_map
 
 __author__ = 'anna'
@@ -21,7 +26,8 @@ def get_ub_elements(model, chebi, s_id2chebi_id, ub_chebi_ids, ub_s_ids):
     """
     Infers ubiquitous species in the model.
     :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
-    :param model: libsbml.Model, input model
+    :param model: libsbml.Model (or sbml_generalization.sbml.model_cache.CachedModel), input model
+    (or None if the species come from several models)
     :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
     :param ub_s_ids: optional, ids of ubiquitous species (will be inferred if set to None)
     :param ub_chebi_ids: optional, ids of ubiquitous ChEBI terms (will be inferred if set to None)
@@ -37,59 +43,271 @@ def get_ub_elements(model, chebi, s_id2chebi_id, ub_chebi_ids, ub_s_ids):
                                                     chebi=chebi)
         else:
             ub_chebi_ids = add_equivalent_chebi_ids(chebi, ub_chebi_ids)
-        ub_s_ids = select_metabolite_ids_by_term_ids(model, ub_chebi_ids)
+        ub_s_ids = {s_id for (s_id, chebi_id) in s_id2chebi_id.items() if chebi_id in ub_chebi_ids}
     return ub_chebi_ids, ub_s_ids
 
 
-def generalize_model(in_sbml, chebi, groups_sbml, out_sbml, ub_s_ids=None, ub_chebi_ids=None, ignore_biomass=True):
+def get_ubiquitous_threshold(model):
     """
-    Generalizes a model.
+    Calculates the threshold for a metabolite to be considered as frequently participating in reactions
+    (and therefore ubiquitous) in the model.
+    :param model: libsbml.Model, input model
+    :return: int, threshold
+    """
+    return min(max(3, int(0.1 * model.getNumReactions())), UBIQUITOUS_THRESHOLD)
+
+
+def preprocess_model(in_sbml, chebi, ignore_biomass=True, annotation_cache=None, name_index=None, model_cache=None):
+    """
+    Reads a model, annotates its species with ChEBI terms
+    and removes the elements that should not take part in the generalization.
+    If a model cache is given and the model is found there, the SBML parsing and annotation are skipped
+    and a read-only sbml_generalization.sbml.model_cache.CachedModel is returned instead of the libsbml one
+    (see sbml_generalization.sbml.model_cache.get_sbml_model to get the libsbml model for serialization).
     :param in_sbml: str, path to the input SBML file
     :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
-    :param groups_sbml: str, path to the output SBML file (with groups extension)
-    :param out_sbml: str, path to the output SBML file (generalized)
-    :param ub_s_ids: optional, ids of ubiquitous species (will be inferred if set to None)
-    :param ub_chebi_ids: optional, ids of ubiquitous ChEBI terms (will be inferred if set to None)
     :param ignore_biomass: boolean, whether to ignore the biomass reaction (and its stoichiometry preserving constraint)
-    :return: tuple (r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids):
-    dict {reaction_id: reaction_group_id}, dict {species_id: species_group_id}, dict {species_id: ChEBI_term_id},
-    collection of ubiquitous species_ids.
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    to reuse ChEBI terms previously inferred from species names
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    to look species names up among ChEBI term names
+    :param model_cache: (optional) sbml_generalization.sbml.model_cache.ModelCache
+    to reuse models preprocessed during previous runs
+    :return: tuple (input_doc, input_model, s_id2chebi_id, r_ids_to_ignore): libsbml.SBMLDocument (or None
+    for a cached model), libsbml.Model (or CachedModel), dict {species_id: ChEBI_term_id},
+    ids of reactions whose stoichiometry preserving constraint can be ignored (or None).
+    """
+    if model_cache:
+        cached = model_cache.get(in_sbml, ignore_biomass, annotation_cache, name_index)
+        if cached:
+            input_model, s_id2chebi_id, r_ids_to_ignore = cached
+            return None, input_model, s_id2chebi_id, r_ids_to_ignore
+
+    input_doc, input_model, s_id2chebi_id, r_ids_to_ignore = \
+        preprocess_document(read_sbml(in_sbml), chebi, ignore_biomass, annotation_cache, name_index)
+    if model_cache:
+        model_cache.put(in_sbml, ignore_biomass, input_model, s_id2chebi_id, r_ids_to_ignore, annotation_cache,
+                        name_index)
+    return input_doc, input_model, s_id2chebi_id, r_ids_to_ignore
+
+
+def preprocess_document(input_doc, chebi, ignore_biomass=True, annotation_cache=None, name_index=None):
+    """
+    Annotates the species of the document's model with ChEBI terms
+    and removes (inplace) the elements that should not take part in the generalization.
+    :param input_doc: libsbml.SBMLDocument input document
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param ignore_biomass: boolean, whether to ignore the biomass reaction (and its stoichiometry preserving constraint)
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    to reuse ChEBI terms previously inferred from species names
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    to look species names up among ChEBI term names
+    :return: tuple (input_doc, input_model, s_id2chebi_id, r_ids_to_ignore): libsbml.SBMLDocument, libsbml.Model,
+    dict {species_id: ChEBI_term_id}, ids of reactions whose stoichiometry preserving constraint can be ignored
+    (or None).
     """
-    # input_model
-    input_doc = libsbml.SBMLReader().readSBML(in_sbml)
     input_model = input_doc.getModel()
     r_ids_to_ignore = get_biomass_r_ids(input_model) if ignore_biomass else None
 
     remove_is_a_reactions(input_model)
-    annotate_metabolites(input_model, chebi)
+    annotate_species(input_model, chebi, annotation_cache, name_index)
     # TODO: fix comp separation
     # separate_boundary_metabolites(input_model)
     remove_unused_elements(input_model)
 
     logging.info("mapping species to ChEBI")
     s_id2chebi_id = get_species_id2chebi_id(input_model)
-    ub_chebi_ids, ub_s_ids = get_ub_elements(input_model, chebi, s_id2chebi_id, ub_chebi_ids, ub_s_ids)
+    return input_doc, input_model, s_id2chebi_id, r_ids_to_ignore
 
+
+def filter_chebi(chebi, s_id2chebi_id, copy_chebi=False):
+    """
+    Filters ChEBI, keeping only the terms that are relevant for generalization of the given species.
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
+    :param copy_chebi: boolean, whether to create a filtered copy of ChEBI and leave the input ontology intact
+    (otherwise it gets filtered inplace, unless it is a read-only SharedOntology, which is always copied)
+    :return: mod_sbml.onto.obo_ontology.Ontology the filtered ontology
+    """
     terms = (t for t in (chebi.get_term(t_id) for t_id in s_id2chebi_id.values()) if t)
     old_onto_len = len(chebi)
-    filter_ontology(chebi, terms, relationships=EQUIVALENT_RELATIONSHIPS, min_deepness=3)
+    if copy_chebi or isinstance(chebi, SharedOntology):
+        chebi = copy_filtered_ontology(chebi, terms, relationships=EQUIVALENT_RELATIONSHIPS, min_deepness=3)
+    else:
+        filter_ontology(chebi, terms, relationships=EQUIVALENT_RELATIONSHIPS, min_deepness=3)
     logging.info('Filtered the ontology from %d terms to %d' % (old_onto_len, len(chebi)))
+    return chebi
+
+
+def generalize_model(in_sbml, chebi, groups_sbml, out_sbml, ub_s_ids=None, ub_chebi_ids=None, ignore_biomass=True,
+                     annotation_cache=None, name_index=None, copy_chebi=False, progress_callback=None,
+                     cancellation_token=None, budget=None, partitioned=False, processes=None, out_matrix=None,
+                     model_cache=None, low_memory=False, groups_sidecar=False, max_exact_cluster_size=None,
+                     metrics=None):
+    """
+    Generalizes a model.
+    :param in_sbml: str, path to the input SBML file
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param groups_sbml: str, path to the output SBML file (with groups extension)
+    :param out_sbml: str, path to the output SBML file (generalized)
+    :param ub_s_ids: optional, ids of ubiquitous species (will be inferred if set to None)
+    :param ub_chebi_ids: optional, ids of ubiquitous ChEBI terms (will be inferred if set to None)
+    :param ignore_biomass: boolean, whether to ignore the biomass reaction (and its stoichiometry preserving constraint)
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    to reuse ChEBI terms previously inferred from species names
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    to look species names up among ChEBI term names
+    :param copy_chebi: boolean, whether to work on a filtered copy of ChEBI and leave the input ontology intact
+    (otherwise it gets filtered inplace)
+    :param progress_callback: (optional) function to be called with progress event dicts
+    {'phase': phase, 'iteration': iteration, 'done': processed_cluster_number, 'total': total_cluster_number,
+    'elapsed': seconds_since_start, 'peak_memory': peak_memory_usage_in_MB}
+    :param cancellation_token: (optional) sbml_generalization.generalization.progress.CancellationToken,
+    if it gets cancelled the generalization stops with a GeneralizationCancelled exception
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time/iteration budget
+    for the metabolite clustering: once it is exhausted, the best stoichiometry-preserving clustering
+    found so far is used, and the truncated phases are listed in budget.truncated_phases
+    :param partitioned: boolean, whether to partition the model into independent components
+    and cluster them in parallel processes
+    :param processes: (optional) int, maximal number of worker processes for the partitioned clustering
+    (by default the number of CPUs)
+    :param out_matrix: (optional) str, path to the output .npz file, where the sparse stoichiometric matrix
+    of the generalized model and the projection matrices from the input model to the generalized one are to be saved
+    (see sbml_generalization.sbml.matrix_serializer)
+    :param model_cache: (optional) sbml_generalization.sbml.model_cache.ModelCache
+    to reuse models preprocessed during previous runs
+    :param low_memory: boolean, whether to create the output models one after another inplace
+    in the input model's document, instead of in copies of the input model (see save_as_comp_generalized_sbml)
+    :param groups_sidecar: boolean, whether to also save the groups into a compact sidecar file next to groups_sbml
+    (see sbml_generalization.sbml.group_serializer)
+    :param max_exact_cluster_size: (optional) int, maximal number of terms of a cluster that is split
+    with the exact greedy search to preserve the reaction stoichiometry, the bigger ones are split approximately
+    (and listed in budget.approximated_clusters if the budget is given)
+    :param metrics: (optional) sbml_generalization.generalization.metrics.MetricsRegistry
+    to collect this generalization's clustering metrics into (if it is enabled)
+    :return: tuple (r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids):
+    dict {reaction_id: reaction_group_id}, dict {species_id: species_group_id}, dict {species_id: ChEBI_term_id},
+    collection of ubiquitous species_ids.
+    """
+    monitor = ProgressMonitor(progress_callback, cancellation_token, metrics)
+    monitor.report(PHASE_PREPROCESSING)
+    # input_model
+    input_doc, input_model, s_id2chebi_id, r_ids_to_ignore = \
+        preprocess_model(in_sbml, chebi, ignore_biomass, annotation_cache, name_index, model_cache)
+    r_id2clu, clu2s_ids, ub_s_ids, chebi = \
+        generalize_preprocessed_model(input_model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_s_ids, ub_chebi_ids,
+                                      copy_chebi, monitor, budget, partitioned, processes,
+                                      max_exact_cluster_size=max_exact_cluster_size)
 
-    threshold = min(max(3, int(0.1 * input_model.getNumReactions())), UBIQUITOUS_THRESHOLD)
-    s_id2clu, ub_s_ids = generalize_species(input_model, s_id2chebi_id, ub_s_ids, chebi, ub_chebi_ids, threshold,
-                                            r_ids_to_ignore=r_ids_to_ignore)
-    logging.info("generalized species")
-    r_id2clu = generalize_reactions(input_model, s_id2clu, s_id2chebi_id, ub_chebi_ids,
-                                    r_ids_to_ignore=r_ids_to_ignore)
-    logging.info("generalized reactions")
-
-    clu2s_ids = {(c_id, term): s_ids for ((c_id, (term, )), s_ids) in invert_map(s_id2clu).items()}
-    r_id2g_eq, s_id2gr_id = save_as_comp_generalized_sbml(input_model, out_sbml, groups_sbml, r_id2clu, clu2s_ids,
-                                                          ub_s_ids, chebi)
+    monitor.report(PHASE_SERIALIZATION)
+    # a cached model needs to be parsed for serialization (the document is kept while its model is used)
+    sbml_doc, sbml_model = get_sbml_model(input_model)
+    r_id2g_eq, s_id2gr_id = save_as_comp_generalized_sbml(sbml_model, out_sbml, groups_sbml, r_id2clu, clu2s_ids,
+                                                          ub_s_ids, chebi, out_matrix=out_matrix, low_memory=low_memory,
+                                                          groups_sidecar=groups_sidecar)
+    log_peak_memory(PHASE_SERIALIZATION)
+    monitor.report(PHASE_DONE)
     return r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids
 
 
-def ubiquitize_model(in_sbml, chebi, groups_sbml, ub_s_ids=None, ub_chebi_ids=None):
+def generalize_preprocessed_model(input_model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_s_ids=None,
+                                  ub_chebi_ids=None, copy_chebi=False, monitor=None, budget=None, partitioned=False,
+                                  processes=None, max_exact_cluster_size=None):
+    """
+    Clusters the species and reactions of a preprocessed model (see preprocess_model and preprocess_document).
+    :param input_model: libsbml.Model (or sbml_generalization.sbml.model_cache.CachedModel) preprocessed model
+    :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
+    :param r_ids_to_ignore: ids of reactions whose stoichiometry preserving constraint can be ignored (or None)
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param ub_s_ids: optional, ids of ubiquitous species (will be inferred if set to None)
+    :param ub_chebi_ids: optional, ids of ubiquitous ChEBI terms (will be inferred if set to None)
+    :param copy_chebi: boolean, whether to work on a filtered copy of ChEBI and leave the input ontology intact
+    (otherwise it gets filtered inplace)
+    :param monitor: (optional) sbml_generalization.generalization.progress.ProgressMonitor
+    to report progress to, check for cancellation, and record the metrics to
+    :param budget: (optional) sbml_generalization.generalization.budget.Budget time/iteration budget
+    for the metabolite clustering
+    :param partitioned: boolean, whether to partition the model into independent components
+    and cluster them in parallel processes
+    :param processes: (optional) int, maximal number of worker processes for the partitioned clustering
+    :param max_exact_cluster_size: (optional) int, maximal number of terms of a cluster that is split
+    with the exact greedy search to preserve the reaction stoichiometry (see generalize_model)
+    :return: tuple (r_id2clu, clu2s_ids, ub_s_ids, chebi): dict {reaction_id: reaction_cluster},
+    dict {(compartment_id, term): species_ids}, collection of ubiquitous species_ids,
+    the (filtered) ontology the clusters refer to
+    """
+    if not monitor:
+        monitor = ProgressMonitor()
+    with monitor.recording_metrics():
+        ub_chebi_ids, ub_s_ids = get_ub_elements(input_model, chebi, s_id2chebi_id, ub_chebi_ids, ub_s_ids)
+        chebi = filter_chebi(chebi, s_id2chebi_id, copy_chebi)
+        log_peak_memory(PHASE_PREPROCESSING)
+
+        monitor.check_cancelled()
+
+        threshold = get_ubiquitous_threshold(input_model)
+        s_id2clu, ub_s_ids = generalize_species(input_model, s_id2chebi_id, ub_s_ids, chebi, ub_chebi_ids, threshold,
+                                                r_ids_to_ignore=r_ids_to_ignore, monitor=monitor, budget=budget,
+                                                partitioned=partitioned, processes=processes,
+                                                max_exact_cluster_size=max_exact_cluster_size)
+        logging.info("generalized species")
+        if budget and budget.is_truncated():
+            logging.warning("the budget was exhausted, truncated phases: %s"
+                            % ', '.join('%s (%s)' % (it['phase'], it['where']) if it['where'] else it['phase']
+                                        for it in budget.truncations))
+        monitor.report(PHASE_REACTION_GROUPING)
+        r_id2clu = generalize_reactions(input_model, s_id2clu, s_id2chebi_id, ub_chebi_ids,
+                                        r_ids_to_ignore=r_ids_to_ignore)
+        logging.info("generalized reactions")
+        log_peak_memory(PHASE_REACTION_GROUPING)
+
+        monitor.check_cancelled()
+
+        clu2s_ids = {(c_id, term): s_ids for ((c_id, (term, )), s_ids) in invert_map(s_id2clu).items()}
+        return r_id2clu, clu2s_ids, ub_s_ids, chebi
+
+
+def generalize_model_in_memory(sbml, chebi, ub_s_ids=None, ub_chebi_ids=None, ignore_biomass=True,
+                               annotation_cache=None, name_index=None, copy_chebi=False, progress_callback=None,
+                               cancellation_token=None, budget=None, partitioned=False, processes=None,
+                               as_string=False, max_exact_cluster_size=None, metrics=None):
+    """
+    Generalizes a model held in memory, without reading or writing any file
+    (see generalize_model for the common parameters).
+    :param sbml: input model: libsbml.Model, libsbml.SBMLDocument, or str containing SBML
+    (it is not modified, the generalization works on its copy)
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param as_string: boolean, whether to return the output models serialized as SBML strings
+    instead of libsbml.SBMLDocument objects
+    :return: tuple (generalized_doc, groups_doc, r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids):
+    libsbml.SBMLDocument (or str) generalized model, libsbml.SBMLDocument (or str) model with groups extension,
+    dict {reaction_id: (reaction_group_id, reaction_group_name)}, dict {species_id: (species_group_id, term)},
+    dict {species_id: ChEBI_term_id}, collection of ubiquitous species_ids.
+    """
+    monitor = ProgressMonitor(progress_callback, cancellation_token, metrics)
+    monitor.report(PHASE_PREPROCESSING)
+    input_doc, input_model, s_id2chebi_id, r_ids_to_ignore = \
+        preprocess_document(get_sbml_document(sbml), chebi, ignore_biomass, annotation_cache, name_index)
+    r_id2clu, clu2s_ids, ub_s_ids, chebi = \
+        generalize_preprocessed_model(input_model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_s_ids, ub_chebi_ids,
+                                      copy_chebi, monitor, budget, partitioned, processes,
+                                      max_exact_cluster_size=max_exact_cluster_size)
+
+    monitor.report(PHASE_SERIALIZATION)
+    # the input document is our own copy, hence the generalized model can be created inplace
+    groups_doc, _, r_id2g_eq, s_id2gr_id = \
+        get_comp_generalized_documents(input_model, r_id2clu, clu2s_ids, ub_s_ids, chebi, in_place=True)
+    # the generalized model is the input document converted inplace, which has to be returned as such:
+    # the document returned by get_comp_generalized_documents does not own it, and would be freed along with it
+    generalized_doc = input_doc
+    if as_string:
+        groups_doc, generalized_doc = libsbml.writeSBMLToString(groups_doc), libsbml.writeSBMLToString(generalized_doc)
+    monitor.report(PHASE_DONE)
+    return generalized_doc, groups_doc, r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids
+
+
+def ubiquitize_model(in_sbml, chebi, groups_sbml, ub_s_ids=None, ub_chebi_ids=None, annotation_cache=None,
+                     name_index=None, model_cache=None, groups_sidecar=False, cancellation_token=None):
     """
     Infers and marks ubiquitous species in the model.
     :param in_sbml: str, path to the input SBML file
@@ -97,15 +315,68 @@ def ubiquitize_model(in_sbml, chebi, groups_sbml, ub_s_ids=None, ub_chebi_ids=No
     :param groups_sbml: str, path to the output SBML file (with groups extension)
     :param ub_s_ids: optional, ids of ubiquitous species (will be inferred if set to None)
     :param ub_chebi_ids: optional, ids of ubiquitous ChEBI terms (will be inferred if set to None)
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    to reuse ChEBI terms previously inferred from species names
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    to look species names up among ChEBI term names
+    :param model_cache: (optional) sbml_generalization.sbml.model_cache.ModelCache
+    to reuse the species annotations inferred during previous runs (see ModelCache.get_annotation),
+    the output does not depend on it
+    :param groups_sidecar: boolean, whether to also save the groups into a compact sidecar file next to groups_sbml
+    (see sbml_generalization.sbml.group_serializer)
+    :param cancellation_token: (optional) sbml_generalization.generalization.progress.CancellationToken,
+    if it gets cancelled, GeneralizationCancelled is raised before the next step (and nothing is saved)
     :return: tuple (s_id2chebi_id, ub_s_ids): dict {species_id: ChEBI_term_id},  collection of ubiquitous species_ids.
     """
-    input_doc = libsbml.SBMLReader().readSBML(in_sbml)
+    monitor = ProgressMonitor(cancellation_token=cancellation_token)
+    input_doc = read_sbml(in_sbml)
     input_model = input_doc.getModel()
-    annotate_metabolites(input_model, chebi)
+    # the groups model keeps all the input elements, hence only the annotation of the input model is cached
+    s_id2chebi_id = model_cache.get_annotation(in_sbml, annotation_cache, name_index) if model_cache else None
+    if s_id2chebi_id is not None:
+        add_chebi_annotations(input_model, s_id2chebi_id)
+    else:
+        annotate_species(input_model, chebi, annotation_cache, name_index)
+
+        logging.info("mapping species to ChEBI")
+        s_id2chebi_id = get_species_id2chebi_id(input_model)
+        if model_cache:
+            model_cache.put_annotation(in_sbml, s_id2chebi_id, annotation_cache, name_index)
+    monitor.check_cancelled()
+    _, ub_s_ids = get_ub_elements(input_model, chebi, s_id2chebi_id, ub_chebi_ids, ub_s_ids)
+    monitor.check_cancelled()
+
+    save_as_comp_generalized_sbml(input_model, None, groups_sbml, {}, {}, ub_s_ids, chebi, groups_sidecar=groups_sidecar)
+    return s_id2chebi_id, ub_s_ids
+
+
+def ubiquitize_model_in_memory(sbml, chebi, ub_s_ids=None, ub_chebi_ids=None, annotation_cache=None,
+                               name_index=None, as_string=False):
+    """
+    Infers and marks ubiquitous species in a model held in memory, without reading or writing any file.
+    :param sbml: input model: libsbml.Model, libsbml.SBMLDocument, or str containing SBML
+    (it is not modified, the ubiquitous species are marked in its copy)
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param ub_s_ids: optional, ids of ubiquitous species (will be inferred if set to None)
+    :param ub_chebi_ids: optional, ids of ubiquitous ChEBI terms (will be inferred if set to None)
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    to reuse ChEBI terms previously inferred from species names
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    to look species names up among ChEBI term names
+    :param as_string: boolean, whether to return the output model serialized as an SBML string
+    instead of a libsbml.SBMLDocument object
+    :return: tuple (groups_doc, s_id2chebi_id, ub_s_ids): libsbml.SBMLDocument (or str) model with groups extension,
+    dict {species_id: ChEBI_term_id}, collection of ubiquitous species_ids.
+    """
+    input_doc = get_sbml_document(sbml)
+    input_model = input_doc.getModel()
+    annotate_species(input_model, chebi, annotation_cache, name_index)
 
     logging.info("mapping species to ChEBI")
     s_id2chebi_id = get_species_id2chebi_id(input_model)
     _, ub_s_ids = get_ub_elements(input_model, chebi, s_id2chebi_id, ub_chebi_ids, ub_s_ids)
 
-    save_as_comp_generalized_sbml(input_model, None, groups_sbml, {}, {}, ub_s_ids, chebi)
-    return s_id2chebi_id, ub_s_ids
+    get_comp_generalized_documents(input_model, {}, {}, ub_s_ids, chebi, generalize=False, in_place=True)
+    # the groups model is the input document converted inplace (see generalize_model_in_memory)
+    groups_doc = input_doc
+    return libsbml.writeSBMLToString(groups_doc) if as_string else groups_doc, s_id2chebi_id, ub_s_ids
@@ -0,0 +1,308 @@
+from collections.abc import Mapping
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+from mod_sbml.onto.obo_ontology import Ontology
+from mod_sbml.onto.term import Term
+
+__author__ = 'anna'
+
+MAGIC = b'SBMLGONT'
+FORMAT_VERSION = 1
+
+_INT = struct.Struct('<q')
+_PAIR = struct.Struct('<2q')
+
+# the sections of the shared ontology: tables mapping
+# term ids to term records (id, name, alt ids, synonyms, parent ids, xrefs, levels),
+# alternative ids to term record indices,
+# normalized names, xrefs and parent ids to the corresponding term ids,
+# term ids and relationship names to the relationships they take part in,
+# and the ids of the root terms (stored as a single record)
+TERMS, ALT_IDS, NAMES, XREFS, CHILDREN, RELATIONSHIPS, ROOTS = range(7)
+_HEADER = struct.Struct('<8sq%dq' % (ROOTS + 1))
+
+
+def _encode(key):
+    return key.encode('utf-8') if isinstance(key, str) else None
+
+
+def _hash(key):
+    return zlib.crc32(key)
+
+
+def _pack_table(key2value):
+    items = sorted((key.encode('utf-8'), marshal.dumps(value)) for (key, value) in key2value.items())
+    key_offsets, value_offsets = [0], [0]
+    for key, value in items:
+        key_offsets.append(key_offsets[-1] + len(key))
+        value_offsets.append(value_offsets[-1] + len(value))
+    # an open addressing hash table of (1 + key index), at most half full
+    n_slots = 1
+    while n_slots < 2 * len(items):
+        n_slots *= 2
+    slots = [0] * n_slots
+    for i, (key, _) in enumerate(items):
+        slot = _hash(key) & (n_slots - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (n_slots - 1)
+        slots[slot] = i + 1
+    data = b''.join([struct.pack('<2q', len(items), n_slots),
+                     struct.pack('<%dq' % len(key_offsets), *key_offsets),
+                     struct.pack('<%dq' % len(value_offsets), *value_offsets),
+                     struct.pack('<%dq' % n_slots, *slots)]
+                    + [key for (key, _) in items] + [value for (_, value) in items])
+    # the next table starts at an aligned offset
+    return data + b'\0' * (-len(data) % _INT.size)
+
+
+def _get_t_id2levels(onto):
+    # the same levels as onto.get_level, but calculated once for all the terms
+    t_id2levels = {}
+
+    def get_levels(t_id):
+        if t_id not in t_id2levels:
+            # guards against cycles
+            t_id2levels[t_id] = ()
+            parent_ids = [p_id for p_id in onto.id2term[t_id].get_parent_ids() if onto.get_term(p_id)]
+            levels = {1 + level for p_id in parent_ids
+                      for level in get_levels(onto.get_term(p_id).get_id())} if parent_ids else {0}
+            t_id2levels[t_id] = tuple(sorted(levels))
+        return t_id2levels[t_id]
+
+    for t_id in onto.id2term:
+        get_levels(t_id)
+    return t_id2levels
+
+
+def _pack_ontology(onto):
+    t_id2levels = _get_t_id2levels(onto)
+    t_ids = sorted(onto.id2term.keys(), key=lambda t_id: t_id.encode('utf-8'))
+    t_id2i = {t_id: i for (i, t_id) in enumerate(t_ids)}
+    t_id2record = {}
+    for t_id in t_ids:
+        term = onto.id2term[t_id]
+        t_id2record[t_id] = (term.id, term.name, tuple(sorted(term.altIds)), tuple(sorted(term.synonyms)),
+                             tuple(sorted(term.parent_ids)),
+                             tuple((db, tuple(sorted(values))) for (db, values) in sorted(term.xrefs.items())),
+                             t_id2levels[t_id])
+    tables = [None] * (ROOTS + 1)
+    tables[TERMS] = t_id2record
+    tables[ALT_IDS] = {alt_id: t_id2i[term.get_id()] for (alt_id, term) in onto.alt_id2term.items()
+                       if term.get_id() in t_id2i}
+    for section, key2ids in ((NAMES, onto.name2term_ids), (XREFS, onto.xref2term_ids),
+                             (CHILDREN, onto.parent2children), (RELATIONSHIPS, onto.rel_map)):
+        tables[section] = {key: tuple(sorted(ids)) for (key, ids) in key2ids.items() if ids}
+    tables[ROOTS] = {'': tuple(sorted(t.get_id() for t in onto.roots))}
+
+    offsets, data = [], []
+    offset = _HEADER.size
+    for table in tables:
+        offsets.append(offset)
+        data.append(_pack_table(table))
+        offset += len(data[-1])
+    return b''.join([_HEADER.pack(MAGIC, FORMAT_VERSION, *offsets)] + data)
+
+
+class _Table(object):
+    """
+    A hashed table of (utf-8 encoded) keys and (marshalled) values, read directly from the buffer.
+    """
+
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.n, n_slots = _PAIR.unpack_from(buf, offset)
+        self.mask = n_slots - 1
+        self.key_offsets = offset + _PAIR.size
+        self.value_offsets = self.key_offsets + _INT.size * (self.n + 1)
+        self.slots = self.value_offsets + _INT.size * (self.n + 1)
+        self.keys = self.slots + _INT.size * n_slots
+        self.values = self.keys + _INT.unpack_from(buf, self.key_offsets + _INT.size * self.n)[0]
+
+    def get_key(self, i):
+        start, end = _PAIR.unpack_from(self.buf, self.key_offsets + _INT.size * i)
+        return self.buf[self.keys + start: self.keys + end]
+
+    def get_value(self, i):
+        start, end = _PAIR.unpack_from(self.buf, self.value_offsets + _INT.size * i)
+        return marshal.loads(self.buf[self.values + start: self.values + end])
+
+    def find(self, key):
+        """
+        :param key: bytes, encoded key
+        :return: int, index of the key in the table, or -1 if it is not there
+        """
+        if key is None:
+            return -1
+        slot = _hash(key) & self.mask
+        while True:
+            i = _INT.unpack_from(self.buf, self.slots + _INT.size * slot)[0] - 1
+            if i < 0 or self.get_key(i) == key:
+                return i
+            slot = (slot + 1) & self.mask
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self.get_key(i).decode('utf-8')
+
+
+class _TermMapping(Mapping):
+    """
+    Read-only {id: mod_sbml.onto.term.Term} view of a table (of term records or of their indices).
+    """
+
+    def __init__(self, table, get_term):
+        self.table = table
+        self.get_term = get_term
+
+    def __getitem__(self, key):
+        i = self.table.find(_encode(key))
+        if i < 0:
+            raise KeyError(key)
+        return self.get_term(i)
+
+    def __contains__(self, key):
+        return self.table.find(_encode(key)) >= 0
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def __len__(self):
+        return len(self.table)
+
+
+class _SetMapping(Mapping):
+    """
+    Read-only {key: set} view of a table, which (as the defaultdict(set) it replaces)
+    returns an empty set for a missing key.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, key):
+        i = self.table.find(_encode(key))
+        return set(self.table.get_value(i)) if i >= 0 else set()
+
+    def get(self, key, default=None):
+        i = self.table.find(_encode(key))
+        return set(self.table.get_value(i)) if i >= 0 else default
+
+    def __contains__(self, key):
+        return self.table.find(_encode(key)) >= 0
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def __len__(self):
+        return len(self.table)
+
+
+class SharedOntology(Ontology):
+    """
+    Read-only ontology, whose terms, names, xrefs, relationships and levels are stored in a buffer
+    (a memory-mapped file or anonymous shared memory) and decoded on access.
+    The processes forked after its creation (or mapping the same file) read the same pages
+    instead of holding copies of the ontology, as nothing is ever written to them.
+
+    It can be used wherever a mod_sbml.onto.obo_ontology.Ontology is only read
+    (e.g. as the source of sbml_generalization.generalization.onto_filter.copy_filtered_ontology,
+    or to annotate and merge models), but not modified.
+    """
+
+    def __init__(self, buf):
+        magic, version = _HEADER.unpack_from(buf, 0)[:2]
+        if MAGIC != magic or FORMAT_VERSION != version:
+            raise ValueError('Not a shared ontology (or saved in another format)')
+        self.buf = buf
+        offsets = _HEADER.unpack_from(buf, 0)[2:]
+        tables = [_Table(buf, offset) for offset in offsets]
+        self._terms = tables[TERMS]
+        self._roots = tables[ROOTS]
+        self.id2term = _TermMapping(tables[TERMS], self._get_term)
+        self.alt_id2term = _TermMapping(tables[ALT_IDS],
+                                        lambda i: self._get_term(tables[ALT_IDS].get_value(i)))
+        self.name2term_ids = _SetMapping(tables[NAMES])
+        self.xref2term_ids = _SetMapping(tables[XREFS])
+        self.parent2children = _SetMapping(tables[CHILDREN])
+        self.rel_map = _SetMapping(tables[RELATIONSHIPS])
+
+    def _get_term(self, i):
+        t_id, name, alt_ids, synonyms, parent_ids, xrefs, _ = self._terms.get_value(i)
+        term = Term(onto=self, t_id=t_id, name=name)
+        term.altIds = set(alt_ids)
+        term.synonyms = set(synonyms)
+        term.parent_ids = set(parent_ids)
+        for db, values in xrefs:
+            term.xrefs[db] = set(values)
+        return term
+
+    def get_term(self, key, check_only_ids=True):
+        # the same as Ontology.get_term, but looks each id up once
+        if not key:
+            return None
+        i = self._terms.find(_encode(key.lower().strip()))
+        if i >= 0:
+            return self._get_term(i)
+        term = self.alt_id2term.get(key.lower().strip(), None)
+        if term or check_only_ids:
+            return term
+        return Ontology.get_term(self, key, check_only_ids)
+
+    @property
+    def roots(self):
+        return {self.id2term[t_id] for t_id in self._roots.get_value(0)}
+
+    def get_level(self, term):
+        i = self._terms.find(_encode(term.get_id()))
+        if i < 0:
+            return Ontology.get_level(self, term)
+        return list(self._terms.get_value(i)[-1])
+
+    def _modify(self, *args, **kwargs):
+        raise TypeError('The shared ontology is read-only, filter it with copy_filtered_ontology instead')
+
+    add_term = remove_term = add_relationship = filter_relationships = remove_relationships = trim = _modify
+
+    def close(self):
+        self.buf.close()
+
+
+def share_ontology(onto, path=None):
+    """
+    Creates a read-only copy of an ontology in anonymous shared memory,
+    to be inherited by the processes forked afterwards,
+    or, if the path is given, in a file, which is then memory-mapped (by any process on the node that loads it).
+    :param onto: mod_sbml.onto.obo_ontology.Ontology ontology
+    :param path: (optional) str, path to the file to store the shared ontology in
+    :return: SharedOntology the shared copy
+    """
+    data = _pack_ontology(onto)
+    if not path:
+        buf = mmap.mmap(-1, len(data))
+        buf.write(data)
+        return SharedOntology(buf)
+    # a unique temporary file in the same directory, so that nobody ever maps a partially written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return load_shared_ontology(path)
+
+
+def load_shared_ontology(path):
+    """
+    Memory-maps a shared ontology saved by share_ontology.
+    :param path: str, path to the shared ontology file
+    :return: SharedOntology the shared ontology
+    """
+    with open(path, 'rb') as f:
+        return SharedOntology(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
@@ -0,0 +1,114 @@
+from copy import deepcopy
+import logging
+import multiprocessing
+import time
+
+from sbml_generalization.generalization.model_generalizer import generalize_species, generalize_reactions, \
+    get_species_degree_histogram
+from sbml_generalization.generalization.sbml_generalizer import preprocess_model, filter_chebi, get_ub_elements, \
+    get_ubiquitous_threshold
+from sbml_generalization.generalization.workers import can_fork, fork_pool
+
+__author__ = 'anna'
+
+# the preprocessed model and settings, shared with the (forked) worker processes
+_sweep_context = None
+
+
+def get_sweep_settings(model, chebi, s_id2chebi_id, thresholds=None, ub_chebi_id_sets=None):
+    """
+    Infers ubiquitous elements for each setting of the sweep.
+    :param model: libsbml.Model (or sbml_generalization.sbml.model_cache.CachedModel) preprocessed model
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology (not filtered yet)
+    :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
+    :param thresholds: (optional) collection of thresholds: for each of them the ChEBI terms
+    whose species participate in more than threshold reactions (in some compartment) are considered ubiquitous
+    (the same way as by generalize_model called with ub_chebi_ids={'chebi:ch'}: no species is ubiquitous
+    during the clustering, and the frequent ones that stay ungrouped become ubiquitous afterwards,
+    see model_generalizer.generalize_species)
+    :param ub_chebi_id_sets: (optional) collection of collections of ubiquitous ChEBI term ids
+    :return: list of tuples (setting, threshold, ub_chebi_ids, ub_s_ids)
+    """
+    settings = []
+    if thresholds:
+        ub_chebi_ids, ub_s_ids = get_ub_elements(model, chebi, s_id2chebi_id, {'chebi:ch'}, None)
+        for threshold in thresholds:
+            settings.append(({'threshold': threshold}, threshold, set(ub_chebi_ids), set(ub_s_ids)))
+    if ub_chebi_id_sets:
+        threshold = get_ubiquitous_threshold(model)
+        for chebi_ids in ub_chebi_id_sets:
+            ub_chebi_ids, ub_s_ids = get_ub_elements(model, chebi, s_id2chebi_id, set(chebi_ids), None)
+            settings.append(({'ub_chebi_ids': sorted(chebi_ids)}, threshold, ub_chebi_ids, ub_s_ids))
+    return settings
+
+
+def _generalize_for_setting(i, chebi=None):
+    model, s_id2chebi_id, onto, r_ids_to_ignore, settings, degree_histogram = _sweep_context
+    setting, threshold, ub_chebi_ids, ub_s_ids = settings[i]
+    start = time.time()
+    s_id2clu, ub_s_ids = generalize_species(model, s_id2chebi_id, set(ub_s_ids), chebi if chebi else onto,
+                                            ub_chebi_ids, threshold, r_ids_to_ignore=r_ids_to_ignore,
+                                            degree_histogram=degree_histogram)
+    r_id2clu = generalize_reactions(model, s_id2clu, s_id2chebi_id, ub_chebi_ids, r_ids_to_ignore=r_ids_to_ignore)
+    s_num, r_num = model.getNumSpecies(), model.getNumReactions()
+    gen_s_num = s_num - len(s_id2clu) + len(set(s_id2clu.values()))
+    gen_r_num = r_num - len(r_id2clu) + len(set(r_id2clu.values()))
+    result = dict(setting)
+    result.update({'ub_species': len(ub_s_ids), 'species': s_num, 'generalized_species': gen_s_num,
+                   'reactions': r_num, 'generalized_reactions': gen_r_num,
+                   'compression_ratio': float(s_num + r_num) / max(gen_s_num + gen_r_num, 1),
+                   'time': time.time() - start})
+    return result
+
+
+def sweep_ubiquitous(in_sbml, chebi, thresholds=None, ub_chebi_id_sets=None, ignore_biomass=True,
+                     annotation_cache=None, name_index=None, processes=None, model_cache=None):
+    """
+    Generalizes a model for several ubiquitous metabolite settings, in order to choose the best one.
+    The model is read, annotated and mapped to ChEBI, the ontology is filtered,
+    and the species degree histogram is calculated only once; then the clustering is performed for each setting in parallel.
+    :param in_sbml: str, path to the input SBML file
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology (is left intact)
+    :param thresholds: (optional) collection of thresholds: for each of them the ChEBI terms
+    whose species participate in more than threshold reactions (in some compartment) are considered ubiquitous
+    :param ub_chebi_id_sets: (optional) collection of collections of ubiquitous ChEBI term ids
+    :param ignore_biomass: boolean, whether to ignore the biomass reaction (and its stoichiometry preserving constraint)
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    to reuse ChEBI terms previously inferred from species names
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    to look species names up among ChEBI term names
+    :param processes: (optional) int, maximal number of worker processes (by default the number of CPUs)
+    :param model_cache: (optional) sbml_generalization.sbml.model_cache.ModelCache
+    to reuse models preprocessed during previous runs
+    :return: list of dicts, one per setting (thresholds first, then ubiquitous sets), with the keys:
+    'threshold' or 'ub_chebi_ids' (the setting), 'ub_species', 'species', 'generalized_species',
+    'reactions', 'generalized_reactions', 'compression_ratio' (number of species and reactions
+    in the input model divided by the one in the generalized model), 'time' (clustering time in seconds).
+    """
+    global _sweep_context
+
+    input_doc, input_model, s_id2chebi_id, r_ids_to_ignore = \
+        preprocess_model(in_sbml, chebi, ignore_biomass, annotation_cache, name_index, model_cache)
+    settings = get_sweep_settings(input_model, chebi, s_id2chebi_id, thresholds, ub_chebi_id_sets)
+    if not settings:
+        return []
+    onto = filter_chebi(chebi, s_id2chebi_id, copy_chebi=True)
+    # the species frequencies do not depend on the setting, only the threshold they are compared to does
+    degree_histogram = get_species_degree_histogram(input_model, s_id2chebi_id)
+
+    # the clustering modifies the ontology, therefore each setting needs its own copy of it:
+    # each forked worker clusters for a single setting (and is then replaced by a new one, forked from this process),
+    # so that it modifies its own copy of the filtered ontology; otherwise the ontology is copied explicitly
+    _sweep_context = input_model, s_id2chebi_id, onto, r_ids_to_ignore, settings, degree_histogram
+    try:
+        processes = min(processes or multiprocessing.cpu_count(), len(settings))
+        if processes > 1 and can_fork():
+            with fork_pool(processes, maxtasksperchild=1) as pool:
+                results = pool.map(_generalize_for_setting, range(len(settings)), chunksize=1)
+        else:
+            results = [_generalize_for_setting(i, deepcopy(onto)) for i in range(len(settings))]
+    finally:
+        _sweep_context = None
+    for result in results:
+        logging.info("sweep: %s" % result)
+    return results
@@ -2,6 +2,7 @@ from collections import defaultdict
 from itertools import chain
 from mod_sbml.sbml.sbml_manager import get_products, get_reactants
 from mod_sbml.sbml.ubiquitous_manager import get_proton_ch_ids
+from sbml_generalization.generalization.metrics import METRICS, VERTICAL_KEY_CALLS, SPECIES_LOOKUPS
 
 __author__ = 'anna'
 
@@ -19,6 +20,7 @@ def get_vertical_key(model, r, s_id2clu, s_id2term_id, ubiquitous_chebi_ids):
     :return: tuple (ubiquitous_reactants, ubiquitous_products,
     specific_reactant_classes, specific_product_classes)
     """
+    METRICS.inc(VERTICAL_KEY_CALLS)
     ubiquitous_reactants, ubiquitous_products, specific_reactant_classes, specific_product_classes = \
         get_key_elements(model, r, s_id2clu, s_id2term_id, ubiquitous_chebi_ids)
     if r.getReversible() and need_to_reverse(
@@ -36,6 +38,7 @@ def need_to_reverse(ubiquitous_reactants, ubiquitous_products, specific_reactant
 
 
 def get_r_compartments(model, r):
+    METRICS.inc(SPECIES_LOOKUPS, r.getNumReactants() + r.getNumProducts())
     return tuple({model.getSpecies(s_id).getCompartment()
                   for s_id in chain((species_ref.getSpecies() for species_ref in r.getListOfReactants()),
                                     (species_ref.getSpecies() for species_ref in r.getListOfProducts()))})
@@ -112,6 +115,7 @@ def get_key_elements(model, r, s_id2clu, s_id2term_id, ubiquitous_chebi_ids, ign
             else:
                 specific.append((s_id2clu[s_id][1] if s_id in s_id2clu
                                 else ((s_id2term_id[s_id] if s_id in s_id2term_id else s_id), ), c_id))
+        METRICS.inc(SPECIES_LOOKUPS, len(specific) + len(ubiquitous) + len(ignored_ubs))
         transform = lambda collection: tuple(sorted(collection))
         return transform(specific), transform(ubiquitous), transform(ignored_ubs)
 
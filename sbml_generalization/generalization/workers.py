@@ -0,0 +1,65 @@
+from contextlib import contextmanager
+import gc
+import multiprocessing
+import threading
+
+__author__ = 'anna'
+
+
+def can_fork():
+    """
+    :return: boolean, whether the worker processes can be forked (and hence inherit the parent's memory)
+    """
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+# the number of pools (e.g. of concurrent generalization jobs) that need the parent's objects frozen
+_frozen_pools = 0
+_freeze_lock = threading.Lock()
+
+
+@contextmanager
+def frozen_objects():
+    """
+    Moves the objects of this process (e.g. the parsed ChEBI) to the garbage collector's permanent generation
+    while the processes are being forked: the collections in a child would otherwise write to all of them
+    (and hence copy all their pages), even to those it never uses.
+    """
+    global _frozen_pools
+    with _freeze_lock:
+        _frozen_pools += 1
+        gc.freeze()
+    try:
+        yield
+    finally:
+        with _freeze_lock:
+            _frozen_pools -= 1
+            if not _frozen_pools:
+                gc.unfreeze()
+
+
+@contextmanager
+def fork_pool(processes, maxtasksperchild=None):
+    """
+    Creates a pool of forked worker processes, which inherit the parent's memory (e.g. ChEBI, the model)
+    instead of receiving pickled copies of it (its pages are copied lazily, once a worker writes to them,
+    but are not written to by the workers' garbage collections, see frozen_objects).
+
+    :param processes: int, number of worker processes
+    :param maxtasksperchild: (optional) int, number of tasks after which a worker is replaced by a newly forked one
+    (1 for the tasks that modify the inherited objects, e.g. the ontology, and hence should not share a worker)
+    :return: multiprocessing.pool.Pool, closed and joined on exit (or terminated if an exception was raised,
+    e.g. the generalization was cancelled)
+    """
+    # the replacement workers are forked later on, hence the objects stay frozen till the pool is joined
+    with frozen_objects():
+        pool = multiprocessing.get_context('fork').Pool(processes, maxtasksperchild=maxtasksperchild)
+        try:
+            yield pool
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
@@ -1,7 +1,6 @@
 import logging
 
 import libsbml
-from mod_sbml.annotation.chebi.chebi_annotator import annotate_metabolites
 
 from mod_sbml.annotation.gene_ontology.go_annotator import get_go_id, annotate_compartments
 from mod_sbml.annotation.gene_ontology.go_serializer import get_go
@@ -10,7 +9,10 @@ from mod_sbml.sbml.compartment.compartment_manager import need_boundary_compartm
 from mod_sbml.annotation.rdf_annotation_helper import get_qualifier_values, add_annotation
 from mod_sbml.onto import parse_simple
 from mod_sbml.annotation.chebi.chebi_serializer import get_chebi
-from sbml_generalization.sbml.sbml_helper import set_consistency_level
+from mod_sbml.annotation.chebi.chebi_annotator import get_chebi_id
+from sbml_generalization.sbml.sbml_helper import set_consistency_level, read_sbml, write_sbml
+from sbml_generalization.annotation.species_annotator import annotate_species
+from sbml_generalization.generalization.progress import ProgressMonitor
 
 
 __author__ = 'anna'
@@ -20,11 +22,71 @@ CYTOPLASM = 'go:0005737'
 CYTOSOL = 'go:0005829'
 
 
-def update_model_element_ids(m_id, model, go2c_id, go, chebi):
+def get_species_key(s, chebi):
+    """
+    Gets the key identifying equivalent species in the merged models: the same ChEBI term in the same compartment.
+    :param s: libsbml.Species species (whose compartment id is already unified)
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :return: tuple (ChEBI_term_id, compartment_id), or None if the species is not annotated with ChEBI
+    """
+    chebi_id = get_chebi_id(s)
+    if not chebi_id:
+        return None
+    # alternative ids are replaced by the primary ones
+    term = chebi.get_term(chebi_id)
+    return term.get_id() if term else chebi_id, s.getCompartment()
+
+
+def get_reaction_key(r):
+    """
+    Gets the key identifying identical reactions in the merged models: the same participants and stoichiometry
+    (the reversible reactions being identical to their reversed versions), the same modifiers and kinetic law.
+    :param r: libsbml.Reaction reaction
+    :return: tuple
+    """
+    rs = tuple(sorted((s_ref.getSpecies(), s_ref.getStoichiometry()) for s_ref in r.getListOfReactants()))
+    ps = tuple(sorted((s_ref.getSpecies(), s_ref.getStoichiometry()) for s_ref in r.getListOfProducts()))
+    ms = tuple(sorted(s_ref.getSpecies() for s_ref in r.getListOfModifiers()))
+    if r.getReversible():
+        rs, ps = min((rs, ps), (ps, rs))
+    return rs, ps, r.getReversible(), ms, get_kinetic_law_key(r)
+
+
+def get_kinetic_law_key(r):
+    """
+    Gets the key identifying identical kinetic laws: the same formula and local parameters.
+    :param r: libsbml.Reaction reaction
+    :return: tuple (formula, ((parameter_id, value, units), ...)), or None if the reaction has no kinetic law
+    """
+    kl = r.getKineticLaw()
+    if not kl:
+        return None
+    formula = libsbml.formulaToL3String(kl.getMath()) if kl.isSetMath() else ''
+    params = tuple(sorted((p.getId(), p.getValue() if p.isSetValue() else None, p.getUnits())
+                          for p in kl.getListOfParameters()))
+    return formula, params
+
+
+def update_model_element_ids(m_id, model, go2c_id, go, chebi, annotation_cache=None, name_index=None,
+                             s_key2s_id=None):
+    """
+    Renames the elements of a model to be merged, unifying its compartments with those of the models merged before.
+    :param m_id: str, model id (used as a prefix of the new element ids)
+    :param model: libsbml.Model model to be merged, is modified inplace
+    :param go2c_id: dict {GO_term_id: merged compartment id}, is updated inplace
+    :param go: mod_sbml.onto.obo_ontology.Ontology GO ontology
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    :param s_key2s_id: (optional) dict {species key: merged species id} (see get_species_key),
+    if given, the species equivalent to those of the models merged before get their ids, and the dict is updated
+    with the new ones once all the species of this model are renamed (the species of the same model are never merged)
+    :return: void
+    """
     id2id = {}
     if need_boundary_compartment(model):
         separate_boundary_metabolites(model)
-    annotate_metabolites(model, chebi)
+    annotate_species(model, chebi, annotation_cache, name_index)
     annotate_compartments(model, go)
 
     for c in model.getListOfCompartments():
@@ -50,15 +112,26 @@ def update_model_element_ids(m_id, model, go2c_id, go, chebi):
         if c.getOutside():
             c.setOutside(id2id[c.getOutside()])
 
+    # the keys of this model are registered only after its loop, not to merge its own species together
+    model_s_key2s_id = {}
     for s in model.getListOfSpecies():
         if s.getCompartment():
             s.setCompartment(id2id[s.getCompartment()])
         old_id = s.getId()
         new_id = "s_%s__%s" % (m_id, old_id)
+        if s_key2s_id is not None:
+            key = get_species_key(s, chebi)
+            if key:
+                if key in s_key2s_id:
+                    new_id = s_key2s_id[key]
+                else:
+                    model_s_key2s_id.setdefault(key, new_id)
         s.setId(new_id)
         id2id[old_id] = new_id
         if s.getSpeciesType():
             s.unsetSpeciesType()
+    if s_key2s_id is not None:
+        s_key2s_id.update(model_s_key2s_id)
 
     for r in model.getListOfReactions():
         old_id = r.getId()
@@ -128,11 +201,32 @@ def copy_compartment(e, model):
     return new_e
 
 
-def merge_models(in_sbml_list, out_sbml):
+def merge_models(in_sbml_list, out_sbml, annotation_cache=None, name_index=None, go=None, chebi=None,
+                 deduplicate=False, cancellation_token=None):
+    """
+    Merges several models into one, unifying their compartments (by their GO terms).
+    :param in_sbml_list: list of paths to the input SBML files
+    :param out_sbml: str, path to the output SBML file
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    :param go: (optional) mod_sbml.onto.obo_ontology.Ontology GO ontology (will be parsed if not given)
+    :param chebi: (optional) mod_sbml.onto.obo_ontology.Ontology ChEBI ontology (will be parsed if not given),
+    is only read, hence can be a sbml_generalization.generalization.shared_ontology.SharedOntology
+    :param deduplicate: boolean, whether to merge the species annotated with the same ChEBI term
+    in the same (unified) compartment into one species, and to keep only one of the identical reactions
+    (with the same participants, stoichiometry, modifiers and kinetic law); otherwise each model keeps
+    its own species and reactions (the species of the same model are never merged together)
+    :param cancellation_token: (optional) sbml_generalization.generalization.progress.CancellationToken,
+    if it gets cancelled, GeneralizationCancelled is raised before the next model is processed (and nothing is saved)
+    :return: void
+    """
+    monitor = ProgressMonitor(cancellation_token=cancellation_token)
     if not in_sbml_list:
         raise ValueError('Provide SBML models to be merged')
-    go = parse_simple(get_go())
-    chebi = parse_simple(get_chebi())
+    if go is None:
+        go = parse_simple(get_go())
+    if chebi is None:
+        chebi = parse_simple(get_chebi())
     i = 0
     model_ids = set()
     go2c_id = {}
@@ -141,9 +235,13 @@ def merge_models(in_sbml_list, out_sbml):
     model = doc.createModel()
     model.setId('m_merged')
     m_c_ids = set()
+    s_key2s_id = {} if deduplicate else None
+    r_keys = set()
+    dup_s_num, dup_r_num = 0, 0
 
     for o_sbml in in_sbml_list:
-        o_doc = libsbml.SBMLReader().readSBML(o_sbml)
+        monitor.check_cancelled()
+        o_doc = read_sbml(o_sbml)
         set_consistency_level(o_doc)
         o_doc.checkL2v4Compatibility()
         o_doc.setLevelAndVersion(2, 4, False, True)
@@ -151,7 +249,7 @@ def merge_models(in_sbml_list, out_sbml):
         logging.info("Processing %s" % o_sbml)
         model_id = get_model_id(i, model_ids, o_model)
 
-        update_model_element_ids(model_id, o_model, go2c_id, go, chebi)
+        update_model_element_ids(model_id, o_model, go2c_id, go, chebi, annotation_cache, name_index, s_key2s_id)
         for e in o_model.getListOfCompartments():
             c_id = e.getId()
             if c_id not in m_c_ids:
@@ -160,11 +258,22 @@ def merge_models(in_sbml_list, out_sbml):
                 m_c_ids.add(c_id)
         for e in o_model.getListOfSpecies():
             if model.getSpecies(e.getId()):
+                if deduplicate:
+                    dup_s_num += 1
                 continue
             if model.addSpecies(e):
                 copy_species(e, model)
         for e in o_model.getListOfReactions():
+            if deduplicate:
+                key = get_reaction_key(e)
+                if key in r_keys:
+                    dup_r_num += 1
+                    continue
+                r_keys.add(key)
             if model.addReaction(e):
                 copy_reaction(e, model)
 
-    libsbml.writeSBMLToFile(doc, out_sbml)
\ No newline at end of file
+    if deduplicate:
+        logging.info("merged %d duplicate species and %d duplicate reactions" % (dup_s_num, dup_r_num))
+    monitor.check_cancelled()
+    write_sbml(doc, out_sbml)
\ No newline at end of file
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import logging
+import os
+import sys
+
+__author__ = 'anna'
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Runs several clustering engines side by side on the same models, "
+                                                 "checks that they produce the same clusterings "
+                                                 "(modulo cluster relabelling) and reports their speed-up.")
+    parser.add_argument('--models', default=None, type=str, nargs='+', help="input models in SBML format")
+    parser.add_argument('--synthetic', default=0, type=int,
+                        help="number of synthetic models (of different random seeds) to compare the engines on")
+    parser.add_argument('--families', default=10, type=int,
+                        help="number of metabolite families in each synthetic model")
+    parser.add_argument('--family_size', default=5, type=int,
+                        help="number of metabolites in each family of a synthetic model")
+    parser.add_argument('--engines', default=['reference', 'sequential', 'partitioned'], type=str, nargs='+',
+                        help="engines to compare, the first one being the reference: 'reference' (the original "
+                             "clustering), 'sequential', 'partitioned' or package.module:function "
+                             "(see sbml_generalization/generalization/equivalence.py)")
+    parser.add_argument('--repeats', default=1, type=int,
+                        help="number of runs of each engine on each model (the fastest one is reported)")
+    parser.add_argument('--report', default='engines.tsv', type=str,
+                        help="path to the output tab-separated report")
+    parser.add_argument('--verbose', action="store_true", help="print logging information")
+    return parser
+
+
+def check_params(parser, params):
+    """
+    Checks the parameters and the input files, before anything heavy (libsbml, ChEBI) gets loaded:
+    exits with an error message if they are invalid.
+    :param parser: argparse.ArgumentParser
+    :param params: argparse.Namespace parsed parameters
+    """
+    if not params.models and params.synthetic < 1:
+        parser.error("either --models or --synthetic should be specified")
+    for path in params.models or []:
+        if not os.path.isfile(path):
+            parser.error("the input model %s does not exist" % path)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(params.report))):
+        parser.error("the directory of %s does not exist" % params.report)
+    if len(params.engines) < 2:
+        parser.error("at least two --engines are needed")
+    if params.families < 2 or params.family_size < 2:
+        parser.error("--families and --family_size should be at least 2")
+    if params.repeats < 1:
+        parser.error("--repeats should be positive")
+
+
+def main(args=None):
+    """
+    :param args: (optional) list of command line arguments (by default sys.argv[1:])
+    :return: int, exit status: 0 if all the engines agree with the reference, 1 otherwise
+    """
+    parser = get_parser()
+    params = parser.parse_args(args)
+    check_params(parser, params)
+
+    # imported here, so that --help and the parameter checks do not have to load libsbml and mod_sbml
+    from mod_sbml.annotation.chebi.chebi_serializer import get_chebi
+    from mod_sbml.onto import parse_simple
+    from sbml_generalization.generalization.equivalence import compare_engines, create_synthetic_model, get_engine, \
+        SYNTHETIC_UB_CHEBI_IDS, COMPONENTS
+    from sbml_generalization.sbml.sbml_helper import read_sbml
+
+    try:
+        engines = [(name, get_engine(name)) for name in params.engines]
+    except (ValueError, ImportError, AttributeError) as e:
+        parser.error("invalid engine: %s" % e)
+
+    if params.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    logging.info("parsing ChEBI...")
+    chebi = parse_simple(get_chebi())
+    results = []
+    for seed in range(params.synthetic):
+        doc = create_synthetic_model(chebi, params.families, params.family_size, seed)
+        results.extend(compare_engines(doc.getModel().getId(), doc, chebi, engines,
+                                       ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS), repeats=params.repeats))
+    for path in params.models or []:
+        results.extend(compare_engines(os.path.basename(path), read_sbml(path), chebi, engines,
+                                       ub_chebi_ids={'chebi:ch'}, repeats=params.repeats))
+
+    with open(params.report, 'w') as f:
+        f.write('model\tengine\ttime (s)\tspeed-up\tstable\tequal\tdiverging reactions\tdiverging species'
+                '\texamples\t%s\n' % '\t'.join('%s time (s)' % component for component in COMPONENTS))
+        for res in results:
+            f.write('%s\t%s\t%.3f\t%.2f\t%s\t%s\t%d\t%d\t%s\t%s\n'
+                    % (res['model'], res['engine'], res['time'], res['speed_up'], res['stable'], res['equal'],
+                       res['diverging_reactions'], res['diverging_species'], ','.join(res['examples']),
+                       '\t'.join('%.3f' % res['component_times'][component] for component in COMPONENTS)))
+    logging.info("saved the report to %s" % params.report)
+    return 0 if all(res['equal'] and res['stable'] for res in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,40 +1,212 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import argparse
 import logging
 import os
 
-from mod_sbml.annotation.chebi.chebi_serializer import get_chebi
-from mod_sbml.onto import parse_simple
-from sbml_generalization.generalization.sbml_generalizer import generalize_model
-
 __author__ = 'anna'
 
+# the options used only when generalizing a single model, ignored by the --models and the sweep modes
+SINGLE_MODEL_OPTIONS = ('output_model', 'groups_model', 'output_matrix', 'time_budget', 'max_iterations',
+                        'max_exact_cluster_size', 'partitioned', 'low_memory')
 
-if __name__ == "__main__":
-    import argparse
 
+def get_parser():
     parser = argparse.ArgumentParser(description="Generalizes an SBML model.")
-    parser.add_argument('--model', required=True, type=str,
+    parser.add_argument('--model', default=None, type=str,
                         help="input model in SBML format")
+    parser.add_argument('--models', default=None, type=str, nargs='+',
+                        help="instead of a single model, generalize a family of related models in SBML format, "
+                             "sharing the clustering of their common reactions")
+    parser.add_argument('--correspondence', default=None, type=str,
+                        help="path to the output tab-separated table of the group correspondence between the models "
+                             "(when generalizing several models)")
     parser.add_argument('--output_model', default=None, type=str,
                         help="path to the output generalized model in SBML format")
     parser.add_argument('--groups_model', default=None, type=str,
                         help="path to the output model in SBML format with groups extension to encode similar elements")
+    parser.add_argument('--output_matrix', default=None, type=str,
+                        help="path to the output .npz file to store the sparse stoichiometric matrix "
+                             "of the generalized model and the projections of the initial model onto it")
+    parser.add_argument('--groups_sidecar', action="store_true",
+                        help="also save the groups into a compact file next to the model with groups extension, "
+                             "for the tools that use them to load them without parsing the SBML")
     parser.add_argument('--verbose', action="store_true", help="print logging information")
     parser.add_argument('--log', default=None, help="a log file")
-    params = parser.parse_args()
+    parser.add_argument('--metrics', default=None, type=str,
+                        help="path to the output file where the clustering metrics (e.g. vertical key calculations, "
+                             "stoichiometry conflicts per cluster) are saved at the end of the run, "
+                             "as JSON if the path ends with .json, in Prometheus text format otherwise")
+    parser.add_argument('--annotation_cache', default=None, type=str,
+                        help="path to the file where ChEBI terms inferred from species names are cached between runs")
+    parser.add_argument('--name_index', default=None, type=str,
+                        help="path to the index of ChEBI term names (will be created if it does not exist yet)")
+    parser.add_argument('--match_name_prefixes', action="store_true",
+                        help="with --name_index, annotate a species whose name matches no ChEBI term name "
+                             "with the only term whose name starts with it (if there is exactly one such term)")
+    parser.add_argument('--model_cache', default=None, type=str,
+                        help="path to the directory where preprocessed models are cached between runs")
+    parser.add_argument('--time_budget', default=None, type=float,
+                        help="maximal time (in seconds) to be spent on metabolite clustering, "
+                             "after which the best clustering found so far is used")
+    parser.add_argument('--max_iterations', default=None, type=int,
+                        help="maximal number of iterations of each metabolite diversity loop")
+    parser.add_argument('--max_exact_cluster_size', default=None, type=int,
+                        help="clusters of more terms than that are split approximately "
+                             "(by conflict graph colouring) to preserve the reaction stoichiometry")
+    parser.add_argument('--low_memory', action="store_true",
+                        help="create the output models one after another inplace in the input model, "
+                             "to lower the peak memory usage of the serialization")
+    parser.add_argument('--partitioned', action="store_true",
+                        help="partition the model into independent components and cluster them in parallel")
+    parser.add_argument('--processes', default=None, type=int,
+                        help="maximal number of worker processes (by default the number of CPUs)")
+    parser.add_argument('--sweep_thresholds', default=None, type=int, nargs='+',
+                        help="instead of generalizing the model, compare the generalizations obtained "
+                             "when considering as ubiquitous the metabolites participating "
+                             "in more than each of the given numbers of reactions")
+    parser.add_argument('--sweep_ub_chebi_ids', default=None, action='append',
+                        help="instead of generalizing the model, compare the generalizations obtained "
+                             "with the given comma-separated ubiquitous ChEBI term ids (can be repeated)")
+    parser.add_argument('--sweep_report', default=None, type=str,
+                        help="path to the output tab-separated report of the sweep")
+    return parser
+
+
+def check_params(parser, params):
+    """
+    Checks the parameters and the input files, before anything heavy (libsbml, ChEBI) gets loaded:
+    exits with an error message if they are invalid.
+    :param parser: argparse.ArgumentParser
+    :param params: argparse.Namespace parsed parameters
+    """
+    if not params.model and not params.models:
+        parser.error("either --model or --models should be specified")
+    if params.model and params.models:
+        parser.error("--model and --models cannot be combined")
+    if params.match_name_prefixes and not params.name_index:
+        parser.error("--match_name_prefixes needs --name_index")
+    if params.models and (params.sweep_thresholds or params.sweep_ub_chebi_ids):
+        parser.error("the sweep is only available for a single --model")
+    if params.models or params.sweep_thresholds or params.sweep_ub_chebi_ids:
+        mode = '--models' if params.models else 'the sweep'
+        for option in SINGLE_MODEL_OPTIONS:
+            if getattr(params, option) not in (None, False):
+                parser.error("--%s cannot be used with %s" % (option, mode))
+    if params.models and params.processes is not None:
+        parser.error("--processes cannot be used with --models")
+    if not params.models and params.correspondence:
+        parser.error("--correspondence needs --models")
+    if (params.sweep_thresholds or params.sweep_ub_chebi_ids) and params.groups_sidecar:
+        parser.error("--groups_sidecar cannot be used with the sweep")
+    if params.sweep_report and not (params.sweep_thresholds or params.sweep_ub_chebi_ids):
+        parser.error("--sweep_report needs --sweep_thresholds or --sweep_ub_chebi_ids")
+    for path in [params.model] if params.model else params.models:
+        if not os.path.isfile(path):
+            parser.error("the input model %s does not exist" % path)
+        if not os.access(path, os.R_OK):
+            parser.error("the input model %s is not readable" % path)
+    for path in (params.output_model, params.groups_model, params.output_matrix, params.correspondence,
+                 params.sweep_report, params.metrics, params.annotation_cache, params.name_index):
+        if path and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            parser.error("the directory of %s does not exist" % path)
+    if params.processes is not None and params.processes < 1:
+        parser.error("--processes should be positive")
+    if params.time_budget is not None and params.time_budget <= 0:
+        parser.error("--time_budget should be positive")
+    if params.max_iterations is not None and params.max_iterations < 1:
+        parser.error("--max_iterations should be positive")
+    if params.max_exact_cluster_size is not None and params.max_exact_cluster_size < 1:
+        parser.error("--max_exact_cluster_size should be positive")
+
 
-    prefix = os.path.splitext(params.model)[0]
+def main(args=None):
+    """
+    Runs the generalization from the command line.
+    :param args: (optional) list of command line arguments (by default sys.argv[1:])
+    """
+    parser = get_parser()
+    params = parser.parse_args(args)
+    check_params(parser, params)
+
+    # imported here, so that --help and the parameter checks do not have to load libsbml and mod_sbml
+    from mod_sbml.annotation.chebi.chebi_serializer import get_chebi
+    from mod_sbml.onto import parse_simple
+    from sbml_generalization.annotation.annotation_cache import AnnotationCache, get_ontology_version
+    from sbml_generalization.annotation.name_index import get_name_index
+    from sbml_generalization.generalization.budget import Budget
+    from sbml_generalization.generalization.family import generalize_models
+    from sbml_generalization.generalization.metrics import METRICS, MetricsRegistry
+    from sbml_generalization.generalization.sbml_generalizer import generalize_model
+    from sbml_generalization.generalization.sweep import sweep_ubiquitous
+    from sbml_generalization.sbml.model_cache import ModelCache
+    from sbml_generalization.sbml.sbml_helper import get_sbml_prefix
+
+    # the output models are compressed the same way as the input one (unless specified otherwise)
+    prefix, compression = get_sbml_prefix(params.model if params.model else params.models[0])
     if not params.output_model:
-        params.output_model = "%s_generalized.xml" % prefix
+        params.output_model = "%s_generalized.xml%s" % (prefix, compression)
     if not params.groups_model:
-        params.groups_model = "%s_with_groups.xml" % prefix
+        params.groups_model = "%s_with_groups.xml%s" % (prefix, compression)
+    if not params.sweep_report:
+        params.sweep_report = "%s_sweep.tsv" % prefix
+    if not params.correspondence:
+        params.correspondence = "%s_correspondence.tsv" % prefix
 
     if params.verbose:
         logging.basicConfig(level=logging.INFO)
+    metrics = MetricsRegistry()
+    if params.metrics:
+        metrics.enable()
 
     logging.info("parsing ChEBI...")
     ontology = parse_simple(get_chebi())
-    r_id2clu, s_id2clu, _, _ = generalize_model(params.model, ontology, params.groups_model, params.output_model,
-                                                ub_chebi_ids={'chebi:ch'})
+    onto_version = get_ontology_version(get_chebi())
+    annotation_cache = AnnotationCache(params.annotation_cache, onto_version) if params.annotation_cache else None
+    name_index = get_name_index(ontology, params.name_index, onto_version, params.match_name_prefixes) \
+        if params.name_index else None
+    model_cache = ModelCache(params.model_cache, onto_version) if params.model_cache else None
+    # the metrics of this run (whatever the mode) are recorded to its own registry
+    with METRICS.bind(metrics):
+        if params.models:
+            prefixes = [get_sbml_prefix(model) for model in params.models]
+            generalize_models(params.models, ontology,
+                              ["%s_with_groups.xml%s" % (m_prefix, m_compression) for (m_prefix, m_compression)
+                               in prefixes],
+                              ["%s_generalized.xml%s" % (m_prefix, m_compression) for (m_prefix, m_compression)
+                               in prefixes],
+                              correspondence_tsv=params.correspondence, ub_chebi_ids={'chebi:ch'},
+                              annotation_cache=annotation_cache, name_index=name_index, model_cache=model_cache,
+                              groups_sidecar=params.groups_sidecar)
+        elif params.sweep_thresholds or params.sweep_ub_chebi_ids:
+            ub_chebi_id_sets = [[it.strip() for it in ids.split(',') if it.strip()]
+                                for ids in params.sweep_ub_chebi_ids] if params.sweep_ub_chebi_ids else None
+            results = sweep_ubiquitous(params.model, ontology, params.sweep_thresholds, ub_chebi_id_sets,
+                                       annotation_cache=annotation_cache, name_index=name_index,
+                                       processes=params.processes, model_cache=model_cache)
+            with open(params.sweep_report, 'w') as f:
+                f.write('setting\tubiquitous species\tspecies\tgeneralized species\treactions\tgeneralized reactions'
+                        '\tcompression ratio\ttime (s)\n')
+                for res in results:
+                    setting = 'threshold=%d' % res['threshold'] if 'threshold' in res \
+                        else 'ub_chebi_ids=%s' % ','.join(res['ub_chebi_ids'])
+                    f.write('%s\t%d\t%d\t%d\t%d\t%d\t%.3f\t%.1f\n'
+                            % (setting, res['ub_species'], res['species'], res['generalized_species'],
+                               res['reactions'], res['generalized_reactions'], res['compression_ratio'], res['time']))
+            logging.info("saved the sweep report to %s" % params.sweep_report)
+        else:
+            generalize_model(params.model, ontology, params.groups_model, params.output_model,
+                             ub_chebi_ids={'chebi:ch'}, annotation_cache=annotation_cache, name_index=name_index,
+                             budget=Budget(params.time_budget, params.max_iterations),
+                             max_exact_cluster_size=params.max_exact_cluster_size,
+                             partitioned=params.partitioned, processes=params.processes,
+                             out_matrix=params.output_matrix, model_cache=model_cache, low_memory=params.low_memory,
+                             groups_sidecar=params.groups_sidecar, metrics=metrics)
+    if params.metrics:
+        metrics.save(params.metrics)
+        logging.info("saved the metrics to %s" % params.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from mod_sbml.annotation.chebi.chebi_serializer import get_chebi
+from mod_sbml.annotation.gene_ontology.go_serializer import get_go
+from mod_sbml.onto import parse_simple
+from sbml_generalization.annotation.annotation_cache import AnnotationCache, get_ontology_version
+from sbml_generalization.annotation.name_index import get_name_index
+from sbml_generalization.sbml.model_cache import ModelCache
+from sbml_generalization.sbml.sbml_helper import get_sbml_prefix
+from sbml_generalization.generalization.budget import Budget
+from sbml_generalization.generalization.metrics import MetricsRegistry
+from sbml_generalization.generalization.progress import CancellationToken, GeneralizationCancelled
+from sbml_generalization.generalization.sbml_generalizer import generalize_model, ubiquitize_model
+from sbml_generalization.merge.model_merger import merge_models
+
+__author__ = 'anna'
+
+JOB_GENERALIZE = 'generalize'
+JOB_UBIQUITIZE = 'ubiquitize'
+JOB_MERGE = 'merge'
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+
+DEFAULT_PORT = 8525
+
+# finished jobs (and their results) are forgotten after this many seconds
+DEFAULT_JOB_TTL = 24 * 60 * 60
+# or when there are more than this many of them (the oldest ones first)
+DEFAULT_MAX_FINISHED_JOBS = 1000
+
+
+def _is_str_list(value):
+    return isinstance(value, list) and all(isinstance(it, str) for it in value)
+
+
+def _is_non_negative_number(value, types=(int, float)):
+    # booleans are ints in python
+    return isinstance(value, types) and not isinstance(value, bool) and value >= 0
+
+
+# the optional job parameters, the check of their values and what is expected
+PARAM_CHECKS = [(('output_model', 'groups_model', 'output_matrix'), lambda value: isinstance(value, str), 'a path'),
+                (('ub_s_ids', 'ub_chebi_ids'), _is_str_list, 'a list of ids'),
+                (('time_budget', ), _is_non_negative_number, 'a non-negative number'),
+                (('max_iterations', 'max_exact_cluster_size'), lambda value: _is_non_negative_number(value, int),
+                 'a non-negative integer'),
+                (('ignore_biomass', 'low_memory', 'groups_sidecar', 'deduplicate', 'metrics'),
+                 lambda value: isinstance(value, bool), 'a boolean')]
+
+
+class JobError(Exception):
+    def __init__(self, msg, code=400):
+        """
+        :param msg: str, error message
+        :param code: int, HTTP status code to answer with (400 for invalid job parameters)
+        """
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.code = code
+
+
+class Job(object):
+    def __init__(self, job_type, params):
+        self.id = uuid.uuid4().hex
+        self.type = job_type
+        self.params = params
+        self.status = STATUS_QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.progress = None
+        self.cancellation_token = CancellationToken()
+
+    def to_dict(self):
+        return {'id': self.id, 'type': self.type, 'status': self.status, 'error': self.error,
+                'submitted': self.submitted, 'started': self.started, 'finished': self.finished,
+                'progress': self.progress}
+
+
+def _get_output_path(path, suffix):
+    prefix, compression = get_sbml_prefix(path)
+    return "%s_%s.xml%s" % (prefix, suffix, compression)
+
+
+class JobManager(object):
+    """
+    Keeps the ontologies loaded and runs the submitted jobs on a bounded worker pool.
+    """
+
+    def __init__(self, chebi, go=None, max_workers=2, max_queued=100, annotation_cache=None, name_index=None,
+                 model_cache=None, job_ttl=DEFAULT_JOB_TTL, max_finished_jobs=DEFAULT_MAX_FINISHED_JOBS):
+        """
+        :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology (is never modified by the jobs)
+        :param go: (optional) mod_sbml.onto.obo_ontology.Ontology GO ontology (will be loaded on the first merge job)
+        :param max_workers: int, maximal number of jobs to be run in parallel
+        :param max_queued: int, maximal number of jobs waiting to be run
+        :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+        :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+        :param model_cache: (optional) sbml_generalization.sbml.model_cache.ModelCache
+        :param job_ttl: (optional) int, number of seconds after which a finished job is forgotten
+        (None for keeping finished jobs until there are too many of them)
+        :param max_finished_jobs: int, maximal number of finished jobs to be kept (the oldest ones are forgotten)
+        """
+        self.chebi = chebi
+        self.go = go
+        self.max_queued = max_queued
+        self.annotation_cache = annotation_cache
+        self.name_index = name_index
+        self.model_cache = model_cache
+        self.job_ttl = job_ttl
+        self.max_finished_jobs = max_finished_jobs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs = {}
+        self.lock = threading.RLock()
+
+    def submit(self, job_type, params):
+        """
+        Submits a job.
+        :param job_type: str, one of JOB_GENERALIZE, JOB_UBIQUITIZE, JOB_MERGE
+        :param params: dict of job parameters
+        :return: Job the submitted job
+        """
+        self._check_params(job_type, params)
+        with self.lock:
+            self._prune()
+            if sum(1 for job in self.jobs.values() if STATUS_QUEUED == job.status) >= self.max_queued:
+                raise JobError('too many queued jobs')
+            job = Job(job_type, params)
+            self.jobs[job.id] = job
+        try:
+            self.executor.submit(self._run, job)
+        except RuntimeError:
+            # the executor has been shut down
+            with self.lock:
+                del self.jobs[job.id]
+            raise JobError('the server is shutting down', 503)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            self._prune()
+            return self.jobs.get(job_id, None)
+
+    def cancel(self, job_id):
+        """
+        Cancels a job: a queued job will not be run, a running job stops at its next check
+        (and does not save its results).
+        :param job_id: str, job id
+        :return: Job the cancelled job or None if there is no such job
+        """
+        job = self.get(job_id)
+        if job:
+            job.cancellation_token.cancel()
+        return job
+
+    def list(self):
+        with self.lock:
+            self._prune()
+            return list(self.jobs.values())
+
+    def _prune(self):
+        """
+        Forgets the finished jobs that are older than the job TTL,
+        and the oldest finished ones if there are more than max_finished_jobs of them.
+        """
+        with self.lock:
+            finished = sorted((job for job in self.jobs.values() if job.finished is not None),
+                              key=lambda job: job.finished)
+            expired = len(finished) - self.max_finished_jobs if len(finished) > self.max_finished_jobs else 0
+            if self.job_ttl is not None:
+                now = time.time()
+                expired = max(expired, sum(1 for job in finished if now - job.finished > self.job_ttl))
+            for job in finished[:expired]:
+                del self.jobs[job.id]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    @staticmethod
+    def _check_params(job_type, params):
+        """
+        Checks the job type and the types of the job parameters, and that the input models exist.
+        :raise JobError: if the job cannot be run with these parameters
+        """
+        if JOB_MERGE == job_type:
+            models = params.get('models', None)
+            if not models or not _is_str_list(models):
+                raise JobError('a merge job needs a list of models')
+            if not params.get('output_model', None):
+                raise JobError('a merge job needs an output_model')
+        elif job_type in (JOB_GENERALIZE, JOB_UBIQUITIZE):
+            models = [params.get('model', None)]
+            if not models[0] or not isinstance(models[0], str):
+                raise JobError('a %s job needs a model' % job_type)
+        else:
+            raise JobError('unknown job type: %s' % (job_type, ))
+        for names, is_valid, expected in PARAM_CHECKS:
+            for name in names:
+                if params.get(name, None) is not None and not is_valid(params[name]):
+                    raise JobError('%s should be %s' % (name, expected))
+        for model in models:
+            if not os.path.exists(model):
+                raise JobError('model file %s does not exist' % model)
+
+    def _run(self, job):
+        if job.cancellation_token.is_cancelled():
+            job.status, job.finished = STATUS_CANCELLED, time.time()
+            return
+        job.status, job.started = STATUS_RUNNING, time.time()
+        logging.info("running %s job %s" % (job.type, job.id))
+        try:
+            if JOB_GENERALIZE == job.type:
+                job.result = self._generalize(job)
+            elif JOB_UBIQUITIZE == job.type:
+                job.result = self._ubiquitize(job)
+            else:
+                job.result = self._merge(job)
+            job.status = STATUS_DONE
+        except GeneralizationCancelled:
+            logging.info("%s job %s was cancelled" % (job.type, job.id))
+            job.status = STATUS_CANCELLED
+        except Exception as e:
+            logging.exception("%s job %s failed" % (job.type, job.id))
+            job.error = str(e)
+            job.status = STATUS_FAILED
+        job.finished = time.time()
+
+    def _generalize(self, job):
+        params = job.params
+
+        def on_progress(event):
+            job.progress = event
+
+        in_sbml = params['model']
+        out_sbml = params.get('output_model', None) or _get_output_path(in_sbml, 'generalized')
+        groups_sbml = params.get('groups_model', None) or _get_output_path(in_sbml, 'with_groups')
+        ub_s_ids = set(params['ub_s_ids']) if params.get('ub_s_ids', None) else None
+        ub_chebi_ids = set(params['ub_chebi_ids']) if params.get('ub_chebi_ids', None) else None
+        out_matrix = params.get('output_matrix', None)
+        budget = Budget(params.get('time_budget', None), params.get('max_iterations', None))
+        # each job collects its own metrics (if asked to), the concurrent ones do not add to them
+        metrics = MetricsRegistry()
+        if params.get('metrics', False):
+            metrics.enable()
+        r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids = \
+            generalize_model(in_sbml, self.chebi, groups_sbml, out_sbml, ub_s_ids=ub_s_ids, ub_chebi_ids=ub_chebi_ids,
+                             ignore_biomass=params.get('ignore_biomass', True),
+                             annotation_cache=self.annotation_cache, name_index=self.name_index, copy_chebi=True,
+                             progress_callback=on_progress, cancellation_token=job.cancellation_token,
+                             budget=budget, out_matrix=out_matrix, model_cache=self.model_cache,
+                             low_memory=params.get('low_memory', False),
+                             groups_sidecar=params.get('groups_sidecar', False),
+                             max_exact_cluster_size=params.get('max_exact_cluster_size', None), metrics=metrics)
+        return {'output_model': out_sbml, 'groups_model': groups_sbml, 'output_matrix': out_matrix,
+                'truncated_phases': budget.truncated_phases,
+                'truncations': budget.truncations, 'approximated_clusters': budget.approximated_clusters,
+                'metrics': metrics.get_snapshot() if metrics.enabled else None,
+                'r_id2g_id': {r_id: g_id for (r_id, (g_id, _)) in r_id2g_eq.items()},
+                's_id2g_id': {s_id: g_id for (s_id, (g_id, _)) in s_id2gr_id.items()},
+                's_id2chebi_id': s_id2chebi_id, 'ub_s_ids': sorted(ub_s_ids)}
+
+    def _ubiquitize(self, job):
+        params = job.params
+        in_sbml = params['model']
+        groups_sbml = params.get('groups_model', None) or _get_output_path(in_sbml, 'with_groups')
+        ub_s_ids = set(params['ub_s_ids']) if params.get('ub_s_ids', None) else None
+        ub_chebi_ids = set(params['ub_chebi_ids']) if params.get('ub_chebi_ids', None) else None
+        s_id2chebi_id, ub_s_ids = ubiquitize_model(in_sbml, self.chebi, groups_sbml, ub_s_ids=ub_s_ids,
+                                                   ub_chebi_ids=ub_chebi_ids, annotation_cache=self.annotation_cache,
+                                                   name_index=self.name_index, model_cache=self.model_cache,
+                                                   groups_sidecar=params.get('groups_sidecar', False),
+                                                   cancellation_token=job.cancellation_token)
+        return {'groups_model': groups_sbml, 's_id2chebi_id': s_id2chebi_id, 'ub_s_ids': sorted(ub_s_ids)}
+
+    def _merge(self, job):
+        params = job.params
+        with self.lock:
+            if self.go is None:
+                logging.info("parsing GO...")
+                self.go = parse_simple(get_go())
+        merge_models(params['models'], params['output_model'], annotation_cache=self.annotation_cache,
+                     name_index=self.name_index, go=self.go, chebi=self.chebi,
+                     deduplicate=params.get('deduplicate', False), cancellation_token=job.cancellation_token)
+        return {'output_model': params['output_model']}
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+
+    def _send(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        manager = self.server.manager
+        parts = [it for it in self.path.split('/') if it]
+        if ['health'] == parts:
+            return self._send(200, {'status': 'ok'})
+        if ['jobs'] == parts:
+            return self._send(200, [job.to_dict() for job in manager.list()])
+        if len(parts) in (2, 3) and 'jobs' == parts[0]:
+            job = manager.get(parts[1])
+            if not job:
+                return self._send(404, {'error': 'unknown job %s' % parts[1]})
+            if 2 == len(parts):
+                return self._send(200, job.to_dict())
+            if 'result' == parts[2]:
+                if STATUS_DONE != job.status:
+                    return self._send(409, dict(job.to_dict(), error=job.error or 'job is not finished yet'))
+                return self._send(200, job.result)
+        self._send(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if ['jobs'] != [it for it in self.path.split('/') if it]:
+            return self._send(404, {'error': 'unknown path %s' % self.path})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+            if not isinstance(params, dict):
+                return self._send(400, {'error': 'malformed request: the job parameters should be a JSON object'})
+            job = self.server.manager.submit(params.pop('type', JOB_GENERALIZE), params)
+        except ValueError as e:
+            return self._send(400, {'error': 'malformed request: %s' % e})
+        except JobError as e:
+            return self._send(e.code, {'error': e.msg})
+        self._send(202, job.to_dict())
+
+    def do_DELETE(self):
+        parts = [it for it in self.path.split('/') if it]
+        if 2 != len(parts) or 'jobs' != parts[0]:
+            return self._send(404, {'error': 'unknown path %s' % self.path})
+        job = self.server.manager.cancel(parts[1])
+        if not job:
+            return self._send(404, {'error': 'unknown job %s' % parts[1]})
+        self._send(202, job.to_dict())
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s" % (self.address_string(), format % args))
+
+
+class JobServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, manager, host='127.0.0.1', port=DEFAULT_PORT):
+        HTTPServer.__init__(self, (host, port), JobRequestHandler)
+        self.manager = manager
+
+
+def serve(host='127.0.0.1', port=DEFAULT_PORT, max_workers=2, annotation_cache_path=None, name_index_path=None,
+          model_cache_path=None, job_ttl=DEFAULT_JOB_TTL, max_finished_jobs=DEFAULT_MAX_FINISHED_JOBS,
+          match_name_prefixes=False):
+    """
+    Loads ChEBI and serves generalization jobs until interrupted.
+    :param host: str, host to bind to (local by default)
+    :param port: int, port to listen to
+    :param max_workers: int, maximal number of jobs to be run in parallel
+    :param annotation_cache_path: (optional) str, path to the annotation cache
+    :param name_index_path: (optional) str, path to the ChEBI name index
+    :param model_cache_path: (optional) str, path to the directory of the preprocessed model cache
+    :param job_ttl: (optional) int, number of seconds after which a finished job is forgotten
+    :param max_finished_jobs: int, maximal number of finished jobs to be kept
+    :param match_name_prefixes: boolean, whether the name index is also used for name prefix matches
+    (see sbml_generalization.annotation.name_index.NameIndex)
+    :return: void
+    """
+    logging.info("parsing ChEBI...")
+    chebi = parse_simple(get_chebi())
+    onto_version = get_ontology_version(get_chebi())
+    annotation_cache = AnnotationCache(annotation_cache_path, onto_version) if annotation_cache_path else None
+    name_index = get_name_index(chebi, name_index_path, onto_version, match_name_prefixes) \
+        if name_index_path else None
+    model_cache = ModelCache(model_cache_path, onto_version) if model_cache_path else None
+    manager = JobManager(chebi, max_workers=max_workers, annotation_cache=annotation_cache, name_index=name_index,
+                         model_cache=model_cache, job_ttl=job_ttl, max_finished_jobs=max_finished_jobs)
+    server = JobServer(manager, host, port)
+    logging.info("serving generalization jobs on %s:%d" % (host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        manager.shutdown()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serves SBML model generalization jobs over a local HTTP API.")
+    parser.add_argument('--host', default='127.0.0.1', type=str, help="host to bind to")
+    parser.add_argument('--port', default=DEFAULT_PORT, type=int, help="port to listen to")
+    parser.add_argument('--workers', default=2, type=int, help="maximal number of jobs to be run in parallel")
+    parser.add_argument('--annotation_cache', default=None, type=str,
+                        help="path to the file where ChEBI terms inferred from species names are cached between runs")
+    parser.add_argument('--name_index', default=None, type=str,
+                        help="path to the index of ChEBI term names (will be created if it does not exist yet)")
+    parser.add_argument('--match_name_prefixes', action="store_true",
+                        help="with --name_index, annotate a species whose name matches no ChEBI term name "
+                             "with the only term whose name starts with it (if there is exactly one such term)")
+    parser.add_argument('--model_cache', default=None, type=str,
+                        help="path to the directory where preprocessed models are cached between runs")
+    parser.add_argument('--job_ttl', default=DEFAULT_JOB_TTL, type=int,
+                        help="number of seconds after which a finished job and its result are forgotten")
+    parser.add_argument('--max_finished_jobs', default=DEFAULT_MAX_FINISHED_JOBS, type=int,
+                        help="maximal number of finished jobs to be kept (the oldest ones are forgotten first)")
+    parser.add_argument('--verbose', action="store_true", help="print logging information")
+    params = parser.parse_args()
+
+    if params.match_name_prefixes and not params.name_index:
+        parser.error("--match_name_prefixes needs --name_index")
+
+    if params.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    serve(params.host, params.port, params.workers, params.annotation_cache, params.name_index, params.model_cache,
+          params.job_ttl, params.max_finished_jobs, params.match_name_prefixes)
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+__author__ = 'anna'
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# the spool subdirectories, a job file being moved between them as its status changes
+STATUS2DIR = {STATUS_QUEUED: 'queue', STATUS_RUNNING: 'running', STATUS_DONE: 'done', STATUS_FAILED: 'failed'}
+TMP_DIR = 'tmp'
+
+JOB_EXTENSION = '.json'
+LEASE_EXTENSION = '.lease'
+
+# a running job whose lease has not been renewed for that long (in seconds) is considered abandoned
+DEFAULT_LEASE_TIMEOUT = 600
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_INTERVAL = 5
+
+
+class LeaseLost(Exception):
+    def __init__(self, job_id):
+        Exception.__init__(self, "lost the lease of job %s" % job_id)
+        self.msg = "lost the lease of job %s" % job_id
+
+
+def _get_dir(spool_dir, status):
+    return os.path.join(spool_dir, STATUS2DIR[status])
+
+
+def _get_job_path(spool_dir, status, job_id):
+    return os.path.join(_get_dir(spool_dir, status), job_id + JOB_EXTENSION)
+
+
+def _get_lease_path(spool_dir, job_id):
+    return os.path.join(_get_dir(spool_dir, STATUS_RUNNING), job_id + LEASE_EXTENSION)
+
+
+def init_spool(spool_dir):
+    """
+    Creates the spool directory structure (if it does not exist yet).
+    :param spool_dir: str, path to the spool directory (on a file system shared by all the nodes)
+    :return: void
+    """
+    for d in list(STATUS2DIR.values()) + [TMP_DIR]:
+        path = os.path.join(spool_dir, d)
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+
+
+def _write_json(spool_dir, path, data):
+    # written next to its destination and renamed, so that nobody ever reads a partially written file
+    tmp = os.path.join(spool_dir, TMP_DIR, '%s.%s' % (os.path.basename(path), uuid.uuid4().hex))
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def _read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _get_output_path(path, suffix):
+    # imported here, so that the spool can be managed without loading libsbml
+    from sbml_generalization.sbml.sbml_helper import get_sbml_prefix
+
+    prefix, compression = get_sbml_prefix(path)
+    return "%s_%s.xml%s" % (prefix, suffix, compression)
+
+
+def submit_job(spool_dir, model, output_model=None, groups_model=None, **params):
+    """
+    Submits a generalization job to the spool.
+    :param spool_dir: str, path to the spool directory
+    :param model: str, path to the input SBML file (accessible from all the nodes)
+    :param output_model: (optional) str, path to the output generalized SBML file
+    (by default model_generalized.xml next to the input model)
+    :param groups_model: (optional) str, path to the output SBML file with groups extension
+    (by default model_with_groups.xml next to the input model)
+    :param params: other generalization parameters: ub_chebi_ids, ub_s_ids, ignore_biomass, output_matrix,
+    time_budget, max_iterations, max_exact_cluster_size, low_memory, groups_sidecar (see sbml_generalizer.generalize_model),
+    metrics (whether to collect the clustering metrics of the job, see metrics.MetricsRegistry.get_snapshot)
+    :return: str, job id
+    """
+    init_spool(spool_dir)
+    # the ids are ordered by submission time, so that the jobs are claimed in that order
+    job_id = '%d_%s' % (int(time.time() * 1000), uuid.uuid4().hex[:8])
+    model = os.path.abspath(model)
+    job = dict(params)
+    job.update({'id': job_id, 'model': model,
+                'output_model': os.path.abspath(output_model or _get_output_path(model, 'generalized')),
+                'groups_model': os.path.abspath(groups_model or _get_output_path(model, 'with_groups')),
+                'status': STATUS_QUEUED, 'submitted': time.time(), 'attempts': 0})
+    _write_json(spool_dir, _get_job_path(spool_dir, STATUS_QUEUED, job_id), job)
+    logging.info("submitted job %s for %s" % (job_id, model))
+    return job_id
+
+
+def get_jobs(spool_dir, status=None):
+    """
+    Lists the jobs of the spool.
+    :param spool_dir: str, path to the spool directory
+    :param status: (optional) str, status of the jobs of interest (by default all the jobs are listed)
+    :return: list of job dicts, ordered by submission
+    """
+    jobs = []
+    for st in ([status] if status else STATUS2DIR.keys()):
+        d = _get_dir(spool_dir, st)
+        if not os.path.exists(d):
+            continue
+        for name in os.listdir(d):
+            if not name.endswith(JOB_EXTENSION):
+                continue
+            try:
+                job = _read_json(os.path.join(d, name))
+            except (IOError, OSError, ValueError):
+                # moved away (or being moved) in the meantime
+                continue
+            job['status'] = st
+            jobs.append(job)
+    return sorted(jobs, key=lambda job: job['id'])
+
+
+def get_status_counts(spool_dir):
+    """
+    :param spool_dir: str, path to the spool directory
+    :return: dict {status: number of jobs}
+    """
+    return {st: sum(1 for name in os.listdir(_get_dir(spool_dir, st)) if name.endswith(JOB_EXTENSION))
+            if os.path.exists(_get_dir(spool_dir, st)) else 0 for st in STATUS2DIR.keys()}
+
+
+def recover_stale_jobs(spool_dir, lease_timeout=DEFAULT_LEASE_TIMEOUT, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Puts the running jobs whose lease was not renewed in time (e.g. their worker or node died) back to the queue,
+    or fails them if they have already been attempted max_attempts times.
+    Can be called by any worker: the recovery of a job is claimed atomically.
+    :param spool_dir: str, path to the spool directory
+    :param lease_timeout: int, time (in seconds) after which a lease that was not renewed expires
+    :param max_attempts: int, maximal number of times a job is run
+    :return: list of ids of the recovered jobs
+    """
+    recovered = []
+    running_dir = _get_dir(spool_dir, STATUS_RUNNING)
+    now = time.time()
+    for name in sorted(os.listdir(running_dir)):
+        if not name.endswith(JOB_EXTENSION):
+            continue
+        job_id = name[:-len(JOB_EXTENSION)]
+        job_path, lease_path = os.path.join(running_dir, name), _get_lease_path(spool_dir, job_id)
+        try:
+            # a job is renamed into the running directory (which updates its ctime) just before its lease is created
+            renewed = os.stat(lease_path).st_mtime if os.path.exists(lease_path) else os.stat(job_path).st_ctime
+        except OSError:
+            continue
+        if now - renewed < lease_timeout:
+            continue
+        tmp = os.path.join(spool_dir, TMP_DIR, '%s.%s' % (name, uuid.uuid4().hex))
+        try:
+            os.rename(job_path, tmp)
+        except OSError:
+            # somebody else has recovered (or finished) it
+            continue
+        if os.path.exists(lease_path):
+            os.remove(lease_path)
+        job = _read_json(tmp)
+        # the outputs of the abandoned run will never be moved into place
+        _remove_lease_outputs(job)
+        if job['attempts'] >= max_attempts:
+            job.update({'status': STATUS_FAILED, 'finished': now,
+                        'error': 'the lease expired %d time(s), giving up' % job['attempts']})
+            _write_json(spool_dir, _get_job_path(spool_dir, STATUS_FAILED, job_id), job)
+            logging.warning("job %s failed: its lease expired %d time(s)" % (job_id, job['attempts']))
+        else:
+            job['status'] = STATUS_QUEUED
+            _write_json(spool_dir, _get_job_path(spool_dir, STATUS_QUEUED, job_id), job)
+            logging.warning("job %s was abandoned by %s, put it back to the queue" % (job_id, job.get('worker', None)))
+        os.remove(tmp)
+        recovered.append(job_id)
+    return recovered
+
+
+def claim_job(spool_dir, worker_id):
+    """
+    Claims the oldest queued job. The claim is atomic: a job is moved into the running directory by one worker only,
+    even if several ones (on different nodes) try to claim it at the same time.
+    :param spool_dir: str, path to the spool directory
+    :param worker_id: str, id of the claiming worker
+    :return: job dict or None if there are no queued jobs
+    """
+    queue_dir = _get_dir(spool_dir, STATUS_QUEUED)
+    for name in sorted(os.listdir(queue_dir)):
+        if not name.endswith(JOB_EXTENSION):
+            continue
+        job_id = name[:-len(JOB_EXTENSION)]
+        job_path = _get_job_path(spool_dir, STATUS_RUNNING, job_id)
+        try:
+            os.rename(os.path.join(queue_dir, name), job_path)
+        except OSError:
+            # claimed by somebody else in the meantime
+            continue
+        # each claim gets its own lease, so that the outputs of different attempts never get mixed up
+        lease = uuid.uuid4().hex
+        _write_json(spool_dir, _get_lease_path(spool_dir, job_id),
+                    {'worker': worker_id, 'lease': lease, 'host': socket.gethostname(), 'pid': os.getpid(),
+                     'claimed': time.time()})
+        job = _read_json(job_path)
+        job.update({'status': STATUS_RUNNING, 'worker': worker_id, 'lease': lease, 'started': time.time(),
+                    'attempts': job['attempts'] + 1})
+        _write_json(spool_dir, job_path, job)
+        return job
+    return None
+
+
+def owns_lease(spool_dir, job_id, worker_id, lease=None):
+    """
+    :param lease: (optional) str, the lease (see claim_job) the worker is supposed to hold
+    :return: boolean, whether the worker still holds the lease of the job
+    """
+    try:
+        data = _read_json(_get_lease_path(spool_dir, job_id))
+        return data['worker'] == worker_id and (lease is None or data.get('lease', None) == lease)
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+
+
+def _get_lease_output_path(path, lease):
+    return os.path.join(os.path.dirname(path), '.%s.%s' % (lease, os.path.basename(path)))
+
+
+def get_output_paths(job):
+    """
+    Lists the job's outputs, and the temporary paths they are written to while the job is running:
+    those are private to the job's lease (hidden files next to the outputs, with the same extensions),
+    so that a worker that has lost the lease never overwrites the outputs of the one that took the job over.
+    The outputs are moved into place by finish_job, while holding the lease.
+    :param job: job dict, as returned by claim_job
+    :return: list of tuples (path, lease_path)
+    """
+    # imported here, so that the spool can be managed without loading libsbml
+    from sbml_generalization.sbml.group_serializer import get_sidecar_path
+
+    paths = [job['output_model'], job['groups_model']]
+    if job.get('output_matrix', None):
+        paths.append(job['output_matrix'])
+    if job.get('groups_sidecar', False):
+        # saved next to the temporary groups model, hence at the temporary path of the sidecar
+        paths.append(get_sidecar_path(job['groups_model']))
+    return [(path, _get_lease_output_path(path, job['lease'])) for path in paths]
+
+
+def _remove_lease_outputs(job):
+    if not job.get('lease', None):
+        return
+    for _, lease_path in get_output_paths(job):
+        if os.path.exists(lease_path):
+            try:
+                os.remove(lease_path)
+            except OSError:
+                pass
+
+
+class LeaseKeeper(threading.Thread):
+    """
+    Renews the lease of a running job, and cancels the job if its lease got lost
+    (i.e. the job was considered abandoned and recovered by another worker).
+    """
+
+    def __init__(self, spool_dir, job_id, worker_id, interval, cancellation_token=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.spool_dir = spool_dir
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = interval
+        self.cancellation_token = cancellation_token
+        self.stopped = threading.Event()
+
+    def run(self):
+        lease_path = _get_lease_path(self.spool_dir, self.job_id)
+        while not self.stopped.wait(self.interval):
+            if not owns_lease(self.spool_dir, self.job_id, self.worker_id):
+                logging.warning("lost the lease of job %s" % self.job_id)
+                if self.cancellation_token:
+                    self.cancellation_token.cancel()
+                return
+            try:
+                os.utime(lease_path, None)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def finish_job(spool_dir, job, worker_id, result=None, error=None):
+    """
+    Stores the job's result (or error) and marks it as done (or failed), provided the worker still holds its lease.
+    The job's outputs are moved from their temporary paths into place (see get_output_paths) if it is done,
+    and removed otherwise.
+    :param spool_dir: str, path to the spool directory
+    :param job: job dict, as returned by claim_job
+    :param worker_id: str, id of the worker
+    :param result: (optional) dict, the job result
+    :param error: (optional) str, the error message if the job failed
+    :return: void
+    """
+    job_id = job['id']
+    lease = job.get('lease', None)
+    if not owns_lease(spool_dir, job_id, worker_id, lease):
+        _remove_lease_outputs(job)
+        raise LeaseLost(job_id)
+    # The running job file is moved away first: from then on the job can be neither recovered nor claimed again,
+    # and if the lease is still ours, nobody else can take it over until the job is finished.
+    running_path = _get_job_path(spool_dir, STATUS_RUNNING, job_id)
+    tmp = os.path.join(spool_dir, TMP_DIR, '%s%s.%s' % (job_id, JOB_EXTENSION, uuid.uuid4().hex))
+    try:
+        os.rename(running_path, tmp)
+    except OSError:
+        # recovered in the meantime
+        _remove_lease_outputs(job)
+        raise LeaseLost(job_id)
+    if not owns_lease(spool_dir, job_id, worker_id, lease):
+        # recovered and claimed again in the meantime, so the job file belongs to the new lease
+        os.rename(tmp, running_path)
+        _remove_lease_outputs(job)
+        raise LeaseLost(job_id)
+    if error:
+        _remove_lease_outputs(job)
+    elif lease:
+        for path, lease_path in get_output_paths(job):
+            if os.path.exists(lease_path):
+                os.replace(lease_path, path)
+    status = STATUS_FAILED if error else STATUS_DONE
+    job = dict(job)
+    job.update({'status': status, 'finished': time.time(), 'result': result, 'error': error})
+    _write_json(spool_dir, _get_job_path(spool_dir, status, job_id), job)
+    os.remove(_get_lease_path(spool_dir, job_id))
+    os.remove(tmp)
+
+
+def run_job(job, chebi, annotation_cache=None, name_index=None, model_cache=None, cancellation_token=None):
+    """
+    Generalizes the job's model.
+    :param job: job dict
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology (is left intact)
+    :return: dict, the job result
+    """
+    from sbml_generalization.generalization.budget import Budget
+    from sbml_generalization.generalization.metrics import MetricsRegistry
+    from sbml_generalization.generalization.sbml_generalizer import generalize_model
+
+    budget = Budget(job.get('time_budget', None), job.get('max_iterations', None))
+    metrics = MetricsRegistry()
+    if job.get('metrics', False):
+        metrics.enable()
+    ub_s_ids = set(job['ub_s_ids']) if job.get('ub_s_ids', None) else None
+    ub_chebi_ids = set(job['ub_chebi_ids']) if job.get('ub_chebi_ids', None) else None
+    # the outputs are written to the temporary paths of the job's lease, see get_output_paths
+    path2lease_path = dict(get_output_paths(job)) if job.get('lease', None) else {}
+    get_path = lambda path: path2lease_path.get(path, path) if path else path
+    r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids = \
+        generalize_model(job['model'], chebi, get_path(job['groups_model']), get_path(job['output_model']),
+                         ub_s_ids=ub_s_ids, ub_chebi_ids=ub_chebi_ids, ignore_biomass=job.get('ignore_biomass', True),
+                         annotation_cache=annotation_cache, name_index=name_index, copy_chebi=True,
+                         cancellation_token=cancellation_token, budget=budget,
+                         out_matrix=get_path(job.get('output_matrix', None)), model_cache=model_cache,
+                         low_memory=job.get('low_memory', False), groups_sidecar=job.get('groups_sidecar', False),
+                         max_exact_cluster_size=job.get('max_exact_cluster_size', None), metrics=metrics)
+    return {'output_model': job['output_model'], 'groups_model': job['groups_model'],
+            'output_matrix': job.get('output_matrix', None), 'truncated_phases': budget.truncated_phases,
+            'truncations': budget.truncations, 'approximated_clusters': budget.approximated_clusters,
+            'metrics': metrics.get_snapshot() if metrics.enabled else None,
+            'r_id2g_id': {r_id: g_id for (r_id, (g_id, _)) in r_id2g_eq.items()},
+            's_id2g_id': {s_id: g_id for (s_id, (g_id, _)) in s_id2gr_id.items()},
+            's_id2chebi_id': s_id2chebi_id, 'ub_s_ids': sorted(ub_s_ids)}
+
+
+def work(spool_dir, chebi, annotation_cache=None, name_index=None, model_cache=None,
+         lease_timeout=DEFAULT_LEASE_TIMEOUT, max_attempts=DEFAULT_MAX_ATTEMPTS, poll_interval=DEFAULT_POLL_INTERVAL,
+         wait=False):
+    """
+    Claims and runs the spooled jobs one after another.
+    :param spool_dir: str, path to the spool directory
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology (is left intact)
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    :param model_cache: (optional) sbml_generalization.sbml.model_cache.ModelCache
+    :param lease_timeout: int, time (in seconds) after which a job whose lease was not renewed is recovered
+    :param max_attempts: int, maximal number of times a job is run
+    :param poll_interval: int, time (in seconds) to wait before looking for jobs again
+    :param wait: boolean, whether to keep waiting for new jobs (otherwise the worker stops
+    once there are no queued or running jobs left)
+    :return: int, number of jobs processed by this worker
+    """
+    # imported here, so that the spool can be managed without loading libsbml
+    from sbml_generalization.generalization.progress import CancellationToken, GeneralizationCancelled
+
+    init_spool(spool_dir)
+    worker_id = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    logging.info("worker %s is polling %s" % (worker_id, spool_dir))
+    n = 0
+    while True:
+        recover_stale_jobs(spool_dir, lease_timeout, max_attempts)
+        job = claim_job(spool_dir, worker_id)
+        if not job:
+            counts = get_status_counts(spool_dir)
+            if not wait and not counts[STATUS_QUEUED] and not counts[STATUS_RUNNING]:
+                break
+            time.sleep(poll_interval)
+            continue
+        logging.info("worker %s is running job %s (%s)" % (worker_id, job['id'], job['model']))
+        token = CancellationToken()
+        keeper = LeaseKeeper(spool_dir, job['id'], worker_id, max(lease_timeout / 4., 0.1), token)
+        keeper.start()
+        result, error = None, None
+        try:
+            result = run_job(job, chebi, annotation_cache, name_index, model_cache, token)
+        except GeneralizationCancelled:
+            error = 'cancelled'
+        except Exception as e:
+            logging.exception("job %s failed" % job['id'])
+            error = str(e) or e.__class__.__name__
+        finally:
+            keeper.stop()
+        try:
+            finish_job(spool_dir, job, worker_id, result, error)
+            n += 1
+        except LeaseLost as e:
+            # the job was given to another worker, which is going to store its own result
+            logging.warning(e.msg)
+    logging.info("worker %s has processed %d job(s)" % (worker_id, n))
+    return n
+
+
+def _work_in_process(i):
+    return work(*_worker_context[0], **_worker_context[1])
+
+
+# the worker settings (including ChEBI), shared with the (forked) local worker processes
+_worker_context = None
+
+
+def run_workers(spool_dir, processes=1, annotation_cache_path=None, name_index_path=None, model_cache_path=None,
+                match_name_prefixes=False, **kwargs):
+    """
+    Loads ChEBI and runs the given number of workers on this node
+    (in forked processes sharing a read-only copy of it, see generalization.shared_ontology).
+    :param spool_dir: str, path to the spool directory
+    :param processes: int, number of worker processes
+    :param annotation_cache_path: (optional) str, path to the annotation cache
+    :param name_index_path: (optional) str, path to the ChEBI name index
+    :param model_cache_path: (optional) str, path to the directory of the preprocessed model cache
+    :param match_name_prefixes: boolean, whether the name index is also used for name prefix matches
+    (see sbml_generalization.annotation.name_index.NameIndex)
+    :param kwargs: other work parameters (lease_timeout, max_attempts, poll_interval, wait)
+    :return: int, number of jobs processed
+    """
+    global _worker_context
+
+    # imported here, so that the spool can be managed without loading libsbml and ChEBI
+    from mod_sbml.annotation.chebi.chebi_serializer import get_chebi
+    from mod_sbml.onto import parse_simple
+    from sbml_generalization.annotation.annotation_cache import AnnotationCache, get_ontology_version
+    from sbml_generalization.annotation.name_index import get_name_index
+    from sbml_generalization.generalization.shared_ontology import share_ontology
+    from sbml_generalization.generalization.workers import can_fork, fork_pool
+    from sbml_generalization.sbml.model_cache import ModelCache
+
+    logging.info("parsing ChEBI...")
+    chebi = parse_simple(get_chebi())
+    onto_version = get_ontology_version(get_chebi())
+    annotation_cache = AnnotationCache(annotation_cache_path, onto_version) if annotation_cache_path else None
+    name_index = get_name_index(chebi, name_index_path, onto_version, match_name_prefixes) \
+        if name_index_path else None
+    model_cache = ModelCache(model_cache_path, onto_version) if model_cache_path else None
+    if processes <= 1 or not can_fork():
+        return work(spool_dir, chebi, annotation_cache, name_index, model_cache, **kwargs)
+    # the parsed ChEBI is replaced by a read-only copy in shared memory, whose pages the workers never write to
+    chebi = share_ontology(chebi)
+    _worker_context = (spool_dir, chebi, annotation_cache, name_index, model_cache), kwargs
+    try:
+        with fork_pool(processes) as pool:
+            return sum(pool.map(_work_in_process, range(processes)))
+    finally:
+        _worker_context = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Distributes SBML model generalization jobs between the workers "
+                                                 "(possibly on different nodes) sharing a spool directory.")
+    parser.add_argument('command', choices=['submit', 'work', 'status'],
+                        help="submit: spool a job per model; work: run the spooled jobs; status: list the jobs")
+    parser.add_argument('--spool', required=True, type=str,
+                        help="path to the spool directory, on a file system shared by the nodes")
+    parser.add_argument('--models', default=None, type=str, nargs='+', help="input models in SBML format (submit)")
+    parser.add_argument('--output_dir', default=None, type=str,
+                        help="directory for the output models (submit; by default next to the input models)")
+    parser.add_argument('--ub_chebi_ids', default='chebi:ch', type=str,
+                        help="comma-separated ubiquitous ChEBI term ids (submit)")
+    parser.add_argument('--time_budget', default=None, type=float,
+                        help="maximal time (in seconds) to be spent on metabolite clustering of each model (submit)")
+    parser.add_argument('--max_exact_cluster_size', default=None, type=int,
+                        help="clusters of more terms than that are split approximately (submit)")
+    parser.add_argument('--groups_sidecar', action="store_true",
+                        help="also save the groups into a compact file next to the model with groups extension "
+                             "(submit)")
+    parser.add_argument('--metrics', action="store_true",
+                        help="collect the clustering metrics of each job into its result (submit)")
+    parser.add_argument('--processes', default=1, type=int, help="number of worker processes on this node (work)")
+    parser.add_argument('--lease_timeout', default=DEFAULT_LEASE_TIMEOUT, type=int,
+                        help="time (in seconds) after which a job whose worker stopped renewing its lease "
+                             "is put back to the queue (work)")
+    parser.add_argument('--max_attempts', default=DEFAULT_MAX_ATTEMPTS, type=int,
+                        help="maximal number of times a job is run (work)")
+    parser.add_argument('--wait', action="store_true",
+                        help="keep waiting for new jobs, instead of stopping once the spool is empty (work)")
+    parser.add_argument('--annotation_cache', default=None, type=str,
+                        help="path to the file where ChEBI terms inferred from species names are cached between runs")
+    parser.add_argument('--name_index', default=None, type=str,
+                        help="path to the index of ChEBI term names (will be created if it does not exist yet)")
+    parser.add_argument('--match_name_prefixes', action="store_true",
+                        help="with --name_index, annotate a species whose name matches no ChEBI term name "
+                             "with the only term whose name starts with it, if there is exactly one such term (work)")
+    parser.add_argument('--model_cache', default=None, type=str,
+                        help="path to the directory where preprocessed models are cached between runs")
+    parser.add_argument('--verbose', action="store_true", help="print logging information")
+    params = parser.parse_args()
+
+    if params.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+
+    if 'submit' == params.command:
+        if not params.models:
+            parser.error("submit needs --models")
+        for model in params.models:
+            output_model, groups_model = None, None
+            if params.output_dir:
+                name = os.path.basename(model)
+                output_model = _get_output_path(os.path.join(params.output_dir, name), 'generalized')
+                groups_model = _get_output_path(os.path.join(params.output_dir, name), 'with_groups')
+            print(submit_job(params.spool, model, output_model, groups_model,
+                             ub_chebi_ids=[it.strip() for it in params.ub_chebi_ids.split(',') if it.strip()],
+                             time_budget=params.time_budget,
+                             max_exact_cluster_size=params.max_exact_cluster_size, groups_sidecar=params.groups_sidecar,
+                             metrics=params.metrics))
+    elif 'work' == params.command:
+        if params.match_name_prefixes and not params.name_index:
+            parser.error("--match_name_prefixes needs --name_index")
+        run_workers(params.spool, params.processes, params.annotation_cache, params.name_index, params.model_cache,
+                    params.match_name_prefixes, lease_timeout=params.lease_timeout, max_attempts=params.max_attempts,
+                    wait=params.wait)
+    else:
+        for job in get_jobs(params.spool):
+            print('%s\t%s\t%s\t%s' % (job['id'], job['status'], job['model'], job.get('error', None) or ''))
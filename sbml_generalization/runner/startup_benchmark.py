@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+__author__ = 'anna'
+
+# what the runner used to import before parsing its arguments
+EAGER_IMPORTS = 'import libsbml; ' \
+                'from mod_sbml.annotation.chebi.chebi_serializer import get_chebi; ' \
+                'from mod_sbml.onto import parse_simple; ' \
+                'from sbml_generalization.generalization.sbml_generalizer import generalize_model; ' \
+                'from sbml_generalization.generalization.family import generalize_models; ' \
+                'from sbml_generalization.generalization.sweep import sweep_ubiquitous'
+
+RUNNER = 'from sbml_generalization.runner.main import main; main()'
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Measures how long the generalization runner takes to start: "
+                                                 "to print its help and to reject a missing input model, "
+                                                 "compared to a bare interpreter and to importing the modules "
+                                                 "the runner used to load before parsing its arguments.")
+    parser.add_argument('--repeats', default=5, type=int,
+                        help="number of runs of each command (the fastest one is reported)")
+    return parser
+
+
+def measure(command, repeats):
+    """
+    Runs a command several times in a new interpreter.
+    :param command: list of str, arguments of the python interpreter
+    :param repeats: int, number of runs
+    :return: float, the minimal wall-clock time (in seconds)
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(it for it in (root, os.environ.get('PYTHONPATH')) if it))
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.call([sys.executable] + command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main(args=None):
+    """
+    :param args: (optional) list of command line arguments (by default sys.argv[1:])
+    """
+    params = get_parser().parse_args(args)
+    if params.repeats < 1:
+        get_parser().error("--repeats should be positive")
+    missing_model = os.path.join(tempfile.gettempdir(), 'no_such_model.xml')
+    for name, command in (('bare interpreter', ['-c', 'pass']),
+                          ('eager imports', ['-c', EAGER_IMPORTS]),
+                          ('runner --help', ['-c', RUNNER, '--help']),
+                          ('runner, missing model', ['-c', RUNNER, '--model', missing_model])):
+        print('%s\t%.3f s' % (name, measure(command, params.repeats)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+
+from sbml_generalization.sbml.model_cache import get_file_hash
+
+__author__ = 'anna'
+
+SIDECAR_FORMAT_VERSION = 1
+
+# appended to the path of the SBML file with groups extension
+SIDECAR_EXTENSION = '.groups.json'
+
+GROUP_TYPE_SPECIES = 'species'
+GROUP_TYPE_REACTIONS = 'reactions'
+GROUP_TYPE_UBIQUITOUS = 'ubiquitous'
+
+UBIQUITOUS_GROUP_ID = "g_ubiquitous_sps"
+UBIQUITOUS_GROUP_NAME = "ubiquitous species"
+
+
+def get_sidecar_path(groups_sbml):
+    """
+    Gets the path to the sidecar file of an SBML file with groups extension.
+    :param groups_sbml: str, path to the SBML file with groups extension
+    :return: str, path to the sidecar file
+    """
+    return groups_sbml + SIDECAR_EXTENSION
+
+
+def save_groups_sidecar(groups_sbml, ub_sps, s_groups, r_groups):
+    """
+    Saves the groups of an (already written) SBML file with groups extension into a compact columnar JSON sidecar,
+    that can be loaded without parsing the SBML (see load_groups_sidecar).
+    The sidecar contains the hash of the SBML file, so that it is not used once the SBML file has changed.
+
+    The 'groups' columns ('id', 'type', 'name', 'term', 'compartment') describe one group per row,
+    the 'members' columns ('group', 'id') one group member per row, 'group' being the group's row number.
+
+    :param groups_sbml: str, path to the SBML file with groups extension
+    :param ub_sps: collection of ubiquitous species ids
+    :param s_groups: list of species groups, see sbml_helper.get_generalized_elements
+    :param r_groups: list of reaction groups, see sbml_helper.get_generalized_elements
+    :return: void
+    """
+    groups = {'id': [], 'type': [], 'name': [], 'term': [], 'compartment': []}
+    members = {'group': [], 'id': []}
+
+    def add_group(g_id, g_type, name, term, c_id, member_ids):
+        i = len(groups['id'])
+        for key, value in (('id', g_id), ('type', g_type), ('name', name), ('term', term), ('compartment', c_id)):
+            groups[key].append(value)
+        for m_id in sorted(member_ids):
+            members['group'].append(i)
+            members['id'].append(m_id)
+
+    add_group(UBIQUITOUS_GROUP_ID, GROUP_TYPE_UBIQUITOUS, UBIQUITOUS_GROUP_NAME, None, None, ub_sps)
+    for (new_s_id, c_id, t_id, g_name, _, s_ids) in s_groups:
+        add_group(new_s_id, GROUP_TYPE_SPECIES, g_name, t_id, c_id, s_ids)
+    for (new_r_id, r_name, r_ids) in r_groups:
+        add_group(new_r_id, GROUP_TYPE_REACTIONS, r_name, None, None, r_ids)
+
+    sidecar = get_sidecar_path(groups_sbml)
+    logging.info("saving the groups to %s" % sidecar)
+    tmp = '%s.%d.tmp' % (sidecar, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'version': SIDECAR_FORMAT_VERSION, 'sbml_hash': get_file_hash(groups_sbml),
+                   'groups': groups, 'members': members}, f, separators=(',', ':'))
+    # the sidecar is replaced atomically, so that a reader never sees a partially written one
+    os.replace(tmp, sidecar)
+
+
+def load_groups_sidecar(groups_sbml, chebi=None):
+    """
+    Loads the groups of an SBML file with groups extension from its sidecar (see save_groups_sidecar).
+    :param groups_sbml: str, path to the SBML file with groups extension
+    :param chebi: (optional) mod_sbml.onto.obo_ontology.Ontology ChEBI ontology to find the species groups' terms
+    :return: tuple (r_id2g_id, s_id2gr_id, ub_sps) as returned by sbml_helper.parse_group_sbml,
+    or None if the sidecar is missing, unreadable or stale (i.e. the SBML file has changed since it was saved)
+    """
+    sidecar = get_sidecar_path(groups_sbml)
+    if not os.path.exists(sidecar) or not os.path.exists(groups_sbml):
+        return None
+    try:
+        with open(sidecar, 'r') as f:
+            data = json.load(f)
+        if data['version'] != SIDECAR_FORMAT_VERSION or data['sbml_hash'] != get_file_hash(groups_sbml):
+            logging.info("the groups sidecar %s is stale, ignoring it" % sidecar)
+            return None
+        groups, members = data['groups'], data['members']
+        g_ids, g_types, g_names, g_terms = groups['id'], groups['type'], groups['name'], groups['term']
+        m_groups, m_ids = members['group'], members['id']
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning("could not read the groups sidecar %s: %s" % (sidecar, e))
+        return None
+
+    sizes = [0] * len(g_ids)
+    for i in m_groups:
+        sizes[i] += 1
+    terms = [chebi.get_term(t_id, check_only_ids=False) if chebi and t_id else None for t_id in g_terms]
+    r_id2g_id, s_id2gr_id, ub_sps = {}, {}, set()
+    for i, m_id in zip(m_groups, m_ids):
+        g_type = g_types[i]
+        if GROUP_TYPE_REACTIONS == g_type:
+            r_id2g_id[m_id] = g_ids[i], g_names[i], sizes[i]
+        elif GROUP_TYPE_SPECIES == g_type:
+            s_id2gr_id[m_id] = g_ids[i], terms[i] if terms[i] else g_names[i], sizes[i]
+        elif GROUP_TYPE_UBIQUITOUS == g_type:
+            ub_sps.add(m_id)
+    return r_id2g_id, s_id2gr_id, ub_sps
@@ -0,0 +1,115 @@
+from collections import defaultdict
+import logging
+
+from mod_sbml.sbml.sbml_manager import get_products, get_reactants
+
+__author__ = 'anna'
+
+MATRIX_KEYS = ('S', 'P_species', 'P_reactions')
+
+
+def _to_csr(np, rows, cols, values, shape):
+    """
+    Converts the coordinates of the non-zero elements of a matrix into the arrays of its CSR representation.
+    :param np: numpy module
+    :param rows: list of row indices
+    :param cols: list of column indices
+    :param values: list of values
+    :param shape: tuple (row_number, column_number)
+    :return: tuple (data, indices, indptr, shape) of numpy arrays
+    """
+    order = sorted(range(len(rows)), key=lambda i: (rows[i], cols[i]))
+    data = np.array([values[i] for i in order], dtype=np.float64)
+    indices = np.array([cols[i] for i in order], dtype=np.int32)
+    indptr = np.zeros(shape[0] + 1, dtype=np.int32)
+    for i in order:
+        indptr[rows[i] + 1] += 1
+    return data, indices, np.cumsum(indptr, dtype=np.int32), np.array(shape, dtype=np.int64)
+
+
+def save_as_matrix(generalized_model, in_s_ids, in_r_ids, r_id2g_eq, s_id2gr_id, out_matrix):
+    """
+    Saves the generalized network as a sparse stoichiometric matrix, together with the projection matrices
+    from the input model elements to the generalized ones, into a numpy .npz file.
+
+    For each matrix M (among 'S', 'P_species' and 'P_reactions') the file contains the arrays
+    M_data, M_indices, M_indptr and M_shape of its CSR representation
+    (e.g. scipy.sparse.csr_matrix((M_data, M_indices, M_indptr), shape=M_shape)), see load_matrix.
+    The rows of S correspond to 'species_ids' and its columns to 'reaction_ids' of the generalized model,
+    each (species, reaction) pair having at most one entry (the net stoichiometry);
+    P_species (P_reactions) maps 'input_species_ids' ('input_reaction_ids') to 'species_ids' ('reaction_ids'):
+    P[i, j] = 1 if the j-th input element is generalized into the i-th generalized one.
+
+    :param generalized_model: libsbml.Model generalized model
+    :param in_s_ids: list of the input model species ids
+    :param in_r_ids: list of the input model reaction ids
+    :param r_id2g_eq: dict {reaction_id: (reaction_group_id, reaction_group_name)}
+    :param s_id2gr_id: dict {species_id: (species_group_id, term)}
+    :param out_matrix: str, path to the output .npz file
+    :return: void
+    """
+    # numpy is only needed if the matrix is to be saved
+    import numpy as np
+
+    logging.info("saving the stoichiometric matrix to %s" % out_matrix)
+
+    s_ids = [s.getId() for s in generalized_model.getListOfSpecies()]
+    r_ids = [r.getId() for r in generalized_model.getListOfReactions()]
+    s_id2i = {s_id: i for (i, s_id) in enumerate(s_ids)}
+    r_id2i = {r_id: i for (i, r_id) in enumerate(r_ids)}
+
+    # a species that is both consumed and produced by a reaction gets a single entry: its net stoichiometry
+    ij2value = defaultdict(float)
+    for j, r in enumerate(generalized_model.getListOfReactions()):
+        for s_id, st in get_reactants(r, stoichiometry=True):
+            ij2value[(s_id2i[s_id], j)] -= st
+        for s_id, st in get_products(r, stoichiometry=True):
+            ij2value[(s_id2i[s_id], j)] += st
+    ijs = list(ij2value.keys())
+    arrays = {'S': _to_csr(np, [i for (i, _) in ijs], [j for (_, j) in ijs], [ij2value[ij] for ij in ijs],
+                           (len(s_ids), len(r_ids)))}
+
+    for key, in_ids, id2g_id, id2i in (('P_species', in_s_ids, s_id2gr_id, s_id2i),
+                                       ('P_reactions', in_r_ids, r_id2g_eq, r_id2i)):
+        rows, cols = [], []
+        for j, e_id in enumerate(in_ids):
+            g_id = id2g_id[e_id][0] if e_id in id2g_id else e_id
+            # elements that did not make it into the generalized model (e.g. unused species) are not projected
+            if g_id in id2i:
+                rows.append(id2i[g_id])
+                cols.append(j)
+        arrays[key] = _to_csr(np, rows, cols, [1] * len(rows), (len(id2i), len(in_ids)))
+
+    kwargs = {'species_ids': np.array(s_ids), 'reaction_ids': np.array(r_ids),
+              'input_species_ids': np.array(in_s_ids), 'input_reaction_ids': np.array(in_r_ids)}
+    for key, (data, indices, indptr, shape) in arrays.items():
+        kwargs.update({'%s_data' % key: data, '%s_indices' % key: indices, '%s_indptr' % key: indptr,
+                       '%s_shape' % key: shape})
+    with open(out_matrix, 'wb') as f:
+        np.savez_compressed(f, **kwargs)
+
+
+def load_matrix(in_matrix):
+    """
+    Loads the stoichiometric and projection matrices saved with save_as_matrix.
+    :param in_matrix: str, path to the .npz file
+    :return: dict {'S': S, 'P_species': P_species, 'P_reactions': P_reactions, 'species_ids': list,
+    'reaction_ids': list, 'input_species_ids': list, 'input_reaction_ids': list},
+    where the matrices are scipy.sparse.csr_matrix if SciPy is available,
+    or tuples (data, indices, indptr, shape) otherwise.
+    """
+    import numpy as np
+    try:
+        from scipy.sparse import csr_matrix
+    except ImportError:
+        csr_matrix = None
+
+    with np.load(in_matrix) as npz:
+        result = {key: [str(it) for it in npz[key]]
+                  for key in ('species_ids', 'reaction_ids', 'input_species_ids', 'input_reaction_ids')}
+        for key in MATRIX_KEYS:
+            data, indices, indptr = (npz['%s_%s' % (key, it)] for it in ('data', 'indices', 'indptr'))
+            shape = tuple(int(it) for it in npz['%s_shape' % key])
+            result[key] = csr_matrix((data, indices, indptr), shape=shape) if csr_matrix \
+                else (data, indices, indptr, shape)
+    return result
@@ -0,0 +1,356 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import zlib
+
+import libsbml
+
+from mod_sbml.sbml.sbml_manager import get_stoichiometry
+
+__author__ = 'anna'
+
+# the cached entries used to be pickled and keyed by the input file hash and the biomass setting only
+CACHE_FORMAT_VERSION = 2
+
+
+def get_file_hash(path):
+    """
+    Calculates the SHA-256 hash of a file's content.
+    :param path: str, path to the file
+    :return: str, hexadecimal hash
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CachedSpecies(object):
+    """
+    Read-only stand-in for libsbml.Species, keeping only what the generalization needs.
+    """
+
+    def __init__(self, s_id, name, compartment):
+        self.id = s_id
+        self.name = name
+        self.compartment = compartment
+
+    @staticmethod
+    def from_sbml(s):
+        return CachedSpecies(s.getId(), s.getName(), s.getCompartment())
+
+    def to_json(self):
+        return [self.id, self.name, self.compartment]
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+    def getCompartment(self):
+        return self.compartment
+
+
+class CachedSpeciesReference(object):
+    """
+    Read-only stand-in for libsbml.SpeciesReference.
+    """
+
+    def __init__(self, species, stoichiometry):
+        self.species = species
+        self.stoichiometry = stoichiometry
+
+    @staticmethod
+    def from_sbml(species_ref):
+        return CachedSpeciesReference(species_ref.getSpecies(), get_stoichiometry(species_ref))
+
+    def to_json(self):
+        return [self.species, self.stoichiometry]
+
+    def getSpecies(self):
+        return self.species
+
+    def getStoichiometry(self):
+        return self.stoichiometry
+
+    def getStoichiometryMath(self):
+        return None
+
+
+class CachedReaction(object):
+    """
+    Read-only stand-in for libsbml.Reaction.
+    """
+
+    def __init__(self, r_id, name, reversible, reactants, products, modifiers):
+        self.id = r_id
+        self.name = name
+        self.reversible = reversible
+        self.reactants = reactants
+        self.products = products
+        self.modifiers = modifiers
+
+    @staticmethod
+    def from_sbml(r):
+        return CachedReaction(r.getId(), r.getName(), r.getReversible(),
+                              [CachedSpeciesReference.from_sbml(it) for it in r.getListOfReactants()],
+                              [CachedSpeciesReference.from_sbml(it) for it in r.getListOfProducts()],
+                              [CachedSpeciesReference.from_sbml(it) for it in r.getListOfModifiers()])
+
+    @staticmethod
+    def from_json(data):
+        r_id, name, reversible, reactants, products, modifiers = data
+        return CachedReaction(r_id, name, reversible, *([CachedSpeciesReference(*it) for it in refs]
+                                                        for refs in (reactants, products, modifiers)))
+
+    def to_json(self):
+        return [self.id, self.name, self.reversible] + \
+               [[it.to_json() for it in refs] for refs in (self.reactants, self.products, self.modifiers)]
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+    def getReversible(self):
+        return self.reversible
+
+    def getListOfReactants(self):
+        return self.reactants
+
+    def getListOfProducts(self):
+        return self.products
+
+    def getListOfModifiers(self):
+        return self.modifiers
+
+    def getNumReactants(self):
+        return len(self.reactants)
+
+    def getNumProducts(self):
+        return len(self.products)
+
+    def getNumModifiers(self):
+        return len(self.modifiers)
+
+
+class CachedModel(object):
+    """
+    Read-only stand-in for a preprocessed libsbml.Model: keeps its reaction/species structure
+    (which is all the metabolite and reaction clustering needs),
+    plus the compressed SBML of the preprocessed model, to be parsed only for serialization (see get_sbml_model).
+    """
+
+    def __init__(self, m_id, species, reactions, sbml):
+        self.id = m_id
+        self.species = species
+        self.reactions = reactions
+        self.id2species = {s.getId(): s for s in self.species}
+        self.id2reaction = {r.getId(): r for r in self.reactions}
+        self.sbml = sbml
+
+    @staticmethod
+    def from_sbml(model):
+        doc = libsbml.SBMLDocument(model.getSBMLNamespaces())
+        doc.setModel(model)
+        return CachedModel(model.getId(), [CachedSpecies.from_sbml(s) for s in model.getListOfSpecies()],
+                           [CachedReaction.from_sbml(r) for r in model.getListOfReactions()],
+                           zlib.compress(libsbml.writeSBMLToString(doc).encode('utf-8')))
+
+    @staticmethod
+    def from_json(data):
+        return CachedModel(data['id'], [CachedSpecies(*it) for it in data['species']],
+                           [CachedReaction.from_json(it) for it in data['reactions']],
+                           base64.b64decode(data['sbml']))
+
+    def to_json(self):
+        return {'id': self.id, 'species': [s.to_json() for s in self.species],
+                'reactions': [r.to_json() for r in self.reactions],
+                'sbml': base64.b64encode(self.sbml).decode('ascii')}
+
+    def getId(self):
+        return self.id
+
+    def getListOfSpecies(self):
+        return self.species
+
+    def getListOfReactions(self):
+        return self.reactions
+
+    def getNumSpecies(self):
+        return len(self.species)
+
+    def getNumReactions(self):
+        return len(self.reactions)
+
+    def getSpecies(self, s_id):
+        return self.id2species.get(s_id, None)
+
+    def getReaction(self, r_id):
+        return self.id2reaction.get(r_id, None)
+
+
+def get_sbml_model(model):
+    """
+    Gets a libsbml model for the given (possibly cached) model.
+    :param model: libsbml.Model or CachedModel
+    :return: tuple (doc, model): libsbml.SBMLDocument (to be kept while the model is used, None for libsbml models),
+    libsbml.Model
+    """
+    if not isinstance(model, CachedModel):
+        return None, model
+    doc = libsbml.readSBMLFromString(zlib.decompress(model.sbml).decode('utf-8'))
+    return doc, doc.getModel()
+
+
+def get_annotation_settings(annotation_cache=None, name_index=None):
+    """
+    Describes the settings the species were annotated with (see species_annotator.annotate_species),
+    as they might change the inferred ChEBI terms.
+    :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+    :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+    :return: str, settings description
+    """
+    return "annotation_cache=%d;name_index=%s" % (1 if annotation_cache is not None else 0,
+                                                  name_index.get_fingerprint() if name_index is not None else None)
+
+
+class ModelCache(object):
+    """
+    Persistent cache of preprocessed models (see sbml_generalization.generalization.sbml_generalizer.preprocess_model),
+    keyed by the input file hash, the biomass and the annotation settings, and valid for a given ontology version:
+    for each model it stores its CachedModel, species to ChEBI mapping and the reactions to be ignored.
+    It also stores the species to ChEBI mapping of the input models annotated as they are (i.e. not preprocessed),
+    see get_annotation.
+    """
+
+    def __init__(self, directory, version):
+        """
+        :param directory: str, path to the directory where the cached models are stored
+        :param version: str, ontology version (see sbml_generalization.annotation.annotation_cache.get_ontology_version)
+        """
+        self.directory = directory
+        self.version = version
+        self.lock = threading.RLock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _get_path(self, in_sbml, ignore_biomass, annotation_settings):
+        settings_hash = hashlib.sha256(annotation_settings.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, "%s_%d_%s.json"
+                            % (get_file_hash(in_sbml), 1 if ignore_biomass else 0, settings_hash))
+
+    def _get_annotation_path(self, in_sbml, annotation_settings):
+        settings_hash = hashlib.sha256(annotation_settings.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, "%s_annotation_%s.json" % (get_file_hash(in_sbml), settings_hash))
+
+    def _load(self, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            logging.error("ignoring the corrupted model cache entry %s" % path)
+            return None
+        if data.get('format') != CACHE_FORMAT_VERSION or data.get('version') != self.version:
+            logging.info("ignoring the model cache entry %s as it was built for another ontology version" % path)
+            return None
+        return data
+
+    def _save(self, path, data):
+        data.update({'format': CACHE_FORMAT_VERSION, 'version': self.version})
+        with self.lock:
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+
+    def get_annotation(self, in_sbml, annotation_cache=None, name_index=None):
+        """
+        Looks for the species to ChEBI mapping of an input model annotated as it is (without preprocessing,
+        e.g. for ubiquitize_model, whose output keeps all the input elements) in the cache.
+        :param in_sbml: str, path to the input SBML file
+        :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+        the species are annotated with
+        :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+        the species are annotated with
+        :return: dict {species_id: ChEBI_term_id}, or None if the model is not cached
+        """
+        path = self._get_annotation_path(in_sbml, get_annotation_settings(annotation_cache, name_index))
+        data = self._load(path)
+        if data is None:
+            return None
+        if not isinstance(data.get('s_id2chebi_id', None), dict):
+            logging.error("ignoring the corrupted model cache entry %s" % path)
+            return None
+        logging.info("loaded the species annotations from %s" % path)
+        return data['s_id2chebi_id']
+
+    def put_annotation(self, in_sbml, s_id2chebi_id, annotation_cache=None, name_index=None):
+        """
+        Caches the species to ChEBI mapping of an input model annotated as it is (see get_annotation).
+        :param in_sbml: str, path to the input SBML file
+        :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
+        :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+        the species were annotated with
+        :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+        the species were annotated with
+        :return: void
+        """
+        self._save(self._get_annotation_path(in_sbml, get_annotation_settings(annotation_cache, name_index)),
+                   {'s_id2chebi_id': s_id2chebi_id})
+
+    def get(self, in_sbml, ignore_biomass=True, annotation_cache=None, name_index=None):
+        """
+        Looks for a preprocessed model in the cache.
+        :param in_sbml: str, path to the input SBML file
+        :param ignore_biomass: boolean, whether the biomass reaction is ignored
+        :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+        the species are annotated with
+        :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+        the species are annotated with
+        :return: tuple (model, s_id2chebi_id, r_ids_to_ignore): CachedModel, dict {species_id: ChEBI_term_id},
+        ids of reactions whose stoichiometry preserving constraint can be ignored (or None);
+        or None if the model is not cached
+        """
+        path = self._get_path(in_sbml, ignore_biomass, get_annotation_settings(annotation_cache, name_index))
+        data = self._load(path)
+        if data is None:
+            return None
+        try:
+            model = CachedModel.from_json(data['model'])
+            r_ids_to_ignore = set(data['r_ids_to_ignore']) if data['r_ids_to_ignore'] is not None else None
+            s_id2chebi_id = data['s_id2chebi_id']
+        except (ValueError, KeyError, TypeError):
+            logging.error("ignoring the corrupted model cache entry %s" % path)
+            return None
+        logging.info("loaded the preprocessed model from %s" % path)
+        return model, s_id2chebi_id, r_ids_to_ignore
+
+    def put(self, in_sbml, ignore_biomass, model, s_id2chebi_id, r_ids_to_ignore, annotation_cache=None,
+            name_index=None):
+        """
+        Caches a preprocessed model.
+        :param in_sbml: str, path to the input SBML file
+        :param ignore_biomass: boolean, whether the biomass reaction is ignored
+        :param model: libsbml.Model preprocessed model
+        :param s_id2chebi_id: dict {species_id: ChEBI_term_id}
+        :param r_ids_to_ignore: ids of reactions whose stoichiometry preserving constraint can be ignored (or None)
+        :param annotation_cache: (optional) sbml_generalization.annotation.annotation_cache.AnnotationCache
+        the species were annotated with
+        :param name_index: (optional) sbml_generalization.annotation.name_index.NameIndex
+        the species were annotated with
+        :return: CachedModel, the cached version of the model
+        """
+        cached_model = model if isinstance(model, CachedModel) else CachedModel.from_sbml(model)
+        self._save(self._get_path(in_sbml, ignore_biomass, get_annotation_settings(annotation_cache, name_index)),
+                   {'model': cached_model.to_json(), 's_id2chebi_id': s_id2chebi_id,
+                    'r_ids_to_ignore': sorted(r_ids_to_ignore) if r_ids_to_ignore is not None else None})
+        return cached_model
@@ -1,4 +1,8 @@
+import bz2
+import gzip
 import logging
+import lzma
+import os
 
 import libsbml
 
@@ -8,6 +12,10 @@ from mod_sbml.annotation.rdf_annotation_helper import add_annotation, get_annota
 from mod_sbml.sbml.sbml_manager import get_products, get_reactants, get_metabolites, generate_unique_id, create_reaction, \
     create_species
 
+from sbml_generalization.sbml.matrix_serializer import save_as_matrix
+from sbml_generalization.sbml.group_serializer import save_groups_sidecar, load_groups_sidecar, \
+    UBIQUITOUS_GROUP_ID, UBIQUITOUS_GROUP_NAME
+
 GROUP_TYPE_EQUIV = "equivalent"
 
 GROUP_TYPE_UBIQUITOUS = "ubiquitous"
@@ -16,6 +24,11 @@ SBO_CHEMICAL_MACROMOLECULE = "SBO:0000248"
 
 SBO_BIOCHEMICAL_REACTION = "SBO:0000176"
 
+# compressed SBML file extension: (python module, whether libsbml can (de)compress it itself)
+COMPRESSIONS = {'.gz': (gzip, libsbml.SBMLReader.hasZlib() and libsbml.SBMLWriter.hasZlib()),
+                '.bz2': (bz2, libsbml.SBMLReader.hasBzip2() and libsbml.SBMLWriter.hasBzip2()),
+                '.xz': (lzma, False)}
+
 
 __author__ = 'anna'
 
@@ -80,26 +93,36 @@ def remove_unused_elements(model, include_modifiers=True):
     :return: void, input model is modified inplace
     """
     species_to_keep = get_used_species(model, include_modifiers)
-    sp_list = list(model.getListOfSpecies())
-    for species in sp_list:
-        species_id = species.getId()
-        if not (species_id in species_to_keep):
-            model.removeSpecies(species_id)
+    remove_elements(model.getListOfSpecies(), lambda species: species.getId() in species_to_keep)
+
+    c_id2outside = {c.getId(): c.getOutside() for c in model.getListOfCompartments()}
     compartments_to_keep = set()
-    for species in model.getListOfSpecies():
-        compartment_id = species.getCompartment()
-        compartments_to_keep.add(compartment_id)
-        comp = model.getCompartment(compartment_id)
-        if comp:
-            outer_compartment = comp.getOutside()
-            while outer_compartment:
-                compartments_to_keep.add(outer_compartment)
-                outer_compartment = model.getCompartment(outer_compartment).getOutside()
-    c_list = list(model.getListOfCompartments())
-    for compartment in c_list:
-        compartment_id = compartment.getId()
-        if not (compartment_id in compartments_to_keep):
-            model.removeCompartment(compartment_id)
+    for compartment_id in {species.getCompartment() for species in model.getListOfSpecies()}:
+        # walk up the outside chain until reaching an already kept (hence already walked) compartment
+        while compartment_id and compartment_id not in compartments_to_keep:
+            compartments_to_keep.add(compartment_id)
+            compartment_id = c_id2outside.get(compartment_id, None)
+    remove_elements(model.getListOfCompartments(), lambda compartment: compartment.getId() in compartments_to_keep)
+
+
+def remove_elements(list_of, keep):
+    """
+    Removes from a list of model elements those that should not be kept.
+    Instead of removing the elements one by one (each removal by id is a linear search in libsbml),
+    the list is rebuilt in a single pass (the kept elements are copied, the list is cleared
+    and the copies are appended back in the same order).
+    :param list_of: libsbml.ListOf list of elements (e.g. model.getListOfSpecies())
+    :param keep: function that takes an element and returns whether it should be kept
+    :return: int, number of removed elements
+    """
+    n = list_of.size()
+    to_keep = [e.clone() for e in (list_of.get(i) for i in range(n)) if keep(e)]
+    if len(to_keep) == n:
+        return 0
+    list_of.clear(True)
+    for e in to_keep:
+        list_of.appendAndOwn(e)
+    return n - len(to_keep)
 
 
 def get_used_species(model, include_modifiers=True):
@@ -137,15 +160,15 @@ def remove_is_a_reactions(model):
     :param model: libsbml.Model model of interest
     :return: void (input model is modified inplace)
     """
-    to_remove = []
+    to_remove = set()
     for reaction in model.getListOfReactions():
         if 1 == reaction.getNumReactants() == reaction.getNumProducts() \
                 and reaction.getName().find("isa ") != -1 \
                 and model.getCompartment(reaction.getListOfReactants().get(0).getSpecies()) == \
                         model.getCompartment(reaction.getListOfReactants().get(0).getSpecies()):
-            to_remove.append(reaction.getId())
-    for r_id in to_remove:
-        model.removeReaction(r_id)
+            to_remove.add(reaction.getId())
+    if to_remove:
+        remove_elements(model.getListOfReactions(), lambda reaction: reaction.getId() not in to_remove)
 
 
 def set_consistency_level(doc):
@@ -159,9 +182,19 @@ def set_consistency_level(doc):
         doc.setConsistencyChecksForConversion(consistency, False)
 
 
-def convert_to_lev3_v1(model):
-    doc = libsbml.SBMLDocument(model.getSBMLNamespaces())
-    doc.setModel(model)
+def convert_to_lev3_v1(model, in_place=False):
+    """
+    Converts the model into SBML Level 3 Version 1 with groups and layout extensions.
+    :param model: libsbml.Model model to be converted
+    :param in_place: boolean, whether to convert the model's own document (the model must not be used after that,
+    the converted one is the document's model), or a copy of the model (the model stays intact)
+    :return: libsbml.SBMLDocument containing the converted model
+    """
+    if in_place:
+        doc = model.getSBMLDocument()
+    else:
+        doc = libsbml.SBMLDocument(model.getSBMLNamespaces())
+        doc.setModel(model)
     set_consistency_level(doc)
     doc.checkL3v1Compatibility()
     doc.setLevelAndVersion(3, 1, False)
@@ -171,129 +204,375 @@ def convert_to_lev3_v1(model):
     return doc
 
 
-def save_as_comp_generalized_sbml(input_model, out_sbml, groups_sbml, r_id2clu, clu2s_ids, ub_sps, onto):
-    logging.info("serializing generalization")
-    s_id_increment, r_id_increment = 0, 0
-
-    if groups_sbml:
-        doc = convert_to_lev3_v1(input_model)
-        groups_model = doc.getModel()
-        groups_plugin = groups_model.getPlugin("groups")
-        if groups_plugin:
-            logging.info("  saving ubiquitous species annotations")
-            s_group = groups_plugin.createGroup()
-            s_group.setId("g_ubiquitous_sps")
-            s_group.setKind(libsbml.GROUP_KIND_COLLECTION)
-            s_group.setSBOTerm(SBO_CHEMICAL_MACROMOLECULE)
-            s_group.setName("ubiquitous species")
-            for s_id in ub_sps:
-                member = s_group.createMember()
-                member.setIdRef(s_id)
-            add_annotation(s_group, libsbml.BQB_IS_DESCRIBED_BY, GROUP_TYPE_UBIQUITOUS)
-    if out_sbml:
-        # generalized model
-        generalized_doc = convert_to_lev3_v1(input_model)
-        generalized_model = generalized_doc.getModel()
-        for _ in range(0, generalized_model.getNumReactions()):
-            generalized_model.removeReaction(0)
+class GeneralizedIdGenerator(object):
+    """
+    Generates the ids of new elements the same way as mod_sbml.sbml.sbml_manager.generate_unique_id
+    would do in the generalized model (i.e. the input model without its reactions, plus the new elements),
+    without the generalized model having to exist.
+    """
 
+    def __init__(self, input_model):
+        self.input_model = input_model
+        self.new_ids = set()
+        # the new ids only get added, so the search for a free suffix can resume where it stopped
+        self.prefix2i = {}
+
+    def is_taken(self, id_):
+        if id_ in self.new_ids:
+            return True
+        element = self.input_model.getElementBySId(id_)
+        return element is not None and element.getTypeCode() != libsbml.SBML_REACTION \
+            and element.getAncestorOfType(libsbml.SBML_REACTION) is None
+
+    def generate(self, id_=None):
+        if not id_:
+            id_ = 's_'
+        else:
+            id_ = ''.join(e for e in id_ if e.isalnum() or '_' == e)
+            if not id_[0].isalpha():
+                id_ = 's_' + id_
+            id_ = id_.encode('ascii', errors='ignore').decode()
+        if self.is_taken(id_):
+            i = self.prefix2i.get(id_, 0)
+            while self.is_taken("%s%d" % (id_, i)):
+                i += 1
+            self.prefix2i[id_] = i
+            id_ = "%s%d" % (id_, i)
+        self.new_ids.add(id_)
+        return id_
+
+
+def get_generalized_elements(input_model, r_id2clu, clu2s_ids, onto, generalize=True):
+    """
+    Decides on the species and reaction groups, and on the elements of the generalized model,
+    so that the output models can then be created one at a time.
+    :param input_model: libsbml.Model input model
+    :param r_id2clu: dict {reaction_id: reaction_cluster}
+    :param clu2s_ids: dict {(compartment_id, term): species_ids}
+    :param onto: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param generalize: boolean, whether the generalized model is to be created
+    (otherwise only the groups are needed, and their ids are generated independently)
+    :return: tuple (s_groups, r_groups, g_reactions, r_id2g_eq, s_id2gr_id):
+    list of species groups (group_id, compartment_id, term_id, group_name, generalized_species_name, species_ids),
+    list of reaction groups (group_id, group_name, reaction_ids),
+    list of reactions of the generalized model (reaction_id, name, reactant2stoichiometry, product2stoichiometry,
+    reversible), dict {reaction_id: (reaction_group_id, reaction_group_name)},
+    dict {species_id: (species_group_id, term)}
+    """
+    s_groups, r_groups, g_reactions = [], [], []
     r_id2g_eq, s_id2gr_id = {}, {}
+    if not clu2s_ids:
+        return s_groups, r_groups, g_reactions, r_id2g_eq, s_id2gr_id
+
+    id_generator = GeneralizedIdGenerator(input_model) if generalize else None
+    s_id_increment, r_id_increment = 0, 0
+    for ((c_id, t), s_ids) in clu2s_ids.items():
+        if len(s_ids) > 1:
+            comp = input_model.getCompartment(c_id)
+            t = onto.get_term(t)
+            t_name, t_id = (t.get_name(), t.get_id()) if t \
+                else (' or '.join(input_model.getSpecies(s_id).getName() for s_id in s_ids), None)
+            if not t_id:
+                t = t_name
+            if generalize:
+                new_s_id = id_generator.generate("s")
+            else:
+                s_id_increment += 1
+                new_s_id = generate_unique_id(input_model, "s_g_", s_id_increment)
+            for s_id in s_ids:
+                s_id2gr_id[s_id] = new_s_id, t
+            s_groups.append((new_s_id, comp.getId(), t_id, "{0} [{1}]".format(t_name, comp.getName()),
+                             "{0} ({1}) [{2}]".format(t_name, len(s_ids), comp.getName()), s_ids))
+
+    generalize_species = lambda species_id: s_id2gr_id[species_id][0] if (species_id in s_id2gr_id) else species_id
+    s_id_to_generalize = set(s_id2gr_id.keys())
+    for clu, r_ids in invert_map(r_id2clu).items():
+        representative = input_model.getReaction(list(r_ids)[0])
+        r_name = "generalized %s" % representative.getName()
+        if generalize:
+            reactants = dict(get_reactants(representative, stoichiometry=True))
+            products = dict(get_products(representative, stoichiometry=True))
+            if (len(r_ids) == 1) and \
+                    not ((set(reactants.keys()) | set(products.keys())) & s_id_to_generalize):
+                g_reactions.append((id_generator.generate(representative.getId()), representative.getName(),
+                                    reactants, products, representative.getReversible()))
+                continue
+            r_id2st = {generalize_species(it): st for (it, st) in reactants.items()}
+            p_id2st = {generalize_species(it): st for (it, st) in products.items()}
+            reversible = next((False for r_id in r_ids if not input_model.getReaction(r_id).getReversible()), True)
+            new_r_id = id_generator.generate(representative.getId() if len(r_ids) == 1 else None)
+            g_reactions.append((new_r_id, r_name, r_id2st, p_id2st, reversible))
+        elif len(r_ids) > 1:
+            r_id_increment += 1
+            new_r_id = generate_unique_id(input_model, "r_g_", r_id_increment)
+        if len(r_ids) > 1:
+            for r_id in r_ids:
+                r_id2g_eq[r_id] = new_r_id, r_name
+            r_groups.append((new_r_id, r_name, r_ids))
+    return s_groups, r_groups, g_reactions, r_id2g_eq, s_id2gr_id
+
+
+def add_groups(groups_model, ub_sps, s_groups, r_groups):
+    """
+    Adds the ubiquitous species group, and the species and reaction groups to the model.
+    :param groups_model: libsbml.Model model with groups extension
+    :param ub_sps: collection of ubiquitous species ids
+    :param s_groups: list of species groups, see get_generalized_elements
+    :param r_groups: list of reaction groups, see get_generalized_elements
+    :return: boolean, whether the groups were added (i.e. the model has the groups extension)
+    """
+    groups_plugin = groups_model.getPlugin("groups")
+    if not groups_plugin:
+        return False
+    logging.info("  saving ubiquitous species annotations")
+    s_group = groups_plugin.createGroup()
+    s_group.setId(UBIQUITOUS_GROUP_ID)
+    s_group.setKind(libsbml.GROUP_KIND_COLLECTION)
+    s_group.setSBOTerm(SBO_CHEMICAL_MACROMOLECULE)
+    s_group.setName(UBIQUITOUS_GROUP_NAME)
+    for s_id in ub_sps:
+        member = s_group.createMember()
+        member.setIdRef(s_id)
+    add_annotation(s_group, libsbml.BQB_IS_DESCRIBED_BY, GROUP_TYPE_UBIQUITOUS)
+
+    logging.info("  creating species groups")
+    for (new_s_id, c_id, t_id, g_name, _, s_ids) in s_groups:
+        s_group = groups_plugin.createGroup()
+        s_group.setId(new_s_id)
+        s_group.setKind(libsbml.GROUP_KIND_CLASSIFICATION)
+        s_group.setSBOTerm(SBO_CHEMICAL_MACROMOLECULE)
+        s_group.setName(g_name)
+        if t_id:
+            add_annotation(s_group, libsbml.BQB_IS, t_id, CHEBI_PREFIX)
+        for s_id in s_ids:
+            member = s_group.createMember()
+            member.setIdRef(s_id)
+        add_annotation(s_group, libsbml.BQB_IS_DESCRIBED_BY, GROUP_TYPE_EQUIV)
+
+    logging.info("  creating reaction groups")
+    for (new_r_id, r_name, r_ids) in r_groups:
+        r_group = groups_plugin.createGroup()
+        r_group.setId(new_r_id)
+        r_group.setKind(libsbml.GROUP_KIND_COLLECTION)
+        r_group.setSBOTerm(SBO_BIOCHEMICAL_REACTION)
+        r_group.setName(r_name)
+        for r_id in r_ids:
+            member = r_group.createMember()
+            member.setIdRef(r_id)
+        add_annotation(r_group, libsbml.BQB_IS_DESCRIBED_BY, GROUP_TYPE_EQUIV)
+    return True
+
+
+def generalize_sbml_model(model, s_groups, g_reactions):
+    """
+    Turns the model into the generalized one: replaces its reactions with the generalized ones,
+    adds the generalized species and removes the elements that are not used any more.
+    :param model: libsbml.Model model to be generalized inplace
+    :param s_groups: list of species groups, see get_generalized_elements
+    :param g_reactions: list of reactions of the generalized model, see get_generalized_elements
+    :return: void
+    """
+    model.getListOfReactions().clear(True)
+    logging.info("  creating generalized species")
+    for (new_s_id, c_id, t_id, _, s_name, _) in s_groups:
+        new_species = create_species(model=model, compartment_id=c_id, type_id=None, name=s_name, id_=new_s_id)
+        add_annotation(new_species, libsbml.BQB_IS, t_id, CHEBI_PREFIX)
+    logging.info("  creating generalized reactions")
+    for (r_id, r_name, r_id2st, p_id2st, reversible) in g_reactions:
+        create_reaction(model, r_id2st, p_id2st, name=r_name, reversible=reversible, id_=r_id)
+    remove_unused_elements(model)
+
+
+def get_comp_generalized_documents(input_model, r_id2clu, clu2s_ids, ub_sps, onto, groups=True, generalize=True,
+                                   in_place=False):
+    """
+    Creates the output documents of the generalization in memory (see save_as_comp_generalized_sbml).
+    :param input_model: libsbml.Model input model
+    :param r_id2clu: dict {reaction_id: reaction_cluster}
+    :param clu2s_ids: dict {(compartment_id, term): species_ids}
+    :param ub_sps: collection of ubiquitous species ids
+    :param onto: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param groups: boolean, whether to create the document with groups extension
+    :param generalize: boolean, whether to create the generalized document
+    :param in_place: boolean, whether the last created document can be the input model's document converted inplace
+    (the input model must not be used afterwards), instead of a copy of it
+    :return: tuple (groups_doc, generalized_doc, r_id2g_eq, s_id2gr_id): libsbml.SBMLDocument (or None if not needed)
+    with groups extension, libsbml.SBMLDocument (or None if not needed) generalized,
+    dict {reaction_id: (reaction_group_id, reaction_group_name)}, dict {species_id: (species_group_id, term)}
+    """
+    s_groups, r_groups, g_reactions, r_id2g_eq, s_id2gr_id = \
+        get_generalized_elements(input_model, r_id2clu, clu2s_ids, onto, generalize)
+    groups_doc, generalized_doc = None, None
+    if groups:
+        groups_doc = convert_to_lev3_v1(input_model, in_place=in_place and not generalize)
+        add_groups(groups_doc.getModel(), ub_sps, s_groups, r_groups)
+    if generalize:
+        generalized_doc = convert_to_lev3_v1(input_model, in_place=in_place)
+        generalize_sbml_model(generalized_doc.getModel(), s_groups, g_reactions)
+    return groups_doc, generalized_doc, r_id2g_eq, s_id2gr_id
+
+
+def save_as_comp_generalized_sbml(input_model, out_sbml, groups_sbml, r_id2clu, clu2s_ids, ub_sps, onto,
+                                  out_matrix=None, low_memory=False, groups_sidecar=False):
+    """
+    Serializes the generalization.
+
+    The output models are created and saved one at a time: first the groups model, then the generalized one.
+    In the low memory mode both are created by modifying the input model's document inplace
+    (instead of working on copies of the input model), hence the input model must not be used afterwards.
+
+    :param input_model: libsbml.Model input model
+    :param out_sbml: str, path to the output SBML file (generalized), or None if it is not needed
+    :param groups_sbml: str, path to the output SBML file (with groups extension), or None if it is not needed
+    :param r_id2clu: dict {reaction_id: reaction_cluster}
+    :param clu2s_ids: dict {(compartment_id, term): species_ids}
+    :param ub_sps: collection of ubiquitous species ids
+    :param onto: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param out_matrix: (optional) str, path to the output .npz file, where the stoichiometric matrix
+    of the generalized model and the projection matrices are to be saved
+    (see sbml_generalization.sbml.matrix_serializer.save_as_matrix)
+    :param low_memory: boolean, whether to create the output models inplace in the input model's document
+    :param groups_sidecar: boolean, whether to also save the groups into a compact sidecar file next to groups_sbml,
+    so that parse_group_sbml can load them without parsing the SBML (only if they were saved into groups_sbml,
+    i.e. the groups extension is available)
+    (see sbml_generalization.sbml.group_serializer.save_groups_sidecar)
+    :return: tuple (r_id2g_eq, s_id2gr_id): dict {reaction_id: (reaction_group_id, reaction_group_name)},
+    dict {species_id: (species_group_id, term)}
+    """
+    logging.info("serializing generalization")
+    generalize = out_sbml or out_matrix
+    s_groups, r_groups, g_reactions, r_id2g_eq, s_id2gr_id = \
+        get_generalized_elements(input_model, r_id2clu, clu2s_ids, onto, generalize)
     if not clu2s_ids:
         logging.info("  nothing to serialize")
+    in_s_ids = [s.getId() for s in input_model.getListOfSpecies()] if out_matrix else None
+    in_r_ids = [r.getId() for r in input_model.getListOfReactions()] if out_matrix else None
+
+    if low_memory:
+        input_doc = convert_to_lev3_v1(input_model, in_place=True)
+        get_doc = lambda: input_doc
     else:
-        clu2r_ids = invert_map(r_id2clu)
-        logging.info("  creating species groups")
-        for ((c_id, t), s_ids) in clu2s_ids.items():
-            comp = input_model.getCompartment(c_id)
-            if len(s_ids) > 1:
-                t = onto.get_term(t)
-                t_name, t_id = (t.get_name(), t.get_id()) if t \
-                    else (' or '.join(input_model.getSpecies(s_id).getName() for s_id in s_ids), None)
-                if not t_id:
-                    t = t_name
-
-                if out_sbml:
-                    new_species = create_species(model=generalized_model, compartment_id=comp.getId(), type_id=None,
-                                                 name="{0} ({1}) [{2}]".format(t_name, len(s_ids), comp.getName()))
-                    add_annotation(new_species, libsbml.BQB_IS, t_id, CHEBI_PREFIX)
-                    new_s_id = new_species.getId()
-                else:
-                    s_id_increment += 1
-                    new_s_id = generate_unique_id(input_model, "s_g_", s_id_increment)
-                for s_id in s_ids:
-                    s_id2gr_id[s_id] = new_s_id, t
-
-                if groups_sbml and groups_plugin:
-                    # save as a group
-                    s_group = groups_plugin.createGroup()
-                    s_group.setId(new_s_id)
-                    s_group.setKind(libsbml.GROUP_KIND_CLASSIFICATION)
-                    s_group.setSBOTerm(SBO_CHEMICAL_MACROMOLECULE)
-                    g_name = "{0} [{1}]".format(t_name, comp.getName())
-                    s_group.setName(g_name)
-                    # logging.info("%s: %d" % (g_name, len(s_ids)))
-                    if t_id:
-                        add_annotation(s_group, libsbml.BQB_IS, t_id, CHEBI_PREFIX)
-                    for s_id in s_ids:
-                        member = s_group.createMember()
-                        member.setIdRef(s_id)
-                    add_annotation(s_group, libsbml.BQB_IS_DESCRIBED_BY, GROUP_TYPE_EQUIV)
-
-        generalize_species = lambda species_id: s_id2gr_id[species_id][0] if (species_id in s_id2gr_id) else species_id
-        s_id_to_generalize = set(s_id2gr_id.keys())
-        logging.info("  creating reaction groups")
-        for clu, r_ids in clu2r_ids.items():
-            representative = input_model.getReaction(list(r_ids)[0])
-            r_name = "generalized %s" % representative.getName()
-            if out_sbml:
-                reactants = dict(get_reactants(representative, stoichiometry=True))
-                products = dict(get_products(representative, stoichiometry=True))
-                if (len(r_ids) == 1) and \
-                        not ((set(reactants.keys()) | set(products.keys())) & s_id_to_generalize):
-                    create_reaction(generalized_model, reactants, products, name=representative.getName(),
-                                    reversible=representative.getReversible(), id_=representative.getId())
-                    continue
-                r_id2st = {generalize_species(it): st for (it, st) in reactants.items()}
-                p_id2st = {generalize_species(it): st for (it, st) in products.items()}
-                reversible = next((False for r_id in r_ids if not input_model.getReaction(r_id).getReversible()), True)
-                new_r_id = create_reaction(generalized_model, r_id2st, p_id2st, name=r_name, reversible=reversible,
-                                           id_=representative.getId() if len(r_ids) == 1 else None).getId()
-            elif len(r_ids) > 1:
-                r_id_increment += 1
-                new_r_id = generate_unique_id(input_model, "r_g_", r_id_increment)
-            if len(r_ids) > 1:
-                for r_id in r_ids:
-                    r_id2g_eq[r_id] = new_r_id, r_name
-                if groups_sbml and groups_plugin:
-                    # save as a group
-                    r_group = groups_plugin.createGroup()
-                    r_group.setId(new_r_id)
-                    r_group.setKind(libsbml.GROUP_KIND_COLLECTION)
-                    r_group.setSBOTerm(SBO_BIOCHEMICAL_REACTION)
-                    r_group.setName(r_name)
-                    for r_id in r_ids:
-                        member = r_group.createMember()
-                        member.setIdRef(r_id)
-                    add_annotation(r_group, libsbml.BQB_IS_DESCRIBED_BY, GROUP_TYPE_EQUIV)
-    if out_sbml:
-        remove_unused_elements(generalized_model)
-        save_as_sbml(generalized_model, out_sbml)
-    if groups_sbml and groups_model:
-        save_as_sbml(groups_model, groups_sbml)
-
-    logging.info("serialized to " + groups_sbml)
+        get_doc = lambda: convert_to_lev3_v1(input_model)
+    if groups_sbml:
+        doc = get_doc()
+        groups_added = add_groups(doc.getModel(), ub_sps, s_groups, r_groups)
+        logging.info("saving to %s" % groups_sbml)
+        write_sbml(doc, groups_sbml)
+        # the sidecar should describe the groups of the SBML file, hence none if they could not be saved there
+        if groups_sidecar and groups_added:
+            save_groups_sidecar(groups_sbml, ub_sps, s_groups, r_groups)
+        if low_memory:
+            groups_plugin = doc.getModel().getPlugin("groups")
+            if groups_plugin:
+                groups_plugin.getListOfGroups().clear(True)
+        # the groups model is released before the generalized one gets created
+        doc = None
+    if generalize:
+        doc = get_doc()
+        generalized_model = doc.getModel()
+        generalize_sbml_model(generalized_model, s_groups, g_reactions)
+        if out_sbml:
+            logging.info("saving to %s" % out_sbml)
+            write_sbml(doc, out_sbml)
+        if out_matrix:
+            save_as_matrix(generalized_model, in_s_ids, in_r_ids, r_id2g_eq, s_id2gr_id, out_matrix)
     return r_id2g_eq, s_id2gr_id
 
 
+def get_compression(sbml):
+    """
+    Gets the compression of an SBML file from its extension.
+    :param sbml: str, path to the SBML file
+    :return: str, compression extension ('.gz', '.bz2' or '.xz'), or '' for an uncompressed file
+    """
+    ext = os.path.splitext(sbml)[1].lower()
+    return ext if ext in COMPRESSIONS else ''
+
+
+def get_sbml_prefix(sbml):
+    """
+    Splits a path to an (optionally compressed) SBML file into its prefix and compression,
+    e.g. 'model.xml.gz' into 'model' and '.gz'.
+    :param sbml: str, path to the SBML file
+    :return: tuple (prefix, compression): str, str (see get_compression)
+    """
+    compression = get_compression(sbml)
+    if compression:
+        sbml = sbml[:-len(compression)]
+    return os.path.splitext(sbml)[0], compression
+
+
+def get_sbml_document(sbml):
+    """
+    Gets a new document containing a copy of a model held in memory.
+    :param sbml: libsbml.SBMLDocument, libsbml.Model, or str (or bytes) containing SBML
+    :return: libsbml.SBMLDocument, that can be modified without affecting the input
+    """
+    if isinstance(sbml, libsbml.SBMLDocument):
+        return sbml.clone()
+    if isinstance(sbml, libsbml.Model):
+        doc = libsbml.SBMLDocument(sbml.getSBMLNamespaces())
+        doc.setModel(sbml)
+        return doc
+    if isinstance(sbml, bytes):
+        sbml = sbml.decode('utf-8')
+    return libsbml.readSBMLFromString(sbml)
+
+
+def read_sbml(in_sbml):
+    """
+    Reads an SBML document from a plain or compressed (.gz, .bz2 or .xz) file.
+    If libsbml cannot decompress the file itself, it is decompressed in memory
+    (no uncompressed copy of it is ever written to the disk).
+    :param in_sbml: str, path to the SBML file
+    :return: libsbml.SBMLDocument
+    """
+    compression = get_compression(in_sbml)
+    if compression and not COMPRESSIONS[compression][1]:
+        with COMPRESSIONS[compression][0].open(in_sbml, 'rb') as f:
+            return libsbml.readSBMLFromString(f.read().decode('utf-8'))
+    return libsbml.SBMLReader().readSBML(in_sbml)
+
+
+def write_sbml(doc, out_sbml):
+    """
+    Writes an SBML document into a plain or compressed (.gz, .bz2 or .xz, depending on the extension) file.
+    If libsbml cannot compress the file itself, the document is written into a string, which is then compressed
+    (no uncompressed copy of it is ever written to the disk).
+    :param doc: libsbml.SBMLDocument
+    :param out_sbml: str, path to the output SBML file
+    :return: void
+    """
+    compression = get_compression(out_sbml)
+    if compression and not COMPRESSIONS[compression][1]:
+        with COMPRESSIONS[compression][0].open(out_sbml, 'wb') as f:
+            f.write(libsbml.writeSBMLToString(doc).encode('utf-8'))
+    else:
+        libsbml.writeSBMLToFile(doc, out_sbml)
+
+
 def save_as_sbml(input_model, out_sbml):
     logging.info("saving to {0}".format(out_sbml))
     out_doc = libsbml.SBMLDocument(input_model.getSBMLNamespaces())
     out_doc.setModel(input_model)
-    libsbml.writeSBMLToFile(out_doc, out_sbml)
+    write_sbml(out_doc, out_sbml)
 
 
-def parse_group_sbml(groups_sbml, chebi):
-    doc = libsbml.SBMLReader().readSBMLFromFile(groups_sbml)
+def parse_group_sbml(groups_sbml, chebi, use_sidecar=True):
+    """
+    Gets the species and reaction groups and the ubiquitous species of an SBML model with groups extension.
+    :param groups_sbml: str, path to the SBML file with groups extension
+    :param chebi: mod_sbml.onto.obo_ontology.Ontology ChEBI ontology
+    :param use_sidecar: boolean, whether to load the groups from the sidecar file saved along with the SBML file
+    (see save_as_comp_generalized_sbml), if it is there and up to date, instead of parsing the SBML
+    :return: tuple (r_id2g_id, s_id2gr_id, ub_sps): dict {reaction_id: (group_id, group_name, group_size)},
+    dict {species_id: (group_id, ChEBI term or group_name, group_size)}, set of ubiquitous species ids
+    """
+    if use_sidecar:
+        groups = load_groups_sidecar(groups_sbml, chebi)
+        if groups is not None:
+            return groups
+    doc = read_sbml(groups_sbml)
     groups_model = doc.getModel()
     groups_plugin = groups_model.getPlugin("groups")
     r_id2g_id, s_id2gr_id, ub_sps = {}, {}, set()
@@ -322,7 +601,7 @@ def parse_group_sbml(groups_sbml, chebi):
 
 
 def check_for_groups(groups_sbml, sbo_term, group_type):
-    doc = libsbml.SBMLReader().readSBMLFromFile(groups_sbml)
+    doc = read_sbml(groups_sbml)
     groups_plugin = doc.getModel().getPlugin("groups")
     if groups_plugin:
         for group in groups_plugin.getListOfGroups():
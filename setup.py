@@ -1,5 +1,5 @@
 import os
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='sbml_generalization',
@@ -18,12 +18,16 @@ setup(
         'Topic :: Scientific/Engineering :: Bio-Informatics',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
-    package_data={'sbml_generalization': [os.path.join('generalization', '*.py'),
+    package_data={'sbml_generalization': [os.path.join('annotation', '*.py'),
+                                          os.path.join('generalization', '*.py'),
                                           os.path.join('merge', '*.py'),
                                           os.path.join('runner', '*.py'),
                                           os.path.join('sbml', '*.py'),
                                           os.path.join('..', 'README.md')]},
     include_package_data=True,
     download_url='https://github.com/annazhukova/mod_gen/archive/0.1.1.zip',
-    install_requires=['python-libsbml-experimental', 'mod_sbml']
+    entry_points={'console_scripts': ['generalize_model = sbml_generalization.runner.main:main']},
+    install_requires=['python-libsbml-experimental', 'mod_sbml', 'natsort'],
+    # numpy is only needed to save the generalized network as a stoichiometric matrix (--output_matrix)
+    extras_require={'matrix': ['numpy']}
 )
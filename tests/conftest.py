@@ -0,0 +1,77 @@
+import os
+
+import libsbml
+import pytest
+
+from mod_sbml.onto.obo_ontology import Ontology
+from mod_sbml.onto.term import Term
+
+__author__ = 'anna'
+
+
+def create_ontology(terms):
+    """
+    Creates a small ontology.
+    :param terms: list of tuples (term_id, name, parent_ids, synonyms, xrefs),
+    xrefs being a dict {db: value}
+    :return: mod_sbml.onto.obo_ontology.Ontology
+    """
+    onto = Ontology()
+    for t_id, name, parent_ids, synonyms, xrefs in terms:
+        term = Term(onto=onto, t_id=t_id, name=name, parent_ids=parent_ids)
+        for synonym in synonyms:
+            term.add_synonym(synonym)
+        for db, value in xrefs.items():
+            term.add_xref(db, value)
+        onto.add_term(term)
+    return onto
+
+
+def create_model(m_id, compartments, species, reactions):
+    """
+    Creates an SBML model.
+    :param m_id: str, model id
+    :param compartments: list of tuples (compartment_id, name)
+    :param species: list of tuples (species_id, name, compartment_id)
+    :param reactions: list of tuples (reaction_id, reactant_ids, product_ids, reversible)
+    :return: libsbml.SBMLDocument
+    """
+    doc = libsbml.SBMLDocument(2, 4)
+    model = doc.createModel()
+    model.setId(m_id)
+    for c_id, name in compartments:
+        c = model.createCompartment()
+        c.setId(c_id)
+        c.setName(name)
+    for s_id, name, c_id in species:
+        s = model.createSpecies()
+        s.setId(s_id)
+        s.setName(name)
+        s.setCompartment(c_id)
+    for r_id, rs, ps, reversible in reactions:
+        r = model.createReaction()
+        r.setId(r_id)
+        r.setReversible(reversible)
+        for s_id in rs:
+            r.createReactant().setSpecies(s_id)
+        for s_id in ps:
+            r.createProduct().setSpecies(s_id)
+    return doc
+
+
+@pytest.fixture
+def small_chebi():
+    return create_ontology([('chebi:1', 'chemical entity', [], [], {}),
+                            ('chebi:2', 'glucose', ['chebi:1'], ['dextrose'], {'KEGG COMPOUND': 'C00031'}),
+                            ('chebi:3', 'fructose', ['chebi:1'], [], {})])
+
+
+@pytest.fixture(scope='session')
+def chebi():
+    from mod_sbml.annotation.chebi.chebi_serializer import get_chebi
+    from mod_sbml.onto import parse_simple
+
+    path = get_chebi()
+    if not path or not os.path.exists(path):
+        pytest.skip("ChEBI is not available")
+    return parse_simple(path)
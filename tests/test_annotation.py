@@ -0,0 +1,109 @@
+import threading
+
+import libsbml
+
+from mod_sbml.annotation.chebi.chebi_annotator import get_chebi_id, CHEBI_PREFIX
+from mod_sbml.annotation.rdf_annotation_helper import add_annotation
+from sbml_generalization.annotation.annotation_cache import AnnotationCache
+from sbml_generalization.annotation.name_index import NameIndex
+from sbml_generalization.annotation.species_annotator import annotate_species
+from tests.conftest import create_model, create_ontology
+
+__author__ = 'anna'
+
+
+def test_cached_species_type_term_is_not_reused_for_a_same_named_species(tmpdir, small_chebi):
+    cache = AnnotationCache(str(tmpdir.join('cache.json')), 'v1')
+    index = NameIndex.from_ontology(small_chebi)
+
+    doc = create_model('a', [('c', 'cytosol')], [('s', 'sugar', 'c')], [])
+    s_type = doc.getModel().createSpeciesType()
+    s_type.setId('st')
+    add_annotation(s_type, libsbml.BQB_IS, 'chebi:3', CHEBI_PREFIX)
+    doc.getModel().getSpecies('s').setSpeciesType('st')
+    annotate_species(doc.getModel(), small_chebi, cache, index)
+    assert 'chebi:3' == get_chebi_id(doc.getModel().getSpecies('s'))
+
+    # the same name, but nothing else pointing to fructose
+    other_doc = create_model('b', [('c', 'cytosol')], [('s', 'sugar', 'c')], [])
+    annotate_species(other_doc.getModel(), small_chebi, AnnotationCache(cache.path, 'v1'), index)
+    assert get_chebi_id(other_doc.getModel().getSpecies('s')) is None
+
+
+def test_cache_is_reused_for_identical_species(tmpdir, small_chebi):
+    cache = AnnotationCache(str(tmpdir.join('cache.json')), 'v1')
+    for m_id in ('a', 'b'):
+        doc = create_model(m_id, [('c', 'cytosol')], [('s', 'dextrose', 'c')], [])
+        annotate_species(doc.getModel(), small_chebi, cache)
+        assert 'chebi:2' == get_chebi_id(doc.getModel().getSpecies('s'))
+    assert 1 == len(cache)
+
+
+def test_cache_save_merges_entries_saved_by_others(tmpdir):
+    path = str(tmpdir.join('cache.json'))
+    cache, other_cache = AnnotationCache(path, 'v1'), AnnotationCache(path, 'v1')
+    cache.put('glucose', 'chebi:2')
+    other_cache.put('fructose', 'chebi:3')
+    other_cache.save()
+    cache.save()
+    assert {'glucose': 'chebi:2', 'fructose': 'chebi:3'} == dict(AnnotationCache(path, 'v1').key2chebi_id)
+    # the entries put since the last save are the most recent ones
+    assert ['fructose', 'glucose'] == list(cache.key2chebi_id.keys())
+
+
+def test_concurrent_cache_saves_keep_all_entries(tmpdir):
+    path = str(tmpdir.join('cache.json'))
+
+    def put_and_save(i):
+        cache = AnnotationCache(path, 'v1')
+        for j in range(5):
+            cache.put('species %d %d' % (i, j), 'chebi:%d' % j)
+            cache.save()
+
+    threads = [threading.Thread(target=put_and_save, args=(i, )) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 8 * 5 == len(AnnotationCache(path, 'v1'))
+
+
+def test_name_index_resolves_ids_and_xrefs(small_chebi):
+    index = NameIndex.from_ontology(small_chebi)
+    doc = create_model('a', [('c', 'cytosol')],
+                       [('s1', 'CHEBI:3', 'c'), ('s2', 'C00031', 'c'), ('s3', 'Dextrose', 'c')], [])
+    annotate_species(doc.getModel(), small_chebi, name_index=index)
+    assert ['chebi:3', 'chebi:2', 'chebi:2'] == [get_chebi_id(doc.getModel().getSpecies(s_id))
+                                                 for s_id in ('s1', 's2', 's3')]
+
+
+def test_name_index_checks_xrefs_before_names():
+    # the name of chebi:4 is the KEGG id of chebi:2, which the ontology resolves first
+    chebi = create_ontology([('chebi:1', 'chemical entity', [], [], {}),
+                             ('chebi:2', 'glucose', ['chebi:1'], [], {'KEGG COMPOUND': 'C00031'}),
+                             ('chebi:4', 'C00031', ['chebi:1'], [], {})])
+    chebi_ids = []
+    for index in (None, NameIndex.from_ontology(chebi)):
+        doc = create_model('a', [('c', 'cytosol')], [('s', 'C00031', 'c')], [])
+        annotate_species(doc.getModel(), chebi, name_index=index)
+        chebi_ids.append(get_chebi_id(doc.getModel().getSpecies('s')))
+    assert ['chebi:2', 'chebi:2'] == chebi_ids
+
+
+def test_name_index_matches_prefixes_only_if_asked(tmpdir, small_chebi):
+    cache = AnnotationCache(str(tmpdir.join('cache.json')), 'v1')
+    chebi_ids = []
+    for match_prefixes in (False, True):
+        index = NameIndex.from_ontology(small_chebi)
+        index.match_prefixes = match_prefixes
+        doc = create_model('a', [('c', 'cytosol')], [('s', 'Fructo', 'c')], [])
+        annotate_species(doc.getModel(), small_chebi, cache, index)
+        chebi_ids.append(get_chebi_id(doc.getModel().getSpecies('s')))
+    # the term inferred without prefix matches is not reused with them
+    assert [None, 'chebi:3'] == chebi_ids
+
+
+def test_corrupted_name_index_is_ignored(tmpdir):
+    path = tmpdir.join('index.json')
+    path.write('{"names": ')
+    assert NameIndex.load(str(path)) is None
@@ -0,0 +1,29 @@
+from sbml_generalization.generalization.budget import Budget
+from sbml_generalization.generalization.equivalence import create_synthetic_model, SYNTHETIC_UB_CHEBI_IDS
+from sbml_generalization.generalization.progress import PHASE_AGGRESSIVE_GROUPING, PHASE_METABOLITE_DIVERSITY
+from sbml_generalization.generalization.sbml_generalizer import generalize_preprocessed_model, preprocess_document
+
+__author__ = 'anna'
+
+
+def test_truncations_record_where_the_phases_were_cut():
+    budget = Budget(max_iterations=1)
+    budget.truncate(PHASE_METABOLITE_DIVERSITY, 'pass 1, iteration 2')
+    budget.truncate(PHASE_METABOLITE_DIVERSITY, 'pass 2, iteration 2')
+    budget.truncate(PHASE_METABOLITE_DIVERSITY, 'pass 2, iteration 2')
+    assert [PHASE_METABOLITE_DIVERSITY] == budget.truncated_phases
+    assert ['pass 1, iteration 2', 'pass 2, iteration 2'] == [it['where'] for it in budget.truncations]
+
+
+def test_exhausted_budget_stops_the_aggressive_grouping(chebi):
+    _, model, s_id2chebi_id, r_ids_to_ignore = \
+        preprocess_document(create_synthetic_model(chebi, 4, 3, 0), chebi)
+    budget = Budget(seconds=0)
+    budget.start_timer()
+    r_id2clu, clu2s_ids, _, _ = \
+        generalize_preprocessed_model(model, s_id2chebi_id, r_ids_to_ignore, chebi,
+                                      ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS), copy_chebi=True, budget=budget)
+    assert {'phase': PHASE_AGGRESSIVE_GROUPING, 'where': 'covering the terms'} in budget.truncations
+    # nothing was grouped
+    assert not clu2s_ids
+    assert len(set(r_id2clu.values())) == model.getNumReactions()
@@ -0,0 +1,51 @@
+import libsbml
+import pytest
+
+from sbml_generalization.generalization.model_generalizer import maximize
+from sbml_generalization.generalization.progress import CancellationToken, GeneralizationCancelled, ProgressMonitor
+from sbml_generalization.generalization.sbml_generalizer import ubiquitize_model
+from sbml_generalization.merge.model_merger import merge_models
+from tests.conftest import create_model
+
+__author__ = 'anna'
+
+
+def get_cancelled_token():
+    token = CancellationToken()
+    token.cancel()
+    return token
+
+
+def save_model(tmpdir, m_id):
+    path = str(tmpdir.join('%s.xml' % m_id))
+    doc = create_model(m_id, [('c', 'cytosol')], [('a', 'glucose', 'c'), ('b', 'fructose', 'c')],
+                       [('r', ['a'], ['b'], False)])
+    libsbml.writeSBMLToFile(doc, path)
+    return path
+
+
+def test_cancelled_ubiquitization_saves_nothing(tmpdir, small_chebi):
+    groups_sbml = str(tmpdir.join('groups.xml'))
+    with pytest.raises(GeneralizationCancelled):
+        ubiquitize_model(save_model(tmpdir, 'm'), small_chebi, groups_sbml, ub_chebi_ids=set(),
+                         cancellation_token=get_cancelled_token())
+    assert not tmpdir.join('groups.xml').exists()
+
+
+def test_cancelled_merge_saves_nothing(tmpdir, small_chebi):
+    with pytest.raises(GeneralizationCancelled):
+        merge_models([save_model(tmpdir, 'm1'), save_model(tmpdir, 'm2')], str(tmpdir.join('merged.xml')),
+                     go=small_chebi, chebi=small_chebi, cancellation_token=get_cancelled_token())
+    assert not tmpdir.join('merged.xml').exists()
+
+
+def test_cancelled_maximization_leaves_the_clusters_intact():
+    doc = create_model('m', [('c', 'cytosol')],
+                       [('a', 'a', 'c'), ('b', 'b', 'c'), ('x', 'x', 'c'), ('y', 'y', 'c'), ('z', 'z', 'c')],
+                       [('r1', ['a', 'x'], ['y'], False), ('r2', ['b', 'x'], ['z'], False)])
+    s_id2t_id = {'a': 't_a', 'b': 't_b', 'x': 't_x', 'y': 't_y', 'z': 't_z'}
+    term_id2clu = {'t_a': ('ab',), 't_b': ('ab',)}
+    monitor = ProgressMonitor(cancellation_token=get_cancelled_token())
+    with pytest.raises(GeneralizationCancelled):
+        maximize(set(), doc.getModel(), term_id2clu, s_id2t_id, set(), monitor=monitor)
+    assert {'t_a': ('ab',), 't_b': ('ab',)} == term_id2clu
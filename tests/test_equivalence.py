@@ -0,0 +1,134 @@
+import json
+import os
+import subprocess
+import sys
+
+import libsbml
+
+from sbml_generalization.generalization import model_generalizer
+from sbml_generalization.generalization.equivalence import ComponentTimer, COMPONENT_GREEDY, COMPONENT_ONTOLOGY, \
+    SYNTHETIC_UB_CHEBI_IDS, compare_engines, compare_partitions, create_synthetic_model, get_partition, \
+    partitioned_engine, reference_engine, run_engine, sequential_engine
+from sbml_generalization.generalization.sbml_generalizer import preprocess_document
+from tests.conftest import create_ontology
+
+__author__ = 'anna'
+
+
+def test_component_timer_measures_the_calls_and_restores_the_functions():
+    greedy = model_generalizer.greedy
+    onto = create_ontology([('chebi:1', 'chemical entity', [], [], {}),
+                            ('chebi:2', 'glucose', ['chebi:1'], [], {}), ('chebi:3', 'fructose', ['chebi:1'], [], {})])
+    with ComponentTimer() as timer:
+        assert list(greedy({'a', 'b'}, {('a', 'b'): 'ab'}, {('a', 'b'): 1})) \
+            == list(model_generalizer.greedy({'a', 'b'}, {('a', 'b'): 'ab'}, {('a', 'b'): 1}))
+        assert {'chebi:1'} == {t.get_id() for t in onto.common_points({onto.get_term('chebi:2'),
+                                                                        onto.get_term('chebi:3')})}
+    assert timer.component2time[COMPONENT_GREEDY] > 0
+    assert timer.component2time[COMPONENT_ONTOLOGY] > 0
+    assert greedy is model_generalizer.greedy
+    assert not timer.patches
+
+
+def create_family_ontology(families=4, family_size=3):
+    """
+    Creates an ontology of families of leaf terms (and of the ubiquitous ATP, ADP and water).
+    :return: mod_sbml.onto.obo_ontology.Ontology
+    """
+    terms = [('chebi:0', 'chemical entity', [], [], {})] \
+        + [(t_id, name, ['chebi:0'], [], {}) for (t_id, name) in zip(SYNTHETIC_UB_CHEBI_IDS, ('ATP', 'ADP', 'water'))]
+    # (numeric ids, as in the species annotations)
+    for f in range(1, families + 1):
+        terms.append(('chebi:%d' % (100 * f), 'family %d' % f, ['chebi:0'], [], {}))
+        terms.extend(('chebi:%d' % (100 * f + i), 'member %d of family %d' % (i, f), ['chebi:%d' % (100 * f)], [], {})
+                     for i in range(1, family_size + 1))
+    return create_ontology(terms)
+
+
+def test_partition_comparison_ignores_cluster_labels():
+    partition = get_partition({'a': ('x', ), 'b': ('x', ), 'c': ('y', 1)})
+    assert {frozenset({'a', 'b'}), frozenset({'c'})} == partition
+    assert (True, [], [], []) == compare_partitions(partition, get_partition({'a': 2, 'b': 2, 'c': 1}))
+    assert (False, [['a', 'b']], [['a'], ['b']], ['a', 'b']) == \
+        compare_partitions(partition, get_partition({'a': 1, 'b': 2, 'c': 3}))
+
+
+def test_synthetic_model_is_built_from_families():
+    onto = create_family_ontology()
+    doc = create_synthetic_model(onto, families=3, family_size=2, seed=1)
+    model = doc.getModel()
+    # the conversions of each member to the next family's one, and a combination of two members,
+    # in both compartments
+    assert 2 * (2 + 1) * (3 - 1) == model.getNumReactions()
+    _, _, s_id2chebi_id, _ = preprocess_document(doc.clone(), onto)
+    family_ids = {onto.get_term(t_id).get_parent_ids().pop() for t_id in s_id2chebi_id.values()} \
+        - {'chebi:0'}
+    assert 3 == len(family_ids)
+    assert set(SYNTHETIC_UB_CHEBI_IDS) <= set(s_id2chebi_id.values())
+    assert libsbml.writeSBMLToString(doc) == \
+        libsbml.writeSBMLToString(create_synthetic_model(onto, families=3, family_size=2, seed=1))
+
+
+def test_engines_agree_on_a_synthetic_model():
+    onto = create_family_ontology()
+    doc = create_synthetic_model(onto, families=4, family_size=3)
+    engines = [('reference', reference_engine), ('sequential', sequential_engine),
+               ('partitioned', partitioned_engine)]
+    results = compare_engines('synthetic', doc, onto, engines, ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS))
+    assert ['reference', 'sequential', 'partitioned'] == [res['engine'] for res in results]
+    for res in results:
+        assert res['equal'] and res['stable'], res
+        assert not res['diverging_reactions'] and not res['diverging_species']
+    # the input model and the ontology are left intact
+    assert 1 + len(SYNTHETIC_UB_CHEBI_IDS) + 4 * (1 + 3) == len(onto)
+    r_partition, s_partition, _, _, _, _ = run_engine(reference_engine, *preprocess_document(doc.clone(), onto)[1:],
+                                                      chebi=onto, ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS))
+    assert next(clu for clu in s_partition if len(clu) > 1), 'nothing got generalized'
+
+
+def _singleton_engine(model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids=None):
+    r_id2clu, clu2s_ids, ub_s_ids = reference_engine(model, s_id2chebi_id, r_ids_to_ignore, chebi, ub_chebi_ids)
+    return {r_id: r_id for r_id in r_id2clu}, {s_id: {s_id} for s_ids in clu2s_ids.values() for s_id in s_ids}, \
+        ub_s_ids
+
+
+def test_compare_engines_reports_divergences():
+    onto = create_family_ontology()
+    doc = create_synthetic_model(onto, families=4, family_size=3)
+    reference, diverging = compare_engines('synthetic', doc, onto, [('reference', reference_engine),
+                                                                     ('singletons', _singleton_engine)],
+                                           ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS))
+    assert reference['equal'] and 1 == reference['speed_up']
+    assert not diverging['equal']
+    assert diverging['diverging_reactions'] and diverging['diverging_species'] and diverging['examples']
+
+
+# compares the engines on a synthetic model, and prints whether they agree and the species clustering
+_HARNESS = """
+import json
+from sbml_generalization.generalization.equivalence import SYNTHETIC_UB_CHEBI_IDS, compare_engines, \\
+    create_synthetic_model, reference_engine, run_engine, sequential_engine
+from sbml_generalization.generalization.sbml_generalizer import preprocess_document
+from tests.test_equivalence import create_family_ontology
+
+onto = create_family_ontology()
+doc = create_synthetic_model(onto, families=4, family_size=3)
+results = compare_engines('synthetic', doc, onto, [('reference', reference_engine), ('sequential', sequential_engine)],
+                          ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS))
+_, s_partition, _, _, _, _ = run_engine(sequential_engine, *preprocess_document(doc.clone(), onto)[1:], chebi=onto,
+                                        ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS))
+print(json.dumps([all(res['equal'] and res['stable'] for res in results), sorted(sorted(clu) for clu in s_partition)]))
+"""
+
+
+def test_engines_agree_whatever_the_hash_seed():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    partitions = []
+    # the greedy covering ties used to be broken by the order of (hash-dependent) sets
+    for hash_seed in range(4):
+        env = dict(os.environ, PYTHONHASHSEED=str(hash_seed), PYTHONPATH=root)
+        output = subprocess.check_output([sys.executable, '-c', _HARNESS], cwd=root, env=env)
+        equal, s_partition = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        assert equal, 'the engines diverge with PYTHONHASHSEED=%d' % hash_seed
+        partitions.append(s_partition)
+    assert all(partitions[0] == s_partition for s_partition in partitions[1:])
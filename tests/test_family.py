@@ -0,0 +1,87 @@
+import libsbml
+
+from mod_sbml.annotation.chebi.chebi_annotator import CHEBI_PREFIX
+from mod_sbml.annotation.rdf_annotation_helper import add_annotation
+from sbml_generalization.generalization.equivalence import get_partition
+from sbml_generalization.generalization.family import generalize_models
+from sbml_generalization.generalization.sbml_generalizer import generalize_model
+from tests.conftest import create_ontology, create_model
+
+__author__ = 'anna'
+
+UB_CHEBI_IDS = {'chebi:1', 'chebi:2'}
+FAMILIES = ('sugar', 'acid', 'amine', 'alcohol')
+
+
+def create_family_ontology():
+    """
+    Creates an ontology of sugars, acids, amines (including diamines) and alcohols.
+    :return: tuple (onto, name2t_id): mod_sbml.onto.obo_ontology.Ontology, dict {term_name: term_id}
+    """
+    terms = [('chebi:0', 'chemical entity', [], [], {}),
+             ('chebi:1', 'atp', ['chebi:0'], [], {}), ('chebi:2', 'adp', ['chebi:0'], [], {}),
+             ('chebi:300', 'diamine', ['chebi:30'], [], {}),
+             ('chebi:301', 'diamine0', ['chebi:300'], [], {}), ('chebi:302', 'diamine1', ['chebi:300'], [], {})]
+    for i, family in enumerate(FAMILIES):
+        f_id = 'chebi:%d0' % (i + 1)
+        terms.append((f_id, family, ['chebi:0'], [], {}))
+        terms.extend(('chebi:%d%d' % (i + 1, j + 1), '%s%d' % (family, j), [f_id], [], {}) for j in range(3))
+    return create_ontology(terms), {name: t_id for (t_id, name, _, _, _) in terms}
+
+
+def save_family_model(tmpdir, m_id, reactions):
+    """
+    Creates a model of the given reactions, whose species are annotated with the terms of the family ontology
+    (see create_family_ontology).
+    :return: str, path to the model file
+    """
+    _, name2t_id = create_family_ontology()
+    s_ids = sorted({s_id for (_, rs, ps, _) in reactions for s_id in rs + ps})
+    doc = create_model(m_id, [('c', 'cytosol')], [(s_id, s_id, 'c') for s_id in s_ids], reactions)
+    for s in doc.getModel().getListOfSpecies():
+        add_annotation(s, libsbml.BQB_IS, name2t_id[s.getId()], CHEBI_PREFIX)
+    path = str(tmpdir.join('%s.xml' % m_id))
+    libsbml.writeSBMLToFile(doc, path)
+    return path
+
+
+def get_groups(r_id2g_eq, s_id2gr_id):
+    """
+    :return: tuple (r_partition, s_partition, s_id2term_id), the group partitions do not depend on the group ids
+    """
+    return get_partition({r_id: g_id for (r_id, (g_id, _)) in r_id2g_eq.items()}), \
+        get_partition({s_id: g_id for (s_id, (g_id, _)) in s_id2gr_id.items()}), \
+        {s_id: term.get_id() for (s_id, (_, term)) in s_id2gr_id.items()}
+
+
+def test_family_groups_match_the_separate_generalizations(tmpdir):
+    reactions = []
+    for i in range(3):
+        reactions.append(('r_sugar%d' % i, ['sugar%d' % i], ['acid%d' % i], False))
+        reactions.append(('r_amine%d' % i, ['amine%d' % i, 'atp'], ['alcohol%d' % i, 'adp'], False))
+    reactions.append(('r_sugars', ['sugar0', 'sugar1'], ['acid2'], False))
+    # the amines can only be generalized as a whole in the second model,
+    # which also converts diamines (that are amines as well), that are not in the first one
+    in_sbml_list = [save_family_model(tmpdir, 'm1', reactions + [('r_amines', ['amine0', 'amine1', 'atp'],
+                                                                  ['alcohol2', 'adp'], False)]),
+                    save_family_model(tmpdir, 'm2', reactions + [('r_diamine%d' % i, ['diamine%d' % i],
+                                                                  ['acid%d' % i], False) for i in (0, 1)])]
+
+    correspondence_tsv = str(tmpdir.join('correspondence.tsv'))
+    results = generalize_models(in_sbml_list, create_family_ontology()[0],
+                                [str(tmpdir.join('groups_%d.xml' % i)) for i in range(2)],
+                                [str(tmpdir.join('generalized_%d.xml' % i)) for i in range(2)],
+                                correspondence_tsv=correspondence_tsv, ub_chebi_ids=set(UB_CHEBI_IDS))
+    for i, (in_sbml, (r_id2g_eq, s_id2gr_id, _, ub_s_ids)) in enumerate(zip(in_sbml_list, results)):
+        expected_r_id2g_eq, expected_s_id2gr_id, _, expected_ub_s_ids = \
+            generalize_model(in_sbml, create_family_ontology()[0], str(tmpdir.join('separate_groups_%d.xml' % i)),
+                             str(tmpdir.join('separate_generalized_%d.xml' % i)), ub_chebi_ids=set(UB_CHEBI_IDS))
+        assert expected_s_id2gr_id, 'nothing got generalized'
+        assert get_groups(expected_r_id2g_eq, expected_s_id2gr_id) == get_groups(r_id2g_eq, s_id2gr_id)
+        assert set(expected_ub_s_ids) == set(ub_s_ids)
+
+    with open(correspondence_tsv) as f:
+        header, rows = f.readline().rstrip('\n').split('\t'), [line.rstrip('\n').split('\t') for line in f]
+    assert ['type', 'id', 'm1', 'm1 term', 'm2', 'm2 term'] == header
+    assert {'r_amines'} == {row[1] for row in rows if row[0] == 'reaction' and not row[4]}
+    assert {'r_diamine0', 'r_diamine1'} == {row[1] for row in rows if row[0] == 'reaction' and not row[2]}
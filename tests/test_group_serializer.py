@@ -0,0 +1,72 @@
+import json
+
+import libsbml
+import pytest
+
+from sbml_generalization.generalization.equivalence import create_synthetic_model, SYNTHETIC_UB_CHEBI_IDS
+from sbml_generalization.generalization.sbml_generalizer import generalize_model
+from sbml_generalization.sbml.group_serializer import get_sidecar_path, load_groups_sidecar
+from sbml_generalization.sbml.sbml_helper import parse_group_sbml
+from tests.test_equivalence import create_family_ontology
+
+__author__ = 'anna'
+
+
+def get_group_ids(groups):
+    """
+    :param groups: tuple (r_id2g_id, s_id2gr_id, ub_sps), see sbml_helper.parse_group_sbml
+    :return: the same groups, with the ids of the species groups' terms instead of the terms
+    """
+    r_id2g_id, s_id2gr_id, ub_sps = groups
+    return r_id2g_id, {s_id: (g_id, term.get_id() if hasattr(term, 'get_id') else term, size)
+                       for (s_id, (g_id, term, size)) in s_id2gr_id.items()}, ub_sps
+
+
+@pytest.fixture
+def generalized(tmpdir):
+    onto = create_family_ontology()
+    in_sbml, groups_sbml = str(tmpdir.join('model.xml')), str(tmpdir.join('groups.xml'))
+    libsbml.writeSBMLToFile(create_synthetic_model(onto, families=4, family_size=3), in_sbml)
+    generalize_model(in_sbml, onto, groups_sbml, str(tmpdir.join('generalized.xml')),
+                     ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS), copy_chebi=True, groups_sidecar=True)
+    return groups_sbml, onto
+
+
+def rename_reaction_groups(sidecar, name):
+    with open(sidecar) as f:
+        data = json.load(f)
+    data['groups']['name'] = [name if 'reactions' == g_type else g_name
+                              for (g_type, g_name) in zip(data['groups']['type'], data['groups']['name'])]
+    return data
+
+
+def test_valid_sidecar_is_loaded(generalized):
+    groups_sbml, onto = generalized
+    expected = get_group_ids(parse_group_sbml(groups_sbml, onto, use_sidecar=False))
+    assert expected[0] and expected[1] and expected[2], 'nothing got generalized'
+    assert expected == get_group_ids(load_groups_sidecar(groups_sbml, onto))
+
+    # the sidecar is what gets loaded, not the SBML
+    sidecar = get_sidecar_path(groups_sbml)
+    data = rename_reaction_groups(sidecar, 'from the sidecar')
+    with open(sidecar, 'w') as f:
+        json.dump(data, f)
+    assert {'from the sidecar'} == {name for (_, name, _) in parse_group_sbml(groups_sbml, onto)[0].values()}
+
+
+@pytest.mark.parametrize('change', ['stale', 'sha256', 'corrupt'])
+def test_invalid_sidecar_falls_back_to_the_sbml(generalized, change):
+    groups_sbml, onto = generalized
+    expected = get_group_ids(parse_group_sbml(groups_sbml, onto, use_sidecar=False))
+    sidecar = get_sidecar_path(groups_sbml)
+    data = rename_reaction_groups(sidecar, 'from the sidecar')
+    if 'stale' == change:
+        # the SBML has changed since the sidecar was saved
+        with open(groups_sbml, 'a') as f:
+            f.write('\n')
+    elif 'sha256' == change:
+        data['sbml_hash'] = '0' * len(data['sbml_hash'])
+    with open(sidecar, 'w') as f:
+        f.write(json.dumps(data)[:-10] if 'corrupt' == change else json.dumps(data))
+    assert load_groups_sidecar(groups_sbml, onto) is None
+    assert expected == get_group_ids(parse_group_sbml(groups_sbml, onto))
@@ -0,0 +1,42 @@
+import pytest
+
+from sbml_generalization.runner.main import get_parser, check_params
+
+__author__ = 'anna'
+
+
+def check(args):
+    parser = get_parser()
+    check_params(parser, parser.parse_args(args))
+
+
+@pytest.fixture
+def models(tmpdir):
+    paths = []
+    for name in ('a.xml', 'b.xml'):
+        path = tmpdir.join(name)
+        path.write('')
+        paths.append(str(path))
+    return paths
+
+
+def test_single_model_options_are_accepted(models, tmpdir):
+    check(['--model', models[0], '--output_model', str(tmpdir.join('out.xml')), '--time_budget', '10',
+           '--partitioned', '--low_memory'])
+
+
+@pytest.mark.parametrize('option', [['--output_model', 'out.xml'], ['--groups_model', 'groups.xml'],
+                                    ['--output_matrix', 'out.npz'], ['--time_budget', '10'],
+                                    ['--max_iterations', '2'], ['--partitioned'], ['--low_memory']])
+def test_options_ignored_by_the_family_mode_are_rejected(models, option, capsys):
+    with pytest.raises(SystemExit):
+        check(['--models'] + models + option)
+    assert 'cannot be used with --models' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('option', [['--output_model', 'out.xml'], ['--output_matrix', 'out.npz'],
+                                    ['--time_budget', '10'], ['--max_exact_cluster_size', '5']])
+def test_options_ignored_by_the_sweep_are_rejected(models, option, capsys):
+    with pytest.raises(SystemExit):
+        check(['--model', models[0], '--sweep_thresholds', '10', '20'] + option)
+    assert 'cannot be used with the sweep' in capsys.readouterr().err
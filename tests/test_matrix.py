@@ -0,0 +1,21 @@
+import pytest
+
+from sbml_generalization.sbml.matrix_serializer import save_as_matrix, load_matrix
+from tests.conftest import create_model
+
+__author__ = 'anna'
+
+
+def test_species_consumed_and_produced_by_a_reaction_gets_a_single_entry(tmpdir):
+    pytest.importorskip('numpy')
+    doc = create_model('m', [('c', 'cytosol')], [('a', 'a', 'c'), ('b', 'b', 'c')],
+                       [('r', ['a', 'a', 'b'], ['a', 'b'], False)])
+    path = str(tmpdir.join('m.npz'))
+    save_as_matrix(doc.getModel(), ['a', 'b'], ['r'], {}, {}, path)
+    matrix = load_matrix(path)
+    s = matrix['S']
+    data, indices, indptr, shape = (s.data, s.indices, s.indptr, s.shape) if hasattr(s, 'indptr') else s
+    assert (2, 1) == shape
+    assert [0, 1, 2] == list(indptr)
+    assert [0, 0] == list(indices)
+    assert [-1., 0.] == list(data)
@@ -0,0 +1,73 @@
+from sbml_generalization.generalization import model_generalizer
+from sbml_generalization.generalization.model_generalizer import maximization_step, update_onto
+from tests.conftest import create_ontology, create_model
+
+__author__ = 'anna'
+
+CLU = ('chebi:0', )
+
+
+def create_sugar_model():
+    doc = create_model('m', [('c', 'cytosol')], [('a', 'a', 'c'), ('b', 'b', 'c'), ('c', 'c', 'c')],
+                       [('r1', ['a'], ['c'], False), ('r2', ['b'], ['c'], False)])
+    return doc.getModel(), {'a': 'chebi:a', 'b': 'chebi:b', 'c': 'chebi:c'}
+
+
+def run_maximization_step(monkeypatch, maximize, cover_with_onto_terms):
+    """
+    Runs maximization_step with the given maximize and cover_with_onto_terms replacements.
+    :return: int, number of iterations
+    """
+    calls = []
+
+    def _maximize(unmapped_s_ids, model, term_id2clu, *args, **kwargs):
+        calls.append(kwargs['iteration'])
+        maximize(term_id2clu, len(calls))
+        return term_id2clu
+
+    def _cover_with_onto_terms(*args, **kwargs):
+        return cover_with_onto_terms(len(calls))
+
+    monkeypatch.setattr(model_generalizer, 'maximize', _maximize)
+    monkeypatch.setattr(model_generalizer, 'cover_with_onto_terms', _cover_with_onto_terms)
+    model, s_id2chebi_id = create_sugar_model()
+    maximization_step(model, None, s_id2chebi_id, {'chebi:a': CLU, 'chebi:b': CLU}, set(), set())
+    return len(calls)
+
+
+def test_maximization_continues_while_the_ontology_is_updated(monkeypatch):
+    # the clustering never changes, but the ontology gets updated during the first two iterations
+    assert 3 == run_maximization_step(monkeypatch, lambda term_id2clu, i: None, lambda i: i <= 2)
+
+
+def test_maximization_continues_while_the_clustering_changes(monkeypatch):
+    def maximize(term_id2clu, i):
+        if 1 == i:
+            term_id2clu['chebi:b'] = CLU + (1, )
+
+    # the ontology never gets updated, but the first iteration splits the cluster
+    assert 2 == run_maximization_step(monkeypatch, maximize, lambda i: False)
+
+
+def test_maximization_stops_at_a_fixed_point(monkeypatch):
+    assert 1 == run_maximization_step(monkeypatch, lambda term_id2clu, i: None, lambda i: False)
+
+
+def test_update_onto_invalidates_clusters_under_removed_equivalents():
+    # x and y clusters share the common ancestor a, which gets removed together with its equivalent e,
+    # an ancestor of the z cluster terms, whose common ancestor b is kept
+    onto = create_ontology([('chebi:0', 'chemical entity', [], [], {}),
+                            ('chebi:a', 'a', ['chebi:0'], [], {}),
+                            ('chebi:e', 'e', ['chebi:0'], [], {}),
+                            ('chebi:b', 'b', ['chebi:e'], [], {}),
+                            ('chebi:x1', 'x1', ['chebi:a'], [], {}), ('chebi:x2', 'x2', ['chebi:a'], [], {}),
+                            ('chebi:y1', 'y1', ['chebi:a'], [], {}), ('chebi:y2', 'y2', ['chebi:a'], [], {}),
+                            ('chebi:z1', 'z1', ['chebi:b'], [], {}), ('chebi:z2', 'z2', ['chebi:b'], [], {})])
+    onto.add_relationship('chebi:e', 'is_conjugate_base_of', 'chebi:a')
+    term_id2clu = {'chebi:x1': ('x', ), 'chebi:x2': ('x', ), 'chebi:y1': ('y', ), 'chebi:y2': ('y', ),
+                   'chebi:z1': ('z', ), 'chebi:z2': ('z', )}
+    updated, affected_clus = update_onto(onto, term_id2clu)
+    assert updated
+    assert not onto.get_term('chebi:e')
+    assert onto.get_term('chebi:b')
+    assert {('x', ), ('y', ), ('z', )} == affected_clus
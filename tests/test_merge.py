@@ -0,0 +1,55 @@
+import libsbml
+
+from sbml_generalization.generalization.shared_ontology import share_ontology
+from sbml_generalization.merge.model_merger import merge_models
+from sbml_generalization.sbml.sbml_helper import read_sbml
+from tests.conftest import create_model
+
+__author__ = 'anna'
+
+
+def save_model(tmpdir, doc):
+    path = str(tmpdir.join('%s.xml' % doc.getModel().getId()))
+    libsbml.writeSBMLToFile(doc, path)
+    return path
+
+
+def merge(tmpdir, chebi, *docs):
+    out_sbml = str(tmpdir.join('merged.xml'))
+    merge_models([save_model(tmpdir, doc) for doc in docs], out_sbml, go=chebi, chebi=chebi, deduplicate=True)
+    return read_sbml(out_sbml).getModel()
+
+
+def test_species_of_the_same_model_are_not_merged(tmpdir, small_chebi):
+    m1 = create_model('m1', [('c', 'cytosol')],
+                      [('a', 'glucose', 'c'), ('a2', 'glucose', 'c'), ('b', 'fructose', 'c')],
+                      [('r', ['a'], ['b'], False), ('r2', ['a2'], ['b'], False)])
+    m2 = create_model('m2', [('c', 'cytosol')], [('a', 'glucose', 'c'), ('b', 'fructose', 'c')],
+                      [('r', ['a'], ['b'], False)])
+    model = merge(tmpdir, small_chebi, m1, m2)
+    assert {'s_m1__a', 's_m1__a2', 's_m1__b'} == {s.getId() for s in model.getListOfSpecies()}
+    # m1's reactions have different participants, and m2's one is identical to the first of them
+    assert {'r_m1__r', 'r_m1__r2'} == {r.getId() for r in model.getListOfReactions()}
+
+
+def test_reactions_with_different_modifiers_are_not_merged(tmpdir, small_chebi):
+    docs = []
+    for m_id, modifier in (('m1', 'a'), ('m2', 'b')):
+        doc = create_model(m_id, [('c', 'cytosol')], [('a', 'glucose', 'c'), ('b', 'fructose', 'c')],
+                           [('r', ['a'], ['b'], False)])
+        doc.getModel().getReaction('r').createModifier().setSpecies(modifier)
+        docs.append(doc)
+    model = merge(tmpdir, small_chebi, *docs)
+    assert {'r_m1__r', 'r_m2__r'} == {r.getId() for r in model.getListOfReactions()}
+
+
+def test_merge_with_shared_chebi_is_the_same(tmpdir, small_chebi):
+    m1 = create_model('m1', [('c', 'cytosol')], [('a', 'glucose', 'c'), ('b', 'fructose', 'c')],
+                      [('r', ['a'], ['b'], False)])
+    m2 = create_model('m2', [('c', 'cytosol')], [('a', 'dextrose', 'c'), ('b', 'fructose', 'c')],
+                      [('r', ['a'], ['b'], False)])
+    models = [merge(tmpdir, chebi, m1, m2) for chebi in (small_chebi, share_ontology(small_chebi))]
+    # dextrose is a synonym of glucose, hence the species a are merged
+    assert {'s_m1__a', 's_m1__b'} == {s.getId() for s in models[1].getListOfSpecies()}
+    assert {s.getId() for s in models[0].getListOfSpecies()} == {s.getId() for s in models[1].getListOfSpecies()}
+    assert {r.getId() for r in models[0].getListOfReactions()} == {r.getId() for r in models[1].getListOfReactions()}
@@ -0,0 +1,69 @@
+import threading
+
+from sbml_generalization.generalization.metrics import METRICS, MetricsRegistry, SPECIES_LOOKUPS, \
+    VERTICAL_KEY_CALLS
+from sbml_generalization.generalization.progress import ProgressMonitor
+from sbml_generalization.generalization.sbml_generalizer import generalize_preprocessed_model
+from sbml_generalization.generalization.StoichiometryFixingThread import TermReactionIndex
+from sbml_generalization.generalization.vertical_key import get_vertical_key
+from tests.test_partitioned import create_two_component_model, UB_CHEBI_IDS
+
+__author__ = 'anna'
+
+
+def generalize(metrics=None, partitioned=False):
+    doc, s_id2chebi_id, onto = create_two_component_model()
+    generalize_preprocessed_model(doc.getModel(), s_id2chebi_id, None, onto, ub_chebi_ids=set(UB_CHEBI_IDS),
+                                  monitor=ProgressMonitor(metrics=metrics), partitioned=partitioned, processes=2)
+
+
+def get_enabled_registry():
+    metrics = MetricsRegistry()
+    metrics.enable()
+    return metrics
+
+
+def test_concurrent_generalizations_record_their_own_metrics():
+    expected = get_enabled_registry()
+    generalize(expected)
+    assert expected.get_snapshot()['counters'][VERTICAL_KEY_CALLS] > 0
+
+    registries = [get_enabled_registry() for _ in range(3)] + [None]
+    threads = [threading.Thread(target=generalize, args=(metrics, )) for metrics in registries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for metrics in registries[:-1]:
+        assert expected.get_snapshot() == metrics.get_snapshot()
+
+
+def test_partitioned_generalization_collects_the_workers_metrics():
+    metrics = get_enabled_registry()
+    generalize(metrics, partitioned=True)
+    counters = metrics.get_snapshot()['counters']
+    assert counters[VERTICAL_KEY_CALLS] > 0
+    assert counters[SPECIES_LOOKUPS] > 0
+
+
+def test_metrics_are_not_recorded_unless_bound():
+    metrics = get_enabled_registry()
+    METRICS.inc(VERTICAL_KEY_CALLS)
+    with METRICS.bind(metrics):
+        METRICS.inc(VERTICAL_KEY_CALLS)
+    METRICS.inc(VERTICAL_KEY_CALLS)
+    assert {VERTICAL_KEY_CALLS: 1} == metrics.get_snapshot()['counters']
+    assert METRICS.get_registry() is None
+
+
+def test_species_lookups_are_counted_where_they_happen():
+    doc, s_id2chebi_id, _ = create_two_component_model()
+    model = doc.getModel()
+    metrics = get_enabled_registry()
+    with METRICS.bind(metrics):
+        reaction_index = TermReactionIndex(model, s_id2chebi_id)
+        assert 'c' == reaction_index.get_compartment('sugar0')
+        assert {SPECIES_LOOKUPS: 1} == metrics.get_snapshot()['counters']
+        # r_amines: 3 reactants and 2 products
+        get_vertical_key(model, model.getReaction('r_amines'), {}, s_id2chebi_id, UB_CHEBI_IDS)
+    assert {SPECIES_LOOKUPS: 6, VERTICAL_KEY_CALLS: 1} == metrics.get_snapshot()['counters']
@@ -0,0 +1,77 @@
+import json
+
+import libsbml
+
+from sbml_generalization.annotation.annotation_cache import AnnotationCache
+from sbml_generalization.annotation.name_index import NameIndex
+from sbml_generalization.sbml.model_cache import ModelCache, get_sbml_model
+from tests.conftest import create_model
+
+__author__ = 'anna'
+
+
+def save_model(tmpdir):
+    path = str(tmpdir.join('m.xml'))
+    doc = create_model('m', [('c', 'cytosol')], [('a', 'glucose', 'c'), ('b', 'fructose', 'c')],
+                       [('r', ['a', 'a'], ['b'], True)])
+    libsbml.writeSBMLToFile(doc, path)
+    return path, doc
+
+
+def test_cached_model_is_stored_as_json_and_restored(tmpdir):
+    in_sbml, doc = save_model(tmpdir)
+    cache = ModelCache(str(tmpdir.join('cache')), 'v1')
+    cache.put(in_sbml, True, doc.getModel(), {'a': 'chebi:2', 'b': 'chebi:3'}, {'r'})
+
+    entries = tmpdir.join('cache').listdir()
+    assert 1 == len(entries)
+    json.loads(entries[0].read())
+
+    model, s_id2chebi_id, r_ids_to_ignore = ModelCache(str(tmpdir.join('cache')), 'v1').get(in_sbml, True)
+    assert {'a': 'chebi:2', 'b': 'chebi:3'} == s_id2chebi_id
+    assert {'r'} == r_ids_to_ignore
+    assert [('a', 'glucose', 'c'), ('b', 'fructose', 'c')] \
+        == [(s.getId(), s.getName(), s.getCompartment()) for s in model.getListOfSpecies()]
+    r = model.getReaction('r')
+    assert r.getReversible()
+    assert [('a', 1.0), ('a', 1.0)] == [(it.getSpecies(), it.getStoichiometry()) for it in r.getListOfReactants()]
+    assert [('b', 1.0)] == [(it.getSpecies(), it.getStoichiometry()) for it in r.getListOfProducts()]
+    _, sbml_model = get_sbml_model(model)
+    assert 2 == sbml_model.getNumSpecies()
+
+
+def test_model_annotated_with_other_settings_is_not_reused(tmpdir, small_chebi):
+    in_sbml, doc = save_model(tmpdir)
+    cache = ModelCache(str(tmpdir.join('cache')), 'v1')
+    index = NameIndex.from_ontology(small_chebi)
+    cache.put(in_sbml, True, doc.getModel(), {'a': 'chebi:2'}, None, name_index=index)
+
+    assert cache.get(in_sbml, True) is None
+    assert cache.get(in_sbml, True, annotation_cache=AnnotationCache(None, 'v1'), name_index=index) is None
+    other_index = NameIndex.from_ontology(small_chebi)
+    other_index.name2t_ids['sugar'] = ['chebi:3']
+    assert cache.get(in_sbml, True, name_index=other_index) is None
+    assert {'a': 'chebi:2'} == cache.get(in_sbml, True, name_index=NameIndex.from_ontology(small_chebi))[1]
+
+
+def test_ubiquitized_model_does_not_depend_on_the_cache(tmpdir, small_chebi):
+    from sbml_generalization.generalization.sbml_generalizer import ubiquitize_model
+
+    # the unused species u would be removed by the preprocessing
+    doc = create_model('m', [('c', 'cytosol')],
+                       [('a', 'dextrose', 'c'), ('b', 'fructose', 'c'), ('u', 'glucose', 'c')],
+                       [('r', ['a'], ['b'], False)])
+    in_sbml = str(tmpdir.join('m.xml'))
+    libsbml.writeSBMLToFile(doc, in_sbml)
+    cache = ModelCache(str(tmpdir.join('cache')), 'v1')
+    results = []
+    # without the cache, filling it, reusing it
+    for model_cache in (None, cache, cache):
+        groups_sbml = str(tmpdir.join('m_with_groups_%d.xml' % len(results)))
+        s_id2chebi_id, ub_s_ids = ubiquitize_model(in_sbml, small_chebi, groups_sbml, ub_chebi_ids={'chebi:3'},
+                                                   model_cache=model_cache)
+        with open(groups_sbml, 'r') as f:
+            results.append((s_id2chebi_id, set(ub_s_ids), f.read()))
+    assert {'a': 'chebi:2', 'b': 'chebi:3', 'u': 'chebi:2'} == results[0][0]
+    assert results[0][0] == cache.get_annotation(in_sbml)
+    assert results[0] == results[1] == results[2]
@@ -0,0 +1,111 @@
+import random
+
+from sbml_generalization.generalization.budget import Budget
+from sbml_generalization.generalization.equivalence import get_clustering
+from sbml_generalization.generalization.sbml_generalizer import generalize_preprocessed_model
+from tests.conftest import create_ontology, create_model
+
+__author__ = 'anna'
+
+UB_CHEBI_IDS = {'chebi:atp', 'chebi:adp'}
+
+COFACTORS = (('atp', 'adp'), ('nad', 'nadh'), ('nadp', 'nadph'), ('coa', 'accoa'))
+
+
+def create_two_component_model():
+    """
+    Creates a model of two components that are never generalized together:
+    sugars are converted into acids, and amines into alcohols (using ATP).
+    :return: tuple (model, s_id2chebi_id, onto)
+    """
+    terms = [('chebi:0', 'chemical entity', [], [], {}),
+             ('chebi:atp', 'ATP', ['chebi:0'], [], {}), ('chebi:adp', 'ADP', ['chebi:0'], [], {})]
+    species, s_id2chebi_id = [], {'atp': 'chebi:atp', 'adp': 'chebi:adp'}
+    for family in ('sugar', 'acid', 'amine', 'alcohol'):
+        terms.append(('chebi:%s' % family, family, ['chebi:0'], [], {}))
+        for i in range(3):
+            s_id = '%s%d' % (family, i)
+            terms.append(('chebi:%s' % s_id, s_id, ['chebi:%s' % family], [], {}))
+            species.append((s_id, s_id, 'c'))
+            s_id2chebi_id[s_id] = 'chebi:%s' % s_id
+    species += [('atp', 'ATP', 'c'), ('adp', 'ADP', 'c')]
+    reactions = []
+    for i in range(3):
+        reactions.append(('r_sugar%d' % i, ['sugar%d' % i], ['acid%d' % i], False))
+        reactions.append(('r_amine%d' % i, ['amine%d' % i, 'atp'], ['alcohol%d' % i, 'adp'], False))
+    # these ones prevent the families from being generalized as a whole
+    reactions.append(('r_sugars', ['sugar0', 'sugar1'], ['acid2'], False))
+    reactions.append(('r_amines', ['amine0', 'amine1', 'atp'], ['alcohol2', 'adp'], False))
+    doc = create_model('m', [('c', 'cytosol')], species, reactions)
+    return doc, s_id2chebi_id, create_ontology(terms)
+
+
+def create_random_model(seed, classes=2, families=4, family_size=3, reactions_per_cofactor=4):
+    """
+    Creates a model whose species belong to families of a few classes, and whose reactions
+    convert them using cofactors: each cofactor is used with its own species, hence its own component,
+    but the components share the families and classes.
+    :param seed: random seed
+    :return: tuple (model, s_id2chebi_id, onto)
+    """
+    rnd = random.Random(seed)
+    terms = [('chebi:0', 'chemical entity', [], [], {})]
+    species, s_id2chebi_id = [], {}
+    for s_id in (s_id for cofactor in COFACTORS for s_id in cofactor):
+        terms.append(('chebi:%s' % s_id, s_id, ['chebi:0'], [], {}))
+        species.append((s_id, s_id, 'c'))
+        s_id2chebi_id[s_id] = 'chebi:%s' % s_id
+    terms.extend(('chebi:class%d' % c, 'class %d' % c, ['chebi:0'], [], {}) for c in range(classes))
+    for f in range(families):
+        terms.append(('chebi:f%d' % f, 'family %d' % f, ['chebi:class%d' % rnd.randrange(classes)], [], {}))
+        for i in range(family_size):
+            s_id = 'f%d_%d' % (f, i)
+            terms.append(('chebi:%s' % s_id, s_id, ['chebi:f%d' % f], [], {}))
+            species.append((s_id, s_id, 'c'))
+            s_id2chebi_id[s_id] = 'chebi:%s' % s_id
+    s_ids = sorted(s_id for s_id in s_id2chebi_id if s_id.startswith('f'))
+    rnd.shuffle(s_ids)
+    reactions = []
+    for k, (substrate, product) in enumerate(COFACTORS):
+        for _ in range(reactions_per_cofactor):
+            s_id, p_id = rnd.sample(s_ids[k::len(COFACTORS)], 2)
+            reactions.append(('r%d' % len(reactions), [s_id, substrate], [p_id, product], False))
+    doc = create_model('m%d' % seed, [('c', 'cytosol')], species, reactions)
+    return doc, s_id2chebi_id, create_ontology(terms)
+
+
+def generalize_random_model(seed, partitioned):
+    doc, s_id2chebi_id, onto = create_random_model(seed)
+    ub_chebi_ids = {'chebi:%s' % s_id for cofactor in COFACTORS for s_id in cofactor}
+    r_id2clu, clu2s_ids, _, _ = generalize_preprocessed_model(doc.getModel(), s_id2chebi_id, None, onto,
+                                                              ub_chebi_ids=ub_chebi_ids, partitioned=partitioned,
+                                                              processes=2)
+    return get_clustering(r_id2clu, clu2s_ids)
+
+
+def generalize(partitioned, budget=None, max_exact_cluster_size=None):
+    doc, s_id2chebi_id, onto = create_two_component_model()
+    r_id2clu, clu2s_ids, ub_s_ids, _ = \
+        generalize_preprocessed_model(doc.getModel(), s_id2chebi_id, None, onto, ub_chebi_ids=set(UB_CHEBI_IDS),
+                                      budget=budget, partitioned=partitioned, processes=2,
+                                      max_exact_cluster_size=max_exact_cluster_size)
+    return get_clustering(r_id2clu, clu2s_ids), set(ub_s_ids)
+
+
+def test_partitioned_clustering_matches_the_monolithic_one():
+    expected = generalize(False)
+    assert expected[0][1], 'nothing got generalized'
+    assert expected == generalize(True)
+
+
+def test_partitioned_clustering_reports_the_budget_records():
+    budget = Budget()
+    generalize(True, budget, max_exact_cluster_size=1)
+    assert budget.approximated_clusters
+
+
+def test_partitioned_clustering_matches_the_monolithic_one_on_random_models():
+    for seed in range(8):
+        expected = generalize_random_model(seed, False)
+        assert next((r_ids for r_ids in expected[0] if len(r_ids) > 1), None), 'nothing got generalized'
+        assert expected == generalize_random_model(seed, True), 'the clusterings differ for seed %d' % seed
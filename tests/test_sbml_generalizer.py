@@ -0,0 +1,68 @@
+import gc
+
+import libsbml
+
+from mod_sbml.utils.misc import invert_map
+from sbml_generalization.generalization.equivalence import create_synthetic_model, SYNTHETIC_UB_CHEBI_IDS
+from sbml_generalization.generalization.sbml_generalizer import generalize_model, generalize_model_in_memory, \
+    ubiquitize_model_in_memory
+from tests.test_equivalence import create_family_ontology
+
+__author__ = 'anna'
+
+
+def get_groups(doc):
+    return {group.getId(): {it.getIdRef() for it in group.getListOfMembers()}
+            for group in doc.getModel().getPlugin('groups').getListOfGroups()}
+
+
+def test_model_is_generalized_in_memory(tmpdir):
+    onto = create_family_ontology()
+    doc = create_synthetic_model(onto, families=4, family_size=3)
+    sbml = libsbml.writeSBMLToString(doc)
+    generalized_doc, groups_doc, r_id2g_eq, s_id2gr_id, s_id2chebi_id, ub_s_ids = \
+        generalize_model_in_memory(doc, onto, ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS), copy_chebi=True)
+    # the output documents outlive the generalization's copy of the input
+    gc.collect()
+    assert sbml == libsbml.writeSBMLToString(doc)
+    assert s_id2gr_id, 'nothing got generalized'
+    assert {s_id for (s_id, chebi_id) in s_id2chebi_id.items() if chebi_id in SYNTHETIC_UB_CHEBI_IDS} == ub_s_ids
+
+    # each species group replaces its species in the generalized model, and so does each reaction group
+    model, generalized_model = doc.getModel(), generalized_doc.getModel()
+    s_ids = {s.getId() for s in generalized_model.getListOfSpecies()}
+    r_ids = {r.getId() for r in generalized_model.getListOfReactions()}
+    assert {s.getId() for s in model.getListOfSpecies()} - set(s_id2gr_id) \
+        | {g_id for (g_id, _) in s_id2gr_id.values()} == s_ids
+    assert {r.getId() for r in model.getListOfReactions()} - set(r_id2g_eq) \
+        | {g_id for (g_id, _) in r_id2g_eq.values()} == r_ids
+    for s_id, (g_id, term) in s_id2gr_id.items():
+        assert model.getSpecies(s_id).getCompartment() == generalized_model.getSpecies(g_id).getCompartment()
+        assert onto.get_term(s_id2chebi_id[s_id]).get_parent_ids() == {term.get_id()}
+
+    # the groups model marks the same groups and the ubiquitous species
+    expected = invert_map({s_id: g_id for (s_id, (g_id, _)) in s_id2gr_id.items()})
+    expected.update(invert_map({r_id: g_id for (r_id, (g_id, _)) in r_id2g_eq.items()}))
+    expected[next(group.getId() for group in groups_doc.getModel().getPlugin('groups').getListOfGroups()
+                  if 'ubiquitous species' == group.getName())] = ub_s_ids
+    assert expected == get_groups(groups_doc)
+
+    # and the same models are saved by generalize_model
+    in_sbml, groups_sbml, out_sbml = (str(tmpdir.join(it)) for it in ('model.xml', 'groups.xml', 'generalized.xml'))
+    libsbml.writeSBMLToFile(doc, in_sbml)
+    generalize_model(in_sbml, onto, groups_sbml, out_sbml, ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS), copy_chebi=True)
+    generalized_sbml, groups_sbml_str = \
+        generalize_model_in_memory(sbml, onto, ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS), copy_chebi=True,
+                                   as_string=True)[:2]
+    assert libsbml.writeSBMLToString(libsbml.readSBMLFromFile(out_sbml)) == generalized_sbml
+    assert libsbml.writeSBMLToString(libsbml.readSBMLFromFile(groups_sbml)) == groups_sbml_str
+
+
+def test_model_is_ubiquitized_in_memory():
+    onto = create_family_ontology()
+    doc = create_synthetic_model(onto, families=4, family_size=3)
+    groups_doc, s_id2chebi_id, ub_s_ids = ubiquitize_model_in_memory(doc, onto,
+                                                                     ub_chebi_ids=set(SYNTHETIC_UB_CHEBI_IDS))
+    gc.collect()
+    assert ub_s_ids and [ub_s_ids] == list(get_groups(groups_doc).values())
+    assert doc.getModel().getNumSpecies() == groups_doc.getModel().getNumSpecies()
@@ -0,0 +1,72 @@
+import tempfile
+
+import libsbml
+
+from sbml_generalization.generalization.sbml_generalizer import generalize_preprocessed_model
+from sbml_generalization.sbml.group_serializer import get_sidecar_path
+from sbml_generalization.sbml.sbml_helper import read_sbml, write_sbml, add_groups, remove_elements, \
+    save_as_comp_generalized_sbml
+from tests.conftest import create_model
+from tests.test_partitioned import create_two_component_model, UB_CHEBI_IDS
+
+__author__ = 'anna'
+
+
+def test_xz_compressed_model_is_written_and_read_back(tmpdir, monkeypatch):
+    def no_temporary_files(*args, **kwargs):
+        raise AssertionError('the SBML should be (de)compressed in memory')
+
+    for name in ('mkstemp', 'NamedTemporaryFile', 'TemporaryFile'):
+        monkeypatch.setattr(tempfile, name, no_temporary_files)
+    doc = create_model('m', [('c', 'cytosol')], [('a', 'glucose', 'c'), ('b', 'fructose', 'c')],
+                       [('r', ['a'], ['b'], False)])
+    path = str(tmpdir.join('m.xml.xz'))
+    write_sbml(doc, path)
+    assert ['m.xml.xz'] == [it.basename for it in tmpdir.listdir()]
+    model = read_sbml(path).getModel()
+    assert ['a', 'b'] == [s.getId() for s in model.getListOfSpecies()]
+    assert libsbml.writeSBMLToString(doc) == libsbml.writeSBMLToString(read_sbml(path))
+
+
+def test_no_groups_are_added_to_a_model_without_groups_extension():
+    doc = create_model('m', [('c', 'cytosol')], [('a', 'glucose', 'c')], [])
+    assert not add_groups(doc.getModel(), {'a'}, [], [])
+
+
+def test_elements_are_removed_in_bulk():
+    species = [(s_id, s_id, 'c') for s_id in 'abcdef']
+    reactions = [('r1', ['a'], ['b'], False), ('r2', ['b'], ['c'], True), ('r3', ['d'], ['e'], False),
+                 ('r4', ['c', 'f'], ['a'], False)]
+    doc = create_model('m', [('c', 'cytosol')], species, reactions)
+    model = doc.getModel()
+    # r2 and r3 go, but b (of r2) is still referenced by r1, while d and e are not referenced any more
+    assert 2 == remove_elements(model.getListOfReactions(), lambda r: r.getId() not in {'r2', 'r3'})
+    assert 2 == remove_elements(model.getListOfSpecies(), lambda s: s.getId() not in {'d', 'e'})
+    assert 0 == remove_elements(model.getListOfSpecies(), lambda s: True)
+
+    expected = create_model('m', [('c', 'cytosol')], [it for it in species if it[0] not in 'de'],
+                            [it for it in reactions if it[0] not in {'r2', 'r3'}])
+    assert libsbml.writeSBMLToString(expected) == libsbml.writeSBMLToString(doc)
+    # the kept elements are found by their ids, and so are the species their references point to
+    assert 'f' == model.getSpecies('f').getId() and model.getSpecies('d') is None
+    r4 = model.getReaction('r4')
+    assert ['c', 'f', 'a'] == [model.getSpecies(ref.getSpecies()).getId()
+                               for ref in list(r4.getListOfReactants()) + list(r4.getListOfProducts())]
+
+
+def test_low_memory_serialization_is_the_same(tmpdir):
+    outputs = []
+    for low_memory in (False, True):
+        doc, s_id2chebi_id, onto = create_two_component_model()
+        model = doc.getModel()
+        r_id2clu, clu2s_ids, ub_s_ids, onto = \
+            generalize_preprocessed_model(model, s_id2chebi_id, None, onto, ub_chebi_ids=set(UB_CHEBI_IDS))
+        out_dir = tmpdir.mkdir('low_memory' if low_memory else 'normal')
+        out_sbml, groups_sbml = str(out_dir.join('generalized.xml')), str(out_dir.join('groups.xml'))
+        r_id2g_eq, s_id2gr_id = \
+            save_as_comp_generalized_sbml(model, out_sbml, groups_sbml, r_id2clu, clu2s_ids, ub_s_ids, onto,
+                                          low_memory=low_memory, groups_sidecar=True)
+        outputs.append((r_id2g_eq, s_id2gr_id, [open(path, 'rb').read()
+                                                for path in (out_sbml, groups_sbml, get_sidecar_path(groups_sbml))]))
+    assert outputs[0][1], 'nothing got generalized'
+    assert outputs[0] == outputs[1]
@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+
+from http.client import HTTPConnection
+
+import pytest
+
+from sbml_generalization.runner.server import Job, JobManager, JobServer, JOB_GENERALIZE, STATUS_QUEUED, \
+    STATUS_RUNNING, STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED
+from tests.test_cancellation import save_model
+
+__author__ = 'anna'
+
+
+@pytest.fixture
+def server(small_chebi):
+    manager = JobManager(small_chebi, max_workers=1)
+    server = JobServer(manager, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    manager.shutdown()
+
+
+def request(server, method, path, body=None):
+    connection = HTTPConnection(*server.server_address)
+    connection.request(method, path, body=json.dumps(body) if body is not None and not isinstance(body, str)
+                       else body)
+    response = connection.getresponse()
+    result = response.status, json.loads(response.read().decode('utf-8'))
+    connection.close()
+    return result
+
+
+def add_finished_job(manager, finished):
+    job = Job(JOB_GENERALIZE, {})
+    job.status, job.finished = STATUS_DONE, finished
+    manager.jobs[job.id] = job
+    return job
+
+
+def test_non_object_job_parameters_are_rejected(server):
+    for body in ('[1, 2]', '"model.xml"', '42'):
+        code, data = request(server, 'POST', '/jobs', body)
+        assert 400 == code
+        assert 'malformed request' in data['error']
+    assert 200 == request(server, 'GET', '/health')[0]
+
+
+def test_expired_finished_jobs_are_forgotten(small_chebi):
+    manager = JobManager(small_chebi, max_workers=1, job_ttl=60)
+    old_job = add_finished_job(manager, time.time() - 120)
+    recent_job = add_finished_job(manager, time.time())
+    assert [recent_job] == manager.list()
+    assert manager.get(old_job.id) is None
+    manager.shutdown()
+
+
+def test_oldest_finished_jobs_are_forgotten(small_chebi):
+    manager = JobManager(small_chebi, max_workers=1, job_ttl=None, max_finished_jobs=2)
+    now = time.time()
+    jobs = [add_finished_job(manager, now - i) for i in range(4)]
+    assert {job.id for job in jobs[:2]} == {job.id for job in manager.list()}
+    manager.shutdown()
+
+
+def test_invalid_job_parameters_are_rejected(server, tmpdir):
+    model = save_model(tmpdir, 'm')
+    for params in ({'model': [model]}, {'model': 42}, {'type': 'merge', 'models': [1, 2], 'output_model': model},
+                   {'type': 'merge', 'models': model, 'output_model': model},
+                   {'model': model, 'ub_s_ids': 'atp'}, {'model': model, 'ub_chebi_ids': [1]},
+                   {'model': model, 'time_budget': 'long'}, {'model': model, 'time_budget': -1},
+                   {'model': model, 'max_iterations': 1.5}, {'model': model, 'max_exact_cluster_size': True},
+                   {'model': model, 'output_model': ['out.xml']}, {'model': model, 'low_memory': 'yes'},
+                   {'type': ['generalize'], 'model': model}):
+        code, data = request(server, 'POST', '/jobs', params)
+        assert 400 == code, params
+        assert data['error']
+    assert [] == request(server, 'GET', '/jobs')[1]
+
+
+def test_jobs_are_not_accepted_after_shutdown(server, tmpdir):
+    model = save_model(tmpdir, 'm')
+    server.manager.shutdown()
+    code, data = request(server, 'POST', '/jobs', {'model': model})
+    assert 503 == code
+    assert [] == request(server, 'GET', '/jobs')[1]
+
+
+def wait_for(server, job_id, statuses, timeout=60):
+    start = time.time()
+    while time.time() - start < timeout:
+        code, data = request(server, 'GET', '/jobs/%s' % job_id)
+        assert 200 == code
+        if data['status'] in statuses:
+            return data
+        time.sleep(0.05)
+    raise AssertionError('job %s did not finish in time' % job_id)
+
+
+def test_generalization_job_is_run_and_cancelled(server, tmpdir):
+    model = save_model(tmpdir, 'm')
+    code, job = request(server, 'POST', '/jobs', {'model': model, 'ub_chebi_ids': [],
+                                                  'output_model': str(tmpdir.join('generalized.xml')),
+                                                  'groups_model': str(tmpdir.join('groups.xml'))})
+    assert 202 == code
+    assert job['status'] in (STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE)
+    assert STATUS_DONE == wait_for(server, job['id'], (STATUS_DONE, STATUS_FAILED))['status']
+    code, result = request(server, 'GET', '/jobs/%s/result' % job['id'])
+    assert 200 == code
+    # the species are annotated by their names
+    assert {'a': 'chebi:2', 'b': 'chebi:3'} == result['s_id2chebi_id']
+    assert [] == result['ub_s_ids']
+    assert tmpdir.join('generalized.xml').exists() and tmpdir.join('groups.xml').exists()
+
+    # the only worker is kept busy, so that the next job is cancelled while queued
+    release = threading.Event()
+    server.manager.executor.submit(release.wait)
+    code, job = request(server, 'POST', '/jobs', {'model': model, 'output_model': str(tmpdir.join('cancelled.xml'))})
+    assert 202 == code
+    assert 202 == request(server, 'DELETE', '/jobs/%s' % job['id'])[0]
+    release.set()
+    assert STATUS_CANCELLED == wait_for(server, job['id'], (STATUS_DONE, STATUS_CANCELLED, STATUS_FAILED))['status']
+    assert 409 == request(server, 'GET', '/jobs/%s/result' % job['id'])[0]
+    assert not tmpdir.join('cancelled.xml').exists()
+    assert 404 == request(server, 'DELETE', '/jobs/unknown')[0]
@@ -0,0 +1,123 @@
+import gc
+
+import pytest
+
+from mod_sbml.annotation.chebi.chebi_annotator import EQUIVALENT_RELATIONSHIPS
+
+from sbml_generalization.generalization.equivalence import get_clustering
+from sbml_generalization.generalization.onto_filter import copy_filtered_ontology
+from sbml_generalization.generalization.sbml_generalizer import generalize_preprocessed_model
+from sbml_generalization.generalization.shared_ontology import share_ontology, load_shared_ontology
+from sbml_generalization.generalization.workers import can_fork, fork_pool
+from tests.conftest import create_ontology
+from tests.test_partitioned import create_two_component_model, UB_CHEBI_IDS
+
+__author__ = 'anna'
+
+
+def create_acid_ontology():
+    onto = create_ontology([('chebi:0', 'chemical entity', [], [], {}),
+                            ('chebi:1', 'acid', ['chebi:0'], [], {}),
+                            ('chebi:2', 'acetic acid', ['chebi:1'], ['ethanoic acid'], {'KEGG COMPOUND': 'C00033'}),
+                            ('chebi:3', 'acetate', ['chebi:0'], [], {}),
+                            ('chebi:4', 'lactic acid', ['chebi:1', 'chebi:2'], [], {}),
+                            ('chebi:5', 'water', ['chebi:0'], [], {})])
+    onto.get_term('chebi:2').add_alt_id('chebi:20')
+    onto.alt_id2term['chebi:20'] = onto.get_term('chebi:2')
+    onto.add_relationship('chebi:2', 'is_conjugate_acid_of', 'chebi:3')
+    onto.add_relationship('chebi:3', 'is_conjugate_base_of', 'chebi:2')
+    return onto
+
+
+def get_signature(onto):
+    return {t.get_id(): (t.get_name(), t.get_parent_ids(), t.altIds, t.get_synonyms(), dict(t.xrefs))
+            for t in onto.get_all_terms()}, \
+           {key: set(rels) for (key, rels) in onto.rel_map.items() if rels}, \
+           {key: set(t_ids) for (key, t_ids) in onto.parent2children.items() if t_ids}, \
+           {t.get_id() for t in onto.get_roots()}
+
+
+def get_id(term):
+    return term.get_id() if term else None
+
+
+def test_shared_ontology_is_looked_up_as_the_original():
+    onto = create_acid_ontology()
+    shared = share_ontology(onto)
+    assert get_signature(onto) == get_signature(shared)
+    for key in ('chebi:2', 'CHEBI:20', 'ethanoic acid', 'Acetic acid', 'c00033', 'kegg.compound:c00033',
+                'lactic acid', 'unknown'):
+        assert get_id(onto.get_term(key, check_only_ids=False)) == \
+               get_id(shared.get_term(key, check_only_ids=False))
+    assert shared.get_term('acetic acid') is None
+    assert {'chebi:2', 'chebi:4'} == shared.get_descendants('chebi:1', False)
+    assert set() == shared.get_descendants('chebi:5')
+    for t in onto.get_all_terms():
+        assert sorted(onto.get_level(t)) == sorted(shared.get_level(shared.get_term(t.get_id())))
+    assert {t.get_id() for t in onto.get_sub_tree(onto.get_term('chebi:3'), EQUIVALENT_RELATIONSHIPS)} == \
+           {t.get_id() for t in shared.get_sub_tree(shared.get_term('chebi:3'), EQUIVALENT_RELATIONSHIPS)}
+
+
+def test_shared_ontology_is_read_only():
+    shared = share_ontology(create_acid_ontology())
+    with pytest.raises(TypeError):
+        shared.remove_term(shared.get_term('chebi:5'))
+    with pytest.raises(TypeError):
+        shared.get_term('chebi:5').add_parent('chebi:1')
+    assert not shared.get_term('chebi:5').get_parent_ids() & {'chebi:1'}
+
+
+def test_filtered_copy_of_shared_ontology_is_the_same(tmpdir):
+    onto = create_acid_ontology()
+    path = str(tmpdir.join('chebi.shared'))
+    share_ontology(onto, path).close()
+    shared = load_shared_ontology(path)
+    for t_ids in (['chebi:3'], ['chebi:5'], ['chebi:4', 'chebi:5']):
+        expected = copy_filtered_ontology(onto, [onto.get_term(t_id) for t_id in t_ids],
+                                          EQUIVALENT_RELATIONSHIPS, min_deepness=3)
+        assert get_signature(expected) == \
+               get_signature(copy_filtered_ontology(shared, [shared.get_term(t_id) for t_id in t_ids],
+                                                    EQUIVALENT_RELATIONSHIPS, min_deepness=3))
+
+
+def _get_name(t_id):
+    return _shared.get_term(t_id).get_name()
+
+
+_shared = None
+
+
+@pytest.mark.skipif(not can_fork(), reason="the workers cannot be forked")
+def test_forked_workers_read_the_shared_ontology():
+    global _shared
+
+    _shared = share_ontology(create_acid_ontology())
+    try:
+        with fork_pool(2) as pool:
+            assert ['acid', 'water'] == pool.map(_get_name, ['chebi:1', 'chebi:5'])
+    finally:
+        _shared = None
+
+
+def _get_freeze_count(_):
+    return gc.get_freeze_count()
+
+
+@pytest.mark.skipif(not can_fork(), reason="the workers cannot be forked")
+def test_forked_workers_do_not_collect_the_parent_objects():
+    onto = create_acid_ontology()
+    with fork_pool(2, maxtasksperchild=1) as pool:
+        assert min(pool.map(_get_freeze_count, range(4), chunksize=1)) > len(onto)
+    assert 0 == gc.get_freeze_count()
+
+
+def test_generalization_with_shared_ontology_is_the_same():
+    results = []
+    for share in (False, True):
+        doc, s_id2chebi_id, onto = create_two_component_model()
+        r_id2clu, clu2s_ids, ub_s_ids, _ = \
+            generalize_preprocessed_model(doc.getModel(), s_id2chebi_id, None,
+                                          share_ontology(onto) if share else onto, ub_chebi_ids=set(UB_CHEBI_IDS))
+        results.append((get_clustering(r_id2clu, clu2s_ids), set(ub_s_ids)))
+    assert results[0][0][1], 'nothing got generalized'
+    assert results[0] == results[1]
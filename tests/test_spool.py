@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+
+import pytest
+
+from sbml_generalization.runner.spool import submit_job, claim_job, finish_job, recover_stale_jobs, get_jobs, \
+    get_output_paths, LeaseLost, STATUS_DONE
+
+__author__ = 'anna'
+
+
+def run_fake_job(job, content):
+    for _, lease_path in get_output_paths(job):
+        with open(lease_path, 'w') as f:
+            f.write(content)
+
+
+def work_without_generalizing(args):
+    spool_dir, worker_id = args
+    n = 0
+    while True:
+        recover_stale_jobs(spool_dir)
+        job = claim_job(spool_dir, worker_id)
+        if not job:
+            return n
+        run_fake_job(job, worker_id)
+        finish_job(spool_dir, job, worker_id, result={'worker': worker_id})
+        n += 1
+
+
+def submit_jobs(tmpdir, n):
+    spool_dir = str(tmpdir.join('spool'))
+    for i in range(n):
+        submit_job(spool_dir, str(tmpdir.join('m%d.xml' % i)), groups_sidecar=True)
+    return spool_dir
+
+
+def test_each_job_is_run_once_by_concurrent_workers(tmpdir):
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        pytest.skip("the worker processes cannot be forked")
+    spool_dir = submit_jobs(tmpdir, 12)
+    pool = multiprocessing.get_context('fork').Pool(3)
+    try:
+        counts = pool.map(work_without_generalizing, [(spool_dir, 'w%d' % i) for i in range(3)], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    assert 12 == sum(counts)
+    jobs = get_jobs(spool_dir)
+    assert [STATUS_DONE] * 12 == [job['status'] for job in jobs]
+    for job in jobs:
+        for path, lease_path in get_output_paths(job):
+            assert not os.path.exists(lease_path)
+            with open(path, 'r') as f:
+                assert job['result']['worker'] == f.read()
+    assert not os.listdir(os.path.join(spool_dir, 'running'))
+    assert not os.listdir(os.path.join(spool_dir, 'tmp'))
+
+
+def test_worker_that_lost_the_lease_does_not_overwrite_the_outputs(tmpdir):
+    spool_dir = submit_jobs(tmpdir, 1)
+    stale_job = claim_job(spool_dir, 'stale')
+    # the lease of the stale worker expires, and the job is taken over
+    assert [stale_job['id']] == recover_stale_jobs(spool_dir, lease_timeout=0)
+    job = claim_job(spool_dir, 'new')
+    run_fake_job(stale_job, 'stale')
+    run_fake_job(job, 'new')
+
+    with pytest.raises(LeaseLost):
+        finish_job(spool_dir, stale_job, 'stale')
+    finish_job(spool_dir, job, 'new')
+    for path, lease_path in get_output_paths(job) + get_output_paths(stale_job):
+        assert not os.path.exists(lease_path)
+        with open(path, 'r') as f:
+            assert 'new' == f.read()
+    assert [(STATUS_DONE, 'new', 2)] == [(it['status'], it['worker'], it['attempts']) for it in get_jobs(spool_dir)]
@@ -0,0 +1,102 @@
+from itertools import chain
+import random
+
+from sbml_generalization.generalization import StoichiometryFixingThread as StoichiometryFixingThread_module
+from sbml_generalization.generalization.StoichiometryFixingThread import StoichiometryFixingThread, get_key_holes, \
+    infer_term_clusters, TermReactionIndex, colour_conflict_graph
+from sbml_generalization.generalization.model_generalizer import fix_stoichiometry
+from tests.conftest import create_model, create_ontology
+
+__author__ = 'anna'
+
+
+def test_dominated_candidate_sets_are_pruned():
+    conflicts = [{'a', 'c'}]
+    set2score = {('a', ): (3, 2), ('b', ): (3, 2), ('c', ): (3, 2),
+                 # contained in a conflict-free set scored as high
+                 ('a', 'b'): (3, 1),
+                 ('a', 'b', 'd'): (3, 1),
+                 # contained in a better scored set, but a conflicting one
+                 ('b', 'c'): (3, 0),
+                 ('a', 'b', 'c'): (3, 1),
+                 # contained in a worse scored set
+                 ('b', 'd'): (3, 2)}
+    psi = StoichiometryFixingThread.prune_dominated_sets(set2score, conflicts)
+    assert {('a', ), ('b', ), ('c', ), ('a', 'b', 'd'), ('b', 'c'), ('b', 'd')} == psi
+
+
+CLU = ('chebi:sugar', )
+
+
+def test_key_holes_remove_at_most_one_cluster_per_side():
+    other_clu = ('chebi:acid', )
+    vk = ((('chebi:atp', 'c'), ), (), ((CLU, 'c'), (('x', ), 'c')), ((other_clu, 'c'), ))
+    assert {((('chebi:atp', 'c'), ), (), ((('x', ), 'c'), ), ((other_clu, 'c'), ), True, False): ((CLU, 'c'), None),
+            ((('chebi:atp', 'c'), ), (), ((CLU, 'c'), (('x', ), 'c')), (), False, True): (None, (other_clu, 'c')),
+            ((('chebi:atp', 'c'), ), (), ((('x', ), 'c'), ), (), True, True): ((CLU, 'c'), (other_clu, 'c'))} \
+        == dict(get_key_holes(vk, {CLU, other_clu}))
+    # only the given clusters can be removed
+    assert [((('chebi:atp', 'c'), ), (), ((('x', ), 'c'), ), ((other_clu, 'c'), ), True, False)] \
+        == [hole for (hole, _) in get_key_holes(vk, {CLU})]
+
+
+def infer(u_compartment='c', reactions=()):
+    """
+    Puts the unmapped metabolite u, which reacts as the sugars s1 and s2 do, into the sugar cluster.
+    :param u_compartment: compartment of u
+    :param reactions: additional reactions
+    :return: dict {term_id: cluster} for the terms that were put into clusters
+    """
+    doc = create_model('m', [('c', 'cytosol'), ('m', 'mitochondrion')],
+                       [('s1', 's1', 'c'), ('s2', 's2', 'c'), ('u', 'u', u_compartment), ('a', 'a', 'c'),
+                        ('b', 'b', 'c')],
+                       [('r1', ['s1', 'a'], ['b'], False), ('r2', ['s2', 'a'], ['b'], False),
+                        ('r3', ['u', 'a'], ['b'], False)] + list(reactions))
+    model = doc.getModel()
+    s_id2term_id = {'s1': 'chebi:s1', 's2': 'chebi:s2', 'a': 'chebi:a', 'b': 'chebi:b'}
+    s_id2clu = {'s1': ('c', CLU), 's2': ('c', CLU)}
+    return infer_term_clusters(model, {'u'}, {CLU: {'chebi:s1', 'chebi:s2'}}, s_id2clu, s_id2term_id, set(),
+                               TermReactionIndex(model, s_id2term_id))
+
+
+def test_unmapped_metabolite_joins_the_cluster_it_can_replace():
+    assert {'u': CLU} == infer()
+
+
+def test_unmapped_metabolite_does_not_replace_a_cluster_of_another_compartment():
+    assert {} == infer(u_compartment='m')
+
+
+def test_unmapped_metabolite_does_not_join_the_cluster_it_reacts_with():
+    assert {} == infer(reactions=[('r4', ['u', 's1'], ['b'], False)])
+
+
+def test_conflict_graph_colouring_never_groups_conflicting_terms():
+    rnd = random.Random(0)
+    t_ids = ['t%d' % i for i in range(30)]
+    for _ in range(20):
+        conflicts = [set(rnd.sample(t_ids, rnd.randint(2, 5))) for _ in range(rnd.randint(1, 40))]
+        groups = colour_conflict_graph(t_ids, conflicts)
+        # each term is in exactly one group
+        assert sorted(t_ids) == sorted(chain(*groups))
+        for group in groups:
+            assert all(len(group & c_ts) <= 1 for c_ts in conflicts)
+
+
+def test_oversized_clusters_are_split_approximately_without_a_budget(monkeypatch):
+    coloured = []
+
+    def _colour_conflict_graph(t_ids, conflicts):
+        coloured.append(set(t_ids))
+        return colour_conflict_graph(t_ids, conflicts)
+
+    monkeypatch.setattr(StoichiometryFixingThread_module, 'colour_conflict_graph', _colour_conflict_graph)
+    onto = create_ontology([('chebi:0', 'chemical entity', [], [], {}), ('chebi:sugar', 'sugar', ['chebi:0'], [], {})]
+                           + [('chebi:s%d' % i, 's%d' % i, ['chebi:sugar'], [], {}) for i in range(1, 4)])
+    doc = create_model('m', [('c', 'cytosol')], [('s%d' % i, 's%d' % i, 'c') for i in range(1, 4)],
+                       [('r1', ['s1', 's2'], ['s3'], False)])
+    s_id2term_id = {'s%d' % i: 'chebi:s%d' % i for i in range(1, 4)}
+    term_id2clu = {t_id: CLU for t_id in s_id2term_id.values()}
+    fix_stoichiometry(doc.getModel(), term_id2clu, s_id2term_id, set(), onto, max_exact_cluster_size=2)
+    assert [{'chebi:s1', 'chebi:s2', 'chebi:s3'}] == coloured
+    assert 3 == len(set(term_id2clu.values()))
@@ -0,0 +1,43 @@
+import libsbml
+
+from sbml_generalization.generalization import model_generalizer, sweep
+from sbml_generalization.generalization.equivalence import create_synthetic_model
+from sbml_generalization.generalization.sbml_generalizer import generalize_model, get_ubiquitous_threshold
+from sbml_generalization.generalization.sweep import sweep_ubiquitous
+
+__author__ = 'anna'
+
+
+def test_sweep_settings_match_the_generalization(tmpdir, chebi):
+    in_sbml = str(tmpdir.join('model.xml'))
+    doc = create_synthetic_model(chebi, 3, 2, 1)
+    libsbml.writeSBMLToFile(doc, in_sbml)
+    threshold = get_ubiquitous_threshold(doc.getModel())
+
+    # the same setting several times: the workers should not reuse an ontology modified by a previous setting
+    results = sweep_ubiquitous(in_sbml, chebi, thresholds=[threshold] * 3, processes=2)
+    r_id2g_eq, s_id2gr_id, _, ub_s_ids = \
+        generalize_model(in_sbml, chebi, str(tmpdir.join('groups.xml')), str(tmpdir.join('generalized.xml')),
+                         ub_chebi_ids={'chebi:ch'}, copy_chebi=True)
+    s_num, r_num = doc.getModel().getNumSpecies(), doc.getModel().getNumReactions()
+    expected = (len(ub_s_ids),
+                s_num - len(s_id2gr_id) + len({g_id for (g_id, _) in s_id2gr_id.values()}),
+                r_num - len(r_id2g_eq) + len({g_id for (g_id, _) in r_id2g_eq.values()}))
+    for result in results:
+        assert expected == (result['ub_species'], result['generalized_species'], result['generalized_reactions'])
+
+
+def test_sweep_calculates_the_degree_histogram_once(tmpdir, chebi, monkeypatch):
+    in_sbml = str(tmpdir.join('model.xml'))
+    libsbml.writeSBMLToFile(create_synthetic_model(chebi, 3, 2, 1), in_sbml)
+    calls, get_histogram = [], model_generalizer.get_species_degree_histogram
+
+    def get_species_degree_histogram(*args):
+        calls.append(args)
+        return get_histogram(*args)
+
+    for module in (model_generalizer, sweep):
+        monkeypatch.setattr(module, 'get_species_degree_histogram', get_species_degree_histogram)
+    results = sweep_ubiquitous(in_sbml, chebi, thresholds=[1, 2, 3], processes=1)
+    assert 3 == len(results)
+    assert 1 == len(calls)